@@ -0,0 +1,28 @@
+"""Guaranteed delivery definitions' retry backoff
+
+Revision ID: 3b4c8f1e9a27
+Revises: 4a8a6f8d0e52
+Create Date: 2026-10-18 21:40:12.513208
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3b4c8f1e9a27'
+down_revision = '4a8a6f8d0e52'
+
+from alembic import op
+import sqlalchemy as sa
+
+# Zato
+from zato.common.odb import model
+
+def upgrade():
+    op.add_column(model.DeliveryDefinitionBase.__tablename__,
+        sa.Column('retry_backoff', sa.Float, nullable=True))
+    
+    op.add_column(model.DeliveryDefinitionBase.__tablename__,
+        sa.Column('retry_max_seconds', sa.Integer, nullable=True))
+
+def downgrade():
+    op.drop_column('delivery_def_base', 'retry_backoff')
+    op.drop_column('delivery_def_base', 'retry_max_seconds')
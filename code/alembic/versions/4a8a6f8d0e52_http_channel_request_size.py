@@ -0,0 +1,28 @@
+"""HTTP channels' request size limits and request streaming
+
+Revision ID: 4a8a6f8d0e52
+Revises: 2538d53b16c8
+Create Date: 2026-10-18 18:12:31.207411
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4a8a6f8d0e52'
+down_revision = '2538d53b16c8'
+
+from alembic import op
+import sqlalchemy as sa
+
+# Zato
+from zato.common.odb import model
+
+def upgrade():
+    op.add_column(model.HTTPSOAP.__tablename__,
+        sa.Column('max_request_size', sa.Integer, nullable=True))
+    
+    op.add_column(model.HTTPSOAP.__tablename__,
+        sa.Column('stream_request', sa.Boolean, nullable=True, default=False))
+
+def downgrade():
+    op.drop_column('http_soap', 'max_request_size')
+    op.drop_column('http_soap', 'stream_request')
@@ -0,0 +1,22 @@
+"""Index for paginating guaranteed deliveries by when they were last used
+
+Revision ID: 5e2d7a9c4b13
+Revises: 3b4c8f1e9a27
+Create Date: 2026-10-18 22:31:47.094116
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e2d7a9c4b13'
+down_revision = '3b4c8f1e9a27'
+
+from alembic import op
+
+# Zato
+from zato.common.odb import model
+
+def upgrade():
+    op.create_index('delivery_def_used_idx', model.Delivery.__tablename__, ['definition_id', 'last_used', 'id'])
+
+def downgrade():
+    op.drop_index('delivery_def_used_idx', 'delivery')
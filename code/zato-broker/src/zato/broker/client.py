@@ -13,7 +13,7 @@ import logging, time
 from traceback import format_exc
 
 # anyjson
-from anyjson import dumps, loads
+from anyjson import dumps
 
 # gevent
 from gevent import spawn
@@ -25,9 +25,12 @@ from bunch import Bunch
 import redis
 
 # Zato
-from zato.common import BROKER, ZATO_NONE
+from zato.common import BROKER, KVDB, ZATO_NONE
 from zato.common.util import new_cid, TRACE1
-from zato.common.broker_message import KEYS, MESSAGE_TYPE, TOPICS
+from zato.common.broker_message import get_connector_topic, KEYS, MESSAGE_TYPE, TOPICS
+from zato.broker.codec import decode, get_codec
+from zato.broker.pool import HandlerPool
+from zato.broker.work_queue import WorkQueue
 
 logger = logging.getLogger(__name__)
 
@@ -36,7 +39,8 @@ NEEDS_TMP_KEY = [v for k,v in TOPICS.items() if k in(
     MESSAGE_TYPE.TO_PARALLEL_ANY,
 )]
 
-def BrokerClient(kvdb, client_type, topic_callbacks):
+def BrokerClient(kvdb, client_type, topic_callbacks, work_queue=False, requeue_after=BROKER.WORK_QUEUE_REQUEUE_AFTER,
+        codec=BROKER.DEFAULT_CODEC, pool_size=BROKER.DEFAULT_POOL_SIZE):
     
     # Imported here so it's guaranteed to be monkey-patched using gevent.monkey.patch_all by whoever called us
     from thread import start_new_thread
@@ -77,7 +81,7 @@ def BrokerClient(kvdb, client_type, topic_callbacks):
                 
         def publish(self, topic, msg):
             if logger.isEnabledFor(TRACE1):
-                logger.log(TRACE1, 'Publishing [{}] to [{}]'.format(msg, topic))
+                logger.log(TRACE1, 'Publishing [{!r}] to [{}]'.format(msg, topic))
             return self.client.publish(topic, msg)
         
         def close(self):
@@ -106,12 +110,30 @@ def BrokerClient(kvdb, client_type, topic_callbacks):
            that bad as it may seem, there will be at most as many clients as there
            are servers in the cluster and truth to be told, Zero MQ < 3.x also would
            do client-side PUB/SUB filtering and it did scale nicely.
+           
+           Alternatively, with work_queue set, 3) is done by means of a WorkQueue
+           - each message is handed out to exactly one client and no one
+           needs to be woken up only to find out someone else got it first.
+           
+        Messages are encoded with the codec of a given name and decoded with whichever
+        one they were encoded with, see zato.broker.codec.
+        
+        Callbacks are run in a pool of at most pool_size greenlets. Once it's full, no more
+        messages are read off the KVDB until there's room in the pool again, and statistics
+        of the pool are periodically stored in the KVDB, see zato.broker.pool.
         """
-        def __init__(self, kvdb, client_type, topic_callbacks):
+        def __init__(self, kvdb, client_type, topic_callbacks, work_queue, requeue_after, codec, pool_size):
             self.kvdb = kvdb
             self.decrypt_func = kvdb.decrypt_func
             self.name = '{}-{}'.format(client_type, new_cid())
             self.topic_callbacks = topic_callbacks
+            self.use_work_queue = work_queue
+            self.requeue_after = requeue_after
+            self.work_queue = None # For producing messages
+            self.work_queue_consumer = None
+            self.codec = get_codec(codec)
+            self.pool = HandlerPool(pool_size)
+            self.keep_running = True
             
         def run(self):
             logger.info('Starting broker client, host:[{}], port:[{}], name:[{}], topics:[{}]'.format(
@@ -126,22 +148,78 @@ def BrokerClient(kvdb, client_type, topic_callbacks):
             for client in(self.pub_client, self.sub_client):
                 while client.keep_running == ZATO_NONE:
                     time.sleep(0.01)
+                    
+            spawn(self.report_pool_stats)
+                    
+            if self.use_work_queue:
+                self.work_queue = WorkQueue(self.kvdb.conn)
+                
+                # Only clients which are interested in such messages consume them
+                if TOPICS[MESSAGE_TYPE.TO_PARALLEL_ANY] in self.topic_callbacks:
+                    start_new_thread(self.consume_work_queue)
+                    
+        def consume_work_queue(self):
+            
+            # Blocking reads need a connection of their own
+            kvdb = self.kvdb.copy()
+            kvdb.init()
+            
+            self.work_queue_consumer = WorkQueue(kvdb.conn, self.name, self.requeue_after)
+            self.work_queue_consumer.consume(self.on_work_queue_message, self.pool.wait_available)
+            
+        def on_work_queue_message(self, msg, item):
+            payload = Bunch(decode(msg))
+            payload.dequeued = time.time()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('Got work queue message payload [{}]'.format(payload))
+                
+            self.pool.spawn(self._handle_work_queue_message, payload, item)
             
-        def publish(self, msg, msg_type=MESSAGE_TYPE.TO_PARALLEL_ALL):
+        def _handle_work_queue_message(self, payload, item):
+            try:
+                self.topic_callbacks[TOPICS[MESSAGE_TYPE.TO_PARALLEL_ANY]](payload)
+            finally:
+                # Acked even if the callback failed - the message has been processed
+                # and requeueing it would only make it fail again.
+                self.work_queue_consumer.ack(item)
+                
+        def report_pool_stats(self):
+            """ Stores statistics of the pool of message handlers in the KVDB every POOL_STATS_INTERVAL seconds.
+            """
+            while self.keep_running:
+                time.sleep(BROKER.POOL_STATS_INTERVAL)
+                
+                stats = self.pool.get_stats()
+                stats['reported'] = time.time()
+                
+                try:
+                    self.kvdb.conn.hset(KVDB.BROKER_POOL_STATS, self.name, dumps(stats))
+                except Exception, e:
+                    logger.warn('Could not store statistics of the pool, e:[{}]'.format(format_exc(e)))
+            
+        def publish(self, msg, msg_type=MESSAGE_TYPE.TO_PARALLEL_ALL, connector_name=None):
+            """ Publishes a message on a topic of its type or, if connector_name is given,
+            on the topic of the connector of that connection only.
+            """
             msg['msg_type'] = msg_type
-            topic = TOPICS[msg_type]
-            self.pub_client.publish(topic, dumps(msg))
+            topic = get_connector_topic(msg_type, connector_name) if connector_name else TOPICS[msg_type]
+            self.pub_client.publish(topic, self.codec.encode(msg))
             
         def invoke_async(self, msg, msg_type=MESSAGE_TYPE.TO_PARALLEL_ANY, expiration=BROKER.DEFAULT_EXPIRATION):
             msg['msg_type'] = msg_type
+            msg['enqueued'] = time.time() # Along with 'dequeued' and 'started', see zato.server.stats.QueueStats
             
             try:
-                msg = dumps(msg)
+                msg = self.codec.encode(msg)
             except Exception, e:
-                error_msg = 'JSON serialization failed for msg:[%r], e:[%s]'
+                error_msg = 'Serialization failed for msg:[%r], e:[%s]'
                 logger.error(error_msg, msg, format_exc(e))
                 raise
             else:
+                if self.work_queue and msg_type == MESSAGE_TYPE.TO_PARALLEL_ANY:
+                    self.work_queue.put(str(msg), expiration)
+                    return
+                    
                 topic = TOPICS[msg_type]
                 key = broker_msg = b'zato:broker{}:{}'.format(KEYS[msg_type], new_cid())
                 
@@ -173,29 +251,36 @@ def BrokerClient(kvdb, client_type, topic_callbacks):
                         if not payload:
                             logger.warning('No KVDB payload for key [{}] (already expired?)'.format(tmp_key))
                         else:
-                            payload = loads(payload)
+                            payload = decode(payload)
                 else:
-                    payload = loads(msg.data)
+                    payload = decode(msg.data)
                     
                 if payload:
                     payload = Bunch(payload)
+                    payload.dequeued = time.time()
                     if logger.isEnabledFor(logging.DEBUG):
                         logger.debug('Got broker message payload [{}]'.format(payload))
                         
+                    # Blocks if the pool is full so no more messages are read until there's room for them
                     callback = self.topic_callbacks[msg.channel]
-                    spawn(callback, payload)
+                    self.pool.spawn(callback, payload)
                 
                 else:
                     if logger.isEnabledFor(logging.DEBUG):
                         logger.debug('No payload in msg:[{}]'.format(msg))
     
         def close(self):
+            self.keep_running = False
+            
+            if self.work_queue_consumer:
+                self.work_queue_consumer.close()
+                
             for client in(self.pub_client, self.sub_client):
                 client.keep_running = False
                 client.kvdb.close()
 
 
-    client = _BrokerClient(kvdb, client_type, topic_callbacks)
+    client = _BrokerClient(kvdb, client_type, topic_callbacks, work_queue, requeue_after, codec, pool_size)
     start_new_thread(client.run)
     
     return client
\ No newline at end of file
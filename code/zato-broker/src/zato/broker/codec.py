@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2013 Dariusz Suchojad <dsuch at zato.io>
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# anyjson
+from anyjson import dumps, loads
+
+# msgpack
+import msgpack
+
+class JSONCodec(object):
+    """ Encodes broker messages as JSON documents without any prefix, which is what
+    all the servers and connectors understand, including ones that don't know about codecs.
+    """
+    name = 'json'
+
+    def encode(self, msg):
+        return dumps(msg)
+
+    def decode(self, data):
+        return loads(data)
+
+class MsgPackCodec(object):
+    """ Encodes broker messages with MessagePack, which is more compact and cheaper
+    to encode and decode than JSON. Each message is prefixed with a version byte
+    so it can be told apart from JSON ones, all of which begin with '{'.
+    """
+    name = 'msgpack'
+    version = b'\x01'
+
+    def encode(self, msg):
+        return self.version + msgpack.packb(msg)
+
+    def decode(self, data):
+        # Strings are decoded into unicode objects, just like the JSON codec does
+        return msgpack.unpackb(data[1:], encoding='utf-8')
+
+CODECS = dict((codec.name, codec()) for codec in (JSONCodec, MsgPackCodec))
+
+# Version bytes -> codecs messages prefixed with them are decoded with
+DECODERS = {
+    MsgPackCodec.version: CODECS[MsgPackCodec.name],
+}
+
+def get_codec(name):
+    """ Returns a codec by its name, as configured in server.conf's [broker] codec.
+    """
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError('Unknown broker codec [{}], expected one of {}'.format(name, sorted(CODECS)))
+
+def decode(data):
+    """ Decodes a broker message regardless of the codec it was encoded with, which means
+    servers in a cluster can be switched over to another codec one by one.
+    """
+    return DECODERS.get(data[:1], CODECS[JSONCodec.name]).decode(data)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2013 Dariusz Suchojad <dsuch at zato.io>
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# stdlib
+from time import time
+
+# gevent
+from gevent.event import Event
+from gevent.pool import Pool
+
+class HandlerPool(object):
+    """ A pool of at most size greenlets handling messages received from the broker.
+    Spawning a handler blocks if the pool is full so whoever reads messages off the KVDB
+    stops doing it until one of the handlers already running completes.
+
+    Keeps statistics of how many handlers were running at most and how long messages
+    waited for a handler since the last time the statistics were returned.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.pool = Pool(size)
+        self.available = Event()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.handled = 0
+        self.max_busy = 0
+        self.wait_time_total = 0.0 # In seconds
+        self.wait_time_max = 0.0 # Ditto
+
+    def wait_available(self, timeout=None):
+        """ Blocks until there's room for one more handler, for no longer than timeout seconds
+        if it's given. Returns whether there's room now.
+        """
+        deadline = None if timeout is None else time() + timeout
+
+        while self.pool.full():
+            remaining = None if deadline is None else deadline - time()
+            if remaining is not None and remaining <= 0:
+                return False
+
+            self.available.clear()
+            self.available.wait(remaining)
+
+        return True
+
+    def spawn(self, func, *args):
+        """ Runs func with args in a greenlet of its own once there's room for it in the pool.
+        """
+        greenlet = self.pool.spawn(self._run, time(), func, *args)
+
+        # Linked after the pool itself has been so it's already made room for another handler
+        greenlet.rawlink(self._on_done)
+
+    def _run(self, received, func, *args):
+        wait_time = time() - received
+
+        self.handled += 1
+        self.wait_time_total += wait_time
+        self.wait_time_max = max(self.wait_time_max, wait_time)
+        self.max_busy = max(self.max_busy, len(self.pool))
+
+        return func(*args)
+
+    def _on_done(self, greenlet):
+        self.available.set()
+
+    def get_stats(self):
+        """ Returns statistics of the pool since the last time they were returned.
+        """
+        stats = {
+            'size': self.size,
+            'busy': len(self.pool),
+            'max_busy': self.max_busy,
+            'handled': self.handled,
+            'wait_time_mean': self.wait_time_total / self.handled if self.handled else 0.0,
+            'wait_time_max': self.wait_time_max,
+        }
+        self._reset_stats()
+
+        return stats
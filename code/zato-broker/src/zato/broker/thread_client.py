@@ -13,9 +13,6 @@ import logging, time
 from threading import Thread
 from traceback import format_exc
 
-# anyjson
-from anyjson import dumps, loads
-
 # Bunch
 from bunch import Bunch
 
@@ -25,7 +22,9 @@ import redis
 # Zato
 from zato.common import BROKER, ZATO_NONE
 from zato.common.util import new_cid, TRACE1
-from zato.common.broker_message import KEYS, MESSAGE_TYPE, TOPICS
+from zato.common.broker_message import get_connector_topic, KEYS, MESSAGE_TYPE, TOPICS
+from zato.broker.codec import decode, get_codec
+from zato.broker.work_queue import WorkQueue
 
 logger = logging.getLogger(__name__)
 
@@ -69,7 +68,7 @@ class _ClientThread(Thread):
             
     def publish(self, topic, msg):
         if logger.isEnabledFor(TRACE1):
-            logger.log(TRACE1, 'Publishing [{}] to [{}]'.format(msg, topic))
+            logger.log(TRACE1, 'Publishing [{!r}] to [{}]'.format(msg, topic))
         return self.client.publish(topic, msg)
     
     def close(self):
@@ -98,13 +97,22 @@ class BrokerClient(Thread):
        that bad as it may seem, there will be at most as many clients as there
        are servers in the cluster and truth to be told, Zero MQ < 3.x also would
        do client-side PUB/SUB filtering and it did scale nicely.
+       
+       Alternatively, with work_queue set, 3) is done by means of a WorkQueue
+       - each message is handed out to exactly one parallel server. This client
+       only produces such messages, parallel servers consume them.
+       
+    Messages are encoded with the codec of a given name and decoded with whichever
+    one they were encoded with, see zato.broker.codec.
     """
-    def __init__(self, kvdb, client_type, topic_callbacks):
+    def __init__(self, kvdb, client_type, topic_callbacks, work_queue=False, codec=BROKER.DEFAULT_CODEC):
         Thread.__init__(self)
         self.kvdb = kvdb
         self.decrypt_func = kvdb.decrypt_func
         self.name = '{}-{}'.format(client_type, new_cid())
         self.topic_callbacks = topic_callbacks
+        self.work_queue = WorkQueue(kvdb.conn) if work_queue else None
+        self.codec = get_codec(codec)
         
     def run(self):
         logger.info('Starting broker client, host:[{}], port:[{}], name:[{}], topics:[{}]'.format(
@@ -120,21 +128,41 @@ class BrokerClient(Thread):
             while client.keep_running == ZATO_NONE:
                 time.sleep(0.01)
         
-    def publish(self, msg, msg_type=MESSAGE_TYPE.TO_PARALLEL_ALL):
+    def publish(self, msg, msg_type=MESSAGE_TYPE.TO_PARALLEL_ALL, connector_name=None):
+        """ Publishes a message on a topic of its type or, if connector_name is given,
+        on the topic of the connector of that connection only.
+        """
         msg['msg_type'] = msg_type
-        topic = TOPICS[msg_type]
-        self.pub_client.publish(topic, dumps(msg))
+        topic = get_connector_topic(msg_type, connector_name) if connector_name else TOPICS[msg_type]
+        self.pub_client.publish(topic, self.codec.encode(msg))
+        
+    def subscribe(self, topic, callback):
+        """ Starts receiving messages published on one more topic, once the client is already running.
+        """
+        self.topic_callbacks[topic] = callback
+        self.sub_client.client.subscribe(topic)
+        
+    def unsubscribe(self, topic):
+        """ Stops receiving messages published on a topic.
+        """
+        self.sub_client.client.unsubscribe(topic)
+        self.topic_callbacks.pop(topic, None)
         
     def invoke_async(self, msg, msg_type=MESSAGE_TYPE.TO_PARALLEL_ANY, expiration=BROKER.DEFAULT_EXPIRATION):
         msg['msg_type'] = msg_type
+        msg['enqueued'] = time.time() # Along with 'dequeued' and 'started', see zato.server.stats.QueueStats
         
         try:
-            msg = dumps(msg)
+            msg = self.codec.encode(msg)
         except Exception, e:
-            error_msg = 'JSON serialization failed for msg:[%r], e:[%s]'
+            error_msg = 'Serialization failed for msg:[%r], e:[%s]'
             logger.error(error_msg, msg, format_exc(e))
             raise
         else:
+            if self.work_queue and msg_type == MESSAGE_TYPE.TO_PARALLEL_ANY:
+                self.work_queue.put(str(msg), expiration)
+                return
+                
             topic = TOPICS[msg_type]
             key = broker_msg = b'zato:broker{}:{}'.format(KEYS[msg_type], new_cid())
             
@@ -166,20 +194,24 @@ class BrokerClient(Thread):
                     if not payload:
                         logger.warning('No KVDB payload for key [{}] (already expired?)'.format(tmp_key))
                     else:
-                        payload = loads(payload)
+                        payload = decode(payload)
             else:
-                payload = loads(msg.data)
+                payload = decode(msg.data)
+                
+            # There may still be messages in flight published on topics no longer subscribed to
+            callback = self.topic_callbacks.get(msg.channel)
                 
-            if payload:
+            if payload and callback:
                 payload = Bunch(payload)
+                payload.dequeued = time.time()
                 if logger.isEnabledFor(logging.DEBUG):
                     logger.debug('Got broker message payload [{}]'.format(payload))
                     
-                return self.topic_callbacks[msg.channel](payload)
+                return callback(payload)
             
             else:
                 if logger.isEnabledFor(logging.DEBUG):
-                    logger.debug('No payload in msg:[{}]'.format(msg))
+                    logger.debug('No payload or callback for msg:[{}]'.format(msg))
 
     def close(self):
         for client in(self.pub_client, self.sub_client):
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2013 Dariusz Suchojad <dsuch at zato.io>
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# stdlib
+import logging
+from time import sleep, time
+from traceback import format_exc
+
+# Zato
+from zato.common import BROKER, KVDB
+
+logger = logging.getLogger(__name__)
+
+class WorkQueue(object):
+    """ A reliable queue of messages each of which is to be processed by exactly one
+    consumer, as opposed to messages published on a topic all of the subscribers
+    race to claim.
+
+    Producers LPUSH messages onto a shared list. Each consumer BRPOPLPUSHes them
+    into a processing list of its own and removes them from there once they have been
+    processed. Consumers keep refreshing a key which tells others they're still alive
+    and if one of them stops doing it, whatever is left in its processing list is
+    moved back to the shared list by the janitor all the consumers run periodically.
+
+    Each message is prefixed with the time it expires at so that messages no one
+    picked up in time are dropped, just like broadcast ones are by the KVDB expiring them.
+    """
+    def __init__(self, conn, consumer_name=None, requeue_after=BROKER.WORK_QUEUE_REQUEUE_AFTER):
+        self.conn = conn
+        self.consumer_name = consumer_name
+        self.requeue_after = requeue_after # In seconds
+        self.processing_key = '{}{}'.format(KVDB.BROKER_QUEUE_PROCESSING, consumer_name)
+        self.alive_key = '{}{}'.format(KVDB.BROKER_QUEUE_CONSUMER_ALIVE, consumer_name)
+        self.keep_running = True
+
+        # Consumers wake up at least this often to tell others they're still alive
+        self.heartbeat_interval = max(int(requeue_after / 3), 1)
+        self.last_heartbeat = 0
+        self.last_janitor = 0
+
+    def put(self, msg, expiration=BROKER.DEFAULT_EXPIRATION):
+        """ Enqueues a message that will expire in expiration seconds unless a consumer picks it up.
+        """
+        self.conn.lpush(KVDB.BROKER_QUEUE, b'{}:{}'.format(int(time() + expiration), msg))
+
+    def get(self):
+        """ Blocks until there's a message to process or until it's time to send a heartbeat,
+        in which case None is returned. The message is kept in the processing list until acked.
+        """
+        return self.conn.brpoplpush(KVDB.BROKER_QUEUE, self.processing_key, self.heartbeat_interval)
+
+    def ack(self, item):
+        """ Confirms the message has been processed, item is exactly what .get returned.
+        """
+        self.conn.lrem(self.processing_key, 1, item)
+
+    def heartbeat(self):
+        """ Tells janitors the consumer is still alive. The consumer is added to the set
+        of all consumers each time because a janitor might've removed it from there
+        if the consumer was slow to send the previous heartbeat.
+        """
+        with self.conn.pipeline(transaction=False) as p:
+            p.setex(self.alive_key, self.requeue_after, 1)
+            p.sadd(KVDB.BROKER_QUEUE_CONSUMERS, self.consumer_name)
+            p.execute()
+            
+        self.last_heartbeat = time()
+
+    def requeue(self):
+        """ Moves messages held by consumers no longer alive back to the shared list.
+        Safe to run by many consumers at a time because each message is moved atomically.
+        """
+        self.last_janitor = time()
+        requeued = 0
+
+        for consumer_name in self.conn.smembers(KVDB.BROKER_QUEUE_CONSUMERS):
+            if self.conn.exists('{}{}'.format(KVDB.BROKER_QUEUE_CONSUMER_ALIVE, consumer_name)):
+                continue
+
+            processing_key = '{}{}'.format(KVDB.BROKER_QUEUE_PROCESSING, consumer_name)
+            while self.conn.rpoplpush(processing_key, KVDB.BROKER_QUEUE):
+                requeued += 1
+
+            self.conn.srem(KVDB.BROKER_QUEUE_CONSUMERS, consumer_name)
+
+        if requeued:
+            logger.warn('Requeued [%s] message(s) of consumers no longer alive', requeued)
+
+        return requeued
+
+    def parse(self, item):
+        """ Returns a message out of a queue item or None if it's already expired.
+        """
+        expires_at, msg = item.split(b':', 1)
+        if int(expires_at) < time():
+            logger.warning('Dropping an expired message [%r]', item)
+            return None
+
+        return msg
+
+    def consume(self, on_message, wait_available=None):
+        """ Invokes on_message with each message read off the queue until told to stop.
+        on_message receives the message and the queue item it should ack when done with it.
+        If given, wait_available is called with a timeout, in seconds, before each message
+        is read and no message is read unless it returns True, meaning there's someone
+        to process it. Heartbeats are sent in the meantime.
+        """
+        self.heartbeat()
+
+        while self.keep_running:
+            try:
+                if wait_available and not wait_available(self.heartbeat_interval):
+                    item = None
+                else:
+                    item = self.get()
+
+                if item:
+                    msg = self.parse(item)
+                    if msg:
+                        on_message(msg, item)
+                    else:
+                        self.ack(item)
+
+                now = time()
+
+                if now - self.last_heartbeat >= self.heartbeat_interval:
+                    self.heartbeat()
+
+                if now - self.last_janitor >= self.requeue_after:
+                    self.requeue()
+
+            except Exception, e:
+                if self.keep_running:
+                    logger.error('Could not consume a message, e:[%s]', format_exc(e))
+
+                    # Don't spin when the KVDB is down
+                    sleep(self.heartbeat_interval)
+
+    def close(self):
+        """ Stops consuming, the consumer's unacked messages are left to janitors.
+        """
+        self.keep_running = False
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2013 Dariusz Suchojad <dsuch at zato.io>
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# stdlib
+from unittest import TestCase
+
+# anyjson
+from anyjson import dumps
+
+# nose
+from nose.tools import eq_
+
+# Zato
+from zato.broker.codec import decode, get_codec, JSONCodec, MsgPackCodec
+
+MSG = {'action':'101802', 'service':'my.service', 'payload':'東京', 'expiration':15, 'enqueued':1382108400.5, 'is_active':True}
+
+class CodecTestCase(TestCase):
+
+    def test_get_codec(self):
+        self.assertIsInstance(get_codec('json'), JSONCodec)
+        self.assertIsInstance(get_codec('msgpack'), MsgPackCodec)
+        self.assertRaises(ValueError, get_codec, 'xml')
+
+    def test_round_trip(self):
+        for name in('json', 'msgpack'):
+            codec = get_codec(name)
+            data = codec.encode(MSG)
+
+            eq_(codec.decode(data), MSG)
+            eq_(decode(data), MSG)
+
+        # MessagePack strings are decoded into unicode objects rather than bytes
+        eq_(type(decode(get_codec('msgpack').encode(MSG))['payload']), unicode)
+
+    def test_decode_version(self):
+        data = get_codec('msgpack').encode(MSG)
+        eq_(data[:1], MsgPackCodec.version)
+
+        # JSON messages have no version byte, including ones from servers which don't know about codecs
+        eq_(get_codec('json').encode(MSG)[:1], b'{')
+        eq_(decode(dumps(MSG)), MSG)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2013 Dariusz Suchojad <dsuch at zato.io>
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# stdlib
+from unittest import TestCase
+
+# anyjson
+from anyjson import loads
+
+# Bunch
+from bunch import Bunch
+
+# gevent
+from gevent import get_hub, sleep, spawn
+from gevent.event import Event
+
+# mock
+from mock import patch
+
+# nose
+from nose.tools import eq_
+
+# Zato
+from zato.broker.client import BrokerClient
+from zato.broker.pool import HandlerPool
+from zato.common import BROKER, KVDB
+
+class HandlerPoolTestCase(TestCase):
+
+    def test_spawn_blocks_when_full(self):
+        pool = HandlerPool(2)
+        release = Event()
+        handled = []
+
+        def handle(idx):
+            release.wait()
+            handled.append(idx)
+
+        def spawn_all():
+            for idx in range(3):
+                pool.spawn(handle, idx)
+
+        spawner = spawn(spawn_all)
+        sleep(0.05)
+
+        # Two handlers are running and the third one is still waiting for room
+        self.assertFalse(spawner.ready())
+        eq_(len(pool.pool), 2)
+
+        release.set()
+        spawner.join(1)
+        pool.pool.join()
+
+        self.assertTrue(spawner.ready())
+        eq_(sorted(handled), [0, 1, 2])
+
+    def test_wait_available(self):
+        pool = HandlerPool(1)
+        release = Event()
+
+        # Room in the pool, no need to wait
+        self.assertTrue(pool.wait_available(0))
+
+        pool.spawn(release.wait)
+        sleep(0)
+
+        # The pool is full and no handler completes in time ..
+        self.assertFalse(pool.wait_available(0.05))
+
+        # .. but once it does, whoever waits is released.
+        spawn(release.set)
+        self.assertTrue(pool.wait_available(1))
+        eq_(len(pool.pool), 0)
+
+    def test_failed_handler(self):
+        pool = HandlerPool(1)
+
+        def handle():
+            raise Exception('Handler failed')
+
+        # gevent would print the traceback of the handler
+        with patch.object(get_hub(), 'print_exception'):
+            pool.spawn(handle)
+            self.assertTrue(pool.wait_available(1))
+
+        # The slot of the failed handler can be taken by another one
+        eq_(len(pool.pool), 0)
+
+        handled = []
+        pool.spawn(handled.append, 1)
+        pool.pool.join()
+        eq_(handled, [1])
+
+    def test_get_stats(self):
+        pool = HandlerPool(2)
+
+        for idx in range(3):
+            pool.spawn(sleep, 0.01)
+        pool.pool.join()
+
+        stats = pool.get_stats()
+        eq_(stats['size'], 2)
+        eq_(stats['busy'], 0)
+        eq_(stats['max_busy'], 2)
+        eq_(stats['handled'], 3)
+        self.assertGreater(stats['wait_time_max'], 0)
+
+        # Statistics are reset each time they're returned
+        eq_(pool.get_stats()['handled'], 0)
+
+class BrokerClientPoolStatsTestCase(TestCase):
+
+    def test_report_pool_stats(self):
+        with patch('thread.start_new_thread'):
+            client = BrokerClient(Bunch(decrypt_func=None), 'parallel', {}, pool_size=3)
+
+        stored = {}
+        client.kvdb.conn = Bunch(hset=lambda key, field, value: stored.setdefault(key, {}).__setitem__(field, value))
+
+        client.pool.spawn(sleep, 0)
+        client.pool.pool.join()
+
+        sleeps = []
+
+        def _sleep(seconds):
+            sleeps.append(seconds)
+
+            # The client stops running right after the first report
+            client.keep_running = False
+
+        with patch('zato.broker.client.time.sleep', _sleep):
+            client.report_pool_stats()
+
+        eq_(sleeps, [BROKER.POOL_STATS_INTERVAL])
+
+        stats = loads(stored[KVDB.BROKER_POOL_STATS][client.name])
+        eq_(stats['size'], 3)
+        eq_(stats['handled'], 1)
+        self.assertIn('reported', stats)
+
+    def test_report_pool_stats_kvdb_error(self):
+        with patch('thread.start_new_thread'):
+            client = BrokerClient(Bunch(decrypt_func=None), 'parallel', {})
+
+        def hset(*ignored_args):
+            client.keep_running = False
+            raise Exception('KVDB is down')
+
+        client.kvdb.conn = Bunch(hset=hset)
+
+        # The exception is only logged, statistics are never worth stopping the client over
+        with patch('zato.broker.client.time.sleep'):
+            client.report_pool_stats()
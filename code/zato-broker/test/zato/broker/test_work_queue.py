@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2013 Dariusz Suchojad <dsuch at zato.io>
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# stdlib
+from unittest import TestCase
+
+# Bunch
+from bunch import Bunch
+
+# gevent
+from gevent import get_hub, sleep, spawn
+from gevent.event import Event
+
+# mock
+from mock import patch
+
+# nose
+from nose.tools import eq_
+
+# Zato
+from zato.broker.client import BrokerClient
+from zato.broker.pool import HandlerPool
+from zato.broker.work_queue import WorkQueue
+from zato.common import KVDB
+from zato.common.broker_message import MESSAGE_TYPE, TOPICS
+from zato.common.test import rand_string
+
+class FakeConn(object):
+    """ Keeps lists, sets and keys of a KVDB in memory, the left end of each list is at index 0.
+    Blocking reads never block for longer than a moment, as though their timeout had been reached.
+    """
+    def __init__(self):
+        self.lists = {}
+        self.sets = {}
+        self.keys = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *ignored_args):
+        pass
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def execute(self):
+        pass
+
+    def lpush(self, key, value):
+        self.lists.setdefault(key, []).insert(0, value)
+
+    def rpoplpush(self, source, destination):
+        if not self.lists.get(source):
+            return None
+
+        item = self.lists[source].pop()
+        self.lpush(destination, item)
+
+        return item
+
+    def brpoplpush(self, source, destination, timeout=0):
+        item = self.rpoplpush(source, destination)
+        if item is None:
+            sleep(0.01)
+
+        return item
+
+    def lrem(self, key, count, value):
+        self.lists.get(key, []).remove(value)
+
+    def setex(self, key, time, value):
+        self.keys[key] = value
+
+    def exists(self, key):
+        return key in self.keys
+
+    def sadd(self, key, value):
+        self.sets.setdefault(key, set()).add(value)
+
+    def srem(self, key, value):
+        self.sets.get(key, set()).discard(value)
+
+    def smembers(self, key):
+        return set(self.sets.get(key, set()))
+
+class WorkQueueTestCase(TestCase):
+
+    def setUp(self):
+        self.conn = FakeConn()
+
+    def get_processing(self, consumer):
+        return self.conn.lists.get(consumer.processing_key, [])
+
+    def test_put_get_ack(self):
+        producer = WorkQueue(self.conn)
+        consumer = WorkQueue(self.conn, rand_string())
+
+        producer.put(b'msg1')
+        producer.put(b'msg2')
+
+        # Messages are consumed in the order they were put in ..
+        item = consumer.get()
+        eq_(consumer.parse(item), b'msg1')
+
+        # .. and kept in the consumer's processing list until acked.
+        eq_(self.get_processing(consumer), [item])
+        consumer.ack(item)
+        eq_(self.get_processing(consumer), [])
+
+        eq_(consumer.parse(consumer.get()), b'msg2')
+        eq_(consumer.get(), None)
+
+    def test_parse_expired(self):
+        producer = WorkQueue(self.conn)
+        consumer = WorkQueue(self.conn, rand_string())
+
+        producer.put(b'msg1:with:colons', 10)
+        eq_(consumer.parse(consumer.get()), b'msg1:with:colons')
+
+        producer.put(b'msg2', -1)
+        eq_(consumer.parse(consumer.get()), None)
+
+    def test_requeue(self):
+        producer = WorkQueue(self.conn)
+        consumer1 = WorkQueue(self.conn, rand_string())
+        consumer2 = WorkQueue(self.conn, rand_string())
+
+        consumer1.heartbeat()
+        consumer2.heartbeat()
+        eq_(self.conn.smembers(KVDB.BROKER_QUEUE_CONSUMERS), set([consumer1.consumer_name, consumer2.consumer_name]))
+
+        producer.put(b'msg1')
+        producer.put(b'msg2')
+        item1 = consumer1.get()
+        item2 = consumer2.get()
+
+        # Both consumers are alive so nothing is requeued
+        eq_(consumer2.requeue(), 0)
+        eq_(self.get_processing(consumer1), [item1])
+
+        # consumer1 stops sending heartbeats and its alive key expires
+        del self.conn.keys[consumer1.alive_key]
+
+        eq_(consumer2.requeue(), 1)
+        eq_(self.get_processing(consumer1), [])
+        eq_(self.get_processing(consumer2), [item2])
+        eq_(self.conn.smembers(KVDB.BROKER_QUEUE_CONSUMERS), set([consumer2.consumer_name]))
+
+        # The message is now handed out to a consumer that is still alive
+        eq_(consumer2.get(), item1)
+
+    def test_consume_acks_expired(self):
+        producer = WorkQueue(self.conn)
+        consumer = WorkQueue(self.conn, rand_string())
+
+        received = []
+
+        def on_message(msg, item):
+            received.append(msg)
+            consumer.ack(item)
+
+        producer.put(b'msg1', -1)
+        producer.put(b'msg2')
+
+        greenlet = spawn(consumer.consume, on_message)
+        sleep(0.1)
+        consumer.close()
+        greenlet.join()
+
+        # The expired message isn't processed but it doesn't linger in the processing list either
+        eq_(received, [b'msg2'])
+        eq_(self.get_processing(consumer), [])
+
+    def test_consume_backpressure(self):
+        producer = WorkQueue(self.conn)
+        consumer = WorkQueue(self.conn, rand_string())
+        pool = HandlerPool(1)
+        release = Event()
+        received = []
+
+        def handle(msg, item):
+            received.append(msg)
+            release.wait()
+            consumer.ack(item)
+
+        def on_message(msg, item):
+            pool.spawn(handle, msg, item)
+
+        producer.put(b'msg1')
+        producer.put(b'msg2')
+
+        greenlet = spawn(consumer.consume, on_message, pool.wait_available)
+        sleep(0.1)
+
+        # The pool is full so the other message is still in the shared list
+        eq_(received, [b'msg1'])
+        eq_(len(self.conn.lists[KVDB.BROKER_QUEUE]), 1)
+        eq_(len(self.get_processing(consumer)), 1)
+
+        release.set()
+        sleep(0.1)
+
+        consumer.close()
+        greenlet.join()
+
+        eq_(received, [b'msg1', b'msg2'])
+        eq_(self.conn.lists[KVDB.BROKER_QUEUE], [])
+        eq_(self.get_processing(consumer), [])
+
+class BrokerClientWorkQueueTestCase(TestCase):
+
+    def get_client(self, callback):
+        topic_callbacks = {TOPICS[MESSAGE_TYPE.TO_PARALLEL_ANY]: callback}
+
+        # Nothing is started in the background, the client is only created
+        with patch('thread.start_new_thread'):
+            client = BrokerClient(Bunch(decrypt_func=None), 'parallel', topic_callbacks, work_queue=True)
+
+        conn = FakeConn()
+        client.work_queue = WorkQueue(conn)
+        client.work_queue_consumer = WorkQueue(conn, client.name)
+
+        return client, conn
+
+    def test_invoke_async(self):
+        received = []
+
+        def callback(payload):
+            received.append(payload)
+            raise Exception('Handler failed')
+
+        client, conn = self.get_client(callback)
+
+        for idx in range(2):
+            client.invoke_async({'service':'my.service', 'idx':idx})
+
+        consumer = client.work_queue_consumer
+
+        # gevent would print tracebacks of handlers that failed
+        with patch.object(get_hub(), 'print_exception'):
+            for idx in range(2):
+                item = consumer.get()
+                client.on_work_queue_message(consumer.parse(item), item)
+
+            client.pool.pool.join()
+
+        eq_(sorted(payload.idx for payload in received), [0, 1])
+        for payload in received:
+            eq_(payload.service, 'my.service')
+            eq_(payload.msg_type, MESSAGE_TYPE.TO_PARALLEL_ANY)
+            self.assertLessEqual(payload.enqueued, payload.dequeued)
+
+        # Messages are acked even though their handlers failed
+        eq_(conn.lists[consumer.processing_key], [])
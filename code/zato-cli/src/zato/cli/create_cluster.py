@@ -181,6 +181,8 @@ zato_services = {
 
     # Statistics
     'zato.stats.delete':'zato.server.service.internal.stats.Delete',
+    'zato.stats.get-broker-pool':'zato.server.service.internal.stats.GetBrokerPool',
+    'zato.stats.get-by-channel':'zato.server.service.internal.stats.GetByChannel',
     'zato.stats.get-by-service':'zato.server.service.internal.stats.GetByService',
     'zato.stats.summary.get-summary-by-day':'zato.server.service.internal.stats.summary.GetSummaryByDay',
     'zato.stats.summary.get-summary-by-month':'zato.server.service.internal.stats.summary.GetSummaryByMonth',
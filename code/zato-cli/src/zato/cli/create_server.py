@@ -88,6 +88,10 @@ internal_services_may_be_deleted=False
 initial_cluster_name = {initial_cluster_name}
 initial_server_name = {initial_server_name}
 delivery_lock_timeout = 2
+delivery_write_interval = 10
+delivery_write_batch_size = 100
+delivery_write_max_pending = 1000
+service_instance_pool_size = 0
 
 [kvdb]
 host={kvdb_host}
@@ -99,6 +103,34 @@ socket_timeout=
 charset=
 errors=
 
+[stats]
+# Whether to keep service statistics in memory and flush them
+# to the KVDB in the background instead of on each invocation.
+# Usage counters services see and sample requests/responses are then only as fresh
+# as the last flush and up to flush_interval of data may be lost if a server crashes.
+buffered=False
+flush_interval=500 # In milliseconds
+flush_max_samples=1000
+pipeline_batch_size=500 # How many commands to read statistics with in one go
+delete_batch_size=1000 # How many keys to delete statistics in in one go
+# Statistics older than archive_after days are moved from the KVDB to archive_dir,
+# empty means they're not archived. Needs to be shared by all the servers in a cluster.
+archive_dir=
+archive_after=7 # In days, at least 2
+
+[broker]
+# Whether async invocations should go through a queue each message of which
+# is picked up by exactly one worker instead of being broadcast to all of them.
+# Needs to be the same on all the servers in a cluster.
+work_queue=False
+work_queue_requeue_after=60 # In seconds, after how long messages of a dead worker are requeued
+# How messages are encoded, json or msgpack. Messages encoded with either are always understood
+# so msgpack can be switched on one server at a time once all of them have been upgraded.
+codec=json
+# How many messages, e.g. async invocations, each worker may be handling at a time.
+# Once there are that many, no more messages are read until any of them has been handled.
+pool_size=1000
+
 [startup_services]
 zato.helpers.input-logger=Sample payload for a startup service
 zato.pattern.delivery.dispatch-auto-resubmit=
@@ -106,6 +138,7 @@ zato.pattern.delivery.dispatch-auto-resubmit=
 [patterns]
 delivery_auto_lock_timeout=90
 delivery_retry_threshold_multiplier=4
+delivery_purge_batch_size=1000 # How many expired deliveries to delete in one transaction
 
 [profiler]
 enabled=False
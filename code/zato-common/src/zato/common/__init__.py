@@ -113,6 +113,10 @@ DEFAULT_HTTP_PING_METHOD = 'HEAD'
 # This is a per-outconn setting
 DEFAULT_HTTP_POOL_SIZE = 200
 
+# Bodies of requests to HTTP channels which stream their requests are spilled over
+# to temporary files once they grow larger than that many bytes.
+HTTP_REQUEST_SPOOL_SIZE = 1048576 # 1 MB
+
 # Used when there's a need for encrypting/decrypting a well-known data.
 ZATO_CRYPTO_WELL_KNOWN_DATA = 'ZATO'
 
@@ -238,25 +242,55 @@ class KVDB(Attrs):
     
     SERVICE_USAGE = 'zato:stats:service:usage:'
     SERVICE_TIME_BASIC = 'zato:stats:service:time:basic:'
-    SERVICE_TIME_RAW = 'zato:stats:service:time:raw:'
-    SERVICE_TIME_RAW_BY_MINUTE = 'zato:stats:service:time:raw-by-minute:'
+    SERVICE_TIME_SKETCH = 'zato:stats:service:time:sketch:'
+    SERVICE_TIME_SKETCH_BY_MINUTE = 'zato:stats:service:time:sketch-by-minute:'
+    SERVICE_TIME_SKETCH_PROCESSING = 'zato:stats:service:time:sketch-processing:'
     SERVICE_TIME_AGGREGATED_BY_MINUTE = 'zato:stats:service:time:aggr-by-minute:'
     SERVICE_TIME_AGGREGATED_BY_HOUR = 'zato:stats:service:time:aggr-by-hour:'
     SERVICE_TIME_AGGREGATED_BY_DAY = 'zato:stats:service:time:aggr-by-day:'
     SERVICE_TIME_AGGREGATED_BY_MONTH = 'zato:stats:service:time:aggr-by-month:'
     SERVICE_TIME_SLOW = 'zato:stats:service:time:slow:'
+    SERVICE_TIME_QUEUE = 'zato:stats:service:time:queue:' # How long async invocations waited before the service started
     
     SERVICE_SUMMARY_PREFIX_PATTERN = 'zato:stats:service:summary:{}:'
     SERVICE_SUMMARY_BY_DAY = 'zato:stats:service:summary:by-day:'
     SERVICE_SUMMARY_BY_WEEK = 'zato:stats:service:summary:by-week:'
     SERVICE_SUMMARY_BY_MONTH = 'zato:stats:service:summary:by-month:'
     SERVICE_SUMMARY_BY_YEAR = 'zato:stats:service:summary:by-year:'
+    SERVICE_SUMMARY_CLOSED = 'zato:stats:service:summary-closed:' # Summaries of periods that have ended
+    SERVICE_SUMMARY_CLOSED_UNTIL = 'zato:stats:service:summary-closed-until'
     
+    SERVICE_STATS_INDEX_PREFIX = 'zato:stats:index:'
+    SERVICE_STATS_INDEX_RAW = '{}raw'.format(SERVICE_STATS_INDEX_PREFIX) # Services with times not processed yet
+    SERVICE_STATS_INDEX_SERVICES = '{}services:'.format(SERVICE_STATS_INDEX_PREFIX) # Services with data in a bucket
+    SERVICE_STATS_INDEX_BUCKETS = '{}buckets:'.format(SERVICE_STATS_INDEX_PREFIX) # Buckets with any data at all
+    SERVICE_STATS_INDEX_MIGRATED = '{}migrated'.format(SERVICE_STATS_INDEX_PREFIX)
+
+    SERVICE_STATS_TOP = 'zato:stats:top:' # Services in a bucket scored by usage or time
+    SERVICE_STATS_TOP_TOTALS = 'zato:stats:top-totals:' # Totals of all the services in a bucket
+
+    SERVICE_STATS_DELETE_STATUS = 'zato:stats:delete:status:' # Progress of each deletion of statistics
+    SERVICE_STATS_DELETE_RUNNING = 'zato:stats:delete:running' # IDs of deletions not finished yet
+    SERVICE_STATS_ARCHIVED_UNTIL = 'zato:stats:archived-until' # Prefix -> score statistics are archived until
+
+    # Requests, HTTP status codes, bytes and response times of each channel
+    CHANNEL_STATS_BY_MINUTE = 'zato:stats:channel:by-minute:'
+    CHANNEL_STATS_BY_HOUR = 'zato:stats:channel:by-hour:'
+    CHANNEL_STATS_BY_DAY = 'zato:stats:channel:by-day:'
+
     REQ_RESP_SAMPLE = 'zato:req-resp:sample:'
     RESP_SLOW = 'zato:resp:slow:'
     
+    BROKER_QUEUE = 'zato:broker:queue:to-parallel:any'
+    BROKER_QUEUE_PROCESSING = '{}:processing:'.format(BROKER_QUEUE)
+    BROKER_QUEUE_CONSUMERS = '{}:consumers'.format(BROKER_QUEUE)
+    BROKER_QUEUE_CONSUMER_ALIVE = '{}:alive:'.format(BROKER_QUEUE)
+    BROKER_POOL_STATS = 'zato:broker:pool-stats' # Broker client name -> statistics of its pool of message handlers
+    
     DELIVERY_PREFIX = 'zato:delivery:'
     DELIVERY_BY_TARGET_PREFIX = '{}by-target:'.format(DELIVERY_PREFIX)
+    DELIVERY_CHECK_DUE = '{}check:due'.format(DELIVERY_PREFIX) # Task IDs scored by when their checks are due
+    DELIVERY_CHECK_ITEM = '{}check:item'.format(DELIVERY_PREFIX) # Task IDs -> what their checks need to run
 
 class SCHEDULER_JOB_TYPE(Attrs):
     ONE_TIME = 'one_time'
@@ -322,6 +356,10 @@ class DELIVERY_CALLBACK_INVOKER(Attrs):
     
 class BROKER:
     DEFAULT_EXPIRATION = 15 # In seconds
+    WORK_QUEUE_REQUEUE_AFTER = 60 # In seconds
+    DEFAULT_CODEC = 'json'
+    DEFAULT_POOL_SIZE = 1000 # How many messages a worker may be handling at a time
+    POOL_STATS_INTERVAL = 10 # In seconds, how often broker clients report statistics of their pools
     
 class MISC:
     SEPARATOR = ':::'
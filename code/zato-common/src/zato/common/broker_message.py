@@ -59,6 +59,22 @@ TOPICS = {
 
 KEYS = {k:v.replace('/zato','').replace('/',':') for k,v in TOPICS.items()}
 
+# Messages meant for one publishing connector only are published on a topic of its own,
+# one of the prefixes below followed by the name of the connection the connector is for.
+CONNECTOR_TOPICS = {
+    MESSAGE_TYPE.TO_AMQP_PUBLISHING_CONNECTOR_ALL: b'/zato/connector/amqp/publishing/name/',
+    MESSAGE_TYPE.TO_JMS_WMQ_PUBLISHING_CONNECTOR_ALL: b'/zato/connector/jms-wmq/publishing/name/',
+    MESSAGE_TYPE.TO_ZMQ_PUBLISHING_CONNECTOR_ALL: b'/zato/connector/zmq/publishing/name/',
+}
+
+def get_connector_topic(msg_type, name):
+    """ Returns a topic messages of a given type are published on for the connector
+    of a given connection only.
+    """
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return CONNECTOR_TOPICS[msg_type] + name
+
 SCHEDULER = Bunch()
 SCHEDULER.CREATE = b'10000'
 SCHEDULER.EDIT = b'10001'
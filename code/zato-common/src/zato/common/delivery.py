@@ -10,18 +10,25 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 # stdlib
 import csv
+from collections import deque
 from contextlib import closing
 from datetime import datetime, timedelta
 from json import dumps, loads
 from logging import getLogger, DEBUG
-from sys import maxint
+from math import ceil
+from random import random
+from time import time
 from traceback import format_exc
 
 # Bunch
 from bunch import Bunch
 
+# dateutil
+from dateutil.parser import parse
+
 # gevent
-from gevent import sleep, spawn_later
+from gevent import sleep, spawn
+from gevent.event import AsyncResult, Event
 
 # Paste
 from paste.util.converters import asbool
@@ -32,9 +39,6 @@ from retools.lock import Lock
 # SQLAlchemy
 from sqlalchemy.orm.query import orm_exc
 
-# WebHelpers
-from webhelpers.paginate import Page
-
 # Zato
 from zato.common import CHANNEL, DATA_FORMAT, DELIVERY_CALLBACK_INVOKER, DELIVERY_COUNTERS, \
      DELIVERY_HISTORY_ENTRY, DELIVERY_STATE, INVOCATION_TARGET, KVDB
@@ -64,8 +68,45 @@ DELIVERY_KEYS = ('def_name', 'target_type', 'task_id', 'creation_time_utc', 'las
 PAYLOAD_KEYS = DELIVERY_KEYS + ('payload', 'args', 'kwargs')
 PAYLOAD_ALL_KEYS = PAYLOAD_KEYS + ('target',)
 
+# Delivery states -> counters deliveries in them are counted in
+_state_counter = {
+    DELIVERY_STATE.IN_DOUBT: DELIVERY_COUNTERS.IN_DOUBT,
+    DELIVERY_STATE.IN_PROGRESS_RESUBMITTED: DELIVERY_COUNTERS.IN_PROGRESS,
+    DELIVERY_STATE.IN_PROGRESS_RESUBMITTED_AUTO: DELIVERY_COUNTERS.IN_PROGRESS,
+    DELIVERY_STATE.IN_PROGRESS_STARTED: DELIVERY_COUNTERS.IN_PROGRESS,
+    DELIVERY_STATE.IN_PROGRESS_TARGET_OK: DELIVERY_COUNTERS.IN_PROGRESS,
+    DELIVERY_STATE.IN_PROGRESS_TARGET_FAILURE: DELIVERY_COUNTERS.IN_PROGRESS,
+    DELIVERY_STATE.CONFIRMED: DELIVERY_COUNTERS.CONFIRMED,
+    DELIVERY_STATE.FAILED: DELIVERY_COUNTERS.FAILED,
+}
+
 LOCK_TIMEOUT = 0.2
-RETRY_SLEEP = 5
+
+CHECK_WHEEL_TICK = 1 # In seconds
+CHECK_WHEEL_SLOTS = 512
+CHECK_LEASE = 120 # In seconds
+CHECK_RECOVER_EVERY = 5 # In ticks
+CHECK_RECOVER_BATCH_SIZE = 500
+
+WRITE_INTERVAL = 10 # In milliseconds
+WRITE_BATCH_SIZE = 100
+WRITE_MAX_PENDING = 1000
+
+AUTO_RESUBMIT_BATCH_SIZE = 500
+
+PURGE_BATCH_SIZE = 1000
+PURGE_LOCK_TIMEOUT = 600 # In seconds
+
+# Claims checks whose lease has expired by leasing them again, all in one go so that
+# each of them is claimed by one worker only - KEYS[1] is the sorted set of checks,
+# ARGV are the current time, when the new lease expires and how many checks to claim at most.
+CLAIM_CHECKS_SCRIPT = """
+local task_ids = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
+for _, task_id in ipairs(task_ids) do
+    redis.call('zadd', KEYS[1], ARGV[2], task_id)
+end
+return task_ids
+"""
 
 def _item_from_api(delivery_def_base, target, payload, task_id, invoke_func, args, kwargs):
     """ Creates an invocation context. 
@@ -80,6 +121,8 @@ def _item_from_api(delivery_def_base, target, payload, task_id, invoke_func, arg
         'check_after': delivery_def_base.check_after,
         'retry_repeats': delivery_def_base.retry_repeats,
         'retry_seconds': delivery_def_base.retry_seconds,
+        'retry_backoff': delivery_def_base.retry_backoff,
+        'retry_max_seconds': delivery_def_base.retry_max_seconds,
         'payload': payload,
         'invoke_func': invoke_func,
         'args': dumps(args),
@@ -87,6 +130,269 @@ def _item_from_api(delivery_def_base, target, payload, task_id, invoke_func, arg
         'log_name': '{}/{}/{}'.format(delivery_def_base.name, target, task_id),
     })
 
+def get_retry_delay(retry_seconds, retry_count, backoff=None, max_seconds=None):
+    """ Returns how many seconds to wait before the retry_count-th repeat of a delivery, counting from 1.
+    Each repeat waits backoff times longer than the previous one did, starting from retry_seconds
+    and never longer than max_seconds. With a backoff greater than 1, half of the time waited is picked
+    at random so that deliveries which failed together don't all repeat together, otherwise repeats
+    run at regular retry_seconds intervals.
+    """
+    backoff = backoff or 1
+    delay = retry_seconds * backoff ** (retry_count - 1)
+    if max_seconds:
+        delay = min(delay, max_seconds)
+
+    if backoff <= 1:
+        return delay
+
+    return delay / 2 + random() * delay / 2
+
+def get_cursor(last_used, id):
+    """ Returns a cursor pointing to a delivery in a list of them.
+    """
+    return '{}/{}'.format(last_used.isoformat(), id)
+
+def parse_cursor(cursor):
+    """ Returns a (last_used, id) tuple out of a cursor, or None if there's no cursor.
+    """
+    if cursor:
+        last_used, id = cursor.rsplit('/', 1)
+        return parse(last_used), int(id)
+
+# ##############################################################################
+
+class DeliveryCheckWheel(object):
+    """ Runs checks of whether targets confirmed deliveries. Each check is kept in the KVDB -
+    in a sorted set of task IDs scored by when checks are due and in a hash of everything
+    a check needs to run - and in a hashed timer wheel of the worker that scheduled it. The wheel
+    is a list of slots, each a list of checks due at ticks whose number modulo the number of slots
+    is the slot's index, and it's turned by a single greenlet which runs checks of the current
+    slot due at the current tick. Checks due more than a revolution later stay in their slots
+    until their tick comes.
+    
+    Checks scheduled by a worker are leased to it - they are scored by when they're due plus
+    the lease time so no other worker runs them. Every few ticks, each worker claims checks
+    whose lease has expired, e.g. because the worker which scheduled them has been restarted,
+    and runs them straightaway. A check that runs either schedules itself again or is done
+    and then removed from the KVDB.
+    """
+    def __init__(self, kvdb, on_due, tick=CHECK_WHEEL_TICK, slots=CHECK_WHEEL_SLOTS, lease=CHECK_LEASE,
+            recover_every=CHECK_RECOVER_EVERY, batch_size=CHECK_RECOVER_BATCH_SIZE):
+        self.kvdb = kvdb
+        self.on_due = on_due
+        self.tick = tick
+        self.wheel = [[] for idx in range(slots)]
+        self.lease = lease
+        self.recover_every = recover_every
+        self.batch_size = batch_size
+        self.current_tick = None
+        self.keep_running = False
+        self.claim_script = None
+        self.logger = getLogger(self.__class__.__name__)
+        
+    def get_tick(self, timestamp):
+        """ Returns the first tick at or after a given time.
+        """
+        return int(ceil(timestamp / self.tick))
+    
+    def add(self, item, check_after):
+        """ Schedules a check of a delivery to run in check_after seconds.
+        """
+        due = time() + check_after
+        data = dumps(dict((key, value) for key, value in item.items() if key != 'invoke_func'))
+        
+        with self.kvdb.conn.pipeline() as p:
+            p.hset(KVDB.DELIVERY_CHECK_ITEM, item.task_id, data)
+            p.zadd(KVDB.DELIVERY_CHECK_DUE, due + self.lease, item.task_id)
+            p.execute()
+            
+        tick = self.get_tick(due)
+        
+        # Checks due before the next tick run on it
+        if self.current_tick is not None:
+            tick = max(tick, self.current_tick + 1)
+            
+        self.wheel[tick % len(self.wheel)].append((tick, due, item))
+        
+    def done(self, task_id):
+        """ Removes a check that won't be run again.
+        """
+        with self.kvdb.conn.pipeline() as p:
+            p.zrem(KVDB.DELIVERY_CHECK_DUE, task_id)
+            p.hdel(KVDB.DELIVERY_CHECK_ITEM, task_id)
+            p.execute()
+            
+    def run_tick(self, tick):
+        """ Runs all the checks due at a given tick.
+        """
+        idx = tick % len(self.wheel)
+        slot = self.wheel[idx]
+        
+        due = [entry for entry in slot if entry[0] <= tick]
+        if due:
+            self.wheel[idx] = [entry for entry in slot if entry[0] > tick]
+            
+        for ignored_tick, ignored_due, item in due:
+            spawn(self.on_due, item)
+            
+    def recover(self):
+        """ Claims checks whose lease has expired and runs them.
+        """
+        if not self.claim_script:
+            self.claim_script = self.kvdb.conn.register_script(CLAIM_CHECKS_SCRIPT)
+            
+        now = time()
+        task_ids = self.claim_script(keys=[KVDB.DELIVERY_CHECK_DUE], args=[now, now + self.lease, self.batch_size])
+        if not task_ids:
+            return
+        
+        for task_id, data in zip(task_ids, self.kvdb.conn.hmget(KVDB.DELIVERY_CHECK_ITEM, task_ids)):
+            if not data:
+                self.kvdb.conn.zrem(KVDB.DELIVERY_CHECK_DUE, task_id)
+                continue
+            
+            # Services that scheduled the check are long gone so targets will be invoked through the broker
+            item = Bunch(loads(data))
+            item.invoke_func = None
+            
+            self.logger.info('Recovered check of [%s]', item.log_name)
+            spawn(self.on_due, item)
+            
+    def run(self):
+        """ Turns the wheel until told to stop, catching up on ticks missed in the meantime.
+        """
+        self.keep_running = True
+        self.current_tick = int(time() / self.tick)
+        
+        while self.keep_running:
+            sleep(max((self.current_tick + 1) * self.tick - time(), 0))
+            
+            try:
+                now_tick = int(time() / self.tick)
+                while self.current_tick < now_tick:
+                    self.current_tick += 1
+                    self.run_tick(self.current_tick)
+                    
+                    if self.current_tick % self.recover_every == 0:
+                        self.recover()
+                        
+            except Exception, e:
+                self.logger.error('Could not run delivery checks, e:[%s]', format_exc(e))
+                
+    def stop(self):
+        """ Stops the wheel and releases checks in it so that other workers run them when they're due.
+        """
+        self.keep_running = False
+        
+        with self.kvdb.conn.pipeline() as p:
+            for slot in self.wheel:
+                for ignored_tick, due, item in slot:
+                    p.zadd(KVDB.DELIVERY_CHECK_DUE, due, item.task_id)
+            p.execute()
+            
+        self.wheel = [[] for idx in range(len(self.wheel))]
+
+# ##############################################################################
+
+class DeliveryWriter(object):
+    """ Group-commits ODB writes of deliveries made by all the greenlets of a worker. Each write
+    is a function which adds or updates objects in a session it's given. Writes are queued
+    and a single greenlet runs up to batch_size of them in one session committed as soon
+    as there are batch_size of them or after interval milliseconds since the first one
+    was queued, whichever comes first.
+    
+    Whoever writes waits until its batch has been committed and gets back what its function
+    returned - steps of a delivery read what the previous ones wrote, e.g. targets look up
+    deliveries right after they have been registered, but each of them costs a fraction
+    of a transaction. If a batch can't be committed, its writes are retried one by one
+    so that one failing write doesn't fail the others. Writes that find max_pending of them
+    queued already, or no greenlet running, are committed straightaway in sessions of their own.
+    """
+    def __init__(self, odb=None, interval=WRITE_INTERVAL, batch_size=WRITE_BATCH_SIZE, max_pending=WRITE_MAX_PENDING):
+        self.odb = odb
+        self.interval = interval / 1000.0 # Milliseconds -> seconds
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.pending = deque()
+        self.has_pending = Event()
+        self.has_batch = Event()
+        self.keep_running = False
+        self.logger = getLogger(self.__class__.__name__)
+        
+    def write(self, func, *args):
+        """ Runs func with a session and args, returns what it returns once the session's been committed.
+        """
+        if not self.keep_running or len(self.pending) >= self.max_pending:
+            return self._write_one(func, args)
+        
+        result = AsyncResult()
+        self.pending.append((func, args, result))
+        
+        self.has_pending.set()
+        if len(self.pending) >= self.batch_size:
+            self.has_batch.set()
+            
+        return result.get()
+    
+    def _write_one(self, func, args):
+        with closing(self.odb.session()) as session:
+            value = func(session, *args)
+            session.commit()
+            
+        return value
+        
+    def flush(self):
+        """ Commits one batch of pending writes.
+        """
+        batch = [self.pending.popleft() for idx in range(min(len(self.pending), self.batch_size))]
+        
+        if len(self.pending) < self.batch_size:
+            self.has_batch.clear()
+        if not self.pending:
+            self.has_pending.clear()
+            
+        if not batch:
+            return
+        
+        try:
+            with closing(self.odb.session()) as session:
+                values = [func(session, *args) for func, args, result in batch]
+                session.commit()
+                
+        except Exception, e:
+            self.logger.warn('Could not commit a batch of [%s] write(s), will retry them one by one, e:[%s]',
+                len(batch), format_exc(e))
+            
+            for func, args, result in batch:
+                try:
+                    result.set(self._write_one(func, args))
+                except Exception, e:
+                    result.set_exception(e)
+        else:
+            for (func, args, result), value in zip(batch, values):
+                result.set(value)
+                
+    def run(self):
+        """ Commits batches of writes until told to stop.
+        """
+        self.keep_running = True
+        
+        while self.keep_running:
+            self.has_pending.wait()
+            self.has_batch.wait(self.interval)
+            self.flush()
+            
+    def stop(self):
+        """ Stops queueing writes and commits everything already queued.
+        """
+        self.keep_running = False
+        
+        while self.pending:
+            self.flush()
+            
+        # Wakes up the greenlet waiting for writes
+        self.has_pending.set()
+
 # ##############################################################################
 
 class DeliveryStore(object):
@@ -95,10 +401,29 @@ class DeliveryStore(object):
     def __init__(self, kvdb=None, broker_client=None, odb=None, delivery_lock_timeout=None):
         self.kvdb = kvdb
         self.broker_client = broker_client
-        self.odb = odb
+        self.writer = DeliveryWriter(odb)
         self.delivery_lock_timeout = delivery_lock_timeout
+        self.check_wheel = DeliveryCheckWheel(kvdb, self.check_target)
         self.logger = getLogger(self.__class__.__name__)
         
+    @property
+    def odb(self):
+        return self.writer.odb
+    
+    @odb.setter
+    def odb(self, odb):
+        self.writer.odb = odb
+        
+    def start(self):
+        """ Starts running delivery checks and writing deliveries to the ODB in the background.
+        """
+        spawn(self.writer.run)
+        spawn(self.check_wheel.run)
+        
+    def stop(self):
+        self.check_wheel.stop()
+        self.writer.stop()
+        
 # ##############################################################################
 
     def _history_from_source(self, delivery, item, now, entry_type):
@@ -126,7 +451,66 @@ class DeliveryStore(object):
         for name in('task_id', 'payload', 'target', 'target_type', 'args', 'kwargs'):
             delivery_req[name] = item[name]
             
-        item.invoke_func('zato.pattern.delivery.dispatch', delivery_req)
+        if item.get('invoke_func'):
+            item.invoke_func('zato.pattern.delivery.dispatch', delivery_req)
+            
+        # Checks recovered from the KVDB have no service to invoke the target through
+        else:
+            self.broker_client.invoke_async({
+                'action': SERVICE.PUBLISH,
+                'task_id': item.task_id,
+                'channel': CHANNEL.DELIVERY,
+                'data_format': DATA_FORMAT.JSON,
+                'service': 'zato.pattern.delivery.dispatch',
+                'payload': dumps(delivery_req),
+                'cid': new_cid(),
+            })
+        
+    def _register(self, session, item, now, is_resubmit, is_auto):
+        """ Saves a new or resubmitted delivery, returns how many times it's been resubmitted.
+        """
+        if is_resubmit:
+            delivery = session.merge(self.get_delivery(item.task_id))
+            delivery.state = DELIVERY_STATE.IN_PROGRESS_RESUBMITTED_AUTO if is_auto else DELIVERY_STATE.IN_PROGRESS_RESUBMITTED
+            delivery.resubmit_count += 1
+            delivery.last_used = now
+            delivery.args = item.args
+            delivery.kwargs = item.kwargs
+            delivery.payload.payload = item.payload
+            
+            session.add(
+                self._history_from_source(
+                    delivery, item, now, 
+                    DELIVERY_HISTORY_ENTRY.SENT_FROM_SOURCE_RESUBMIT_AUTO if is_auto else DELIVERY_HISTORY_ENTRY.SENT_FROM_SOURCE_RESUBMIT))
+            
+        else:
+            delivery = Delivery()
+            delivery.task_id = item.task_id
+            delivery.name = '{}/{}/{}'.format(item.def_name, item.target, item.target_type)
+            delivery.creation_time = now
+            delivery.args = item.args
+            delivery.kwargs = item.kwargs
+            delivery.state = DELIVERY_STATE.IN_PROGRESS_STARTED
+            delivery.definition_id = item.def_id
+            
+            payload = DeliveryPayload()
+            payload.task_id = item.task_id
+            payload.creation_time = now
+            payload.payload = item.payload
+            payload.delivery = delivery
+            
+            session.add(delivery)
+            session.add(payload)
+            session.add(self._history_from_source(delivery, item, now, DELIVERY_HISTORY_ENTRY.SENT_FROM_SOURCE))
+
+            # Flush the session so the newly created delivery's definition can be reached ..
+            session.flush()
+            
+            # .. and update time the delivery was last used.
+            delivery.last_used = now
+            delivery.definition.last_used = now
+            
+        return delivery.resubmit_count
         
     def register_invoke_schedule(self, item, is_resubmit=False, is_auto=False):
         """ Registers the task, invokes target and schedules a check to find out if the invocation was OK.
@@ -137,53 +521,7 @@ class DeliveryStore(object):
         self._validate_register(item)
 
         # First, save everything in the ODB
-        with closing(self.odb.session()) as session:
-            
-            if is_resubmit:
-                delivery = session.merge(self.get_delivery(item.task_id))
-                delivery.state = DELIVERY_STATE.IN_PROGRESS_RESUBMITTED_AUTO if is_auto else DELIVERY_STATE.IN_PROGRESS_RESUBMITTED
-                delivery.resubmit_count += 1
-                delivery.last_used = now
-                delivery.args = item.args
-                delivery.kwargs = item.kwargs
-                delivery.payload.payload = item.payload
-                
-                session.add(
-                    self._history_from_source(
-                        delivery, item, now, 
-                        DELIVERY_HISTORY_ENTRY.SENT_FROM_SOURCE_RESUBMIT_AUTO if is_auto else DELIVERY_HISTORY_ENTRY.SENT_FROM_SOURCE_RESUBMIT))
-                
-            else:
-                delivery = Delivery()
-                delivery.task_id = item.task_id
-                delivery.name = '{}/{}/{}'.format(item.def_name, item.target, item.target_type)
-                delivery.creation_time = now
-                delivery.args = item.args
-                delivery.kwargs = item.kwargs
-                delivery.state = DELIVERY_STATE.IN_PROGRESS_STARTED
-                delivery.definition_id = item.def_id
-                
-                payload = DeliveryPayload()
-                payload.task_id = item.task_id
-                payload.creation_time = now
-                payload.payload = item.payload
-                payload.delivery = delivery
-                
-                session.add(delivery)
-                session.add(payload)
-                session.add(self._history_from_source(delivery, item, now, DELIVERY_HISTORY_ENTRY.SENT_FROM_SOURCE))
-    
-                # Flush the session so the newly created delivery's definition can be reached ..
-                session.flush()
-                
-                # .. update time the delivery was last used ..
-                delivery.last_used = now
-                delivery.definition.last_used = now
-                
-            resubmit_count = delivery.resubmit_count
-            
-            # .. and commit the whole transaction.
-            session.commit()
+        resubmit_count = self.writer.write(self._register, item, now, is_resubmit, is_auto)
             
         self.logger.info(
           'Submitting delivery [%s] for target:[%s] (%s/%s), resubmit:[%s], expire_after:[%s], check_after:[%s], retry_repeats:[%s], retry_seconds:[%s]',
@@ -193,26 +531,25 @@ class DeliveryStore(object):
         # Invoke the target now that things are in the ODB
         self._invoke_delivery_service(item)
 
-        # Spawn a greenlet to check whether target confirmed delivery
+        # Schedule a check whether target confirmed delivery
         self.spawn_check_target(item, item.check_after)
 
 # ##############################################################################
         
     def spawn_check_target(self, item, check_after):
-        """ Spawns a greenlet that checks whether the target replied and acts accordingly.
+        """ Schedules a check whether the target replied, run in check_after seconds.
         """
-        spawn_later(check_after, self.check_target, item)
+        self.check_wheel.add(item, check_after)
         
-    def _invoke_callbacks(self, target, target_type, delivery, target_ok, in_doubt, invoker):
+    def _invoke_callbacks(self, target, target_type, task_id, callback_list, target_ok, in_doubt, invoker):
         """ Asynchronously notifies all callback services of the outcome of the target's invocation.
         """
-        callback_list = delivery.definition.callback_list
-        callback_list = callback_list.split(',') or []
+        callback_list = (callback_list or '').split(',')
         
         payload = dumps({
             'target_ok': target_ok,
             'in_doubt': in_doubt,
-            'task_id': delivery.task_id,
+            'task_id': task_id,
             'target': target,
             'target_type': target_type,
             'invoker': invoker
@@ -222,7 +559,7 @@ class DeliveryStore(object):
             if service:
                 broker_msg = {}
                 broker_msg['action'] = SERVICE.PUBLISH
-                broker_msg['task_id'] = delivery.task_id
+                broker_msg['task_id'] = task_id
                 broker_msg['channel'] = CHANNEL.DELIVERY
                 broker_msg['data_format'] = DATA_FORMAT.JSON
                 broker_msg['service'] = service
@@ -233,104 +570,120 @@ class DeliveryStore(object):
                     self.broker_client.invoke_async(broker_msg)
                 except Exception, e:
                     msg = 'Could not invoke callback:[%s], task_id:[%s], e:[%s]'.format(
-                        service, delivery.task_id, format_exc(e))
+                        service, task_id, format_exc(e))
                     self.logger.warn(msg)
         
 # ##############################################################################
         
+    def _write_in_doubt(self, session, delivery, now):
+        delivery = session.merge(delivery)
+        delivery.state = DELIVERY_STATE.IN_DOUBT
+        delivery.last_used = now
+        delivery.definition.last_used = now
+        
+        history = DeliveryHistory()
+        history.task_id = delivery.task_id
+        history.entry_type = DELIVERY_HISTORY_ENTRY.ENTERED_IN_DOUBT
+        history.entry_time = now
+        history.entry_ctx = DELIVERY_HISTORY_ENTRY.NONE
+        history.delivery = delivery
+        history.resubmit_count = delivery.resubmit_count
+        
+        session.add(delivery)
+        session.add(history)
+        
+        return delivery.definition.callback_list, delivery.source_count, delivery.target_count
+        
     def _on_in_doubt(self, item, delivery, now):
         """ Delivery enteres an in-doubt state.
         """
-        with closing(self.odb.session()) as session:
-            delivery = session.merge(delivery)
-            delivery.state = DELIVERY_STATE.IN_DOUBT
-            delivery.last_used = now
-            delivery.definition.last_used = now
-            
-            history = DeliveryHistory()
-            history.task_id = delivery.task_id
-            history.entry_type = DELIVERY_HISTORY_ENTRY.ENTERED_IN_DOUBT
-            history.entry_time = now
-            history.entry_ctx = DELIVERY_HISTORY_ENTRY.NONE
-            history.delivery = delivery
-            history.resubmit_count = delivery.resubmit_count
-            
-            session.add(delivery)
-            session.add(history)
-            
-            session.commit()
-            
-            self._invoke_callbacks(item.target, item.target_type, delivery, False, True, DELIVERY_CALLBACK_INVOKER.SOURCE)
+        callback_list, source_count, target_count = self.writer.write(self._write_in_doubt, delivery, now)
+        
+        self._invoke_callbacks(
+            item.target, item.target_type, item.task_id, callback_list, False, True, DELIVERY_CALLBACK_INVOKER.SOURCE)
+        
+        msg = 'Delivery [%s] is in-doubt (source/target %s/%s)'
+        self.logger.warn(msg, item.log_name, source_count, target_count)
+        
+    def _write_finish(self, session, delivery, target_ok, now_dt):
+        delivery = session.merge(delivery)
+        
+        if target_ok:
+            expires = delivery.definition.expire_arch_succ_after
+            delivery_state = DELIVERY_STATE.CONFIRMED
+            history_entry_type = DELIVERY_HISTORY_ENTRY.ENTERED_CONFIRMED
+        else:
+            expires = delivery.definition.expire_arch_fail_after
+            delivery_state = DELIVERY_STATE.FAILED
+            history_entry_type = DELIVERY_HISTORY_ENTRY.ENTERED_FAILED
+        
+        delivery.state = delivery_state
+        delivery.last_used = now_dt
+        delivery.definition.last_used = now_dt
             
-            msg = 'Delivery [%s] is in-doubt (source/target %s/%s)'
-            self.logger.warn(msg, item.log_name, delivery.source_count, delivery.target_count)
+        history = DeliveryHistory()
+        history.task_id = delivery.task_id
+        history.entry_type = history_entry_type
+        history.entry_time = now_dt
+        history.entry_ctx = DELIVERY_HISTORY_ENTRY.NONE
+        history.delivery = delivery
+        history.resubmit_count = delivery.resubmit_count
+        
+        session.add(delivery)
+        session.add(history)
+        
+        return delivery.definition.callback_list, delivery.source_count, delivery.definition.retry_repeats, expires
             
     def finish_delivery(self, delivery, target_ok, now_dt, item):
         """ Called after running out of attempts to deliver the payload.
         """
-        with closing(self.odb.session()) as session:
-            delivery = session.merge(delivery)
-            
-            if target_ok:
-                msg_prefix = 'Confirmed delivery'
-                log_func = self.logger.info
-                expires = delivery.definition.expire_arch_succ_after
-                delivery_state = DELIVERY_STATE.CONFIRMED
-                history_entry_type = DELIVERY_HISTORY_ENTRY.ENTERED_CONFIRMED
-            else:
-                msg_prefix = 'Delivery failed'
-                log_func = self.logger.warn
-                expires = delivery.definition.expire_arch_fail_after
-                delivery_state = DELIVERY_STATE.FAILED
-                history_entry_type = DELIVERY_HISTORY_ENTRY.ENTERED_FAILED
-            
-            delivery.state = delivery_state
-            delivery.last_used = now_dt
-            delivery.definition.last_used = now_dt
-                
-            history = DeliveryHistory()
-            history.task_id = delivery.task_id
-            history.entry_type = history_entry_type
-            history.entry_time = now_dt
-            history.entry_ctx = DELIVERY_HISTORY_ENTRY.NONE
-            history.delivery = delivery
-            history.resubmit_count = delivery.resubmit_count
-            
-            session.add(delivery)
-            session.add(history)
-            
-            session.commit()
+        callback_list, source_count, retry_repeats, expires = self.writer.write(
+            self._write_finish, delivery, target_ok, now_dt)
+        
+        if target_ok:
+            msg_prefix = 'Confirmed delivery'
+            log_func = self.logger.info
+        else:
+            msg_prefix = 'Delivery failed'
+            log_func = self.logger.warn
             
-            self._invoke_callbacks(item.target, item.target_type, delivery, target_ok, False, DELIVERY_CALLBACK_INVOKER.SOURCE)
-                
-            msg = '{} [{}] after {}/{} attempts, archive expires in {} hour(s) ({} UTC)'.format(
-                msg_prefix, item.log_name, delivery.source_count, delivery.definition.retry_repeats, 
-                expires, now_dt + timedelta(hours=expires))
+        self._invoke_callbacks(
+            item.target, item.target_type, item.task_id, callback_list, target_ok, False, DELIVERY_CALLBACK_INVOKER.SOURCE)
             
-            log_func(msg)
+        msg = '{} [{}] after {}/{} attempts, archive expires in {} hour(s) ({} UTC)'.format(
+            msg_prefix, item.log_name, source_count, retry_repeats, expires, now_dt + timedelta(hours=expires))
+        
+        log_func(msg)
+        
+    def _write_retry(self, session, delivery, item, now):
+        delivery = session.merge(delivery)
+        delivery.last_used = now
+        delivery.definition.last_used = now
+        delivery.source_count += 1
+        
+        session.add(delivery)
+        session.add(self._history_from_source(delivery, item, datetime.utcnow(), DELIVERY_HISTORY_ENTRY.ENTERED_RETRY))
+        
+        return delivery.source_count
             
     def retry(self, delivery, item, now):
-        with closing(self.odb.session()) as session:
-            delivery = session.merge(delivery)
-            delivery.last_used = now
-            delivery.definition.last_used = now
-            delivery.source_count += 1
-
-            # 'source_count' is needed outside of the 'with' statement because
-            # we want to sleep a bit and there's no need to keep the session open in that time.
-            source_count = delivery.source_count
-            
-            session.add(delivery)
-            session.add(self._history_from_source(delivery, item, datetime.utcnow(), DELIVERY_HISTORY_ENTRY.ENTERED_RETRY))
-            session.commit()
-            
-            # Sleep a constant time so we're sure any locks related to that task are released
-            sleep(RETRY_SLEEP)
-            
+        """ Schedules another attempt at a delivery. The target is invoked by the check wheel
+        once the delay has passed, so the lock on the task is released in the meantime.
+        """
+        source_count = self.writer.write(self._write_retry, delivery, item, now)
+        delay = get_retry_delay(
+            item.retry_seconds, source_count - 1, item.get('retry_backoff'), item.get('retry_max_seconds'))
+        
+        self.logger.info('Will retry delivery [%s] (%s/%s) in %.1f s', item.log_name, source_count, item.retry_repeats, delay)
+        
+        item.retry_pending = True
+        self.spawn_check_target(item, delay)
+        
+    def _on_retry_due(self, item, source_count):
         self.logger.info('Retrying delivery [%s] (%s/%s)', item.log_name, source_count, item.retry_repeats)
         
         self._invoke_delivery_service(item)
-        self.spawn_check_target(item, item.retry_seconds)
+        self.spawn_check_target(item, item.check_after)
                 
 # ##############################################################################
         
@@ -339,6 +692,7 @@ class DeliveryStore(object):
         
         if self.is_deleted(item.def_name):
             self.logger.info('Stopping [%s] (definition.is_deleted->True)', item.log_name)
+            self.check_wheel.done(item.task_id)
             return
         
         now_dt = datetime.utcnow()
@@ -352,6 +706,7 @@ class DeliveryStore(object):
             except orm_exc.NoResultFound, e:
                 # Apparently the delivery was deleted since the last time we were scheduled to run
                 self.logger.info('Stopping [%s] (NoResultFound->True)', item.log_name)
+                self.check_wheel.done(item.task_id)
                 return
         
         # Fetch new values because it's possible they have been changed since the last time we were invoked
@@ -359,11 +714,17 @@ class DeliveryStore(object):
         item['args'] = delivery.args
         item['kwargs'] = delivery.kwargs
         
+        # It's not a check but a retry scheduled the last time one ran
+        if item.pop('retry_pending', False):
+            self._on_retry_due(item, delivery.source_count)
+            return
+        
         with Lock(lock_name, self.delivery_lock_timeout, LOCK_TIMEOUT, self.kvdb.conn):
 
             # Target did not reply at all hence we're entering in-doubt
             if delivery.source_count > delivery.target_count:
                 self._on_in_doubt(item, delivery, now)
+                self.check_wheel.done(item.task_id)
                 
             else:
                 # The target has confirmed the invocation in an expected time so we
@@ -376,6 +737,7 @@ class DeliveryStore(object):
                 # All good, we can stop now.
                 if target_ok:
                     self.finish_delivery(delivery, target_ok, now_dt, item)
+                    self.check_wheel.done(item.task_id)
                     
                 # Not so good, we know there was an error.
                 else:
@@ -386,6 +748,7 @@ class DeliveryStore(object):
                     # Nope, that was the last attempt.
                     else:
                         self.finish_delivery(delivery, target_ok, now_dt, item)
+                        self.check_wheel.done(item.task_id)
 
 # ##############################################################################
 
@@ -433,6 +796,18 @@ class DeliveryStore(object):
         
         self.kvdb.conn.hmset('{}{}'.format(KVDB.DELIVERY_BY_TARGET_PREFIX, name), counters)
         
+    def _decr_counter(self, name, counter, value):
+        """ Decrements a counter of a given delivery definition along with the total one,
+        unless the counters haven't been computed yet.
+        """
+        key = '{}{}'.format(KVDB.DELIVERY_BY_TARGET_PREFIX, name)
+        
+        if self.kvdb.conn.hexists(key, counter):
+            with self.kvdb.conn.pipeline() as p:
+                p.hincrby(key, counter, -value)
+                p.hincrby(key, DELIVERY_COUNTERS.TOTAL, -value)
+                p.execute()
+        
     def get_counters(self, name):
         """ Returns usage counters for a given delivery definition.
         """
@@ -442,6 +817,60 @@ class DeliveryStore(object):
         
         return dict(zip(keys, values))
 
+# ##############################################################################
+
+    def _purge_batch(self, session, def_id, state, stop, batch_size):
+        """ Deletes at most batch_size deliveries of a given definition in a given state which were
+        last used before stop, least recently used first, along with their payloads and history.
+        Returns how many deliveries and history entries were deleted.
+        """
+        task_ids = [task_id for task_id, in session.query(Delivery.task_id).\
+            filter(Delivery.definition_id==def_id).\
+            filter(Delivery.state==state).\
+            filter(Delivery.last_used < stop).\
+            order_by(Delivery.last_used, Delivery.id).\
+            limit(batch_size)]
+        
+        if not task_ids:
+            return 0, 0
+        
+        history_count = session.query(DeliveryHistory).\
+            filter(DeliveryHistory.task_id.in_(task_ids)).\
+            delete(synchronize_session=False)
+            
+        session.query(DeliveryPayload).\
+            filter(DeliveryPayload.task_id.in_(task_ids)).\
+            delete(synchronize_session=False)
+            
+        session.query(Delivery).\
+            filter(Delivery.task_id.in_(task_ids)).\
+            delete(synchronize_session=False)
+        
+        return len(task_ids), history_count
+        
+    def purge(self, def_id, def_name, state, stop, batch_size=PURGE_BATCH_SIZE):
+        """ Deletes confirmed or failed deliveries of a given definition which were last used before stop,
+        in batches of batch_size, each committed on its own so that no transaction holds onto too many rows,
+        and updates the definition's counters. Returns how many deliveries and history entries were deleted.
+        """
+        delivery_count, history_count = 0, 0
+        
+        while True:
+            with closing(self.odb.session()) as session:
+                batch_delivery_count, batch_history_count = self._purge_batch(session, def_id, state, stop, batch_size)
+                session.commit()
+                
+            delivery_count += batch_delivery_count
+            history_count += batch_history_count
+            
+            if batch_delivery_count < batch_size:
+                break
+            
+        if delivery_count:
+            self._decr_counter(def_name, _state_counter[state], delivery_count)
+            
+        return delivery_count, history_count
+
 # ##############################################################################
 
     def deliver(self, cluster_id, def_name, payload, task_id, invoke_func, is_resubmit=False, is_auto=False, *args, **kwargs):
@@ -471,6 +900,26 @@ class DeliveryStore(object):
 
 # ##############################################################################
         
+    def _write_target_completed(self, session, task_id, now, target_ok, entry_ctx):
+        delivery = session.merge(self.get_delivery(task_id))
+        delivery.state = DELIVERY_STATE.IN_PROGRESS_TARGET_OK if target_ok else DELIVERY_STATE.IN_PROGRESS_TARGET_FAILURE
+        delivery.last_used = now
+        delivery.definition.last_used = now
+        delivery.target_count += 1
+        
+        history = DeliveryHistory()
+        history.task_id = task_id
+        history.entry_type = DELIVERY_HISTORY_ENTRY.TARGET_OK if target_ok else DELIVERY_HISTORY_ENTRY.TARGET_FAILURE
+        history.entry_time = now
+        history.entry_ctx = entry_ctx
+        history.delivery = delivery
+        history.resubmit_count = delivery.resubmit_count
+        
+        session.add(delivery)
+        session.add(history)
+        
+        return delivery.definition.callback_list
+        
     def on_target_completed(self, target_type, target, delivery, start, end, target_ok, target_self_info, err_info=None):
         now = datetime.utcnow().isoformat()
         task_id = delivery['task_id']
@@ -483,62 +932,79 @@ class DeliveryStore(object):
                 'total_time': total_time
             })
             
-            with closing(self.odb.session()) as session:
-                delivery = session.merge(self.get_delivery(task_id))
-                delivery.state = DELIVERY_STATE.IN_PROGRESS_TARGET_OK if target_ok else DELIVERY_STATE.IN_PROGRESS_TARGET_FAILURE
-                delivery.last_used = now
-                delivery.definition.last_used = now
-                delivery.target_count += 1
-                
-                history = DeliveryHistory()
-                history.task_id = task_id
-                history.entry_type = DELIVERY_HISTORY_ENTRY.TARGET_OK if target_ok else DELIVERY_HISTORY_ENTRY.TARGET_FAILURE
-                history.entry_time = now
-                history.entry_ctx = entry_ctx
-                history.delivery = delivery
-                history.resubmit_count = delivery.resubmit_count
-                
-                session.add(delivery)
-                session.add(history)
-                
-                session.commit()
-                
-                self._invoke_callbacks(target, target_type, delivery, target_ok, False, DELIVERY_CALLBACK_INVOKER.TARGET)
+            callback_list = self.writer.write(self._write_target_completed, task_id, now, target_ok, entry_ctx)
+            
+            self._invoke_callbacks(
+                target, target_type, task_id, callback_list, target_ok, False, DELIVERY_CALLBACK_INVOKER.TARGET)
 
 # ##############################################################################
 
-    def _get_page(self, session, cluster_id, params, state):
-        return Page(delivery_list(session, cluster_id, params.def_name, state, params.start, params.stop, params.get('needs_payload', False)),
-             page=params.current_batch,
-             items_per_page=params.batch_size)
+    def _get_batch(self, session, cluster_id, params, state):
+        """ Returns a batch of at most params.batch_size deliveries, most recently used first, along with
+        whether there are batches before and after it. Batches are found by cursors pointing to deliveries
+        they come after or before, rather than by their numbers, so the ODB never needs to skip over
+        all the deliveries in the preceding batches, nor to count them.
+        """
+        after = parse_cursor(params.get('after'))
+        before = parse_cursor(params.get('before'))
+        
+        # One more than needed so that it's known if there's anything beyond the batch
+        rows = delivery_list(session, cluster_id, params.def_name, state, params.start, params.stop, 
+            params.get('needs_payload', False), after, before).\
+            limit(params.batch_size + 1).\
+            all()
+        
+        has_more = len(rows) > params.batch_size
+        rows = rows[:params.batch_size]
+        
+        if before:
+            rows.reverse()
+            return rows, has_more, True
+        
+        return rows, bool(after), has_more
+    
+    def get_approx_count(self, def_name, state):
+        """ Returns how many deliveries of a given definition are in given states as of the last time
+        the definition's counters were updated.
+        """
+        counters = self.get_counters(def_name)
+        return sum(int(counters.get(name) or 0) for name in set(_state_counter[elem] for elem in state))
 
     def get_batch_info(self, cluster_id, params, state):
-        """ Returns information regarding how given set of data will be split into
-        smaller batches given maximum number of items on a single batch and min/max member score
-        of the set. Also returns information regarding a current batch - whether it has prev/next batches.
+        """ Returns information regarding a current batch - whether it has prev/next batches and cursors
+        pointing to them - along with an approximate number of all the deliveries in given states.
         """
         with closing(self.odb.session()) as session:
-            page = self._get_page(session, cluster_id, params, state)
-            return {
-                'total_results': page.item_count,
-                'num_batches': page.page_count,
-                'has_previous': page.previous_page is not None,
-                'has_next': page.next_page is not None,
-                'next_batch_number': page.next_page,
-                'previous_batch_number': page.previous_page,
-            }
+            rows, has_previous, has_next = self._get_batch(session, cluster_id, params, state)
+            
+        return {
+            'total_results': self.get_approx_count(params.def_name, state),
+            'has_previous': has_previous and bool(rows),
+            'has_next': has_next and bool(rows),
+            'next_batch_cursor': get_cursor(rows[-1].last_used_utc, rows[-1].id) if rows else None,
+            'previous_batch_cursor': get_cursor(rows[0].last_used_utc, rows[0].id) if rows else None,
+        }
+
+    def _get_instance_list(self, cluster_id, params, state):
+        """ Returns a batch of instances along with a cursor pointing to the last one, if there are any.
+        """
+        with closing(self.odb.session()) as session:
+            rows = self._get_batch(session, cluster_id, params, state)[0]
+            
+        out_list = []
+        for values in rows:
+            out = dict(zip((PAYLOAD_KEYS if params.get('needs_payload') else DELIVERY_KEYS), values))
+            for name in('creation_time_utc', 'last_used_utc'):
+                out[name] = out[name].isoformat()
+                
+            out_list.append(out)
+            
+        return out_list, get_cursor(rows[-1].last_used_utc, rows[-1].id) if rows else None
 
     def get_delivery_instance_list(self, cluster_id, params, state):
         """ Returns a batch of instances that are in the in-doubt state.
         """
-        with closing(self.odb.session()) as session:
-            page = self._get_page(session, cluster_id, params, state)
-            for values in page.items:
-                out = dict(zip((PAYLOAD_KEYS if params.get('needs_payload') else DELIVERY_KEYS), values))
-                for name in('creation_time_utc', 'last_used_utc'):
-                    out[name] = out[name].isoformat()
-                    
-                yield out
+        return self._get_instance_list(cluster_id, params, state)[0]
                 
     def get_delivery_instance(self, task_id, target_def_class):
         """ Returns an instance by its task's ID.
@@ -554,58 +1020,74 @@ class DeliveryStore(object):
 
 # ##############################################################################
 
+    def _write_update(self, session, task_id, payload, args, kwargs, now):
+        delivery = session.merge(self.get_delivery(task_id))
+        
+        old_payload = delivery.payload.payload
+        old_args = delivery.args
+        old_kwargs = delivery.kwargs
+        
+        delivery.payload.payload = payload
+        delivery.args = args
+        delivery.kwargs = kwargs
+        
+        delivery.definition.last_used = now
+        delivery.target_count += 1
+        
+        entry_ctx = dumps({
+            'old_payload': old_payload,
+            'old_args': old_args,
+            'old_kwargs': old_kwargs,
+            })
+        
+        history = DeliveryHistory()
+        history.task_id = task_id
+        history.entry_type = DELIVERY_HISTORY_ENTRY.UPDATED
+        history.entry_time = now
+        history.entry_ctx = entry_ctx
+        history.delivery = delivery
+        history.resubmit_count = delivery.resubmit_count
+        
+        session.add(delivery)
+        session.add(history)
+        
+        # So the history entry's ID is known before the batch it's in is committed
+        session.flush()
+        
+        return history.id
+        
     def update_delivery(self, task_id, payload, args, kwargs):
-        with closing(self.odb.session()) as session:
-            now = datetime.utcnow().isoformat()
-            delivery = session.merge(self.get_delivery(task_id))
-            
-            old_payload = delivery.payload.payload
-            old_args = delivery.args
-            old_kwargs = delivery.kwargs
-            
-            delivery.payload.payload = payload
-            delivery.args = args
-            delivery.kwargs = kwargs
-            
-            delivery.definition.last_used = now
-            delivery.target_count += 1
-            
-            entry_ctx = dumps({
-                'old_payload': old_payload,
-                'old_args': old_args,
-                'old_kwargs': old_kwargs,
-                })
-            
-            history = DeliveryHistory()
-            history.task_id = task_id
-            history.entry_type = DELIVERY_HISTORY_ENTRY.UPDATED
-            history.entry_time = now
-            history.entry_ctx = entry_ctx
-            history.delivery = delivery
-            history.resubmit_count = delivery.resubmit_count
-            
-            session.add(delivery)
-            session.add(history)
-            
-            session.commit()
-            
-            self.logger.info('Updated delivery [%s], history.id [%s]', task_id, history.id)
+        now = datetime.utcnow().isoformat()
+        history_id = self.writer.write(self._write_update, task_id, payload, args, kwargs, now)
+        
+        self.logger.info('Updated delivery [%s], history.id [%s]', task_id, history_id)
 
 # ##############################################################################
 
-    def get_delivery_list_for_auto_resubmit(self, cluster_id, def_name, stop):
+    def get_delivery_list_for_auto_resubmit(self, cluster_id, def_name, stop, batch_size=AUTO_RESUBMIT_BATCH_SIZE):
+        """ Yields in-progress deliveries last used before stop, reading them in batches of batch_size,
+        each in a session of its own, so no session is kept open while they are being resubmitted.
+        Deliveries resubmitted in the meantime are used again after stop so they aren't read twice.
+        """
         params = Bunch({
             'def_name': def_name,
             'start': None,
             'stop': stop,
-            'current_batch': 1,
-            'batch_size': maxint,
+            'after': None,
+            'batch_size': batch_size,
             'needs_payload': True,
         })
-        for item in self.get_delivery_instance_list(
+        
+        while True:
+            batch, params.after = self._get_instance_list(
                 cluster_id, params, [DELIVERY_STATE.IN_PROGRESS_STARTED, 
                                       DELIVERY_STATE.IN_PROGRESS_RESUBMITTED,
                                       DELIVERY_STATE.IN_PROGRESS_RESUBMITTED_AUTO,
                                       DELIVERY_STATE.IN_PROGRESS_TARGET_OK, 
-                                      DELIVERY_STATE.IN_PROGRESS_TARGET_FAILURE]):
-            yield item
+                                      DELIVERY_STATE.IN_PROGRESS_TARGET_FAILURE])
+            
+            for item in batch:
+                yield item
+                
+            if len(batch) < batch_size:
+                break
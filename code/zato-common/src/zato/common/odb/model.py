@@ -14,7 +14,7 @@ from json import dumps
 
 # SQLAlchemy
 from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Sequence, \
-     Boolean, LargeBinary, UniqueConstraint, Enum, SmallInteger
+     Boolean, LargeBinary, UniqueConstraint, Enum, SmallInteger, Float, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import backref, relationship
 
@@ -282,6 +282,12 @@ class HTTPSOAP(Base):
     # New in 1.2
     params_pri = Column(String(200), nullable=True, default='channel-params-over-msg')
     
+    # New in 1.2
+    max_request_size = Column(Integer, nullable=True)
+    
+    # New in 1.2
+    stream_request = Column(Boolean, nullable=True, default=False)
+    
     service_id = Column(Integer, ForeignKey('service.id', ondelete='CASCADE'), nullable=True)
     service = relationship('Service', backref=backref('http_soap', order_by=name, cascade='all, delete, delete-orphan'))
     
@@ -295,8 +301,9 @@ class HTTPSOAP(Base):
                  connection=None, transport=None, host=None, url_path=None, method=None,
                  soap_action=None, soap_version=None, data_format=None, ping_method=None,
                  pool_size=None, merge_url_params_req=None, url_params_pri=None,
-                 params_pri=None, service_id=None, service=None, security=None, cluster_id=None,
-                 cluster=None, service_name=None, security_id=None, security_name=None):
+                 params_pri=None, max_request_size=None, stream_request=None, service_id=None,
+                 service=None, security=None, cluster_id=None, cluster=None, service_name=None,
+                 security_id=None, security_name=None):
         self.id = id
         self.name = name
         self.is_active = is_active
@@ -314,6 +321,8 @@ class HTTPSOAP(Base):
         self.merge_url_params_req = merge_url_params_req
         self.url_params_pri = url_params_pri
         self.params_pri = params_pri
+        self.max_request_size = max_request_size
+        self.stream_request = stream_request
         self.service_id = service_id
         self.service = service
         self.security = security
@@ -420,6 +429,11 @@ class Service(Base):
         self.time_max_all_time = None # Not used by the database
         self.time_mean_all_time = None # Not used by the database
         
+        self.time_queue_p50 = None # Not used by the database
+        self.time_queue_p99 = None # Not used by the database
+        self.time_queue_broker_p99 = None # Not used by the database
+        self.time_queue_pool_p99 = None # Not used by the database
+        
         self.time_usage_1h = None # Not used by the database
         self.time_min_1h = None # Not used by the database
         self.time_max_1h = None # Not used by the database
@@ -931,6 +945,8 @@ class DeliveryDefinitionBase(Base):
     check_after = Column(Integer, nullable=False)
     retry_repeats = Column(Integer, nullable=False)
     retry_seconds = Column(Integer, nullable=False)
+    retry_backoff = Column(Float, nullable=True) # Each repeat waits that many times longer than the previous one
+    retry_max_seconds = Column(Integer, nullable=True) # No repeat waits longer than that
     
     cluster_id = Column(Integer, ForeignKey('cluster.id', ondelete='CASCADE'), nullable=False)
     cluster = relationship(Cluster, backref=backref('delivery_list', order_by=name, cascade='all, delete, delete-orphan'))
@@ -953,6 +969,7 @@ class Delivery(Base):
     """ A guaranteed delivery.
     """
     __tablename__ = 'delivery'
+    __table_args__ = (Index('delivery_def_used_idx', 'definition_id', 'last_used', 'id'), {})
     
     id = Column(Integer, Sequence('deliv_seq'), primary_key=True)
     task_id = Column(String(64), unique=True, nullable=False, index=True)
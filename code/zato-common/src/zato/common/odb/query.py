@@ -12,7 +12,7 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 from functools import wraps
 
 # SQLAlchemy
-from sqlalchemy import func
+from sqlalchemy import and_, func, or_
 from sqlalchemy.sql.expression import case
 
 # Zato
@@ -363,6 +363,8 @@ def _http_soap(session, cluster_id):
         case([(HTTPSOAP.merge_url_params_req != None, HTTPSOAP.merge_url_params_req)], else_=True).label('merge_url_params_req'),
         case([(HTTPSOAP.url_params_pri != None, HTTPSOAP.url_params_pri)], else_=URL_PARAMS_PRIORITY.DEFAULT).label('url_params_pri'),
         case([(HTTPSOAP.params_pri != None, HTTPSOAP.params_pri)], else_=PARAMS_PRIORITY.DEFAULT).label('params_pri'),
+        HTTPSOAP.max_request_size,
+        case([(HTTPSOAP.stream_request != None, HTTPSOAP.stream_request)], else_=False).label('stream_request'),
         SecurityBase.sec_type,
         Service.name.label('service_name'),
         Service.id.label('service_id'),
@@ -502,7 +504,11 @@ def delivery_count_by_state(session, def_id):
         filter(Delivery.definition_id==def_id).\
         group_by(Delivery.state)
 
-def delivery_list(session, cluster_id, def_name, state, start=None, stop=None, needs_payload=False):
+def delivery_list(session, cluster_id, def_name, state, start=None, stop=None, needs_payload=False, after=None, before=None):
+    """ Returns deliveries, most recently used first, with each row's last column being the delivery's ID.
+    after and before are (last_used, id) tuples of deliveries the ones returned need to come after or before,
+    in the latter case the deliveries are returned in the reverse order.
+    """
     columns = [
         DeliveryDefinitionBase.name.label('def_name'),
         DeliveryDefinitionBase.target_type,
@@ -520,6 +526,8 @@ def delivery_list(session, cluster_id, def_name, state, start=None, stop=None, n
     
     if needs_payload:
         columns.extend([DeliveryPayload.payload, Delivery.args, Delivery.kwargs])
+        
+    columns.append(Delivery.id)
     
     q = session.query(*columns).\
         filter(DeliveryDefinitionBase.id==Delivery.definition_id).\
@@ -536,7 +544,16 @@ def delivery_list(session, cluster_id, def_name, state, start=None, stop=None, n
     if stop:
         q = q.filter(Delivery.last_used <= stop)
         
-    q = q.order_by(Delivery.last_used.desc())
+    if after:
+        last_used, id = after
+        q = q.filter(or_(Delivery.last_used < last_used, and_(Delivery.last_used == last_used, Delivery.id < id)))
+        
+    if before:
+        last_used, id = before
+        q = q.filter(or_(Delivery.last_used > last_used, and_(Delivery.last_used == last_used, Delivery.id > id)))
+        q = q.order_by(Delivery.last_used.asc(), Delivery.id.asc())
+    else:
+        q = q.order_by(Delivery.last_used.desc(), Delivery.id.desc())
 
     return q
 
@@ -86,6 +86,9 @@ class FakeKVDB(object):
         
         get = hget = return_none
         
+        def hgetall(self, *ignored_args, **ignored_kwargs):
+            return {}
+        
         def setnx(self, *args):
             self.setnx_args = args
             return self.setnx_return_value
@@ -121,6 +124,7 @@ class FakeServer(object):
         self.fs_server_config.misc.internal_services_may_be_deleted = False
         self.repo_location = rand_string()
         self.delivery_store = None
+        self.stats_buffer = None
 
 class ForceTypeWrapper(object):
     """ Makes comparison between two ForceType elements use their names.
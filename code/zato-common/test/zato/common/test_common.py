@@ -16,6 +16,7 @@ from nose.tools import eq_
 
 # Zato
 from zato.common import StatsElem
+from zato.common.broker_message import get_connector_topic, MESSAGE_TYPE, TOPICS
 
 class StatsElemTestCase(TestCase):
     def test_from_json(self):
@@ -34,3 +35,16 @@ class StatsElemTestCase(TestCase):
         for k, v in item.items():
             value = getattr(stats_elem, k)
             eq_(v, value)
+
+class ConnectorTopicTestCase(TestCase):
+    def test_get_connector_topic(self):
+        eq_(get_connector_topic(MESSAGE_TYPE.TO_AMQP_PUBLISHING_CONNECTOR_ALL, 'my.conn'),
+            b'/zato/connector/amqp/publishing/name/my.conn')
+        eq_(get_connector_topic(MESSAGE_TYPE.TO_ZMQ_PUBLISHING_CONNECTOR_ALL, '\u017c\u00f3\u0142w'),
+            b'/zato/connector/zmq/publishing/name/\xc5\xbc\xc3\xb3\xc5\x82w')
+            
+        # Topics of connections can't be mistaken for the ones all the connectors of a type subscribe to
+        for msg_type in(MESSAGE_TYPE.TO_AMQP_PUBLISHING_CONNECTOR_ALL, MESSAGE_TYPE.TO_JMS_WMQ_PUBLISHING_CONNECTOR_ALL,
+                MESSAGE_TYPE.TO_ZMQ_PUBLISHING_CONNECTOR_ALL):
+            topic = get_connector_topic(msg_type, 'all')
+            assert topic not in TOPICS.values(), topic
@@ -9,9 +9,19 @@ Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 # stdlib
+from contextlib import closing
+from datetime import datetime, timedelta
+from json import dumps, loads
+from time import time
 from unittest import TestCase
 from uuid import uuid4
 
+# Bunch
+from bunch import Bunch
+
+# gevent
+from gevent import sleep, spawn
+
 # Nose
 from nose.tools import eq_
 
@@ -20,6 +30,10 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
 # Zato
+from zato.common import DELIVERY_COUNTERS, DELIVERY_STATE, INVOCATION_TARGET, KVDB
+from zato.common.delivery import DeliveryCheckWheel, DeliveryStore, DeliveryWriter, get_cursor, get_retry_delay
+from zato.common.odb.model import Cluster, ConnDefWMQ, Delivery, DeliveryDefinitionOutconnWMQ, DeliveryHistory, \
+     DeliveryPayload, OutgoingWMQ
 from zato.common.test import ODBTestCase
 
 # ##############################################################################
@@ -27,4 +41,390 @@ from zato.common.test import ODBTestCase
 class MiscTestCase(ODBTestCase):
     def test_null_basic_data(self):
         #self.fail()
-        pass
\ No newline at end of file
+        pass
+
+class FakeCounterConn(object):
+    """ Keeps hashes of counters in dictionaries.
+    """
+    def __init__(self):
+        self.hashes = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *ignored_args):
+        pass
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def execute(self):
+        pass
+
+    def hexists(self, key, field):
+        return field in self.hashes.get(key, {})
+
+    def hincrby(self, key, field, value):
+        self.hashes.setdefault(key, {})
+        self.hashes[key][field] = self.hashes[key].get(field, 0) + value
+
+class DeliveryListTestCase(ODBTestCase):
+
+    def setUp(self):
+        super(DeliveryListTestCase, self).setUp()
+        self.session = sessionmaker(bind=self.engine)
+        self.conn = FakeCounterConn()
+        self.store = DeliveryStore(kvdb=Bunch(conn=self.conn), odb=Bunch(session=self.session))
+
+        session = self.session()
+
+        cluster = Cluster(None, 'c', 'c', 'sqlite', 'localhost', 5432, 'zato', 'zato', None,
+            'localhost', 6379, 'localhost', 11223, 20151)
+        session.add(cluster)
+        session.flush()
+        self.cluster_id = cluster.id
+
+        conn_def = ConnDefWMQ(None, 'c', 'localhost', 1414, 'QM01', 'SVRCONN.1', False, False, True, False,
+            None, None, False, 100, cluster.id)
+        session.add(conn_def)
+        session.flush()
+
+        out = OutgoingWMQ(None, 'o', True, 1, 5, None, conn_def.id)
+        session.add(out)
+        session.flush()
+
+        definition = DeliveryDefinitionOutconnWMQ(None, out.id)
+        definition.name = 'd'
+        definition.short_def = 'd'
+        definition.target_type = INVOCATION_TARGET.OUTCONN_WMQ
+        definition.expire_after = definition.expire_arch_succ_after = definition.expire_arch_fail_after = 1
+        definition.check_after = definition.retry_repeats = definition.retry_seconds = 1
+        definition.cluster_id = cluster.id
+        session.add(definition)
+        session.flush()
+        self.def_id = definition.id
+
+        # Seven deliveries, 0 to 6, the last two of them last used at the same time
+        self.now = datetime.utcnow()
+        for idx in range(7):
+            delivery = Delivery()
+            delivery.task_id = str(idx)
+            delivery.name = 'd/o/{}'.format(idx)
+            delivery.creation_time = self.now
+            delivery.last_used = self.now + timedelta(seconds=min(idx, 5))
+            delivery.state = DELIVERY_STATE.IN_PROGRESS_STARTED
+            delivery.definition_id = definition.id
+            delivery.args = delivery.kwargs = b''
+            session.add(delivery)
+
+            payload = DeliveryPayload()
+            payload.task_id = delivery.task_id
+            payload.creation_time = self.now
+            payload.payload = b''
+            payload.delivery = delivery
+            session.add(payload)
+
+            for entry_type in ('a', 'b'):
+                history = DeliveryHistory()
+                history.task_id = delivery.task_id
+                history.entry_type = entry_type
+                history.entry_time = self.now
+                history.entry_ctx = b''
+                history.delivery = delivery
+                session.add(history)
+
+        session.commit()
+        session.close()
+
+    def get_batch(self, **params):
+        params.update({'def_name':'d', 'start':None, 'stop':None, 'batch_size':3})
+        with closing(self.session()) as session:
+            rows, has_previous, has_next = self.store._get_batch(
+                session, self.cluster_id, Bunch(params), [DELIVERY_STATE.IN_PROGRESS_STARTED])
+
+        return [row.task_id for row in rows], has_previous, has_next, rows
+
+    def test_get_batch(self):
+        task_ids, has_previous, has_next, rows = self.get_batch()
+        eq_((task_ids, has_previous, has_next), (['6', '5', '4'], False, True))
+
+        task_ids, has_previous, has_next, rows = self.get_batch(after=get_cursor(rows[-1].last_used_utc, rows[-1].id))
+        eq_((task_ids, has_previous, has_next), (['3', '2', '1'], True, True))
+
+        task_ids, has_previous, has_next, ignored = self.get_batch(after=get_cursor(rows[-1].last_used_utc, rows[-1].id))
+        eq_((task_ids, has_previous, has_next), (['0'], True, False))
+
+        # Back to the first batch
+        task_ids, has_previous, has_next, ignored = self.get_batch(before=get_cursor(rows[0].last_used_utc, rows[0].id))
+        eq_((task_ids, has_previous, has_next), (['6', '5', '4'], False, True))
+
+    def test_auto_resubmit(self):
+        items = self.store.get_delivery_list_for_auto_resubmit(
+            self.cluster_id, 'd', self.now + timedelta(seconds=4), batch_size=2)
+        eq_([item['task_id'] for item in items], ['4', '3', '2', '1', '0'])
+
+    def test_purge(self):
+        session = self.session()
+        for delivery in session.query(Delivery).filter(Delivery.task_id.in_(['0', '1', '2', '3', '6'])):
+            delivery.state = DELIVERY_STATE.CONFIRMED
+        session.commit()
+        session.close()
+
+        key = '{}d'.format(KVDB.DELIVERY_BY_TARGET_PREFIX)
+        self.conn.hashes[key] = {DELIVERY_COUNTERS.CONFIRMED: 5, DELIVERY_COUNTERS.TOTAL: 7}
+
+        # Only confirmed deliveries last used before the cut-off are purged, least recently used first
+        eq_(self.store.purge(self.def_id, 'd', DELIVERY_STATE.CONFIRMED, self.now + timedelta(seconds=3), 3), (3, 6))
+        eq_(self.conn.hashes[key], {DELIVERY_COUNTERS.CONFIRMED: 2, DELIVERY_COUNTERS.TOTAL: 4})
+
+        # Once again, this time in two batches
+        eq_(self.store.purge(self.def_id, 'd', DELIVERY_STATE.CONFIRMED, self.now + timedelta(seconds=10), 1), (2, 4))
+
+        session = self.session()
+        eq_(sorted(task_id for task_id, in session.query(Delivery.task_id)), ['4', '5'])
+        eq_(sorted(task_id for task_id, in session.query(DeliveryPayload.task_id)), ['4', '5'])
+        eq_(sorted(task_id for task_id, in session.query(DeliveryHistory.task_id)), ['4', '4', '5', '5'])
+        session.close()
+
+        # Nothing to purge and counters that haven't been computed yet aren't touched
+        eq_(self.store.purge(self.def_id, 'd', DELIVERY_STATE.FAILED, self.now + timedelta(seconds=10), 1), (0, 0))
+        eq_(self.conn.hashes[key], {DELIVERY_COUNTERS.CONFIRMED: 0, DELIVERY_COUNTERS.TOTAL: 2})
+
+class RetryDelayTestCase(TestCase):
+    def assert_delay(self, expected, *args):
+        delays = [get_retry_delay(*args) for idx in range(100)]
+
+        # Half of the delay is jitter
+        self.assertTrue(all(expected / 2 <= delay <= expected for delay in delays), delays)
+        self.assertTrue(len(set(delays)) > 1)
+
+    def test_constant(self):
+
+        # Repeats at regular intervals have no jitter
+        for retry_count in range(1, 5):
+            eq_(get_retry_delay(10, retry_count), 10)
+            eq_(get_retry_delay(10, retry_count, 1), 10)
+            eq_(get_retry_delay(10, retry_count, None, 50), 10)
+
+    def test_backoff(self):
+        self.assert_delay(10, 10, 1, 3)
+        self.assert_delay(30, 10, 2, 3)
+        self.assert_delay(90, 10, 3, 3)
+
+    def test_backoff_fraction(self):
+        self.assert_delay(15, 10, 2, 1.5)
+        self.assert_delay(22.5, 10, 3, 1.5)
+
+    def test_max_seconds(self):
+        self.assert_delay(40, 10, 3, 2, 50)
+        self.assert_delay(50, 10, 4, 2, 50)
+        self.assert_delay(50, 10, 40, 2, 50)
+
+# ##############################################################################
+
+class FakeCheckConn(object):
+    """ Keeps the sorted set of checks and the hash of their data in dictionaries.
+    """
+    def __init__(self):
+        self.due = {}
+        self.items = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *ignored_args):
+        pass
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def execute(self):
+        pass
+
+    def hset(self, key, name, value):
+        self.items[name] = value
+
+    def hdel(self, key, name):
+        self.items.pop(name, None)
+
+    def hmget(self, key, names):
+        return [self.items.get(name) for name in names]
+
+    def zadd(self, key, score, name):
+        self.due[name] = score
+
+    def zrem(self, key, name):
+        self.due.pop(name, None)
+
+    def register_script(self, script):
+        def _claim(keys, args):
+            now, lease_until, batch_size = args
+            task_ids = sorted((name for name, score in self.due.items() if score <= now), key=self.due.get)[:batch_size]
+            for task_id in task_ids:
+                self.due[task_id] = lease_until
+            return task_ids
+        return _claim
+
+class DeliveryCheckWheelTestCase(TestCase):
+
+    def setUp(self):
+        self.conn = FakeCheckConn()
+        self.called = []
+        self.wheel = DeliveryCheckWheel(Bunch(conn=self.conn), self.called.append, tick=1, slots=4, lease=120)
+
+    def get_item(self, task_id):
+        return Bunch(task_id=task_id, log_name='my.def/my.target/{}'.format(task_id), invoke_func=self.called.append)
+
+    def run_ticks(self, start, stop):
+        for tick in range(start, stop):
+            self.wheel.run_tick(tick)
+        sleep(0) # So that the greenlets spawned run
+
+    def test_add_run(self):
+        now = time()
+        self.wheel.current_tick = int(now)
+
+        self.wheel.add(self.get_item('a'), 2)
+        self.wheel.add(self.get_item('b'), 10) # More than a revolution of the wheel later
+
+        # Checks are leased and stored without anything that can't be serialized
+        self.assertAlmostEqual(self.conn.due['a'], now + 2 + 120, delta=1)
+        eq_(sorted(loads(self.conn.items['a'])), ['log_name', 'task_id'])
+
+        self.run_ticks(self.wheel.current_tick + 1, self.wheel.current_tick + 4)
+        eq_([item.task_id for item in self.called], ['a'])
+
+        self.run_ticks(self.wheel.current_tick + 4, self.wheel.current_tick + 12)
+        eq_([item.task_id for item in self.called], ['a', 'b'])
+
+        # Both checks are still in the KVDB until they're done
+        eq_(sorted(self.conn.due), ['a', 'b'])
+
+        self.wheel.done('a')
+        eq_(sorted(self.conn.due), ['b'])
+        eq_(sorted(self.conn.items), ['b'])
+
+    def test_recover(self):
+        now = time()
+
+        # Left over by a worker no longer running, one with its data already gone
+        self.conn.items['a'] = dumps({'task_id':'a', 'log_name':'a'})
+        self.conn.due['a'] = now - 1
+        self.conn.due['b'] = now - 1
+
+        # Leased by a worker still running
+        self.conn.due['c'] = now + 100
+
+        self.wheel.recover()
+        sleep(0)
+
+        eq_([item.task_id for item in self.called], ['a'])
+        eq_(self.called[0].invoke_func, None)
+        self.assertAlmostEqual(self.conn.due['a'], now + 120, delta=1)
+        eq_(sorted(self.conn.due), ['a', 'c'])
+
+        # Claimed already
+        self.wheel.recover()
+        sleep(0)
+        eq_(len(self.called), 1)
+
+    def test_stop(self):
+        now = time()
+        self.wheel.current_tick = int(now)
+        self.wheel.add(self.get_item('a'), 5)
+
+        # Checks are released so that other workers run them as soon as they're due
+        self.wheel.stop()
+        self.assertAlmostEqual(self.conn.due['a'], now + 5, delta=1)
+        eq_(sum(len(slot) for slot in self.wheel.wheel), 0)
+
+# ##############################################################################
+
+class FakeSession(object):
+    def __init__(self):
+        self.added = []
+        self.committed = False
+
+    def add(self, value):
+        self.added.append(value)
+
+    def commit(self):
+        if 'fail' in self.added and len(self.added) > 1:
+            raise Exception('Batch failed')
+        self.committed = True
+
+    def close(self):
+        pass
+
+class FakeODB(object):
+    def __init__(self):
+        self.sessions = []
+
+    def session(self):
+        session = FakeSession()
+        self.sessions.append(session)
+        return session
+
+class DeliveryWriterTestCase(TestCase):
+
+    def setUp(self):
+        self.odb = FakeODB()
+        self.writer = DeliveryWriter(self.odb, interval=5, batch_size=10, max_pending=20)
+
+    def _write(self, session, value):
+        session.add(value)
+        return value * 2
+
+    def write_all(self, values):
+        greenlets = [spawn(self.writer.write, self._write, value) for value in values]
+        for greenlet in greenlets:
+            greenlet.join()
+        return greenlets
+
+    def test_batches(self):
+        spawn(self.writer.run)
+        sleep(0)
+
+        greenlets = self.write_all(range(15))
+
+        # Each write gets its own value back, 15 of them are committed in 2 batches
+        eq_([greenlet.value for greenlet in greenlets], [value * 2 for value in range(15)])
+        eq_([len(session.added) for session in self.odb.sessions], [10, 5])
+        eq_([session.committed for session in self.odb.sessions], [True, True])
+
+        self.writer.stop()
+
+    def test_batch_failed(self):
+        spawn(self.writer.run)
+        sleep(0)
+
+        greenlets = self.write_all([1, 'fail', 2])
+
+        # The batch is retried one write at a time so only the one failing write fails
+        eq_([greenlet.value for greenlet in greenlets], [2, 'failfail', 4])
+        eq_([len(session.added) for session in self.odb.sessions], [3, 1, 1, 1])
+        eq_([session.committed for session in self.odb.sessions], [False, True, True, True])
+
+        self.writer.stop()
+
+    def test_not_running(self):
+
+        # Without the greenlet committing batches, each write is committed right away
+        eq_(self.writer.write(self._write, 1), 2)
+        eq_(self.writer.write(self._write, 2), 4)
+        eq_([session.added for session in self.odb.sessions], [[1], [2]])
+
+    def test_max_pending(self):
+        self.writer.keep_running = True # Nothing commits batches so writes stay pending
+
+        greenlets = [spawn(self.writer.write, self._write, value) for value in range(21)]
+        sleep(0)
+
+        # Once 20 writes are queued, the next one is committed in a session of its own
+        eq_(len(self.writer.pending), 20)
+        eq_([session.added for session in self.odb.sessions], [[20]])
+        eq_(greenlets[-1].value, 40)
+
+        self.writer.stop()
+        sleep(0)
+        eq_([greenlet.value for greenlet in greenlets], [value * 2 for value in range(21)])
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2013 Dariusz Suchojad <dsuch at zato.io>
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Compares broker codecs - for each of a few typical SERVICE_PUBLISH messages, such as
+# BrokerClient.invoke_async produces, measures how long it takes to encode and decode
+# one message, how large it is once encoded and how much Redis memory it takes when stored
+# under a key of its own, as messages broadcast to parallel servers are. Needs a Redis
+# server on localhost, its database BENCH_DB is used. Run it with bin/py, e.g.
+# $ ./bin/py ./zato-server/bench/bench_broker_codec.py
+
+# stdlib
+from timeit import timeit
+
+# anyjson
+from anyjson import dumps
+
+# Redis
+import redis
+
+# Zato
+from zato.broker.codec import CODECS, decode
+from zato.common import CHANNEL, DATA_FORMAT
+from zato.common.broker_message import MESSAGE_TYPE, SERVICE
+from zato.common.util import new_cid
+
+ITERATIONS = 20000
+KEYS = 20000
+BENCH_DB = 15
+KEY_PREFIX = 'zato:bench:broker:codec:'
+
+def get_msg(payload, data_format=None):
+    return {
+        'action': SERVICE.PUBLISH,
+        'service': 'zato.bench.broker.codec',
+        'payload': payload,
+        'cid': new_cid(),
+        'channel': CHANNEL.INVOKE_ASYNC,
+        'data_format': data_format,
+        'transport': None,
+        'msg_type': MESSAGE_TYPE.TO_PARALLEL_ANY,
+    }
+
+def get_customer(idx):
+    return {
+        'id': idx,
+        'name': 'Customer {}'.format(idx),
+        'is_active': idx % 2 == 0,
+        'balance': idx * 10.25,
+        'tags': ['retail', 'priority', 'newsletter'],
+        'address': {'street': '{} Main St'.format(idx), 'city': 'Dublin', 'country': 'IE'},
+    }
+
+MESSAGES = (
+    ('no payload', get_msg('')),
+    ('string', get_msg('Lorem ipsum dolor sit amet, consectetur adipiscing elit ' * 4)),
+    ('dict', get_msg({'customers': [get_customer(idx) for idx in range(10)]})),
+    ('JSON in JSON', get_msg(dumps({'customers': [get_customer(idx) for idx in range(10)]}), DATA_FORMAT.JSON)),
+)
+
+def get_memory(conn, codec, msg):
+    """ Returns how many bytes of Redis memory a message stored under a key of its own takes, on average.
+    """
+    conn.flushdb()
+    before = conn.info()['used_memory']
+
+    encoded = codec.encode(msg)
+    with conn.pipeline(transaction=False) as p:
+        for idx in range(KEYS):
+            p.set('{}{}'.format(KEY_PREFIX, new_cid()), encoded)
+        p.execute()
+
+    used = conn.info()['used_memory'] - before
+    conn.flushdb()
+
+    return used / KEYS
+
+def main():
+    conn = redis.StrictRedis(db=BENCH_DB)
+
+    print('{:>14} {:>8} {:>14} {:>14} {:>10} {:>14}'.format(
+        'message', 'codec', 'encode [us]', 'decode [us]', 'size [B]', 'Redis [B/key]'))
+
+    for msg_name, msg in MESSAGES:
+        for codec_name, codec in sorted(CODECS.items()):
+            encoded = codec.encode(msg)
+            assert decode(encoded) == decode(CODECS['json'].encode(msg))
+
+            encode_time = timeit(lambda: codec.encode(msg), number=ITERATIONS) / ITERATIONS * 1e6
+            decode_time = timeit(lambda: decode(encoded), number=ITERATIONS) / ITERATIONS * 1e6
+
+            print('{:>14} {:>8} {:>14.2f} {:>14.2f} {:>10} {:>14.0f}'.format(
+                msg_name, codec_name, encode_time, decode_time, len(encoded), get_memory(conn, codec, msg)))
+
+if __name__ == '__main__':
+    main()
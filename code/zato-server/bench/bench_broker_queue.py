@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2013 Dariusz Suchojad <dsuch at zato.io>
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Benchmark of async invocations going through the broker - compares messages broadcast
+# to all the workers which then race to claim them with messages taken off a work queue,
+# for a growing number of worker processes. Each message takes 1 ms to process.
+# Needs a Redis server on localhost, its database BENCH_DB is used. Run it with bin/py, e.g.
+# $ ./bin/py ./zato-server/bench/bench_broker_queue.py
+
+# stdlib
+from multiprocessing import Process
+from time import sleep, time
+
+# Redis
+import redis
+
+# Zato
+from zato.broker.work_queue import WorkQueue
+from zato.common import BROKER
+from zato.common.util import new_cid
+
+MESSAGES = 2000
+WORKERS = (1, 2, 4, 8)
+PROCESSING_TIME = 0.001 # In seconds
+BENCH_DB = 15
+
+TOPIC = 'zato:bench:broker:topic'
+KEY_PREFIX = 'zato:bench:broker:msg:'
+READY = 'zato:bench:broker:ready'
+DONE = 'zato:bench:broker:done'
+
+def get_conn():
+    return redis.StrictRedis(db=BENCH_DB)
+
+def process(conn):
+    sleep(PROCESSING_TIME)
+    conn.incr(DONE)
+
+def broadcast_worker():
+    conn = get_conn()
+    pubsub = conn.pubsub()
+    pubsub.subscribe(TOPIC)
+    conn.incr(READY)
+
+    for msg in pubsub.listen():
+        if msg['type'] != 'message':
+            continue
+
+        if msg['data'] == 'stop':
+            break
+
+        # The same dance BrokerClient.on_message does in order to claim a message
+        tmp_key = '{}.tmp'.format(msg['data'])
+        try:
+            conn.rename(msg['data'], tmp_key)
+        except redis.ResponseError:
+            continue
+        else:
+            conn.get(tmp_key)
+            conn.delete(tmp_key)
+            process(conn)
+
+def broadcast_producer(conn):
+    for idx in range(MESSAGES):
+        key = '{}{}'.format(KEY_PREFIX, new_cid())
+        conn.set(key, 'msg')
+        conn.expire(key, BROKER.DEFAULT_EXPIRATION)
+        conn.publish(TOPIC, key)
+
+def broadcast_stop(conn, workers):
+    conn.publish(TOPIC, 'stop')
+
+def queue_worker():
+    conn = get_conn()
+    queue = WorkQueue(conn, 'bench-{}'.format(new_cid()))
+    conn.incr(READY)
+
+    def on_message(msg, item):
+        if msg == 'stop':
+            queue.ack(item)
+            queue.close()
+        else:
+            process(conn)
+            queue.ack(item)
+
+    queue.consume(on_message)
+
+def queue_producer(conn):
+    queue = WorkQueue(conn)
+    for idx in range(MESSAGES):
+        queue.put('msg')
+
+def queue_stop(conn, workers):
+    queue = WorkQueue(conn)
+    for idx in range(workers):
+        queue.put('stop')
+
+def run(worker, producer, stop, workers):
+    conn = get_conn()
+    conn.flushdb()
+
+    processes = [Process(target=worker) for idx in range(workers)]
+    for p in processes:
+        p.start()
+
+    while int(conn.get(READY) or 0) < workers:
+        sleep(0.01)
+
+    start = time()
+    producer(conn)
+
+    while int(conn.get(DONE) or 0) < MESSAGES:
+        sleep(0.001)
+
+    elapsed = time() - start
+
+    stop(conn, workers)
+    for p in processes:
+        p.join()
+
+    return MESSAGES / elapsed
+
+def main():
+    print('{:>8} {:>20} {:>20}'.format('workers', 'broadcast [msg/s]', 'work queue [msg/s]'))
+
+    for workers in WORKERS:
+        broadcast = run(broadcast_worker, broadcast_producer, broadcast_stop, workers)
+        queue = run(queue_worker, queue_producer, queue_stop, workers)
+
+        print('{:>8} {:>20.0f} {:>20.0f}'.format(workers, broadcast, queue))
+
+if __name__ == '__main__':
+    main()
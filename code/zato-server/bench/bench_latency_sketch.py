@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2013 Dariusz Suchojad <dsuch at zato.io>
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Compares aggregating response times kept as raw lists, which is what the statistics
+# used to do, with aggregating them out of latency sketches, for a growing number of times.
+# Shows how long it takes to compute p50/p95/p99, how many bytes the data takes
+# in the KVDB and the worst relative error of the percentiles. Run it with bin/py, e.g.
+# $ ./bin/py ./zato-server/bench/bench_latency_sketch.py
+
+# stdlib
+from random import Random
+from time import time
+
+# SciPy
+from scipy import stats as sp_stats
+
+# Zato
+from zato.server.stats import LatencySketch, PERCENTILES
+
+TIMES = (1000, 10000, 100000, 1000000)
+
+def get_times(count):
+    random = Random(1)
+    return [int(random.lognormvariate(3, 1)) for x in range(count)]
+
+def raw(times):
+    start = time()
+    result = [sp_stats.scoreatpercentile(times, percentile) for percentile in PERCENTILES]
+    return time() - start, sum(len(str(elem)) for elem in times), result
+
+def sketched(times):
+    sketch = LatencySketch()
+    for value in times:
+        sketch.add(value)
+
+    # Only the time spent on reading percentiles off a sketch that's already in the KVDB counts
+    data = sketch.dumps()
+
+    start = time()
+    sketch = LatencySketch.loads(data)
+    result = [sketch.get_percentile(percentile) for percentile in PERCENTILES]
+    return time() - start, len(data), result
+
+def main():
+    print('{:>10} {:>14} {:>14} {:>14} {:>14} {:>10}'.format(
+        'times', 'raw [ms]', 'raw [bytes]', 'sketch [ms]', 'sketch [bytes]', 'error [%]'))
+
+    for count in TIMES:
+        times = get_times(count)
+
+        raw_time, raw_size, expected = raw(times)
+        sketch_time, sketch_size, result = sketched(times)
+
+        error = max(abs(value - elem) / elem for value, elem in zip(result, expected) if elem)
+
+        print('{:>10} {:>14.2f} {:>14} {:>14.2f} {:>14} {:>10.2f}'.format(
+            count, raw_time * 1000, raw_size, sketch_time * 1000, sketch_size, error * 100))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2013 Dariusz Suchojad <dsuch at zato.io>
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Microbenchmark of RequestHandler.handle - invokes a service which does nothing
+# so what is measured is the overhead of the invocation machinery alone, both with
+# new instances created for each request and with instances taken from a pool.
+# Run it with bin/py, e.g.
+# $ ./bin/py ./zato-server/bench/bench_request_handler.py
+
+# stdlib
+from timeit import repeat
+
+# Bunch
+from bunch import Bunch
+
+# Zato
+from zato.common import PARAMS_PRIORITY, URL_TYPE
+from zato.common.test import FakeKVDB
+from zato.common.util import new_cid
+from zato.server.connection.http_soap.channel import RequestHandler
+from zato.server.service import Outgoing, Service
+from zato.server.service.store import ServiceStore
+
+NUMBER = 10000
+REPEAT = 3
+POOL_SIZES = (0, 100)
+
+class Empty(Service):
+    def handle(self):
+        pass
+
+class StatsBuffer(object):
+    """ Doesn't store anything so that statistics aren't part of what's measured.
+    """
+    def incr_usage(self, name):
+        return 1
+
+    def add_time(self, *ignored):
+        pass
+
+    def should_store_req_resp(self, *ignored):
+        return None, 0
+
+def get_handler(pool_size):
+    impl_name = Empty.get_impl_name()
+
+    service_store = ServiceStore()
+    service_store.services = {impl_name: {'service_class': Empty, 'slow_threshold': 99999}}
+    service_store.instance_pool_size = pool_size
+
+    Empty.get_invocation_plan()
+
+    server = Bunch()
+    server.kvdb = FakeKVDB()
+    server.kvdb.translate = None
+    server.service_store = service_store
+    server.delivery_store = None
+    server.stats_buffer = StatsBuffer()
+
+    worker_store = Bunch()
+    worker_store.odb = None
+    worker_store.kvdb = server.kvdb
+    worker_store.broker_client = None
+    worker_store.get_outgoing = lambda: Outgoing()
+
+    channel_item = Bunch()
+    channel_item.service_impl_name = impl_name
+    channel_item.merge_url_params_req = False
+    channel_item.data_format = None
+    channel_item.transport = URL_TYPE.PLAIN_HTTP
+    channel_item.params_pri = PARAMS_PRIORITY.DEFAULT
+
+    handler = RequestHandler(server)
+
+    def handle():
+        return handler.handle(new_cid(), Bunch(), channel_item, {}, '', worker_store, {})
+
+    return handle
+
+def main():
+    print('{:>10} {:>20}'.format('pool size', 'handle [us]'))
+
+    for pool_size in POOL_SIZES:
+        handle = get_handler(pool_size)
+        result = min(repeat(handle, repeat=REPEAT, number=NUMBER)) / NUMBER * 1000000
+
+        print('{:>10} {:>20.2f}'.format(pool_size, result))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2013 Dariusz Suchojad <dsuch at zato.io>
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Compares how many invocations a second Service.pre_handle and Service.post_handle
+# can cope with when service statistics are written directly to the KVDB on each invocation
+# vs. when they are buffered in memory and flushed in pipelines. Needs a local redis-server,
+# run it with bin/py, e.g.
+# $ ./bin/py ./zato-server/bench/bench_service_stats.py [host] [port] [db]
+
+# stdlib
+import sys
+from time import time
+
+# Bunch
+from bunch import Bunch
+
+# Redis
+from redis import StrictRedis
+
+# Zato
+from zato.common import KVDB
+from zato.server.service import Service
+from zato.server.stats import ServiceStatsBuffer
+
+INVOCATIONS = 20000
+SERVICES = 20
+
+class BenchService(Service):
+    pass
+
+def get_services(kvdb, stats_buffer):
+    services = []
+    server = Bunch(stats_buffer=stats_buffer)
+
+    for idx in range(SERVICES):
+        service = BenchService()
+        service.name = 'zato.bench.service-stats.{}'.format(idx)
+        service.server = server
+        service.kvdb = kvdb
+        services.append(service)
+
+    return services
+
+def run(kvdb, stats_buffer):
+    services = get_services(kvdb, stats_buffer)
+
+    start = time()
+    for idx in range(INVOCATIONS):
+        service = services[idx % SERVICES]
+        service.pre_handle()
+        service.post_handle()
+
+    if stats_buffer:
+        stats_buffer.flush()
+
+    return INVOCATIONS / (time() - start)
+
+def cleanup(kvdb):
+    for pattern in(KVDB.SERVICE_USAGE, KVDB.SERVICE_TIME_BASIC, KVDB.SERVICE_TIME_SKETCH,
+            KVDB.SERVICE_TIME_SKETCH_BY_MINUTE):
+        keys = kvdb.conn.keys('{}zato.bench.service-stats.*'.format(pattern))
+        if keys:
+            kvdb.conn.delete(*keys)
+
+def main():
+    host = sys.argv[1] if len(sys.argv) > 1 else 'localhost'
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 6379
+    db = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+
+    kvdb = Bunch(conn=StrictRedis(host=host, port=port, db=db))
+    cleanup(kvdb)
+
+    try:
+        direct = run(kvdb, None)
+        cleanup(kvdb)
+
+        print('{:>28} {:>12}'.format('mode', 'req/s'))
+        print('{:>28} {:>12.0f}'.format('direct', direct))
+
+        for flush_max_samples in(100, 1000, 10000):
+            buffered = run(kvdb, ServiceStatsBuffer(kvdb, 500, flush_max_samples))
+            cleanup(kvdb)
+            print('{:>28} {:>12.0f}'.format('buffered, {} samples'.format(flush_max_samples), buffered))
+    finally:
+        cleanup(kvdb)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2013 Dariusz Suchojad <dsuch at zato.io>
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Microbenchmark of SimpleIOPayload.getvalue - serializes responses of 10 up to 10,000
+# repeated elements to JSON and XML, the latter both with the compiled output plan
+# and with objectify building the whole tree. Run it with bin/py, e.g.
+# $ ./bin/py ./zato-server/bench/bench_simple_io.py
+
+# stdlib
+import logging
+from timeit import repeat
+
+# Zato
+from zato.common import SIMPLE_IO
+from zato.server.service import AsIs, Boolean, get_output_plan, Integer, OutputPlan, SimpleIOPayload
+
+ITEM_COUNTS = (10, 100, 1000, 10000)
+REPEAT = 3
+
+logger = logging.getLogger(__name__)
+
+simple_io_config = {
+    'bool_parameter_prefixes': ['is_', 'should_'],
+    'int_parameters': ['id'],
+    'int_parameter_suffixes': ['_id', '_count'],
+}
+
+class SimpleIO:
+    output_required = ('id', 'name', 'is_active', 'user_id', Boolean('flag'))
+    output_optional = ('description', AsIs('group_id'), Integer('size'))
+
+def get_items(count):
+    return [{'id':str(idx), 'name':'name-{}'.format(idx), 'is_active':'true', 'user_id':str(idx * 10),
+             'flag':'false', 'description':'', 'group_id':'123', 'size':str(idx)} for idx in range(count)]
+
+def serialize(items, data_format, plan):
+    payload = SimpleIOPayload('cid', logger, data_format, plan.required_list, plan.optional_list,
+        simple_io_config, plan.response_elem, plan.namespace, plan)
+    payload[:] = items
+    return payload.getvalue()
+
+def bench(func, count):
+    number = max(10000 // count, 1)
+    return min(repeat(func, repeat=REPEAT, number=number)) / number * 1000
+
+def main():
+    plan = get_output_plan(SimpleIO, simple_io_config)
+
+    objectify_plan = OutputPlan(SimpleIO, simple_io_config)
+    objectify_plan.xml_fast = False
+
+    print('{:>8} {:>16} {:>16} {:>20}'.format('items', 'JSON [ms]', 'XML [ms]', 'XML objectify [ms]'))
+
+    for count in ITEM_COUNTS:
+        items = get_items(count)
+
+        assert serialize(items, SIMPLE_IO.FORMAT.XML, plan) == serialize(items, SIMPLE_IO.FORMAT.XML, objectify_plan)
+
+        json = bench(lambda: serialize(items, SIMPLE_IO.FORMAT.JSON, plan), count)
+        xml = bench(lambda: serialize(items, SIMPLE_IO.FORMAT.XML, plan), count)
+        xml_objectify = bench(lambda: serialize(items, SIMPLE_IO.FORMAT.XML, objectify_plan), count)
+
+        print('{:>8} {:>16.2f} {:>16.2f} {:>20.2f}'.format(count, json, xml, xml_objectify))
+
+if __name__ == '__main__':
+    main()
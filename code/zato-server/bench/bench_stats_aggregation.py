@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2013 Dariusz Suchojad <dsuch at zato.io>
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Compares StatsReturningService.get_stats, which reads statistics in pipelines
+# and aggregates them with NumPy, with the previous implementation that used
+# a round-trip to the KVDB for each service and minute and aggregated them in Python loops.
+# Runs over a one-day range of per-minute statistics of SERVICES services. Needs a Redis
+# server on localhost, its database BENCH_DB is used. Run it with bin/py, e.g.
+# $ ./bin/py ./zato-server/bench/bench_stats_aggregation.py
+
+# stdlib
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from random import Random
+from time import time
+
+# Bunch
+from bunch import Bunch
+
+# dateutil
+from dateutil.parser import parse
+
+# Redis
+import redis
+
+# SciPy
+from scipy import stats as sp_stats
+
+# Zato
+from zato.common import KVDB, StatsElem
+from zato.server.service.internal.stats import STATS_KEYS, StatsReturningService
+from zato.server.stats import StatsIndex
+
+SERVICES = 500
+START = datetime(2013, 11, 12)
+STOP = START + timedelta(days=1)
+PIPELINE_BATCH_SIZES = (100, 500, 2000)
+BENCH_DB = 15
+
+class Legacy(StatsReturningService):
+    """ How get_stats used to read and aggregate the data.
+    """
+    def get_stats(self, start, stop, service='*', n=None, n_type=None, needs_trends=True,
+            stats_key_prefix=None, suffixes=None):
+
+        stats_key_prefix = stats_key_prefix or self.stats_key_prefix
+        stats_elems = {}
+        all_services_stats = Bunch({'usage':0, 'time':0})
+        mean_all_services_list = []
+
+        start = parse(start)
+        stop = parse(stop)
+        delta_seconds = (stop - start).total_seconds()
+        suffixes = suffixes or self.get_suffixes(start, stop)
+
+        stats_index = StatsIndex(self.server.kvdb.conn)
+
+        for suffix in suffixes:
+            for service_name in stats_index.get_services(stats_key_prefix, suffix):
+                stats_elem = stats_elems[service_name] = StatsElem(service_name)
+                stats_elem.expected_time_elems = OrderedDict(
+                    (elem, Bunch({'mean':0, 'usage':0.0})) for elem in suffixes)
+
+        for service, stats_elem in stats_elems.items():
+            for suffix in suffixes:
+                key = '{}{}:{}'.format(stats_key_prefix, service, suffix)
+                key_values = Bunch(
+                    ((name, float(value)) for (name, value) in self.server.kvdb.conn.hgetall(key).items()
+                        if name in STATS_KEYS))
+
+                if key_values:
+                    time = (key_values.usage * key_values.mean)
+                    stats_elem.time += time
+
+                    mean_all_services_list.append(key_values.mean)
+                    all_services_stats.time += time
+                    all_services_stats.usage += key_values.usage
+
+                    stats_elem.min_resp_time = min(stats_elem.min_resp_time, key_values.min)
+                    stats_elem.max_resp_time = max(stats_elem.max_resp_time, key_values.max)
+
+                    for attr in('mean', 'usage'):
+                        stats_elem.expected_time_elems[suffix][attr] = key_values[attr]
+
+        mean_all_services = '{:.0f}'.format(sp_stats.tmean(mean_all_services_list)) if mean_all_services_list else 0
+
+        for stats_elem in stats_elems.values():
+            stats_elem.mean_all_services = mean_all_services
+            stats_elem.all_services_time = int(all_services_stats.time)
+            stats_elem.all_services_usage = int(all_services_stats.usage)
+
+            values = stats_elem.expected_time_elems.values()
+
+            stats_elem.mean_trend_int = [int(elem.mean) for elem in values]
+            stats_elem.usage_trend_int = [int(elem.usage) for elem in values]
+
+            stats_elem.mean = float('{:.2f}'.format(sp_stats.tmean(stats_elem.mean_trend_int)))
+            stats_elem.usage = sum(stats_elem.usage_trend_int)
+            stats_elem.rate = float('{:.2f}'.format(sum(stats_elem.usage_trend_int) / delta_seconds))
+
+            self.set_percent_of_all_services(all_services_stats, stats_elem)
+
+            if needs_trends:
+                stats_elem.mean_trend = ','.join(str(elem) for elem in stats_elem.mean_trend_int)
+                stats_elem.usage_trend = ','.join(str(elem) for elem in stats_elem.usage_trend_int)
+
+        if n:
+            for stats_elem in self.yield_top_n(n, n_type, stats_elems):
+                yield stats_elem
+        else:
+            for stats_elem in stats_elems.values():
+                yield stats_elem
+
+def populate(conn, suffixes):
+    random = Random(1)
+    prefix = KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE
+    index = StatsIndex(conn)
+
+    for suffix in suffixes:
+        with conn.pipeline(transaction=False) as p:
+            for idx in range(SERVICES):
+                name = 'zato.bench.stats.{}'.format(idx)
+                usage = random.randint(1, 1000)
+                mean = random.randint(1, 100)
+                p.hmset('{}{}:{}'.format(prefix, name, suffix), {
+                    'usage':usage, 'mean':mean, 'min':random.randint(0, mean), 'max':random.randint(mean, 1000),
+                    'rate':usage / 60.0})
+                index.add(prefix, name, suffix, p)
+            p.execute()
+
+def run(service_class, conn, batch_size, suffixes):
+    service = service_class()
+    service.server = Bunch(kvdb=Bunch(conn=conn), stats_pipeline_batch_size=batch_size, stats_archive=None)
+
+    start = time()
+    result = list(service.get_stats(START.isoformat(), STOP.isoformat(), n=10, n_type='usage', suffixes=suffixes))
+    return time() - start, [elem.service_name for elem in result]
+
+def main():
+    conn = redis.StrictRedis(db=BENCH_DB)
+    conn.flushdb()
+
+    suffixes = StatsReturningService().get_suffixes(START, STOP)
+
+    print('Populating {} services x {} minutes'.format(SERVICES, len(suffixes)))
+    populate(conn, suffixes)
+
+    try:
+        print('{:>24} {:>12}'.format('implementation', 'time [s]'))
+
+        legacy, expected = run(Legacy, conn, None, suffixes)
+        print('{:>24} {:>12.2f}'.format('legacy', legacy))
+
+        for batch_size in PIPELINE_BATCH_SIZES:
+            result, top = run(StatsReturningService, conn, batch_size, suffixes)
+            assert top == expected, (top, expected)
+            print('{:>24} {:>12.2f}'.format('pipelined, {} commands'.format(batch_size), result))
+    finally:
+        conn.flushdb()
+
+if __name__ == '__main__':
+    main()
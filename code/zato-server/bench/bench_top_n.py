@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2013 Dariusz Suchojad <dsuch at zato.io>
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Compares finding top N services with per-minute statistics of all the services read
+# and sorted with finding them out of unions of sorted sets of heavy hitters, rolled up into hours,
+# and reading statistics of these N services only. Runs over a range of HOURS hours, starting
+# and ending half an hour past a full hour, of SERVICES services each of which is invoked
+# in a given minute with a probability of ACTIVE. Needs a Redis server on localhost,
+# its database BENCH_DB is used. Run it with bin/py, e.g.
+# $ ./bin/py ./zato-server/bench/bench_top_n.py
+
+# stdlib
+from datetime import datetime, timedelta
+from random import Random
+from time import time
+
+# Bunch
+from bunch import Bunch
+
+# Redis
+import redis
+
+# Zato
+from zato.common import KVDB
+from zato.server.service.internal.stats import StatsReturningService
+from zato.server.stats import HeavyHitters, StatsIndex, TOP_N_TYPES
+
+SERVICES = 5000
+ACTIVE = 0.1
+HOURS = 6
+N = 10
+START = datetime(2013, 11, 12)
+BENCH_DB = 15
+
+class ReadAll(StatsReturningService):
+    """ Reads statistics of all the services to find top N ones.
+    """
+    def get_top_n(self, *ignored):
+        return None
+
+def populate(conn):
+    random = Random(1)
+    minute, hour = KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE, KVDB.SERVICE_TIME_AGGREGATED_BY_HOUR
+    index = StatsIndex(conn)
+    heavy_hitters = HeavyHitters(conn)
+
+    for hour_idx in range(HOURS + 1):
+        hour_start = START + timedelta(hours=hour_idx)
+        minute_suffixes = []
+
+        for minute_idx in range(60):
+            suffix = (hour_start + timedelta(minutes=minute_idx)).strftime('%Y:%m:%d:%H:%M')
+            minute_suffixes.append(suffix)
+            stats = []
+
+            with conn.pipeline(transaction=False) as p:
+                for idx in range(SERVICES):
+                    if random.random() > ACTIVE:
+                        continue
+
+                    name = 'zato.bench.stats.{}'.format(idx)
+                    usage = random.randint(1, 1000)
+                    mean = random.randint(1, 100)
+
+                    p.hmset('{}{}:{}'.format(minute, name, suffix), {
+                        'usage':usage, 'mean':mean, 'min':random.randint(0, mean), 'max':random.randint(mean, 1000),
+                        'rate':usage / 60.0})
+                    index.add(minute, name, suffix, p)
+                    stats.append((name, usage, mean))
+
+                heavy_hitters.add_bucket(minute, suffix, stats, p)
+                p.execute()
+
+        heavy_hitters.rollup(hour, hour_start.strftime('%Y:%m:%d:%H'), minute, minute_suffixes)
+
+def run(service_class, conn, n_type):
+    service = service_class()
+    service.server = Bunch(kvdb=Bunch(conn=conn), stats_pipeline_batch_size=500, stats_archive=None)
+
+    start = START + timedelta(minutes=30)
+    stop = start + timedelta(hours=HOURS)
+
+    started = time()
+    result = list(service.get_stats(start.isoformat(), stop.isoformat(), n=N, n_type=n_type))
+    return time() - started, [elem.service_name for elem in result]
+
+def main():
+    conn = redis.StrictRedis(db=BENCH_DB)
+    conn.flushdb()
+
+    print('Populating {} services x {} minutes'.format(SERVICES, (HOURS + 1) * 60))
+    populate(conn)
+
+    try:
+        print('{:>8} {:>20} {:>20}'.format('n_type', 'read all [s]', 'heavy hitters [s]'))
+
+        for n_type in TOP_N_TYPES:
+            read_all, expected = run(ReadAll, conn, n_type)
+            heavy_hitters, top = run(StatsReturningService, conn, n_type)
+            assert top == expected, (top, expected)
+
+            print('{:>8} {:>20.2f} {:>20.2f}'.format(n_type, read_all, heavy_hitters))
+    finally:
+        conn.flushdb()
+
+if __name__ == '__main__':
+    main()
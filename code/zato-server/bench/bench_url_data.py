@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2013 Dariusz Suchojad <dsuch at zato.io>
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Microbenchmark of URLData.match - compares the route index against a linear scan
+# of all the channels for 10 up to 10,000 channels. Run it with bin/py, e.g.
+# $ ./bin/py ./zato-server/bench/bench_url_data.py
+
+# stdlib
+from timeit import repeat
+
+# Bunch
+from bunch import Bunch
+
+# parse
+from parse import compile as parse_compile
+
+# Zato
+from zato.common import MISC
+from zato.server.connection.http_soap.url_data import URLData
+
+CHANNEL_COUNTS = (10, 100, 1000, 10000)
+REPEAT = 3
+NUMBER = 2000
+
+def get_channel_data(count):
+    """ Half of the channels use exact paths, the other half has placeholders.
+    """
+    channel_data = []
+    for idx in range(count):
+        if idx % 2:
+            url_path = '/app/{}/customer/{{cid}}/order/{{oid}}'.format(idx)
+        else:
+            url_path = '/app/{}/status'.format(idx)
+
+        item = Bunch()
+        item.match_target = '{}{}{}'.format('', MISC.SEPARATOR, url_path)
+        item.match_target_compiled = parse_compile(item.match_target)
+        channel_data.append(item)
+
+    return channel_data
+
+def linear_match(channel_data, url_path, soap_action):
+    target = '{}{}{}'.format(soap_action, MISC.SEPARATOR, url_path)
+    for item in channel_data:
+        match = item.match_target_compiled.parse(target)
+        if match:
+            return match, item
+
+    return None, None
+
+def bench(func, number=NUMBER):
+    return min(repeat(func, repeat=REPEAT, number=number)) / number * 1000000
+
+def main():
+    print('{:>8} {:>16} {:>16} {:>16}'.format('channels', 'linear [us]', 'index [us]', 'index miss [us]'))
+
+    for count in CHANNEL_COUNTS:
+        channel_data = get_channel_data(count)
+        url_data = URLData(channel_data)
+
+        # Last channel with placeholders, i.e. the worst case for a linear scan
+        last = count - 1 if (count - 1) % 2 else count - 2
+        url_path = '/app/{}/customer/123/order/456'.format(last)
+
+        assert url_data.match(url_path, '')[1] is linear_match(channel_data, url_path, '')[1]
+
+        # Linear scans are repeated fewer times for larger counts, they'd take ages otherwise
+        linear = bench(lambda: linear_match(channel_data, url_path, ''), max(NUMBER * 10 // count, 10))
+        indexed = bench(lambda: url_data.match(url_path, ''))
+        miss = bench(lambda: url_data.match('/app/{}/no-such-path'.format(last), ''))
+
+        print('{:>8} {:>16.2f} {:>16.2f} {:>16.2f}'.format(count, linear, indexed, miss))
+
+if __name__ == '__main__':
+    main()
@@ -37,10 +37,11 @@ from retools.lock import Lock
 
 # Zato
 from zato.broker.client import BrokerClient
-from zato.common import CHANNEL, KVDB, MISC, SERVER_JOIN_STATUS, SERVER_UP_STATUS,\
+from zato.common import BROKER, CHANNEL, KVDB, MISC, SERVER_JOIN_STATUS, SERVER_UP_STATUS,\
      ZATO_ODB_POOL_NAME
 from zato.common.broker_message import AMQP_CONNECTOR, code_to_name, HOT_DEPLOY,\
      JMS_WMQ_CONNECTOR, MESSAGE_TYPE, SERVICE, TOPICS, ZMQ_CONNECTOR
+from zato.common.delivery import WRITE_BATCH_SIZE, WRITE_INTERVAL, WRITE_MAX_PENDING
 from zato.common.util import add_startup_jobs, new_cid
 from zato.server.base import BrokerMessageReceiver
 from zato.server.base.worker import WorkerStore
@@ -52,6 +53,9 @@ from zato.server.connection.jms_wmq.outgoing import start_connector as jms_wmq_o
 from zato.server.connection.zmq_.channel import start_connector as zmq_channel_start_connector
 from zato.server.connection.zmq_.outgoing import start_connector as zmq_outgoing_start_connector
 from zato.server.pickup import get_pickup
+from zato.server.service import is_stream
+from zato.server.stats import ARCHIVE_AFTER, DELETE_BATCH_SIZE, MaintenanceTool, PIPELINE_BATCH_SIZE, ServiceStatsBuffer, \
+     StatsArchive, StatsIndex
 
 logger = logging.getLogger(__name__)
 
@@ -92,6 +96,11 @@ class ParallelServer(DisposableObject, BrokerMessageReceiver):
         self.app_context = None
         self.has_gevent = None
         self.delivery_store = None
+        self.stats_buffer = None
+        self.stats_pipeline_batch_size = PIPELINE_BATCH_SIZE
+        self.stats_delete_batch_size = DELETE_BATCH_SIZE
+        self.stats_archive = None
+        self.stats_archive_after = ARCHIVE_AFTER
         
         # The main config store
         self.config = ConfigStore()
@@ -116,6 +125,11 @@ class ParallelServer(DisposableObject, BrokerMessageReceiver):
         headers = ((k.encode('utf-8'), v.encode('utf-8')) for k, v in wsgi_environ['zato.http.response.headers'].items())
         start_response(wsgi_environ['zato.http.response.status'], headers)
         
+        # Streamed responses have no length known up front so the WSGI server sends them
+        # using chunked transfer encoding - one chunk each time the iterator yields data.
+        if is_stream(payload):
+            return payload
+        
         return [payload]
     
     def maybe_on_first_worker(self, server, redis_conn, deployment_key):
@@ -167,6 +181,9 @@ class ParallelServer(DisposableObject, BrokerMessageReceiver):
                 # .. deploy them back.
                 import_initial_services_jobs()
                 
+                # .. and index statistics stored by any previous version.
+                StatsIndex(redis_conn).migrate()
+                
                 # Add the flag to Redis indicating that this server has already
                 # deployed its services. Note that by default the expiration
                 # time is more than a century in the future. It will be cleared out
@@ -191,6 +208,25 @@ class ParallelServer(DisposableObject, BrokerMessageReceiver):
         self.kvdb.server = self
         self.kvdb.decrypt_func = self.crypto_manager.decrypt
         self.kvdb.init()
+        
+        # Service statistics buffer - new in 1.2 so the whole section is optional
+        stats_config = self.fs_server_config.get('stats', {})
+        if asbool(stats_config.get('buffered', False)):
+            self.stats_buffer = ServiceStatsBuffer(self.kvdb,
+                int(stats_config.get('flush_interval', 500)), int(stats_config.get('flush_max_samples', 1000)))
+            self.stats_buffer.start()
+            
+        self.stats_pipeline_batch_size = int(stats_config.get('pipeline_batch_size', PIPELINE_BATCH_SIZE))
+        self.stats_delete_batch_size = int(stats_config.get('delete_batch_size', DELETE_BATCH_SIZE))
+        
+        # Statistics are archived on disk only if there's a directory to archive them in
+        archive_dir = stats_config.get('archive_dir')
+        if archive_dir:
+            self.stats_archive = StatsArchive(os.path.normpath(os.path.join(self.repo_location, archive_dir)))
+            self.stats_archive_after = int(stats_config.get('archive_after', ARCHIVE_AFTER))
+            
+        # Reusing service instances is optional and new in 1.2 as well
+        self.service_store.instance_pool_size = int(self.fs_server_config.misc.get('service_instance_pool_size', 0))
 
         # Service sources
         self.service_sources = []
@@ -228,7 +264,14 @@ class ParallelServer(DisposableObject, BrokerMessageReceiver):
         if is_first:
             broker_callbacks[TOPICS[MESSAGE_TYPE.TO_SINGLETON]] = self.on_broker_msg_singleton
         
-        self.broker_client = BrokerClient(self.kvdb, 'parallel', broker_callbacks)
+        # Async invocations may go through a work queue instead of being broadcast to all the workers,
+        # note that it needs to be configured in the same way on all the servers in a cluster.
+        broker_config = self.fs_server_config.get('broker', {})
+        self.broker_client = BrokerClient(self.kvdb, 'parallel', broker_callbacks,
+            asbool(broker_config.get('work_queue', False)),
+            int(broker_config.get('work_queue_requeue_after', BROKER.WORK_QUEUE_REQUEUE_AFTER)),
+            broker_config.get('codec', BROKER.DEFAULT_CODEC),
+            int(broker_config.get('pool_size', BROKER.DEFAULT_POOL_SIZE)))
         
         if is_first:
             
@@ -253,6 +296,10 @@ class ParallelServer(DisposableObject, BrokerMessageReceiver):
             self.singleton_server.scheduler.wait_for_init()
             self.singleton_server.server_id = server.id
             
+            # Finish deleting statistics if the server crashed before it was done with it
+            stats_maint = MaintenanceTool(self.kvdb.conn, self.stats_delete_batch_size, self.stats_pipeline_batch_size)
+            Thread(target=stats_maint.resume).start()
+            
         return is_first
                         
     def _after_init_accepted(self, server, deployment_key):
@@ -546,6 +593,13 @@ class ParallelServer(DisposableObject, BrokerMessageReceiver):
         parallel_server.delivery_store.broker_client = parallel_server.broker_client
         parallel_server.delivery_store.odb = parallel_server.odb
         parallel_server.delivery_store.delivery_lock_timeout = float(parallel_server.fs_server_config.misc.delivery_lock_timeout)
+        parallel_server.delivery_store.writer.interval = float(
+            parallel_server.fs_server_config.misc.get('delivery_write_interval', WRITE_INTERVAL)) / 1000.0
+        parallel_server.delivery_store.writer.batch_size = int(
+            parallel_server.fs_server_config.misc.get('delivery_write_batch_size', WRITE_BATCH_SIZE))
+        parallel_server.delivery_store.writer.max_pending = int(
+            parallel_server.fs_server_config.misc.get('delivery_write_max_pending', WRITE_MAX_PENDING))
+        parallel_server.delivery_store.start()
         
         if is_first:
             parallel_server.invoke_startup_services()
@@ -561,6 +615,12 @@ class ParallelServer(DisposableObject, BrokerMessageReceiver):
     def destroy(self):
         """ A Spring Python hook for closing down all the resources held.
         """
+        if self.stats_buffer:
+            self.stats_buffer.stop()
+            
+        if self.delivery_store:
+            self.delivery_store.stop()
+            
         if self.singleton_server:
             
             # Close all the connector subprocesses this server has possibly started
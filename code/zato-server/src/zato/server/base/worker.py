@@ -13,7 +13,7 @@ import logging, inspect, os, socket, sys, traceback
 from copy import deepcopy
 from errno import ENOENT
 from threading import RLock
-from time import sleep
+from time import time
 from traceback import format_exc
 from uuid import uuid4
 
@@ -22,8 +22,6 @@ from bunch import Bunch
 
 # dateutil
 from dateutil.parser import parse
-from dateutil.relativedelta import relativedelta
-from dateutil.rrule import DAILY, MINUTELY, rrule
 
 # gunicorn
 from gunicorn.workers.ggevent import GeventWorker as GunicornGeventWorker
@@ -34,15 +32,19 @@ from paste.util.multidict import MultiDict
 
 # Zato
 from zato.common import CHANNEL, SIMPLE_IO, ZATO_ODB_POOL_NAME
-from zato.common.broker_message import code_to_name, STATS
-from zato.common.util import new_cid, pairwise, security_def_type, TRACE1
+from zato.common.broker_message import code_to_name
+from zato.common.util import new_cid, security_def_type, TRACE1
 from zato.server.base import BrokerMessageReceiver
+from zato.server.connection.amqp.outgoing import PublisherFacade
 from zato.server.connection.ftp import FTPStore
 from zato.server.connection.http_soap.channel import RequestDispatcher, RequestHandler
 from zato.server.connection.http_soap.outgoing import HTTPSOAPWrapper
 from zato.server.connection.http_soap.url_data import URLData
+from zato.server.connection.jms_wmq.outgoing import WMQFacade
 from zato.server.connection.sql import PoolStore, SessionWrapper
-from zato.server.stats import MaintenanceTool
+from zato.server.connection.zmq_.outgoing import ZMQFacade
+from zato.server.service import is_stream, join_stream, Outgoing
+from zato.server.stats import MaintenanceTool, QueueStats
 
 logger = logging.getLogger(__name__)
 
@@ -75,11 +77,13 @@ class WorkerStore(BrokerMessageReceiver):
         self.update_lock = RLock()
         self.kvdb = server.kvdb
         self.broker_client = None
+        self.outgoing = None
         
     def init(self):
         
         # Statistics maintenance
-        self.stats_maint = MaintenanceTool(self.kvdb.conn)
+        self.stats_maint = MaintenanceTool(
+            self.kvdb.conn, self.server.stats_delete_batch_size, self.server.stats_pipeline_batch_size)
 
         # Request dispatcher - matches URLs, checks security and dispatches HTTP
         # requests to services.
@@ -96,6 +100,21 @@ class WorkerStore(BrokerMessageReceiver):
         self.init_ftp()
         self.init_http_soap()
         
+    def get_outgoing(self):
+        """ Returns outgoing connections all the services invoked by this worker share.
+        Created on first use because the delivery store is set up only after the worker.
+        """
+        if not self.outgoing:
+            delivery_store = self.server.delivery_store
+            out_amqp = PublisherFacade(self.broker_client, delivery_store)
+            out_jms_wmq = WMQFacade(self.broker_client, delivery_store)
+            out_zmq = ZMQFacade(self.broker_client, delivery_store)
+            
+            out_ftp, out_plain_http, out_soap = self.worker_config.outgoing_connections()
+            self.outgoing = Outgoing(out_ftp, out_amqp, out_zmq, out_jms_wmq, self.sql_pool_store, out_plain_http, out_soap)
+            
+        return self.outgoing
+        
     def filter(self, msg):
         # TODO: Fix it, worker doesn't need to accept all the messages
         return True
@@ -321,13 +340,35 @@ class WorkerStore(BrokerMessageReceiver):
 # ##############################################################################
 
     def _set_service_response_data(self, service, **ignored):
-        if not isinstance(service.response.payload, basestring):
+        if is_stream(service.response.payload):
+            service.response.payload = join_stream(service.response.payload)
+        elif not isinstance(service.response.payload, basestring):
             service.response.payload = service.response.payload.getvalue()
 
+    def _update_queue_stats(self, msg):
+        """ Stores statistics of how long a message waited before its service started, through
+        the server's stats buffer if there is one or directly in the KVDB otherwise. Statistics
+        are never worth failing the invocation over so any exception is only logged.
+        """
+        try:
+            fields = QueueStats.get_fields(msg.enqueued, msg.get('dequeued', msg.started), msg.started)
+            
+            if self.server.stats_buffer:
+                self.server.stats_buffer.add_queue(msg.service, fields)
+            else:
+                QueueStats(self.kvdb.conn).add(msg.service, fields)
+        except Exception, e:
+            logger.warn('Could not update queue statistics of service:[%s], e:[%s]', msg.get('service'), format_exc(e))
+
     def _on_message_invoke_service(self, msg, channel, action, args=None):
         """ Triggered by external processes, such as AMQP or the singleton's scheduler,
         creates a new service instance and invokes it.
         """
+        # Messages from broker clients know when they were enqueued
+        if msg.get('enqueued'):
+            msg.started = time()
+            self._update_queue_stats(msg)
+            
         # WSGI environment is the best place we have to store raw msg in
         wsgi_environ = {'zato.request_ctx.async_msg':msg}
         
@@ -444,8 +485,9 @@ class WorkerStore(BrokerMessageReceiver):
         # Where to delete it from in the second step
         fs_location = self.server.service_store.services[msg.impl_name]['deployment_info']['fs_location']
         
-        # Delete it from the service store
+        # Delete it from the service store, along with any of its pooled instances
         del self.server.service_store.services[msg.impl_name]
+        self.server.service_store.instance_pool.pop(msg.impl_name, None)
         
         # Delete it from the filesystem, including any bytecode left over. Note that
         # other parallel servers may wish to do exactly the same so we just ignore
@@ -492,45 +534,11 @@ class WorkerStore(BrokerMessageReceiver):
 # ##############################################################################
 
     def on_broker_msg_STATS_DELETE(self, msg, *args):
-        start = parse(msg.start)
-        stop = parse(msg.stop)
-        
-        # Looks weird but this is so we don't have to create a list instead of a generator
-        # (and Python 3 won't leak the last element anymore)
-        last_elem = None
-        
-        # Are the dates are at least a day apart? If so, we'll split the interval
-        # into smaller one day-long batches.
-        if(stop-start).days:
-            for elem1, elem2 in pairwise(elem for elem in rrule(DAILY, dtstart=start, until=stop)):
-                self.broker_client.invoke_async({'action':STATS.DELETE_DAY, 'start':elem1.isoformat(), 'stop':elem2.isoformat()})
-                   
-                # So as not to drown the broker with a sudden surge of messages
-                sleep(0.02)
-            
-                last_elem = elem2
-                
-            # It's possible we still have something left over. Let's say
-            # 
-            # start = '2012-07-24T02:02:53'
-            # stop = '2012-07-25T02:04:53'
-            #
-            # The call to rrule(DAILY, ...) will nicely slice the time between
-            # start and stop into one day intervals yet the last element of the slice
-            # will have the time portion equal to that of start - so in this
-            # particular case it would be that last_elem was 2012-07-25T02:02:53
-            # which would be still be 2 minutes short of stop. Hence the need for
-            # a relativedelta, to tease out the remaining time information.
-            delta = relativedelta(stop, last_elem)
-            if delta.minutes:
-                self.stats_maint.delete(last_elem, stop, MINUTELY)
-
-        # Not a full day apart so we can delete everything ourselves   
-        else:
-            self.stats_maint.delete(start, stop, MINUTELY)
+        self.stats_maint.delete(parse(msg.start), parse(msg.stop), msg.get('id'))
 
     def on_broker_msg_STATS_DELETE_DAY(self, msg, *args):
-        self.stats_maint.delete(parse(msg.start), parse(msg.stop), MINUTELY)
+        # Servers in a cluster may be still running a version which splits deletions into days
+        self.stats_maint.delete(parse(msg.start), parse(msg.stop))
 
 # ##############################################################################
 
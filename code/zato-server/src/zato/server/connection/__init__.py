@@ -25,9 +25,12 @@ import psutil
 # Bunch
 from bunch import Bunch
 
+# Paste
+from paste.util.converters import asbool
+
 # Zato
 from zato.broker.thread_client import BrokerClient
-from zato.common import ZATO_ODB_POOL_NAME
+from zato.common import BROKER, ZATO_ODB_POOL_NAME
 from zato.common.delivery import DeliveryStore
 from zato.common.kvdb import KVDB
 from zato.common.util import get_app_context, get_config, get_crypto_manager, get_executable, TRACE1
@@ -141,6 +144,7 @@ class BaseConnector(BrokerMessageReceiver):
         self.odb = None
         self.odb_config = None
         self.sql_pool_store = None
+        self.connector_topic = None
         
     def _close(self):
         """ Close the process, don't forget about the ODB connection if it exists.
@@ -156,6 +160,22 @@ class BaseConnector(BrokerMessageReceiver):
         if not self.server:
             raise Exception('Server does not exist in the ODB')
         
+    def _get_connector_topic(self):
+        """ Returns the topic messages meant for this connector only are published on, if there is any.
+        Publishing connectors override it.
+        """
+        return None
+    
+    def _set_connector_topic(self):
+        """ Subscribes to the topic of this connector after its connection has been renamed,
+        no longer receiving messages published for the connection's previous name.
+        """
+        topic = self._get_connector_topic()
+        if topic != self.connector_topic:
+            self.broker_client.unsubscribe(self.connector_topic)
+            self.broker_client.subscribe(topic, self.on_broker_msg)
+            self.connector_topic = topic
+        
     def _init(self):
         """ Initializes all the basic run-time data structures and connects
         to the Zato broker.
@@ -175,10 +195,6 @@ class BaseConnector(BrokerMessageReceiver):
         self.kvdb.decrypt_func = self.odb.crypto_manager.decrypt
         self.kvdb.init()
         
-        # Broker client
-        self.broker_client = BrokerClient(self.kvdb, self.broker_client_id, self.broker_callbacks)
-        self.broker_client.start()
-
         # ODB        
         
         #
@@ -211,6 +227,17 @@ class BaseConnector(BrokerMessageReceiver):
         
         self._setup_odb()
         
+        # Broker client - started once the ODB has been read because the topic of messages
+        # meant for this connector only is derived from the name of its connection.
+        self.connector_topic = self._get_connector_topic()
+        if self.connector_topic:
+            self.broker_callbacks[self.connector_topic] = self.on_broker_msg
+        
+        broker_config = fs_server_config.get('broker', {})
+        self.broker_client = BrokerClient(self.kvdb, self.broker_client_id, self.broker_callbacks,
+            asbool(broker_config.get('work_queue', False)), broker_config.get('codec', BROKER.DEFAULT_CODEC))
+        self.broker_client.start()
+        
         # Delivery store
         self.delivery_store = DeliveryStore(self.kvdb, self.broker_client, self.odb, float(fs_server_config.misc.delivery_lock_timeout))
         
@@ -21,7 +21,7 @@ from kombu.pools import producers, reset as reset_pools
 from kombu.transport.pyamqp import Transport
 
 # Zato
-from zato.common.broker_message import MESSAGE_TYPE, OUTGOING, TOPICS
+from zato.common.broker_message import get_connector_topic, MESSAGE_TYPE, OUTGOING, TOPICS
 from zato.common.util import get_component_name, TRACE1
 from zato.server.connection.amqp import BaseAMQPConnector
 from zato.server.connection import setup_logging, start_connector as _start_connector
@@ -73,8 +73,8 @@ class PublisherFacade(object):
         self.delivery_store = delivery_store
     
     def send(self, msg, out_name, exchange, routing_key, properties={}, headers={}, *args, **kwargs):
-        """ Publishes the message on the Zato broker which forwards it to one of the
-        AMQP connectors.
+        """ Publishes the message on the Zato broker which forwards it to the AMQP connector
+        of the given outgoing connection only.
         """
         params = {}
         params['action'] = OUTGOING.AMQP_PUBLISH
@@ -87,7 +87,7 @@ class PublisherFacade(object):
         params['args'] = args
         params['kwargs'] = kwargs
         
-        self.broker_client.publish(params, msg_type=MESSAGE_TYPE.TO_AMQP_PUBLISHING_CONNECTOR_ALL)
+        self.broker_client.publish(params, msg_type=MESSAGE_TYPE.TO_AMQP_PUBLISHING_CONNECTOR_ALL, connector_name=out_name)
         
     def conn(self):
         """ Returns self. Added to make the facade look like other outgoing
@@ -133,11 +133,14 @@ class OutgoingConnector(BaseAMQPConnector):
         self.out_amqp.app_id = item.app_id
         self.out_amqp.def_name = item.def_name
         self.out_amqp.def_id = item.def_id
+        
+    def _get_connector_topic(self):
+        return get_connector_topic(MESSAGE_TYPE.TO_AMQP_PUBLISHING_CONNECTOR_ALL, self.out_amqp.name)
                 
     def filter(self, msg):
         """ Finds out whether the incoming message actually belongs to the 
-        listener. All the listeners receive each of the incoming PUB messages 
-        and filtering out is being performed here, on the client side, not in the broker.
+        listener. Messages to publish are received on the connector's own topic only
+        but configuration ones are sent to all the listeners and filtered out here.
         """
         if super(OutgoingConnector, self).filter(msg):
             return True
@@ -165,6 +168,7 @@ class OutgoingConnector(BaseAMQPConnector):
         with self.def_amqp_lock:
             with self.out_amqp_lock:
                 self.out_amqp = msg
+                self._set_connector_topic()
                 self._recreate_sender()
 
     def out_amqp_get(self, name):
@@ -11,8 +11,11 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 # stdlib
 import logging
 from cStringIO import StringIO
-from httplib import INTERNAL_SERVER_ERROR, NOT_FOUND, responses, UNAUTHORIZED
+from datetime import datetime
+from httplib import INTERNAL_SERVER_ERROR, NOT_FOUND, REQUEST_ENTITY_TOO_LARGE, responses, UNAUTHORIZED
+from itertools import chain
 from pprint import pprint
+from tempfile import SpooledTemporaryFile
 from traceback import format_exc
 
 # anyjson
@@ -25,21 +28,27 @@ from bunch import Bunch
 from django.http import QueryDict
 
 # Zato
-from zato.common import CHANNEL, DATA_FORMAT, SIMPLE_IO, URL_PARAMS_PRIORITY, \
+from zato.common import CHANNEL, DATA_FORMAT, HTTP_REQUEST_SPOOL_SIZE, SIMPLE_IO, URL_PARAMS_PRIORITY, \
      URL_TYPE, zato_namespace, ZATO_ERROR, ZATO_NONE, ZATO_OK
 from zato.common.util import security_def_type, TRACE1
 from zato.server.connection.http_soap import BadRequest, ClientHTTPError, \
-     NotFound, Unauthorized
+     NotFound, RequestEntityTooLarge, Unauthorized
+from zato.server.service import is_stream
 from zato.server.service.internal import AdminService
+from zato.server.stats import ChannelStats
 
 logger = logging.getLogger(__name__)
 
 _status_internal_server_error = b'{} {}'.format(INTERNAL_SERVER_ERROR, responses[INTERNAL_SERVER_ERROR])
 _status_not_found = b'{} {}'.format(NOT_FOUND, responses[NOT_FOUND])
+_status_request_entity_too_large = b'{} {}'.format(REQUEST_ENTITY_TOO_LARGE, responses[REQUEST_ENTITY_TOO_LARGE])
 _status_unauthorized = b'{} {}'.format(UNAUTHORIZED, responses[UNAUTHORIZED])
 
 soap_doc = b"""<?xml version='1.0' encoding='UTF-8'?><soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/" xmlns="https://zato.io/ns/20130518"><soap:Body>{body}</soap:Body></soap:Envelope>""" # noqa
 
+# What streamed responses are wrapped in
+soap_doc_start, soap_doc_end = soap_doc.split(b'{body}')
+
 zato_message_soap = b"""<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/" xmlns="https://zato.io/ns/20130518">
   <soap:Body>{data}</soap:Body>
 </soap:Envelope>"""
@@ -115,6 +124,58 @@ class RequestDispatcher(object):
             
         return soap_action
     
+    def _check_request_size(self, cid, channel_item, size):
+        """ Raises RequestEntityTooLarge if a request is larger than the channel allows for.
+        """
+        max_request_size = channel_item.get('max_request_size')
+        if max_request_size and size > max_request_size:
+            msg = 'Request size exceeds max_request_size:[{}] of channel:[{}]'.format(max_request_size, channel_item.get('name'))
+            logger.warn('%s, cid:[%s]', msg, cid)
+            raise RequestEntityTooLarge(cid, msg)
+    
+    def _get_payload(self, cid, channel_item, wsgi_environ):
+        """ Reads the whole of a request. If the channel limits the size of requests
+        and the client declares the length of its request, oversized ones are rejected
+        before anything is read. Otherwise, no more than one byte over the limit is read.
+        """
+        self._check_request_size(cid, channel_item, int(wsgi_environ.get('CONTENT_LENGTH') or 0))
+        
+        max_request_size = channel_item.get('max_request_size')
+        if max_request_size:
+            payload = wsgi_environ['wsgi.input'].read(max_request_size + 1)
+            self._check_request_size(cid, channel_item, len(payload))
+        else:
+            payload = wsgi_environ['wsgi.input'].read()
+            
+        return payload
+    
+    def _get_input_stream(self, cid, channel_item, wsgi_environ, chunk_size=65536):
+        """ Copies a request over to a file-like object which keeps it in RAM
+        until it grows over HTTP_REQUEST_SPOOL_SIZE bytes, after which it's moved
+        to a temporary file on disk. Size limits are enforced the same way _get_payload does it.
+        """
+        self._check_request_size(cid, channel_item, int(wsgi_environ.get('CONTENT_LENGTH') or 0))
+        
+        wsgi_input = wsgi_environ['wsgi.input']
+        input_stream = SpooledTemporaryFile(HTTP_REQUEST_SPOOL_SIZE)
+        size = 0
+        
+        try:
+            while True:
+                chunk = wsgi_input.read(chunk_size)
+                if not chunk:
+                    break
+                
+                size += len(chunk)
+                self._check_request_size(cid, channel_item, size)
+                input_stream.write(chunk)
+        except Exception:
+            input_stream.close()
+            raise
+            
+        input_stream.seek(0)
+        return input_stream
+    
     def dispatch(self, cid, req_timestamp, wsgi_environ, worker_store):
         """ Base method for dispatching incoming HTTP/SOAP messages. If the security
         configuration is one of the technical account or HTTP basic auth, 
@@ -142,12 +203,34 @@ class RequestDispatcher(object):
                 logger.warn('url_data:[%s] is not active, raising NotFound', sorted(url_match.items()))
                 raise NotFound(cid, 'Channel inactive')
             
-            # Read payload only now, right before it's needed the first time,
-            # possibly, by security checks.
-            payload = wsgi_environ['wsgi.input'].read()
+            input_stream = None
+            
+            # Statistics of the channel, stored once there's a status code to store
+            status_code = None
+            bytes_in = bytes_out = 0
             
             try:
                 
+                # Read payload only now, right before it's needed the first time,
+                # possibly, by security checks. Channels streaming their requests
+                # give services a file-like object instead.
+                if channel_item.get('stream_request'):
+                    input_stream = self._get_input_stream(cid, channel_item, wsgi_environ)
+                    wsgi_environ['zato.http.input_stream'] = input_stream
+                    
+                    # WS-Security needs the whole SOAP envelope
+                    if channel_item.get('sec_type') == security_def_type.wss:
+                        payload = input_stream.read()
+                    else:
+                        payload = ''
+                        input_stream.seek(0, 2)
+                        
+                    bytes_in = input_stream.tell()
+                    input_stream.seek(0)
+                else:
+                    payload = self._get_payload(cid, channel_item, wsgi_environ)
+                    bytes_in = len(payload)
+                
                 # Will raise an exception on any security violation
                 self.url_data.check_security(cid, channel_item, path_info, payload, wsgi_environ)
 
@@ -158,8 +241,18 @@ class RequestDispatcher(object):
                 
                 # Got response from the service so we can construct response headers now
                 self.add_response_headers(wsgi_environ, response)
+                status_code = response.status_code
 
-                # Return the payload to the client
+                # Return the payload to the client, bytes of streamed responses
+                # aren't counted because they're sent only after we return.
+                # Such responses may still be reading the request so it's
+                # them that close it once they're done.
+                if is_stream(response.payload):
+                    response_stream = self.stream_payload(cid, response.payload, input_stream)
+                    input_stream = None
+                    return response_stream
+                
+                bytes_out = len(response.payload or '')
                 return response.payload
 
             except Exception, e:
@@ -176,6 +269,8 @@ class RequestDispatcher(object):
                         wsgi_environ['zato.http.response.headers']['WWW-Authenticate'] = e.challenge
                     elif isinstance(e, NotFound):
                         status = _status_not_found
+                    elif isinstance(e, RequestEntityTooLarge):
+                        status = _status_request_entity_too_large
                 else:
                     status_code = INTERNAL_SERVER_ERROR
                     response = _format_exc
@@ -197,8 +292,16 @@ class RequestDispatcher(object):
                     response = error_wrapper(cid, response)
                     
                 wsgi_environ['zato.http.response.status'] = status
+                bytes_out = len(response)
                 return response
             
+            finally:
+                if input_stream:
+                    input_stream.close()
+                    
+                if status_code:
+                    self.update_channel_stats(channel_item, status_code, bytes_in, bytes_out, req_timestamp)
+            
         # This is 404, no such URL path and SOAP action is known.
         else:
             response = "[{}] Unknown URL:[{}] or SOAP action:[{}]".format(cid, path_info, soap_action)
@@ -207,6 +310,47 @@ class RequestDispatcher(object):
             logger.error(response)
             return response
         
+    def update_channel_stats(self, channel_item, status_code, bytes_in, bytes_out, req_timestamp):
+        """ Stores statistics of a request a channel has handled, through the server's
+        stats buffer if there is one or directly in the KVDB otherwise. Statistics
+        are never worth failing the request over so any exception is only logged.
+        """
+        try:
+            now = datetime.utcnow()
+            processing_time = int(round((now - req_timestamp).total_seconds() * 1000.0))
+            fields = ChannelStats.get_fields(status_code, bytes_in, bytes_out, processing_time)
+            
+            server = self.request_handler.server
+            if server.stats_buffer:
+                server.stats_buffer.add_channel(channel_item.name, fields, now)
+            else:
+                ChannelStats(server.kvdb.conn).add(channel_item.name, now.strftime('%Y:%m:%d:%H:%M'), fields)
+        except Exception, e:
+            logger.warn('Could not update statistics of channel:[%s], e:[%s]', channel_item.get('name'), format_exc(e))
+            
+    def stream_payload(self, cid, payload, input_stream=None):
+        """ Yields chunks of a streamed response, encoded to UTF-8 if need be. Status and headers
+        have been already sent by the time chunks are produced so any exception can be only logged
+        and the response is cut short. A streamed request, if any, is closed after the response.
+        """
+        try:
+            for chunk in payload:
+                if isinstance(chunk, unicode):
+                    chunk = chunk.encode('utf-8')
+                    
+                # An empty chunk would end a chunked response prematurely
+                if chunk:
+                    yield chunk
+        except Exception, e:
+            logger.error('Could not stream the response, cid:[%s], e:[%s]', cid, format_exc(e))
+        finally:
+            close = getattr(payload, 'close', None)
+            if close:
+                close()
+                
+            if input_stream:
+                input_stream.close()
+        
     def add_response_headers(self, wsgi_environ, response):
         """ Adds HTTP response headers on a 200 OK.
         """
@@ -325,12 +469,15 @@ class RequestHandler(object):
                 else:
                     response.payload = self._get_xml_admin_payload(service_instance, zato_message_template, None)
         else:
-            if not isinstance(response.payload, basestring):
+            if not isinstance(response.payload, basestring) and not is_stream(response.payload):
                 response.payload = response.payload.getvalue() if response.payload else ''
 
         if transport == URL_TYPE.SOAP:
             if not isinstance(service_instance, AdminService):
-                response.payload = soap_doc.format(body=response.payload)
+                if is_stream(response.payload):
+                    response.payload = chain([soap_doc_start], response.payload, [soap_doc_end])
+                else:
+                    response.payload = soap_doc.format(body=response.payload)
     
     def set_content_type(self, response, data_format, transport, url_match):
         """ Sets a response's content type if one hasn't been supplied by the user.
@@ -32,6 +32,73 @@ from zato.server.connection.http_soap import Unauthorized
 
 logger = logging.getLogger(__name__)
 
+class RouteIndex(object):
+    """ An index of HTTP channels narrowing down the list of candidates a request
+    needs to be matched against. Targets without any {placeholders} are kept in
+    a dictionary of exact paths, the rest of them in a segment trie holding the
+    literal prefix of each URL path, both keyed by SOAP action first. Channels
+    whose SOAP action has placeholders itself are always candidates.
+
+    The index never decides on its own whether a channel matches, it only returns
+    candidates in the same order they've been configured in and each of them still
+    needs to be confirmed with its compiled parse pattern. Patterns are
+    case-insensitive so the index is built out of lower-cased strings.
+    """
+    def __init__(self, channel_data, separator=MISC.SEPARATOR):
+        self.separator = separator
+        self.exact = {}
+        self.trie = {}
+        self.any_soap_action = []
+
+        for position, item in enumerate(channel_data):
+            self.add(position, item)
+
+    def _is_pattern(self, value):
+        return '{' in value or '}' in value
+
+    def add(self, position, item):
+        """ Adds a channel to the index, position is the one the channel has
+        in the list of all channels.
+        """
+        soap_action, url_path = item.match_target.split(self.separator, 1)
+        soap_action, url_path = soap_action.lower(), url_path.lower()
+
+        if self._is_pattern(soap_action):
+            self.any_soap_action.append((position, item))
+
+        elif not self._is_pattern(url_path):
+            self.exact.setdefault((soap_action, url_path), []).append((position, item))
+
+        else:
+            node = self.trie.setdefault(soap_action, ({}, []))
+            for segment in url_path.split('/'):
+                if self._is_pattern(segment):
+                    break
+                node = node[0].setdefault(segment, ({}, []))
+            node[1].append((position, item))
+
+    def get_candidates(self, url_path, soap_action):
+        """ Returns all the channels that may possibly match the SOAP action
+        and URL path given on input, sorted by their position.
+        """
+        soap_action, url_path = soap_action.lower(), url_path.lower()
+
+        candidates = self.exact.get((soap_action, url_path), [])[:]
+        candidates.extend(self.any_soap_action)
+
+        node = self.trie.get(soap_action)
+        if node:
+            candidates.extend(node[1])
+            for segment in url_path.split('/'):
+                node = node[0].get(segment)
+                if not node:
+                    break
+                candidates.extend(node[1])
+
+        candidates.sort()
+
+        return candidates
+
 class URLData(object):
     """ Performs URL matching and all the HTTP/SOAP-related security checks.
     """
@@ -45,6 +112,7 @@ class URLData(object):
         self.url_sec_lock = RLock()
         self._wss = WSSE()
         self._target_separator = MISC.SEPARATOR
+        self._route_index = None
 
     def _handle_security_basic_auth(self, cid, sec_def, path_info, body, headers):
         """ Performs the authentication using HTTP Basic Auth.
@@ -119,12 +187,32 @@ class URLData(object):
         
 # ##############################################################################
 
+    def _build_route_index(self):
+        """ Creates a new index of channels out of the current channel data. The index
+        is swapped in with a single assignment so concurrent readers never see
+        a partially built one.
+        """
+        self._route_index = RouteIndex(self.channel_data or [], self._target_separator)
+
     def match(self, url_path, soap_action):
         """ Attemps to match the combination of SOAP Action and URL path against 
         the list of HTTP channel targets.
         """
         target = '{}{}{}'.format(soap_action, self._target_separator, url_path)
-        for item in self.channel_data:
+
+        # A separator in either of the parts means it's ambiguous where the SOAP action
+        # ends and the URL path begins so all the channels need to be checked.
+        if self._target_separator in soap_action or self._target_separator in url_path:
+            candidates = enumerate(self.channel_data)
+        else:
+            route_index = self._route_index
+            if route_index is None:
+                with self.url_sec_lock:
+                    self._build_route_index()
+                    route_index = self._route_index
+            candidates = route_index.get_candidates(url_path, soap_action)
+
+        for _, item in candidates:
             match = item.match_target_compiled.parse(target)
             if match:
                 if logger.isEnabledFor(TRACE1):
@@ -172,6 +260,7 @@ class URLData(object):
         # No error, let's delete channel info
         if match_idx != ZATO_NONE:
             self.channel_data.pop(match_idx)
+            self._route_index = None
 
     def _update_basic_auth(self, name, config):
         self.basic_auth_config[name] = Bunch()
@@ -312,7 +401,7 @@ class URLData(object):
             'is_internal', 'method', 'name', 'ping_method', 'pool_size', 
             'service_id',  'impl_name', 'service_name',
             'soap_action', 'soap_version', 'transport', 'url_path',
-            'merge_url_params_req', 'url_params_pri', 'params_pri'):
+            'merge_url_params_req', 'url_params_pri', 'params_pri', 'max_request_size', 'stream_request'):
             
             channel_item[name] = msg[name]
             
@@ -384,11 +473,13 @@ class URLData(object):
                 self._delete_channel(msg)
                 
             self._create_channel(msg)
+            self._build_route_index()
             
     def on_broker_msg_CHANNEL_HTTP_SOAP_DELETE(self, msg, *args):
         """ Deletes an HTTP/SOAP channel.
         """
         with self.url_sec_lock:
             self._delete_channel(msg)
+            self._build_route_index()
 
 # ##############################################################################
@@ -28,7 +28,7 @@ from springpython.jms.core import JmsTemplate, TextMessage
 
 # Zato
 from zato.common import INVOCATION_TARGET, KVDB
-from zato.common.broker_message import MESSAGE_TYPE, OUTGOING, TOPICS
+from zato.common.broker_message import get_connector_topic, MESSAGE_TYPE, OUTGOING, TOPICS
 from zato.common.model import DeliveryItem
 from zato.common.util import new_cid, TRACE1
 from zato.server.connection import setup_logging, start_connector as _start_connector
@@ -69,7 +69,7 @@ class WMQFacade(object):
         params['args'] = args
         params['kwargs'] = kwargs
 
-        self.broker_client.publish(params, msg_type=MESSAGE_TYPE.TO_JMS_WMQ_PUBLISHING_CONNECTOR_ALL)
+        self.broker_client.publish(params, msg_type=MESSAGE_TYPE.TO_JMS_WMQ_PUBLISHING_CONNECTOR_ALL, connector_name=out_name)
         
     def conn(self):
         """ Returns self. Added to make the facade look like other outgoing
@@ -206,6 +206,9 @@ class OutgoingConnector(BaseJMSWMQConnector):
         self.out.expiration = item.expiration
         self.out.sender = None
         
+    def _get_connector_topic(self):
+        return get_connector_topic(MESSAGE_TYPE.TO_JMS_WMQ_PUBLISHING_CONNECTOR_ALL, self.out.name)
+        
     def filter(self, msg):
         """ Can we handle the incoming message?
         """
@@ -294,6 +297,7 @@ class OutgoingConnector(BaseJMSWMQConnector):
                 sender = self.out.get('sender')
                 self.out = msg
                 self.out.sender = sender
+                self._set_connector_topic()
                 self._recreate_sender()
 
 def run_connector():
@@ -16,7 +16,7 @@ from threading import RLock, Thread
 from bunch import Bunch
 
 # Zato
-from zato.common.broker_message import MESSAGE_TYPE, OUTGOING, TOPICS
+from zato.common.broker_message import get_connector_topic, MESSAGE_TYPE, OUTGOING, TOPICS
 from zato.common.util import TRACE1
 from zato.server.connection import setup_logging, start_connector as _start_connector
 from zato.server.connection.zmq_ import BaseZMQConnection, BaseZMQConnector
@@ -41,7 +41,7 @@ class ZMQFacade(object):
         params['args'] = args
         params['kwargs'] = kwargs
         
-        self.broker_client.publish(params, msg_type=MESSAGE_TYPE.TO_ZMQ_PUBLISHING_CONNECTOR_ALL)
+        self.broker_client.publish(params, msg_type=MESSAGE_TYPE.TO_ZMQ_PUBLISHING_CONNECTOR_ALL, connector_name=out_name)
         
     def conn(self):
         """ Returns self. Added to make the facade look like other outgoing
@@ -97,6 +97,9 @@ class OutgoingConnector(BaseZMQConnector):
         self.out.socket_type = self.socket_type = item.socket_type
         self.out.sender = None
         
+    def _get_connector_topic(self):
+        return get_connector_topic(MESSAGE_TYPE.TO_ZMQ_PUBLISHING_CONNECTOR_ALL, self.out.name)
+        
     def filter(self, msg):
         """ Can we handle the incoming message?
         """
@@ -168,6 +171,7 @@ class OutgoingConnector(BaseZMQConnector):
             sender = self.out.get('sender')
             self.out = msg
             self.out.sender = sender
+            self._set_connector_topic()
             self._recreate_sender()
 
 def run_connector():
@@ -10,12 +10,14 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 # stdlib
 import logging
+from collections import Iterator
 from copy import deepcopy
 from datetime import datetime
 from httplib import OK
 from itertools import chain
 from sys import maxint
 from traceback import format_exc
+from weakref import WeakKeyDictionary
 
 # anyjson
 from anyjson import dumps, loads
@@ -31,6 +33,7 @@ from django.http import QueryDict
 
 # lxml
 from lxml import etree
+from lxml.etree import SubElement
 from lxml.objectify import deannotate, Element, ElementMaker
 
 # Paste
@@ -44,15 +47,13 @@ from sqlalchemy.util import NamedTuple
 
 # Zato
 from zato.common import BROKER, CHANNEL, KVDB, PARAMS_PRIORITY, ParsingException, \
-     path, SIMPLE_IO, URL_TYPE, ZatoException, ZATO_NONE, ZATO_OK
+     SCHEDULER_JOB_TYPE, SIMPLE_IO, URL_TYPE, ZatoException, ZATO_NONE, ZATO_OK
 from zato.common.broker_message import SERVICE
 from zato.common.util import uncamelify, make_repr, new_cid, payload_from_request, service_name_from_impl, TRACE1
 from zato.server.connection import request_response, slow_response
-from zato.server.connection.amqp.outgoing import PublisherFacade
-from zato.server.connection.jms_wmq.outgoing import WMQFacade
-from zato.server.connection.zmq_.outgoing import ZMQFacade
+from zato.server.stats import LatencySketch, StatsIndex
 
-__all__ = ['Service', 'Request', 'Response', 'Outgoing', 'SimpleIOPayload']
+__all__ = ['Service', 'Request', 'Response', 'Outgoing', 'SimpleIOPayload', 'InvocationPlan', 'is_stream']
 
 # Need to use such a constant because we can sometimes be interested in setting
 # default values which evaluate to boolean False.
@@ -190,7 +191,7 @@ class Request(ValueConverter):
     __slots__ = ('logger', 'payload', 'raw_request', 'input', 'cid', 'has_simple_io_config',
                  'simple_io_config', 'bool_parameter_prefixes', 'int_parameters', 
                  'int_parameter_suffixes', 'is_xml', 'data_format', 'transport',
-                 '_wsgi_environ', 'channel_params', 'merge_channel_params')
+                 '_wsgi_environ', 'channel_params', 'merge_channel_params', 'input_plan', 'input_stream')
 
     def __init__(self, logger, simple_io_config={}, data_format=None, transport=None):
         self.logger = logger
@@ -211,12 +212,17 @@ class Request(ValueConverter):
         self.channel_params = {}
         self.merge_channel_params = True
         self.params_priority = PARAMS_PRIORITY.DEFAULT
+        self.input_plan = None
+        self.input_stream = None
 
     def init(self, is_sio, cid, io, data_format, transport, wsgi_environ):
         """ Initializes the object with an invocation-specific data.
         """
         if transport in(URL_TYPE.PLAIN_HTTP, URL_TYPE.SOAP):
             self.http.init(wsgi_environ)
+            
+            # Set only if the channel streams its requests instead of reading them into self.raw_request
+            self.input_stream = wsgi_environ.get('zato.http.input_stream')
         
         if is_sio:
             self.is_xml = data_format == SIMPLE_IO.FORMAT.XML
@@ -224,11 +230,12 @@ class Request(ValueConverter):
             self.transport = transport
             self._wsgi_environ = wsgi_environ
             
-            path_prefix = getattr(io, 'request_elem', 'request')
-            required_list = getattr(io, 'input_required', [])
-            optional_list = getattr(io, 'input_optional', [])
-            default_value = getattr(io, 'default_value', None)
-            use_text = getattr(io, 'use_text', True)
+            self.input_plan = get_input_plan(io, self.simple_io_config)
+            path_prefix = self.input_plan.path_prefix
+            required_list = self.input_plan.required_list
+            optional_list = self.input_plan.optional_list
+            default_value = self.input_plan.default_value
+            use_text = self.input_plan.use_text
             
             if self.simple_io_config:
                 self.has_simple_io_config = True
@@ -263,26 +270,28 @@ class Request(ValueConverter):
         """
         params = {}
         if not isinstance(self.payload, basestring):
-            for param in request_params:
-                
-                if isinstance(param, ForceType):
-                    param_name = param.name
-                else:
-                    param_name = param
+            
+            if self.input_plan:
+                elems = self.input_plan.get_elems(request_params, path_prefix, is_required, self.simple_io_config)
+            else:
+                elems = [InputElem(param, is_required, self.simple_io_config, path_prefix) for param in request_params]
+            
+            for elem in elems:
+                param = elem.param
+                param_name = elem.name
     
                 if self.is_xml:
-                    try:
-                        elem = path('{}.{}'.format(path_prefix, param_name), is_required).get_from(self.payload)
-                    except ParsingException, e:
+                    xml_elem = elem.get_from(self.payload)
+                    if xml_elem is None and is_required:
                         msg = 'Caught an exception while parsing, payload:[<![CDATA[{}]]>], e:[{}]'.format(
-                            etree.tostring(self.payload), format_exc(e))
+                            etree.tostring(self.payload), 'Element [{}.{}] not found'.format(path_prefix, param_name))
                         raise ParsingException(self.cid, msg)
                     
-                    if elem is not None:
+                    if xml_elem is not None:
                         if use_text:
-                            value = elem.text # We are interested in the text the elem contains ..
+                            value = xml_elem.text # We are interested in the text the elem contains ..
                         else:
-                            return elem # .. or in the elem itself.
+                            return xml_elem # .. or in the elem itself.
                     else:
                         value = default_value
                 else:
@@ -297,8 +306,8 @@ class Request(ValueConverter):
                         value = unicode(value)
 
                 try:
-                    if not isinstance(param, AsIs):
-                        params[param_name] = self.convert(param, param_name, value, self.has_simple_io_config)
+                    if not elem.leave_as_is:
+                        params[param_name] = elem.convert(value)
                     else:
                         params[param_name] = value
                 except Exception, e:
@@ -322,6 +331,13 @@ class Request(ValueConverter):
         for name in Request.__slots__:
             if name == 'logger':
                 continue
+            
+            # Plans are compiled once per SimpleIO class and are never changed so they can be shared,
+            # and there's only one stream of data a request can be read from.
+            if name in('input_plan', 'input_stream'):
+                setattr(request, name, getattr(self, name))
+                continue
+            
             setattr(request, name, deepcopy(getattr(self, name)))
             
     
@@ -338,6 +354,20 @@ class Request(ValueConverter):
         return bunchify(loads(self.raw_request))
 
 # ##############################################################################
+
+def is_stream(payload):
+    """ Returns True if a response's payload is an iterable of chunks which should be sent
+    to clients one by one, as they are produced, rather than a complete response.
+    """
+    return isinstance(payload, Iterator)
+
+def join_stream(payload):
+    """ Consumes a streamed response and returns all of its chunks joined, encoded to UTF-8 if need be.
+    Used by callers which need a complete response, e.g. other services or asynchronous invocations.
+    """
+    return b''.join(chunk.encode('utf-8') if isinstance(chunk, unicode) else chunk for chunk in payload)
+
+# ##############################################################################
         
 class Response(object):
     """ A response from the service's invocation.
@@ -381,8 +411,14 @@ class Response(object):
         return self._payload
 
     def _set_payload(self, value):
-        if isinstance(value, basestring):
+        
+        # Strings and iterators are used as-is, the latter including generators,
+        # so services can produce large responses chunk by chunk. Lists and tuples
+        # can be streamed too in services which don't declare their SimpleIO output.
+        if isinstance(value, basestring) or is_stream(value):
             self._payload = value
+        elif isinstance(value, (list, tuple)) and not self.outgoing_declared:
+            self._payload = iter(value)
         else:
             if not self.outgoing_declared:
                 raise Exception("Can't set payload, there's no output_required nor output_optional declared")
@@ -392,15 +428,186 @@ class Response(object):
 
     def init(self, cid, io, data_format):
         self.data_format = data_format
-        required_list = getattr(io, 'output_required', [])
-        optional_list = getattr(io, 'output_optional', [])
-        response_elem = getattr(io, 'response_elem', 'response')
-        namespace = getattr(io, 'namespace', '')
-        self.outgoing_declared = True if required_list or optional_list else False
+        plan = get_output_plan(io, self.simple_io_config)
+        self.outgoing_declared = plan.outgoing_declared
         
-        if required_list or optional_list:
+        if plan.outgoing_declared:
             self._payload = SimpleIOPayload(cid, self.logger, data_format, 
-                required_list, optional_list, self.simple_io_config, response_elem, namespace)
+                plan.required_list, plan.optional_list, self.simple_io_config, plan.response_elem, plan.namespace, plan)
+
+# ##############################################################################
+
+# Names objectify elements treat as their own properties rather than as children
+_objectify_reserved = ('text', 'pyval', 'tail', 'tag', 'base', '__class__')
+
+# Namespaces objectify declares on each element it creates, unused ones are removed by deannotate
+_objectify_nsmap = Element('item').nsmap
+
+class SimpleIOElem(object):
+    """ A single element of a compiled SimpleIO plan. All the checks whether
+    an element's value needs to be converted, and to what type, are made once,
+    when the element is created.
+    """
+    __slots__ = ('param', 'name', 'is_required', 'leave_as_is', 'is_bool', 'force_type', 'is_int')
+
+    def __init__(self, param, is_required, simple_io_config):
+        self.param = param
+        self.name = param.name if isinstance(param, ForceType) else param
+        self.is_required = is_required
+        self.leave_as_is = isinstance(param, AsIs)
+
+        self.force_type = None
+        for type_ in(Boolean, CSV, Integer, Unicode, UTC):
+            if isinstance(param, type_):
+                self.force_type = type_
+                break
+
+        bool_parameter_prefixes = simple_io_config.get('bool_parameter_prefixes', [])
+        int_parameters = simple_io_config.get('int_parameters', [])
+        int_parameter_suffixes = simple_io_config.get('int_parameter_suffixes', [])
+
+        self.is_bool = self.force_type is Boolean or any(self.name.startswith(prefix) for prefix in bool_parameter_prefixes)
+        self.is_int = self.force_type is None and (
+            self.name in int_parameters or any(self.name.endswith(suffix) for suffix in int_parameter_suffixes))
+
+    def convert(self, value):
+        """ Same as ValueConverter.convert except that all the name-based checks
+        have been already made when the plan was compiled.
+        """
+        try:
+            if self.is_bool:
+                value = asbool(value or None) # value can be an empty string and asbool chokes on that
+                
+            if value: # Can be a 0
+                force_type = self.force_type
+                if force_type is Boolean:
+                    value = asbool(value)
+                elif force_type is CSV:
+                    value = value.split(',')
+                elif force_type is Integer:
+                    value = int(value)
+                elif force_type is Unicode:
+                    value = unicode(value)
+                elif force_type is UTC:
+                    value = value.replace('+00:00', '')
+                elif self.is_int and value != ZATO_NONE:
+                    value = int(value)
+                    
+            if self.force_type is CSV and not value:
+                value = []
+                
+            return value
+        except Exception, e:
+            msg = 'Conversion error, param:[{}], param_name:[{}], repr(value):[{}], e:[{}]'.format(
+                self.param, self.name, repr(value), format_exc(e))
+            logger.error(msg)
+            
+            raise ZatoException(msg=msg)
+
+class InputElem(SimpleIOElem):
+    """ An input element of a compiled SimpleIO plan. In addition to what each element
+    has, it knows how to find itself in XML requests - the XPath expression returns
+    the first child of a path_prefix root whose namespace is the same as the root's,
+    i.e. the very same element path('{path_prefix}.{name}').get_from would return.
+    """
+    __slots__ = ('xpath',)
+
+    def __init__(self, param, is_required, simple_io_config, path_prefix):
+        super(InputElem, self).__init__(param, is_required, simple_io_config)
+        self.xpath = etree.XPath('self::*[local-name()="{}"]/*[local-name()="{}" and namespace-uri()=namespace-uri(..)][1]'.format(
+            path_prefix, self.name))
+
+    def get_from(self, payload):
+        """ Returns the element out of an XML payload or None if there isn't any.
+        """
+        result = self.xpath(payload)
+        return result[0] if result else None
+
+class InputPlan(object):
+    """ Everything a Request needs to know in order to extract input parameters
+    of a given SimpleIO class, worked out once instead of for each request.
+    """
+    def __init__(self, io, simple_io_config):
+        self.simple_io_config = simple_io_config
+        self.path_prefix = getattr(io, 'request_elem', 'request')
+        self.required_list = getattr(io, 'input_required', [])
+        self.optional_list = getattr(io, 'input_optional', [])
+        self.default_value = getattr(io, 'default_value', None)
+        self.use_text = getattr(io, 'use_text', True)
+
+        self.required = [InputElem(param, True, simple_io_config, self.path_prefix) for param in self.required_list]
+        self.optional = [InputElem(param, False, simple_io_config, self.path_prefix) for param in self.optional_list]
+
+    def get_elems(self, request_params, path_prefix, is_required, simple_io_config):
+        """ Returns compiled elements for a list of parameters, the plan's own ones
+        if possible, and new ones otherwise.
+        """
+        if path_prefix == self.path_prefix and simple_io_config is self.simple_io_config:
+            if request_params is self.required_list and is_required:
+                return self.required
+            if request_params is self.optional_list and not is_required:
+                return self.optional
+
+        return [InputElem(param, is_required, simple_io_config, path_prefix) for param in request_params]
+
+class OutputPlan(object):
+    """ Everything SimpleIOPayload needs to know in order to serialize a response
+    of a given SimpleIO class, worked out once instead of for each response.
+    """
+    def __init__(self, io, simple_io_config):
+        self.simple_io_config = simple_io_config
+        self.required_list = getattr(io, 'output_required', [])
+        self.optional_list = getattr(io, 'output_optional', [])
+        self.response_elem = getattr(io, 'response_elem', 'response')
+        self.namespace = getattr(io, 'namespace', '')
+        self.outgoing_declared = True if self.required_list or self.optional_list else False
+        self.em = ElementMaker(annotate=False, namespace=self.namespace, nsmap={None:self.namespace})
+
+        self.elems = []
+        self.all_attrs = set()
+        self.xml_fast = True
+        
+        for is_required, param in chain(((True, name) for name in self.required_list), ((False, name) for name in self.optional_list)):
+            elem = SimpleIOElem(param, is_required, simple_io_config)
+            
+            # Names objectify would treat differently than plain child elements mean it has to build the whole item
+            if elem.name in self.all_attrs or elem.name in _objectify_reserved or '{' in elem.name:
+                self.xml_fast = False
+
+            self.elems.append(elem)
+            self.all_attrs.add(elem.name)
+
+# SimpleIO classes -> their compiled plans
+_input_plans = WeakKeyDictionary()
+_output_plans = WeakKeyDictionary()
+
+def _get_plan(plans, plan_class, io, simple_io_config):
+    """ Returns a plan of a given class for a SimpleIO class, compiling it
+    on first use or whenever the server's SimpleIO configuration has changed.
+    """
+    try:
+        plan = plans.get(io)
+    except TypeError:
+        plan = None # Not a class and can't be weakly referenced so there's nothing to cache it by
+
+    if not plan or plan.simple_io_config is not simple_io_config:
+        plan = plan_class(io, simple_io_config)
+        try:
+            plans[io] = plan
+        except TypeError:
+            pass
+
+    return plan
+
+def get_input_plan(io, simple_io_config):
+    """ Returns a plan for extracting input parameters of a given SimpleIO class.
+    """
+    return _get_plan(_input_plans, InputPlan, io, simple_io_config)
+
+def get_output_plan(io, simple_io_config):
+    """ Returns a plan for serializing responses of a given SimpleIO class.
+    """
+    return _get_plan(_output_plans, OutputPlan, io, simple_io_config)
 
 # ##############################################################################
             
@@ -409,7 +616,8 @@ class SimpleIOPayload(ValueConverter):
     SimpleIO abstract data. All of the attributes are prefixed with zato_ so that
     they don't conflict with user-provided data.
     """
-    def __init__(self, zato_cid, logger, data_format, required_list, optional_list, simple_io_config, response_elem, namespace):
+    def __init__(self, zato_cid, logger, data_format, required_list, optional_list, simple_io_config, response_elem, namespace,
+            zato_plan=None):
         self.zato_cid = zato_cid
         self.zato_logger = logger
         self.zato_is_xml = data_format == SIMPLE_IO.FORMAT.XML
@@ -424,11 +632,12 @@ class SimpleIOPayload(ValueConverter):
         self.response_elem = response_elem
         self.namespace = namespace
 
-        self.zato_all_attrs = set()
-        for name in chain(required_list, optional_list):
-            if isinstance(name, ForceType):
-                name = name.name
-            self.zato_all_attrs.add(name)
+        if not zato_plan:
+            io = Bunch(output_required=required_list, output_optional=optional_list, response_elem=response_elem, namespace=namespace)
+            zato_plan = OutputPlan(io, simple_io_config)
+
+        self.zato_plan = zato_plan
+        self.zato_all_attrs = zato_plan.all_attrs
         
         self.set_expected_attrs(required_list, optional_list)
 
@@ -475,32 +684,6 @@ class SimpleIOPayload(ValueConverter):
         self.zato_output.append(item)
         self.zato_is_repeated = True
 
-    def _getvalue(self, name, item, is_sa_namedtuple, is_required, leave_as_is):
-        """ Returns an element's value if any has been provided while taking
-        into account the differences between dictionaries and other formats
-        as well as the type conversions.
-        """
-        lookup_name = name.name if isinstance(name, ForceType) else name
-
-        if is_sa_namedtuple or self._is_sqlalchemy(item):
-            elem_value = getattr(item, lookup_name, '')
-        else:
-            elem_value = item.get(lookup_name, '')
-
-        if isinstance(elem_value, basestring) and not elem_value:
-            msg = self._missing_value_log_msg(name, item, is_sa_namedtuple, is_required)
-            if is_required:
-                self.zato_logger.debug(msg)
-                raise ZatoException(self.zato_cid, msg)
-            else:
-                if self.zato_logger.isEnabledFor(TRACE1):
-                    self.zato_logger.log(TRACE1, msg)
-
-        if leave_as_is:
-            return elem_value
-        else:
-            return self.convert(name, lookup_name, elem_value, True)
-
     def _missing_value_log_msg(self, name, item, is_sa_namedtuple, is_required):
         """ Returns a log message indicating that an element was missing.
         """
@@ -511,6 +694,62 @@ class SimpleIOPayload(ValueConverter):
         return '{} elem:[{}] not found in item:[{}]'.format(
             'Expected' if is_required else 'Optional', name, msg_item)
 
+    def _iter_output_values(self, item, is_sa_namedtuple, use_getattr):
+        """ Yields output elements of a single item along with their values,
+        in the order the elements were declared in.
+        """
+        for elem in self.zato_plan.elems:
+            name = elem.name
+            
+            if use_getattr:
+                elem_value = getattr(item, name, '')
+            else:
+                elem_value = item.get(name, '')
+                
+            if isinstance(elem_value, basestring) and not elem_value:
+                msg = self._missing_value_log_msg(elem.param, item, is_sa_namedtuple, elem.is_required)
+                if elem.is_required:
+                    self.zato_logger.debug(msg)
+                    raise ZatoException(self.zato_cid, msg)
+                else:
+                    if self.zato_logger.isEnabledFor(TRACE1):
+                        self.zato_logger.log(TRACE1, msg)
+                        
+            if not elem.leave_as_is:
+                elem_value = elem.convert(elem_value)
+                
+            if isinstance(elem_value, basestring):
+                elem_value = elem_value.decode('utf-8')
+                
+            yield elem, elem_value
+    
+    def _get_xml_item(self, values, fast):
+        """ Turns a single item into an XML element. Values whose representation
+        is the same in objectify and plain lxml are added directly, anything else
+        is left to objectify to carry on with its own conventions, such as xsi:nil
+        for None or multiple elements for lists.
+        """
+        if not fast:
+            xml_item = Element('item')
+            for elem, elem_value in values:
+                setattr(xml_item, elem.name, elem_value)
+            return xml_item
+            
+        xml_item = etree.Element('item', nsmap=_objectify_nsmap)
+        for elem, elem_value in values:
+            if isinstance(elem_value, unicode):
+                SubElement(xml_item, elem.name).text = elem_value
+            elif isinstance(elem_value, bool):
+                SubElement(xml_item, elem.name).text = 'true' if elem_value else 'false'
+            elif isinstance(elem_value, (int, long)):
+                SubElement(xml_item, elem.name).text = str(elem_value)
+            else:
+                objectified = Element('item')
+                setattr(objectified, elem.name, elem_value)
+                xml_item.extend(objectified.iterchildren())
+                
+        return xml_item
+
     def getvalue(self, serialize=True):
         """ Gets the actual payload's value converted to a string representing
         either XML or JSON.
@@ -529,33 +768,24 @@ class SimpleIOPayload(ValueConverter):
         if self.zato_is_repeated:
             output = self.zato_output
         else:
-            output = set(dir(self)) & self.zato_all_attrs
-            output = [dict((name, getattr(self, name)) for name in output)]
+            output = [dict((name, getattr(self, name)) for name in self.zato_all_attrs if hasattr(self, name))]
             
         if output:
 
             # All elements must be of the same type so it's OK to do it
             is_sa_namedtuple = isinstance(output[0], NamedTuple)
+            use_getattr = is_sa_namedtuple or self._is_sqlalchemy(output[0])
+            
+            # Unserialized XML is handed over to callers as objectify trees so it's built by objectify only
+            xml_fast = serialize and self.zato_plan.xml_fast
             
             for item in output:
+                values = self._iter_output_values(item, is_sa_namedtuple, use_getattr)
+                
                 if self.zato_is_xml:
-                    out_item = Element('item')
+                    out_item = self._get_xml_item(values, xml_fast)
                 else:
-                    out_item = {}
-                for is_required, name in chain(self.zato_required, self.zato_optional):
-                    leave_as_is = isinstance(name, AsIs)
-                    elem_value = self._getvalue(name, item, is_sa_namedtuple, is_required, leave_as_is)
-                    
-                    if isinstance(name, ForceType):
-                        name = name.name
-                        
-                    if isinstance(elem_value, basestring):
-                        elem_value = elem_value.decode('utf-8')
-                    
-                    if self.zato_is_xml:
-                        setattr(out_item, name, elem_value)
-                    else:
-                        out_item[name] = elem_value
+                    out_item = dict((elem.name, elem_value) for elem, elem_value in values)
     
                 if self.zato_is_repeated:
                     value.append(out_item)
@@ -563,7 +793,7 @@ class SimpleIOPayload(ValueConverter):
                     value = out_item
                         
         if self.zato_is_xml:
-            em = ElementMaker(annotate=False, namespace=self.namespace, nsmap={None:self.namespace})
+            em = self.zato_plan.em
             zato_env = em.zato_env(em.cid(self.zato_cid), em.result(ZATO_OK))
             top = getattr(em, self.response_elem)(zato_env)
             top.append(value)
@@ -639,6 +869,32 @@ class TimeUtil(object):
         
 # ##############################################################################
 
+# Hooks a service may override - those it doesn't override are no-ops and needn't be called at all
+HOOK_NAMES = ['before_handle', 'after_handle', 'finalize_handle', 'before_job', 'after_job'] + [
+    '{}_{}_job'.format(prefix, job_type) for prefix in('before', 'after') for job_type in(
+        SCHEDULER_JOB_TYPE.ONE_TIME, SCHEDULER_JOB_TYPE.INTERVAL_BASED, SCHEDULER_JOB_TYPE.CRON_STYLE)]
+
+class InvocationPlan(object):
+    """ Everything about a service class that doesn't change from one invocation
+    to another - whether it uses SimpleIO and which of its hooks need to be run.
+    Created once per class, when the class is being deployed.
+    """
+    __slots__ = ('is_sio', 'sio', 'hooks')
+
+    def __init__(self, service_class):
+        self.is_sio = hasattr(service_class, 'SimpleIO')
+        self.sio = getattr(service_class, 'SimpleIO', None)
+        
+        # Hook name -> an unbound method to call or None if the hook is the default no-op one
+        self.hooks = {}
+        for name in HOOK_NAMES:
+            hook = getattr(service_class, name)
+            if getattr(hook, '__func__', hook) is getattr(Service, name).__func__:
+                hook = None
+            self.hooks[name] = hook
+            
+# ##############################################################################
+
 class Service(object):
     """ A base class for all services deployed on Zato servers, no matter 
     the transport and protocol, be it plain HTTP, SOAP, WebSphere MQ or any other,
@@ -646,6 +902,15 @@ class Service(object):
     """
     def __init__(self, *ignored_args, **ignored_kwargs):
         self.logger = logging.getLogger(self.get_name())
+        self.name = self.__class__.get_name()
+        self.impl_name = self.__class__.get_impl_name()
+        self.time = TimeUtil(None)
+        self._reset()
+        
+    def _reset(self):
+        """ Sets all the per-request attributes to their initial values. Called when
+        an instance is created and each time a pooled one is about to be reused.
+        """
         self.server = None
         self.broker_client = None
         self.channel = None
@@ -667,9 +932,6 @@ class Service(object):
         self.processing_time = None # Processing time in milliseconds
         self.usage = 0 # How many times the service has been invoked
         self.slow_threshold = maxint # After how many ms to consider the response came too late
-        self.name = self.__class__.get_name()
-        self.impl_name = self.__class__.get_impl_name()
-        self.time = TimeUtil(None)
         
     @classmethod
     def get_name(class_):
@@ -686,6 +948,17 @@ class Service(object):
             
         return class_.__name
 
+    @classmethod
+    def get_invocation_plan(class_):
+        """ Returns the class' invocation plan, creating it on first use. The service store
+        calls it while the service is being deployed so requests find it ready.
+        """
+        # Looked up in the class' own __dict__ because subclasses mustn't use their parent's plan
+        plan = class_.__dict__.get('_invocation_plan')
+        if not plan:
+            plan = class_._invocation_plan = InvocationPlan(class_)
+        return plan
+
     @classmethod
     def get_impl_name(class_):
         if not hasattr(class_, '__impl_name'):
@@ -714,25 +987,25 @@ class Service(object):
         
         self.slow_threshold = self.server.service_store.services[self.impl_name]['slow_threshold']
         
-        out_amqp = PublisherFacade(self.broker_client, self.server.delivery_store)
-        out_jms_wmq = WMQFacade(self.broker_client, self.server.delivery_store)
-        out_zmq = ZMQFacade(self.broker_client, self.server.delivery_store)
-        out_sql = self.worker_store.sql_pool_store
-
-        out_ftp, out_plain_http, out_soap = self.worker_store.worker_config.outgoing_connections()
-        self.outgoing = Outgoing(out_ftp, out_amqp, out_zmq, out_jms_wmq, out_sql, out_plain_http, out_soap)
+        # Facades are stateless so all the services of a worker can share them
+        self.outgoing = self.worker_store.get_outgoing()
         
-        is_sio = hasattr(self, 'SimpleIO')
+        plan = self.get_invocation_plan()
         
-        self.request.init(is_sio, self.cid, getattr(self, 'SimpleIO', None),
+        self.request.init(plan.is_sio, self.cid, plan.sio,
             self.data_format, self.transport, self.wsgi_environ)
         
-        if is_sio:
-            self.response.init(self.cid, self.SimpleIO, self.data_format)
+        if plan.is_sio:
+            self.response.init(self.cid, plan.sio, self.data_format)
             
     def set_response_data(self, service, **kwargs):
         response = service.response.payload
-        if not isinstance(response, basestring):
+        
+        # Services invoking other ones get complete responses, even if these were streamed
+        if is_stream(response):
+            response = service.response.payload = join_stream(response)
+            
+        elif not isinstance(response, basestring):
             response = response.getvalue(serialize=kwargs['serialize'])
             if kwargs['as_bunch']:
                 response = bunchify(response)
@@ -760,7 +1033,13 @@ class Service(object):
         service.post_handle()
         service.call_hooks('finalize')
         
-        return set_response_func(service, data_format=data_format, transport=transport, **kwargs)
+        response = set_response_func(service, data_format=data_format, transport=transport, **kwargs)
+        
+        # A stream is still to be consumed and it may need the instance so it can't be reused yet
+        if not is_stream(service.response.payload):
+            server.service_store.release_instance(service)
+        
+        return response
             
     def invoke_by_impl_name(self, impl_name, payload='', channel=CHANNEL.INVOKE, data_format=None,
             transport=None, serialize=False, as_bunch=False):
@@ -826,9 +1105,24 @@ class Service(object):
         """ An internal method run just before the service sets to process the payload.
         Used for incrementing the service's usage count and storing the service invocation time.
         """
-        self.usage = self.kvdb.conn.incr('{}{}'.format(KVDB.SERVICE_USAGE, self.name))
+        stats_buffer = self.server.stats_buffer
+        if stats_buffer:
+            self.usage = stats_buffer.incr_usage(self.name)
+        else:
+            self.usage = self.kvdb.conn.incr('{}{}'.format(KVDB.SERVICE_USAGE, self.name))
+            
         self.invocation_time = datetime.utcnow()
         
+    def _get_response_sample(self):
+        """ Returns the response as it should be stored in statistics. Streamed responses
+        haven't been produced yet at that point and they can be consumed only once.
+        """
+        payload = self.response.payload
+        if is_stream(payload):
+            return ''
+        
+        return (payload.getvalue() if hasattr(payload, 'getvalue') else payload) or ''
+        
     def post_handle(self):
         """ An internal method executed after the service has completed and has
         a response ready to return. Updates its statistics and, optionally, stores
@@ -846,28 +1140,44 @@ class Service(object):
         proc_time = proc_time if proc_time > 1 else 0
         
         self.processing_time = int(round(proc_time))
-
-        self.kvdb.conn.hset('{}{}'.format(KVDB.SERVICE_TIME_BASIC, self.name), 'last', self.processing_time)
-        self.kvdb.conn.rpush('{}{}'.format(KVDB.SERVICE_TIME_RAW, self.name), self.processing_time)
-
-        key = '{}{}:{}'.format(KVDB.SERVICE_TIME_RAW_BY_MINUTE, 
-            self.name, self.handle_return_time.strftime('%Y:%m:%d:%H:%M'))
-        self.kvdb.conn.rpush(key, self.processing_time)
         
-        # .. we'll have 5 minutes (5 * 60 seconds = 300 seconds) 
-        # to aggregate processing times for a given minute and then it will expire
+        # With a stats buffer, everything is flushed to the KVDB in the background
+        stats_buffer = self.server.stats_buffer
         
-        # Note that we need Redis 2.1.3+ otherwise the key has just been overwritten
-        self.kvdb.conn.expire(key, 300)
+        if stats_buffer:
+            stats_buffer.add_time(self.name, self.processing_time, self.handle_return_time)
+        else:
+            stats_index = StatsIndex(self.kvdb.conn)
+            
+            sketch_index = LatencySketch.get_index(self.processing_time)
+            
+            self.kvdb.conn.hset('{}{}'.format(KVDB.SERVICE_TIME_BASIC, self.name), 'last', self.processing_time)
+            self.kvdb.conn.hincrby('{}{}'.format(KVDB.SERVICE_TIME_SKETCH, self.name), sketch_index, 1)
+            stats_index.add_raw(self.name)
+    
+            suffix = self.handle_return_time.strftime('%Y:%m:%d:%H:%M')
+            key = '{}{}:{}'.format(KVDB.SERVICE_TIME_SKETCH_BY_MINUTE, self.name, suffix)
+            self.kvdb.conn.hincrby(key, sketch_index, 1)
+            
+            # .. we'll have 5 minutes (5 * 60 seconds = 300 seconds) 
+            # to aggregate processing times for a given minute and then it will expire
+            
+            # Note that we need Redis 2.1.3+ otherwise the key has just been overwritten
+            self.kvdb.conn.expire(key, 300)
+            stats_index.add_raw_by_minute(self.name, suffix)
         
         # 
         # Sample requests/responses
         #
-        key, freq = request_response.should_store(self.kvdb, self.usage, self.name)
+        if stats_buffer:
+            key, freq = stats_buffer.should_store_req_resp(self.name, self.usage)
+        else:
+            key, freq = request_response.should_store(self.kvdb, self.usage, self.name)
+            
         if freq:
 
             # TODO: Don't parse it here and a moment later below
-            resp = (self.response.payload.getvalue() if hasattr(self.response.payload, 'getvalue') else self.response.payload) or ''            
+            resp = self._get_response_sample()
             
             data = {
                 'cid': self.cid,
@@ -876,7 +1186,10 @@ class Service(object):
                 'req': self.request.raw_request or '',
                 'resp':resp,
             }
-            request_response.store(self.kvdb, key, self.usage, freq, **data)
+            if stats_buffer:
+                stats_buffer.store_req_resp(key, **data)
+            else:
+                request_response.store(self.kvdb, key, self.usage, freq, **data)
             
         #
         # Slow responses
@@ -884,7 +1197,7 @@ class Service(object):
         if self.processing_time > self.slow_threshold:
 
             # TODO: Don't parse it here and a moment earlier above
-            resp = (self.response.payload.getvalue() if hasattr(self.response.payload, 'getvalue') else self.response.payload) or ''            
+            resp = self._get_response_sample()
             
             data = {
                 'cid': self.cid,
@@ -895,7 +1208,10 @@ class Service(object):
                 'req': self.request.raw_request or '',
                 'resp': resp,
             }
-            slow_response.store(self.kvdb, self.name, **data)
+            if stats_buffer:
+                stats_buffer.store_slow(self.name, **data)
+            else:
+                slow_response.store(self.kvdb, self.name, **data)
             
     def translate(self, *args, **kwargs):
         raise NotImplementedError('An initializer should override this method')
@@ -920,23 +1236,34 @@ class Service(object):
     
 # ##############################################################################
 
+    def _run_hook(self, name):
+        """ Runs a hook unless the service doesn't override it. Hooks unknown
+        to the invocation plan are looked up by their name.
+        """
+        hooks = self.get_invocation_plan().hooks
+        if name in hooks:
+            hook = hooks[name]
+            if hook:
+                hook(self)
+        else:
+            getattr(self, name)()
+
     def call_job_hooks(self, prefix):
         if self.channel == CHANNEL.SCHEDULER and prefix != 'finalize':
             try:
-                getattr(self, '{}_job'.format(prefix))()
+                self._run_hook('{}_job'.format(prefix))
             except Exception, e:
                 self.logger.error("Can't run {}_job, e:[{}]".format(prefix, format_exc(e)))
             else:
                 try:
                     func_name = '{}_{}_job'.format(prefix, self.job_type)
-                    func = getattr(self, func_name)
-                    func()
+                    self._run_hook(func_name)
                 except Exception, e:
                     self.logger.error("Can't run {}, e:[{}]".format(func_name, format_exc(e)))
 
     def call_handle(self, prefix):
         try:
-            getattr(self, '{}_handle'.format(prefix))()
+            self._run_hook('{}_handle'.format(prefix))
         except Exception, e:
             self.logger.error("Can't run {}_handle, e:[{}]".format(prefix, format_exc(e)))
 
@@ -15,6 +15,9 @@ from traceback import format_exc
 # anyjson
 from json import dumps
 
+# Paste
+from paste.util.converters import asbool
+
 # Zato
 from zato.common import DEFAULT_HTTP_PING_METHOD, DEFAULT_HTTP_POOL_SIZE, PARAMS_PRIORITY,\
      URL_PARAMS_PRIORITY, URL_TYPE, ZATO_NONE
@@ -69,7 +72,8 @@ class GetList(AdminService):
         output_required = ('id', 'name', 'is_active', 'is_internal', 'url_path')
         output_optional = ('service_id', 'service_name', 'security_id', 'security_name', 'sec_type', 
                            'method', 'soap_action', 'soap_version', 'data_format', 'host', 'ping_method',
-                           'pool_size', 'merge_url_params_req', 'url_params_pri', 'params_pri')
+                           'pool_size', 'merge_url_params_req', 'url_params_pri', 'params_pri',
+                           'max_request_size', 'stream_request')
         output_repeated = True
         
     def get_data(self, session):
@@ -88,7 +92,8 @@ class Create(AdminService, _HTTPSOAPService):
         response_elem = 'zato_http_soap_create_response'
         input_required = ('cluster_id', 'name', 'is_active', 'connection', 'transport', 'is_internal', 'url_path')
         input_optional = ('service', 'security_id', 'method', 'soap_action', 'soap_version', 'data_format',
-            'host', 'ping_method', 'pool_size', 'merge_url_params_req', 'url_params_pri', 'params_pri')
+            'host', 'ping_method', 'pool_size', 'merge_url_params_req', 'url_params_pri', 'params_pri',
+            'max_request_size', 'stream_request')
         output_required = ('id', 'name')
     
     def handle(self):
@@ -149,6 +154,8 @@ class Create(AdminService, _HTTPSOAPService):
                 item.merge_url_params_req = input.get('merge_url_params_req') or True
                 item.url_params_pri = input.get('url_params_pri') or URL_PARAMS_PRIORITY.DEFAULT
                 item.params_pri = input.get('params_pri') or PARAMS_PRIORITY.DEFAULT
+                item.max_request_size = input.get('max_request_size') or None
+                item.stream_request = asbool(input.get('stream_request') or False)
 
                 session.add(item)
                 session.commit()
@@ -157,6 +164,8 @@ class Create(AdminService, _HTTPSOAPService):
                     input.impl_name = service.impl_name
                     input.service_id = service.id
                     input.service_name = service.name
+                    input.max_request_size = item.max_request_size
+                    input.stream_request = item.stream_request
 
                 input.id = item.id
                 input.update(sec_info)
@@ -185,7 +194,8 @@ class Edit(AdminService, _HTTPSOAPService):
         response_elem = 'zato_http_soap_edit_response'
         input_required = ('id', 'cluster_id', 'name', 'is_active', 'connection', 'transport', 'url_path')
         input_optional = ('service', 'security_id', 'method', 'soap_action', 'soap_version', 'data_format', 
-            'host', 'ping_method', 'pool_size', 'merge_url_params_req', 'url_params_pri', 'params_pri')
+            'host', 'ping_method', 'pool_size', 'merge_url_params_req', 'url_params_pri', 'params_pri',
+            'max_request_size', 'stream_request')
         output_required = ('id', 'name')
     
     def handle(self):
@@ -248,6 +258,8 @@ class Edit(AdminService, _HTTPSOAPService):
                 item.merge_url_params_req = input.get('merge_url_params_req') or True
                 item.url_params_pri = input.get('url_params_pri') or URL_PARAMS_PRIORITY.DEFAULT
                 item.params_pri = input.get('params_pri') or PARAMS_PRIORITY.DEFAULT
+                item.max_request_size = input.get('max_request_size') or None
+                item.stream_request = asbool(input.get('stream_request') or False)
 
                 session.add(item)
                 session.commit()
@@ -259,6 +271,8 @@ class Edit(AdminService, _HTTPSOAPService):
                     input.merge_url_params_req = item.merge_url_params_req
                     input.url_params_pri = item.url_params_pri
                     input.params_pri = item.params_pri
+                    input.max_request_size = item.max_request_size
+                    input.stream_request = item.stream_request
                 else:
                     input.ping_method = item.ping_method
                     input.pool_size = item.pool_size
@@ -14,6 +14,7 @@ from json import dumps, loads
 
 # Zato
 from zato.common import DATA_FORMAT, DELIVERY_STATE, INVOCATION_TARGET, KVDB
+from zato.common.delivery import PURGE_BATCH_SIZE, PURGE_LOCK_TIMEOUT
 from zato.common.odb.model import DeliveryDefinitionBase, DeliveryDefinitionOutconnWMQ
 from zato.common.odb.query import delivery_count_by_state, delivery_definition_list, \
      delivery_history_list
@@ -126,15 +127,15 @@ class GetBatchInfo(_Base):
         request_elem = 'zato_pattern_delivery_get_batch_info_request'
         response_elem = 'zato_pattern_delivery_get_batch_info_response'
         input_required = ('def_name', 'state')
-        input_optional = ('batch_size', 'current_batch', 'start', 'stop')
-        output_required = ('total_results', 'num_batches', 'has_previous', 'has_next', 'next_batch_number', 'previous_batch_number')
+        input_optional = ('batch_size', AsIs('after'), AsIs('before'), 'start', 'stop')
+        output_required = ('total_results', 'has_previous', 'has_next')
+        output_optional = (AsIs('next_batch_cursor'), AsIs('previous_batch_cursor'))
 
     def handle(self):
         input = self.request.input
         state = self._validate_get_state(input)
         
-        input['batch_size'] = input['batch_size'] or 25
-        input['current_batch'] = input['current_batch'] or 1
+        input['batch_size'] = int(input['batch_size'] or 25)
         
         self.response.payload = self.delivery_store.get_batch_info(self.server.cluster_id, input, state)
 
@@ -237,7 +238,7 @@ class GetList(_Base):
         request_elem = 'zato_pattern_delivery_in_doubt_get_list_request'
         response_elem = 'zato_pattern_delivery_in_doubt_get_list_response'
         input_required = ('def_name', 'state')
-        input_optional = ('batch_size', 'current_batch', 'start', 'stop',)
+        input_optional = ('batch_size', AsIs('after'), AsIs('before'), 'start', 'stop',)
         output_required = ('def_name', 'target_type', AsIs('task_id'), 'creation_time_utc', 'last_used_utc', 
             'source_count', 'target_count', 'resubmit_count', 'retry_repeats', 'check_after', 'retry_seconds')
         output_repeated = True
@@ -245,8 +246,7 @@ class GetList(_Base):
     def handle(self):
         input = self.request.input
         state = self._validate_get_state(input)
-        input['batch_size'] = input['batch_size'] or 25
-        input['current_batch'] = input['current_batch'] or 1
+        input['batch_size'] = int(input['batch_size'] or 25)
         
         self.response.payload[:] = self.delivery_store.get_delivery_instance_list(self.server.cluster_id, input, state)
 
@@ -326,3 +326,47 @@ class DispatchAutoResubmit(AdminService):
                         {'def_id':def_id, 'def_name':def_name, 'retry_seconds':retry_seconds})
 
 # ##############################################################################
+
+class Purge(AdminService):
+    """ Deletes confirmed and failed deliveries whose time in the archive, as configured in their
+    definitions, has expired, along with their payloads and history, and reports how many were deleted.
+    """
+    class SimpleIO(AdminSIO):
+        request_elem = 'zato_pattern_delivery_purge_request'
+        response_elem = 'zato_pattern_delivery_purge_response'
+        output_required = ('confirmed_count', 'failed_count', 'history_count')
+
+    def handle(self):
+        now = datetime.utcnow()
+        batch_size = int(self.server.fs_server_config.patterns.get('delivery_purge_batch_size', PURGE_BATCH_SIZE))
+        
+        with closing(self.odb.session()) as session:
+            def_list = [(d_def.id, d_def.name, d_def.expire_arch_succ_after, d_def.expire_arch_fail_after)
+                for d_def in delivery_definition_list(session, self.server.cluster_id)]
+            
+        counts = {DELIVERY_STATE.CONFIRMED:0, DELIVERY_STATE.FAILED:0}
+        history_count = 0
+        
+        with self.lock(expires=PURGE_LOCK_TIMEOUT):
+            for def_id, def_name, expire_arch_succ_after, expire_arch_fail_after in def_list:
+                for state, expires in ((DELIVERY_STATE.CONFIRMED, expire_arch_succ_after), (DELIVERY_STATE.FAILED, expire_arch_fail_after)):
+                    
+                    # Archive expiration times are in hours
+                    delivery_count, def_history_count = self.delivery_store.purge(
+                        def_id, def_name, state, now - timedelta(hours=expires), batch_size)
+                    
+                    if delivery_count:
+                        self.logger.info('Purged [%s] %s deliveries of [%s] along with [%s] history entries',
+                            delivery_count, state, def_name, def_history_count)
+                        
+                    counts[state] += delivery_count
+                    history_count += def_history_count
+                    
+        self.logger.info('Purged [%s] confirmed and [%s] failed deliveries along with [%s] history entries',
+            counts[DELIVERY_STATE.CONFIRMED], counts[DELIVERY_STATE.FAILED], history_count)
+        
+        self.response.payload.confirmed_count = counts[DELIVERY_STATE.CONFIRMED]
+        self.response.payload.failed_count = counts[DELIVERY_STATE.FAILED]
+        self.response.payload.history_count = history_count
+
+# ##############################################################################
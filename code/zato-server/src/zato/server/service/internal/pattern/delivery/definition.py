@@ -52,6 +52,14 @@ class _DeliveryService(AdminService):
                 self.logger.warn(msg)
                 raise ValueError(msg)
             
+        # Optional ones, defaulting to repeats at regular intervals, the backoff may be a fraction, e.g. 1.5
+        for name, type_ in (('retry_backoff', float), ('retry_max_seconds', int)):
+            value = self.request.input.get(name)
+            if value and type_(value) < 1:
+                msg = '[{}] should be at least 1 instead of [{}]'.format(name, value)
+                self.logger.warn(msg)
+                raise ValueError(msg)
+            
     def _batch_size_from_input(self):
         """ Returns a batch size taking into account handling of invalid input values.
         """
@@ -89,7 +97,7 @@ class GetList(_DeliveryService):
             'expire_after', 'expire_arch_succ_after', 'expire_arch_fail_after', 'check_after', 
             'retry_repeats', 'retry_seconds', 'short_def', 'total_count', 
             'in_progress_count', 'in_doubt_count', 'confirmed_count', 'failed_count')
-        output_optional = (UTC('last_updated_utc'), UTC('last_used_utc'), 'callback_list')
+        output_optional = (UTC('last_updated_utc'), UTC('last_used_utc'), 'callback_list', 'retry_backoff', 'retry_max_seconds')
 
     def get_data(self, session, cluster_id, target_type):
         for item in delivery_definition_list(session, cluster_id, target_type):
@@ -103,8 +111,8 @@ class GetList(_DeliveryService):
             }
             
             for name in ('id', 'name', 'expire_after', 'expire_arch_succ_after', 
-                  'expire_arch_fail_after', 'check_after', 'retry_repeats', 'retry_seconds', 'short_def',
-                  'callback_list', 'last_used_utc'):
+                  'expire_arch_fail_after', 'check_after', 'retry_repeats', 'retry_seconds', 'retry_backoff',
+                  'retry_max_seconds', 'short_def', 'callback_list', 'last_used_utc'):
                 out[name] = getattr(item, name, None)
                 
             last_used = getattr(item, 'last_used', None)
@@ -136,7 +144,7 @@ class _CreateEdit(_DeliveryService):
         input_required = ('cluster_id', 'target', 'target_type', 'expire_after', 
             'expire_arch_succ_after', 'expire_arch_fail_after', 'check_after', 
             'retry_repeats', 'retry_seconds',)
-        input_optional = ('callback_list',)
+        input_optional = ('callback_list', 'retry_backoff', 'retry_max_seconds')
         output_required = ('id', 'name')
         
     def _get_item(self, session, target_def_class, input):
@@ -176,6 +184,8 @@ class _CreateEdit(_DeliveryService):
                 item.check_after = input.check_after
                 item.retry_repeats = input.retry_repeats
                 item.retry_seconds = input.retry_seconds
+                item.retry_backoff = float(input.retry_backoff) if input.get('retry_backoff') else None
+                item.retry_max_seconds = input.get('retry_max_seconds') or None
                 item.cluster_id = input.cluster_id
                 item.callback_list = input.callback_list.encode('utf-8')
                 
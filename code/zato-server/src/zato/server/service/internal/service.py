@@ -32,6 +32,7 @@ from zato.common.odb.query import service_list
 from zato.common.util import hot_deploy, payload_from_request
 from zato.server.service import Boolean, Integer
 from zato.server.service.internal import AdminService, AdminSIO
+from zato.server.stats import QueueStats
 
 _no_such_service_name = uuid4().hex
 
@@ -86,7 +87,8 @@ class GetByName(AdminService):
         input_required = ('cluster_id', 'name')
         output_required = ('id', 'name', 'is_active', 'impl_name', 'is_internal', Boolean('may_be_deleted'),
             Integer('usage'), Integer('slow_threshold'), Integer('time_last'), 
-            Integer('time_min_all_time'), Integer('time_max_all_time'), 'time_mean_all_time',)
+            Integer('time_min_all_time'), Integer('time_max_all_time'), 'time_mean_all_time',
+            'time_queue_p50', 'time_queue_p99', 'time_queue_broker_p99', 'time_queue_pool_p99')
         
     def get_data(self, session):
         return session.query(Service.id, Service.name, Service.is_active,
@@ -120,6 +122,14 @@ class GetByName(AdminService):
             self.response.payload.time_min_all_time = int(self.response.payload.time_min_all_time)
             self.response.payload.time_max_all_time = int(self.response.payload.time_max_all_time)
             self.response.payload.time_mean_all_time = round(self.response.payload.time_mean_all_time, 1)
+            
+            # How long asynchronous invocations waited before the service started, in total and in each part of the wait
+            queue = QueueStats(self.server.kvdb.conn).get(service.name)
+            
+            self.response.payload.time_queue_p50 = round(queue['queue'].get_percentile(50), 1)
+            self.response.payload.time_queue_p99 = round(queue['queue'].get_percentile(99), 1)
+            self.response.payload.time_queue_broker_p99 = round(queue['broker'].get_percentile(99), 1)
+            self.response.payload.time_queue_pool_p99 = round(queue['pool'].get_percentile(99), 1)
 
 class Edit(AdminService):
     """ Updates a service.
@@ -10,13 +10,13 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 # stdlib
 from calendar import mdays
-from collections import OrderedDict
 from contextlib import closing
 from datetime import datetime, timedelta
-from heapq import nlargest
-from operator import itemgetter
 from sys import maxint
 
+# anyjson
+from anyjson import loads
+
 # Bunch
 from bunch import Bunch
 
@@ -25,18 +25,31 @@ from dateutil.parser import parse
 from dateutil.relativedelta import relativedelta
 from dateutil.rrule import MINUTELY, rrule, rruleset
 
+# NumPy
+import numpy as np
+
 # SciPy
 from scipy import stats as sp_stats
 
+# Redis
+from redis import ResponseError
+
 # Zato
-from zato.common import KVDB, SECONDS_IN_DAY, StatsElem, ZatoException
+from zato.common import BROKER, KVDB, SECONDS_IN_DAY, StatsElem, ZatoException
 from zato.common.broker_message import STATS
 from zato.common.odb.model import Service
 from zato.server.service import Integer, UTC
 from zato.server.service.internal import AdminService, AdminSIO
+from zato.server.stats import ARCHIVE_AFTER_MIN, ARCHIVE_PREFIXES, ChannelStats, get_bucket_range, get_bucket_start, \
+     get_closed_summary_key, get_score, HeavyHitters, LatencySketch, MaintenanceTool, PERCENTILES, read_pipelined, \
+     StatsIndex, SUMMARY_PREFIXES, TOP_N_PREFIXES
 
 STATS_KEYS = ('usage', 'max', 'rate', 'mean', 'min')
 
+# Fields GetStats reads, in the order they're stored in arrays, and what's read if there are none
+STATS_FIELDS = ('usage', 'mean', 'min', 'max')
+MISSING_FIELDS = [float('nan')] * len(STATS_FIELDS)
+
 def stop_excluding_rrset(freq, start, stop):
     rrs = rruleset()
     rrs.rrule(rrule(freq, dtstart=start, until=stop))
@@ -53,83 +66,80 @@ class Delete(AdminService):
         request_elem = 'zato_stats_delete_request'
         response_elem = 'zato_stats_delete_response'
         input_required = (UTC('start'), UTC('stop'))
+        output_optional = ('id',)
 
     def handle(self):
+        # Progress of the deletion can be checked under KVDB.SERVICE_STATS_DELETE_STATUS + id
         self.broker_client.invoke_async(
-            {'action':STATS.DELETE, 'start':self.request.input.start, 'stop':self.request.input.stop})
+            {'action':STATS.DELETE, 'start':self.request.input.start, 'stop':self.request.input.stop, 'id':self.cid})
+        
+        self.response.payload.id = self.cid
+        
+class Archive(AdminService):
+    """ Moves statistics of periods that have ended long enough ago from the KVDB
+    to the archive on disk, if there's one.
+    """
+    def handle(self):
+        if not self.server.stats_archive:
+            return
+        
+        until = datetime.utcnow() - timedelta(days=max(self.server.stats_archive_after, ARCHIVE_AFTER_MIN))
+        until = until.replace(minute=0, second=0, microsecond=0)
+        
+        tool = MaintenanceTool(self.kvdb.conn, self.server.stats_delete_batch_size, self.server.stats_pipeline_batch_size)
+        
+        # The first run may have a lot of catching up to do
+        with self.lock(expires=3600):
+            for prefix in sorted(ARCHIVE_PREFIXES):
+                tool.archive(self.server.stats_archive, prefix, until)
         
 # ##############################################################################
 
 class BaseAggregatingService(AdminService):
     """ A base class for all services that process statistics into aggregated values.
     """
-    def aggregate_raw_times(self, key, service_name, max_batch_size=None):
-        """ Aggregates values from a list living under a given key. Returns its
-        min, max, mean and an overall usage count. 'max_batch_size' controls how
-        many items will be fetched from the list so it's possible to fetch less
-        items than its LLEN returns.
+    def get_sketch(self, key):
+        """ Returns a sketch of response times kept in a hash under a given key.
         """
-        key_len = self.server.kvdb.conn.llen(key)
-        if max_batch_size:
-            batch_size = min(key_len, max_batch_size)
-            if batch_size < key_len:
-                msg = ('batch_size:[{}] < key_len:[{}], max_batch_size:[{}], key:[{}], '
-                'consider decreasing the job interval or increasing the max_batch_size').format(
-                    batch_size, key_len, max_batch_size, key)
-                self.logger.warn(msg)
-        else:
-            batch_size = key_len
-            
-        times = [int(elem) for elem in self.server.kvdb.conn.lrange(key, 0, batch_size)]
-
-        if times:
+        return LatencySketch.from_hash(self.server.kvdb.conn.hgetall(key))
+    
+    def aggregate_sketch(self, sketch, service_name):
+        """ Aggregates response times from a sketch. Returns their min, max, mean
+        and an overall usage count. The mean doesn't include times above the service's
+        mean_percentile.
+        """
+        if sketch.buckets:
             mean_percentile = int(self.server.kvdb.conn.hget(KVDB.SERVICE_TIME_BASIC + service_name, 'mean_percentile') or 0)
-            max_score = int(sp_stats.scoreatpercentile(times, mean_percentile))
             
-            return min(times), max(times), (sp_stats.tmean(times, (None, max_score)) or 0), len(times)
+            return (int(round(sketch.get_min())), int(round(sketch.get_max())), sketch.get_mean(mean_percentile),
+                sketch.count)
         else:
             return 0, 0, 0, 0
     
-    def collect_service_stats(self, keys_pattern, key_prefix, key_suffix, total_seconds, 
-                              suffix_needs_colon=True, chop_off_service_name=True, needs_rate=True):
-
+    def collect_service_stats(self, buckets, total_seconds, needs_rate=True):
+        """ Collects statistics of all the services from buckets given on input,
+        each of which is a (key prefix, key suffix) tuple.
+        """
         service_stats = {}
-        if suffix_needs_colon:
-            key_suffix = ':' + key_suffix
-            
-        for key in self.kvdb.conn.keys(keys_pattern):
-            service_name = key.replace(key_prefix, '').replace(key_suffix, '')
-            if chop_off_service_name:
-                service_name = service_name[:-3]
+        stats_index = StatsIndex(self.kvdb.conn)
+        batch_size = self.server.stats_pipeline_batch_size
+        
+        buckets = list(buckets)
+        args = [(stats_index.get_services_key(key_prefix, key_suffix),) for key_prefix, key_suffix in buckets]
+        
+        # Names of services in each of the buckets
+        names = []
+        for (key_prefix, key_suffix), service_names in zip(buckets, read_pipelined(self.kvdb.conn, 'smembers', args, batch_size)):
+            for service_name in service_names:
+                names.append((service_name, '{}{}:{}'.format(key_prefix, service_name, key_suffix)))
                 
-            values = self.kvdb.conn.hgetall(key)
-            
-            stats = service_stats.setdefault(service_name, {})
-            
-            for name in STATS_KEYS:
+        args = [(key,) for service_name, key in names]
+        
+        for (service_name, key), values in zip(names, read_pipelined(self.kvdb.conn, 'hgetall', args, batch_size)):
             
-                value = values[name]
-                if name in('rate', 'mean'):
-                    value = float(value)
-                else:
-                    value = int(value)
-                    
-                if not name in stats:
-                    if name == 'mean':
-                        stats[name] = []
-                    elif name == 'min':
-                        stats[name] = maxint
-                    else:
-                        stats[name] = 0
-                    
-                if name == 'usage':
-                    stats[name] += value
-                elif name == 'max':
-                    stats[name] = max(stats[name], value)
-                elif name == 'mean':
-                    stats[name].append(value)
-                elif name == 'min':
-                    stats[name] = min(stats[name], value)
+            # Deleted since it was indexed
+            if values:
+                self._collect_values(service_stats.setdefault(service_name, {}), values)
                     
         for service_name, values in service_stats.items():
             values['mean'] = sp_stats.tmean(values['mean'])
@@ -138,7 +148,37 @@ class BaseAggregatingService(AdminService):
                 values['rate'] = values['usage'] / total_seconds
             
         return service_stats
-        
+    
+    def _collect_values(self, stats, values):
+        """ Merges values of a single bucket into statistics collected so far.
+        """
+        for name in STATS_KEYS:
+            value = values[name]
+            if name in('rate', 'mean'):
+                value = float(value)
+            else:
+                value = int(value)
+                
+            if not name in stats:
+                if name == 'mean':
+                    stats[name] = []
+                elif name == 'min':
+                    stats[name] = maxint
+                else:
+                    stats[name] = 0
+                
+            if name == 'usage':
+                stats[name] += value
+            elif name == 'max':
+                stats[name] = max(stats[name], value)
+            elif name == 'mean':
+                stats[name].append(value)
+            elif name == 'min':
+                stats[name] = min(stats[name], value)
+                
+        if 'sketch' in values:
+            stats.setdefault('sketch', LatencySketch()).merge(LatencySketch.loads(values['sketch']))
+    
     def aggregate_partly_aggregated(self, delta, source_strftime_format, source, target, now=None):
         """ Further aggregates service statistics, e.g. turns per-minute statistics
         into per-hour statistcs.
@@ -154,12 +194,34 @@ class BaseAggregatingService(AdminService):
             total_seconds = mdays[delta_diff.month] * SECONDS_IN_DAY # TODO: Use calendar.monthrange instead of mdays so leap years are taken into account
         
         key_suffix = delta_diff.strftime(source_strftime_format)
-        service_stats = self.collect_service_stats(
-            '{}*:{}*'.format(source, key_suffix), source, key_suffix, total_seconds)
+        
+        # All the source buckets which are part of the target one
+        start, stop = get_bucket_range(key_suffix)
+        source_suffixes = StatsIndex(self.kvdb.conn).get_buckets(source, start, stop)
+        
+        service_stats = self.collect_service_stats(((source, elem) for elem in source_suffixes), total_seconds)
         
         self.hset_aggr_keys(service_stats, target, key_suffix)
         
+        if target in TOP_N_PREFIXES:
+            HeavyHitters(self.kvdb.conn, self.server.stats_pipeline_batch_size).rollup(
+                target, key_suffix, source, source_suffixes)
+            
+    def aggregate_channels(self, delta, source_strftime_format, source, target, now=None):
+        """ Rolls up statistics of channels, e.g. per-minute ones into per-hour ones.
+        """
+        key_suffix = ((now or datetime.utcnow()) - delta).strftime(source_strftime_format)
+        
+        start, stop = get_bucket_range(key_suffix)
+        source_suffixes = StatsIndex(self.kvdb.conn).get_buckets(source, start, stop)
+        
+        if source_suffixes:
+            ChannelStats(self.kvdb.conn, self.server.stats_pipeline_batch_size).rollup(
+                target, key_suffix, source, source_suffixes)
+        
     def hset_aggr_keys(self, service_stats, key_prefix, key_suffix):
+        stats_index = StatsIndex(self.server.kvdb.conn)
+        
         for service_name, values in service_stats.items():
             if service_name.endswith(':'):
                 service_name = service_name[:-1]
@@ -167,37 +229,53 @@ class BaseAggregatingService(AdminService):
             aggr_key = '{}{}:{}'.format(key_prefix, service_name, key_suffix)
             for name in STATS_KEYS:
                 self.hset_aggr_key(aggr_key, name, values[name])
+                
+            # Sketches merged out of buckets some of which had none, e.g. ones stored
+            # by previous versions, would have resulted in skewed percentiles.
+            sketch = values.get('sketch')
+            if sketch and sketch.count == values['usage']:
+                self.hset_sketch(aggr_key, sketch)
+                
+            stats_index.add(key_prefix, service_name, key_suffix)
         
     def hset_aggr_key(self, aggr_key, hash_key, hash_value):
         self.server.kvdb.conn.hset(aggr_key, hash_key, hash_value)
         
+    def hset_sketch(self, aggr_key, sketch):
+        """ Stores a sketch of response times next to statistics aggregated out of it
+        so it can be merged into less fine-grained ones later on, along with percentiles read off it.
+        """
+        self.hset_aggr_key(aggr_key, 'sketch', sketch.dumps())
+        
+        for percentile in PERCENTILES:
+            self.hset_aggr_key(aggr_key, 'p{}'.format(percentile), int(round(sketch.get_percentile(percentile))))
+        
 # ##############################################################################
         
 class ProcessRawTimes(BaseAggregatingService):
     def handle(self):
         
-        # 
-        # Sample config values
-        # 
-        # global_slow_threshold=120
-        # max_batch_size=99999
-        #
-        config = Bunch()
-        for item in self.request.payload.splitlines():
-            key, value = item.split('=')
-            config[key] = int(value)
-
-        for key in self.server.kvdb.conn.keys(KVDB.SERVICE_TIME_RAW + '*'):
+        for service_name in StatsIndex(self.server.kvdb.conn).get_raw_services():
+            
+            # Workers keep on adding to the sketch so it's moved away first
+            # and only then processed, in order not to lose any new times.
+            key = KVDB.SERVICE_TIME_SKETCH + service_name
+            processing_key = KVDB.SERVICE_TIME_SKETCH_PROCESSING + service_name
+            
+            try:
+                self.server.kvdb.conn.rename(key, processing_key)
+            except ResponseError:
+                # No new times since the last run
+                continue
             
-            service_name = key.replace(KVDB.SERVICE_TIME_RAW, '')
+            sketch = self.get_sketch(processing_key)
             
             current_mean = float(
                 self.server.kvdb.conn.hget(KVDB.SERVICE_TIME_BASIC + service_name, 'mean_all_time') or 0)
             current_min = float(self.server.kvdb.conn.hget(KVDB.SERVICE_TIME_BASIC + service_name, 'min_all_time') or 0)
             current_max = float(self.server.kvdb.conn.hget(KVDB.SERVICE_TIME_BASIC + service_name, 'max_all_time') or 0)
             
-            batch_min, batch_max, batch_mean, batch_total = self.aggregate_raw_times(
-                key, service_name, config.max_batch_size)
+            batch_min, batch_max, batch_mean, batch_total = self.aggregate_sketch(sketch, service_name)
             
             self.server.kvdb.conn.hset(
                KVDB.SERVICE_TIME_BASIC + service_name, 'mean_all_time', sp_stats.tmean((batch_mean, current_mean)))
@@ -206,9 +284,7 @@ class ProcessRawTimes(BaseAggregatingService):
             self.server.kvdb.conn.hset(
                 KVDB.SERVICE_TIME_BASIC + service_name, 'max_all_time', max(current_max, batch_max))
             
-            # Services use RPUSH for storing raw times so we are safe to use LTRIM
-            # in order to do away with the already processed ones
-            self.server.kvdb.conn.ltrim(key, batch_total, -1)
+            self.server.kvdb.conn.delete(processing_key)
             
 # ##############################################################################
 
@@ -225,22 +301,32 @@ class AggregateByMinute(BaseAggregatingService):
         now = datetime.utcnow()
         key_suffix = (now - timedelta(minutes=2)).strftime('%Y:%m:%d:%H:%M')
         
-        for key in self.server.kvdb.conn.keys('{}*:{}'.format(KVDB.SERVICE_TIME_RAW_BY_MINUTE, key_suffix)):
+        stats_index = StatsIndex(self.server.kvdb.conn)
+        top_n_stats = []
+        
+        for service_name in stats_index.get_services(KVDB.SERVICE_TIME_SKETCH_BY_MINUTE, key_suffix):
             
-            service_name = key.replace(KVDB.SERVICE_TIME_RAW_BY_MINUTE, '').replace(':' + key_suffix, '')
+            key = '{}{}:{}'.format(KVDB.SERVICE_TIME_SKETCH_BY_MINUTE, service_name, key_suffix)
             aggr_key = '{}{}:{}'.format(KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE, service_name, key_suffix)
             
-            batch_min, batch_max, batch_mean, batch_total = self.aggregate_raw_times(key, service_name)
+            sketch = self.get_sketch(key)
+            batch_min, batch_max, batch_mean, batch_total = self.aggregate_sketch(sketch, service_name)
             
             self.hset_aggr_key(aggr_key, 'min', batch_min)
             self.hset_aggr_key(aggr_key, 'max', batch_max)
             self.hset_aggr_key(aggr_key, 'mean', batch_mean)
             self.hset_aggr_key(aggr_key, 'usage', batch_total)
             self.hset_aggr_key(aggr_key, 'rate', batch_total / 60.0) # I.e. req/s
+            self.hset_sketch(aggr_key, sketch)
+            
+            stats_index.add(KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE, service_name, key_suffix)
+            top_n_stats.append((service_name, batch_total, batch_mean))
             
-            # Raw per-minute statistics keys will expire by themselves, we don't need
+            # Per-minute sketches will expire by themselves, we don't need
             # to delete them manually.
             
+        HeavyHitters(self.server.kvdb.conn).add_bucket(KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE, key_suffix, top_n_stats)
+            
 class AggregateByHour(BaseAggregatingService):
     """ Creates per-hour stats.
     """
@@ -251,6 +337,7 @@ class AggregateByHour(BaseAggregatingService):
         target = KVDB.SERVICE_TIME_AGGREGATED_BY_HOUR
         
         self.aggregate_partly_aggregated(delta, source_strftime_format, source, target)
+        self.aggregate_channels(delta, source_strftime_format, KVDB.CHANNEL_STATS_BY_MINUTE, KVDB.CHANNEL_STATS_BY_HOUR)
         
 class AggregateByDay(BaseAggregatingService):
     """ Creates per-day stats.
@@ -262,6 +349,7 @@ class AggregateByDay(BaseAggregatingService):
         target = KVDB.SERVICE_TIME_AGGREGATED_BY_DAY
         
         self.aggregate_partly_aggregated(delta, source_strftime_format, source, target)
+        self.aggregate_channels(delta, source_strftime_format, KVDB.CHANNEL_STATS_BY_HOUR, KVDB.CHANNEL_STATS_BY_DAY)
         
 class AggregateByMonth(BaseAggregatingService):
     """ Creates per-month stats.
@@ -307,19 +395,56 @@ class StatsReturningService(AdminService):
             raise ZatoException(self.cid, msg)
 
         else:
-            data = dict.fromkeys(stats_elems, 0)
-            for name in data:
-                data[name] = getattr(stats_elems[name], n_type)
+            names = sorted(stats_elems)
+            values = np.array([getattr(stats_elems[name], n_type) for name in names], dtype=float)
 
-            # It's itemgetter(1 ,0) because idx=1 is the actual value and idx=0
-            # is a name so in the end nlargest returns values in ascending order
-            # while also sorting lexicographically services that happen to have equal values.
-            names = nlargest(n, data.items(), key=itemgetter(1, 0)) 
-            for name, value in names:
-                yield stats_elems[name]
+            # The primary sort key is the actual value and the secondary one is a position
+            # of the name so in the end the order is descending while services that happen
+            # to have equal values are also sorted lexicographically, in descending order as well.
+            for idx in np.lexsort((np.arange(len(names)), values))[::-1][:n]:
+                yield stats_elems[names[idx]]
     
     def get_suffixes(self, start, stop):
         return [elem.strftime('%Y:%m:%d:%H:%M') for elem in stop_excluding_rrset(MINUTELY, start, stop)]
+    
+    def get_top_n(self, stats_key_prefix, suffixes, n, n_type):
+        """ Returns names of top n services along with totals of all the services
+        or None if statistics of all of them need to be read to find it out.
+        """
+        return HeavyHitters(self.server.kvdb.conn, self.server.stats_pipeline_batch_size).get_top_n(
+            stats_key_prefix, suffixes, n, n_type)
+    
+    def get_closed_records(self, stats_key_prefix, suffixes):
+        """ Returns summaries of periods that have ended, keyed by an index of their suffix.
+        """
+        if stats_key_prefix not in SUMMARY_PREFIXES:
+            return {}
+        
+        args = [(get_closed_summary_key(stats_key_prefix, suffix),) for suffix in suffixes]
+        records = read_pipelined(self.server.kvdb.conn, 'get', args, self.server.stats_pipeline_batch_size)
+        
+        return dict((suffix_idx, loads(record)) for suffix_idx, record in enumerate(records) if record)
+    
+    def get_archived(self, stats_key_prefix, suffixes, service):
+        """ Returns indexes of suffixes of buckets which have been archived along with
+        their statistics read off the archive, if there are any such buckets.
+        """
+        archive = self.server.stats_archive
+        if not archive or stats_key_prefix not in ARCHIVE_PREFIXES:
+            return set(), None
+        
+        archived_until = int(self.server.kvdb.conn.hget(KVDB.SERVICE_STATS_ARCHIVED_UNTIL, stats_key_prefix) or 0)
+        archived_idx = [suffix_idx for suffix_idx, suffix in enumerate(suffixes)
+            if get_score(get_bucket_start(suffix)) < archived_until]
+        
+        if not archived_idx:
+            return set(), None
+        
+        archived = archive.read(stats_key_prefix, [suffixes[suffix_idx] for suffix_idx in archived_idx], STATS_FIELDS,
+            None if service == '*' else service)
+        archived.suffix_idx = np.array(archived_idx)[archived.suffix_idx]
+        
+        return set(archived_idx), archived
 
     def get_stats(self, start, stop, service='*', n=None, n_type=None, needs_trends=True, 
             stats_key_prefix=None, suffixes=None):
@@ -331,15 +456,6 @@ class StatsReturningService(AdminService):
         if not stats_key_prefix:
             stats_key_prefix = self.stats_key_prefix
             
-        stats_elems = {}
-        all_services_stats = Bunch({'usage':0, 'time':0})
-    
-        # All mean values
-        mean_all_services_list = []
-        
-        # A mean value of all the mean values (mean_all_services_list)
-        mean_all_services = 0
-    
         start = parse(start)
         stop = parse(stop)
         delta = (stop - start)
@@ -351,73 +467,135 @@ class StatsReturningService(AdminService):
         
         if not suffixes:
             suffixes = self.get_suffixes(start, stop)
+            
+        conn = self.server.kvdb.conn
+        batch_size = self.server.stats_pipeline_batch_size
+        stats_index = StatsIndex(conn)
         
-        # We make several passes. First two passes are made over Redis keys, one gathers the services, if any at all,
-        # and another one actually collects statistics for each service found. Next pass, a partly optional one,
-        # computes trends for mean response time and service usage. Another one computes each of the service's
-        # average rate and updates other attributes basing on values collected in the previous step.
+        # We make several passes. The first one reads the index to find out which services, if any at all,
+        # have statistics in which time elems and the second one actually reads the statistics of these services
+        # into arrays of services x time elems. Out of these, the next pass computes each of the service's usage,
+        # average rate, trends for mean response time and service usage and the rest of the attributes.
         # Optionally, the last one will pick only top n elements of a given type (top mean response time
-        # or top usage).
+        # or top usage). All the KVDB commands are sent in pipelines of batch_size commands each.
+        #
+        # Summaries of periods that have already ended are read from their records instead, each of
+        # which has statistics of all the services, and statistics moved to the archive on disk
+        # are read from there, so the first two passes concern only the rest of time elems.
+        #
+        # If only top n services by usage or time are needed, they are found out first and then
+        # only their statistics are read, in which case the first pass isn't needed at all.
+        # This isn't possible if any of the time elems has been archived.
+        
+        records = self.get_closed_records(stats_key_prefix, suffixes)
+        archived_idx, archived = self.get_archived(stats_key_prefix, suffixes, service)
+        open_suffixes = [suffix_idx for suffix_idx in range(len(suffixes))
+            if suffix_idx not in records and suffix_idx not in archived_idx]
+        
+        top_n = self.get_top_n(stats_key_prefix, suffixes, n, n_type) if n and service == '*' and not archived_idx else None
         
         # 1st pass
-        for suffix in suffixes:
-            keys = self.server.kvdb.conn.keys('{}{}:{}'.format(stats_key_prefix, service, suffix))
-            for key in keys:
-                service_name = key.replace(stats_key_prefix, '').replace(':{}'.format(suffix), '')
+        if top_n is not None:
+            suffix_names = [top_n.names] * len(open_suffixes)
+        elif service == '*':
+            args = [(stats_index.get_services_key(stats_key_prefix, suffixes[suffix_idx]),) for suffix_idx in open_suffixes]
+            suffix_names = list(read_pipelined(conn, 'smembers', args, batch_size))
+        else:
+            args = [(stats_index.get_services_key(stats_key_prefix, suffixes[suffix_idx]), service)
+                for suffix_idx in open_suffixes]
+            suffix_names = [[service] if is_member else [] for is_member in read_pipelined(conn, 'sismember', args, batch_size)]
             
-                stats_elem = StatsElem(service_name)
-                stats_elems[service_name] = stats_elem
-                
-                # When building statistics, we can't expect there will be data for all the time
-                # elems built above so to guard against it, this is a dictionary whose keys are the
-                # said elems and values are mean/usage for each elem. The values will remain
-                # 0/0.0 if there is no data for the time elem, which may mean that in this
-                # particular time slice the service wasn't invoked at all.
-                stats_elem.expected_time_elems = OrderedDict(
-                    (elem, Bunch({'mean':0, 'usage':0.0})) for elem in suffixes)
-                
+        # A (service, time elem) pair for each key with statistics
+        cells = [(name, suffix_idx) for suffix_idx, elem in zip(open_suffixes, suffix_names) for name in elem]
+        
         # 2nd pass
-        for service, stats_elem in stats_elems.items():
-            for suffix in suffixes:
-                key = '{}{}:{}'.format(stats_key_prefix, service, suffix)
-                
-                # We can convert all the values to floats here to ease with computing
-                # all the stuff and convert them still to integers later on, when necessary.
-                key_values = Bunch(
-                    ((name, float(value)) for (name, value) in self.server.kvdb.conn.hgetall(key).items()))
-                    
-                if key_values:
-    
-                    time = (key_values.usage * key_values.mean)
-                    stats_elem.time += time
-                    
-                    mean_all_services_list.append(key_values.mean)
-                    all_services_stats.time += time
-                    all_services_stats.usage += key_values.usage
-                    
-                    stats_elem.min_resp_time = min(stats_elem.min_resp_time, key_values.min)
-                    stats_elem.max_resp_time = max(stats_elem.max_resp_time, key_values.max)
+        args = [('{}{}:{}'.format(stats_key_prefix, name, suffixes[suffix_idx]),) + STATS_FIELDS for name, suffix_idx in cells]
+        values = [elem if elem[0] is not None else MISSING_FIELDS for elem in read_pipelined(conn, 'hmget', args, batch_size)]
+        
+        for suffix_idx, record in records.items():
+            for name, elem in record.items():
+                if service in('*', name):
+                    cells.append((name, suffix_idx))
+                    values.append([elem[field] for field in STATS_FIELDS])
                     
-                    for attr in('mean', 'usage'):
-                        stats_elem.expected_time_elems[suffix][attr] = key_values[attr]
-                        
-        mean_all_services = '{:.0f}'.format(sp_stats.tmean(mean_all_services_list)) if mean_all_services_list else 0
-                        
-        # 3rd pass (partly optional)
-        for stats_elem in stats_elems.values():
+        names = set(name for name, suffix_idx in cells)
+        if archived:
+            names.update(archived.names[idx] for idx in np.unique(archived.name_idx))
+        names = sorted(names)
+        
+        if not names:
+            return
+        
+        name_idx = dict((name, idx) for idx, name in enumerate(names))
+        cells = np.array([(name_idx[name], suffix_idx) for name, suffix_idx in cells], dtype=int).reshape(-1, 2)
+        values = np.array(values, dtype=float).reshape(-1, len(STATS_FIELDS))
+        
+        if archived:
+            archived_name_idx = np.array([name_idx.get(name, -1) for name in archived.names], dtype=int)
+            cells = np.concatenate((cells, np.column_stack((archived_name_idx[archived.name_idx], archived.suffix_idx))))
+            values = np.concatenate((values, archived.stats))
+        
+        # Keys may have been deleted since they were indexed
+        found = ~np.isnan(values[:,0])
+        values = values[found]
+        name_idx, suffix_idx = cells[found].T
+        
+        # When building statistics, we can't expect there will be data for all the time elems
+        # so all the arrays are filled with values meaning there was no data in a given time elem,
+        # which may mean that in this particular time slice the service wasn't invoked at all.
+        shape = (len(names), len(suffixes))
+        
+        usage = np.zeros(shape)
+        mean = np.zeros(shape)
+        min_resp_time = np.empty(shape)
+        min_resp_time.fill(maxint)
+        max_resp_time = np.zeros(shape)
+        
+        for idx, array in enumerate((usage, mean, min_resp_time, max_resp_time)):
+            array[name_idx, suffix_idx] = values[:,idx]
+        
+        # 3rd pass
+        time = (usage * mean).sum(axis=1)
+        
+        if top_n is not None:
+            all_services_time = top_n.time
+            all_services_usage = top_n.usage
+            mean_all_services = '{:.0f}'.format(top_n.mean / top_n.count) if top_n.count else 0
+        else:
+            all_services_time = time.sum()
+            all_services_usage = usage.sum()
+            mean_all_services = '{:.0f}'.format(values[:,1].mean()) if len(values) else 0
+        
+        mean_trend_int = mean.astype(int)
+        usage_trend_int = usage.astype(int)
+        
+        service_mean = mean_trend_int.mean(axis=1)
+        service_usage = usage_trend_int.sum(axis=1)
+        
+        min_resp_time = min_resp_time.min(axis=1)
+        max_resp_time = max_resp_time.max(axis=1)
+        
+        all_services_stats = Bunch({'usage':all_services_usage, 'time':all_services_time})
+        stats_elems = {}
+        
+        for idx, name in enumerate(names):
             
-            stats_elem.mean_all_services = mean_all_services
-            stats_elem.all_services_time = int(all_services_stats.time)
-            stats_elem.all_services_usage = int(all_services_stats.usage)
+            stats_elem = stats_elems[name] = StatsElem(name)
             
-            values = stats_elem.expected_time_elems.values()
+            stats_elem.time = float(time[idx])
+            stats_elem.min_resp_time = float(min_resp_time[idx]) if min_resp_time[idx] < maxint else maxint
+            stats_elem.max_resp_time = float(max_resp_time[idx])
             
-            stats_elem.mean_trend_int = [int(elem.mean) for elem in values]            
-            stats_elem.usage_trend_int = [int(elem.usage) for elem in values]
+            stats_elem.mean_all_services = mean_all_services
+            stats_elem.all_services_time = int(all_services_time)
+            stats_elem.all_services_usage = int(all_services_usage)
+            
+            stats_elem.mean_trend_int = mean_trend_int[idx].tolist()
+            stats_elem.usage_trend_int = usage_trend_int[idx].tolist()
             
-            stats_elem.mean = float('{:.2f}'.format(sp_stats.tmean(stats_elem.mean_trend_int)))
-            stats_elem.usage = sum(stats_elem.usage_trend_int)
-            stats_elem.rate = float('{:.2f}'.format(sum(stats_elem.usage_trend_int) / delta_seconds))
+            stats_elem.mean = float('{:.2f}'.format(service_mean[idx]))
+            stats_elem.usage = int(service_usage[idx])
+            stats_elem.rate = float('{:.2f}'.format(service_usage[idx] / delta_seconds))
             
             self.set_percent_of_all_services(all_services_stats, stats_elem)
 
@@ -455,4 +633,95 @@ class GetByService(StatsReturningService):
             stats_elem = stats_elem[0]
             self.response.payload = Bunch(stats_elem.to_dict())
 
+class GetByChannel(AdminService):
+    """ Returns statistics of HTTP channels - how many requests each of them has handled,
+    with what HTTP status codes, how many bytes there were in requests and responses
+    and how long it took to respond.
+    """
+    class SimpleIO(AdminSIO):
+        request_elem = 'zato_stats_get_by_channel_request'
+        response_elem = 'zato_stats_get_by_channel_response'
+        input_required = (UTC('start'), UTC('stop'))
+        input_optional = ('channel_name',)
+        output_optional = ('channel_name', 'usage', 'rate', 'bytes_in', 'bytes_out', 'mean', 'min_resp_time',
+            'max_resp_time', 'p50', 'p95', 'p99', 'status_codes')
+        
+    def get_stats(self, start, stop, channel_name=None, now=None):
+        """ Yields statistics of each channel, or of one channel only, for a given interval.
+        """
+        start = parse(start)
+        stop = parse(stop)
+        delta_seconds = (stop - start).total_seconds()
+        suffixes = [elem.strftime('%Y:%m:%d:%H:%M') for elem in stop_excluding_rrset(MINUTELY, start, stop)]
+        
+        channel_stats = ChannelStats(self.server.kvdb.conn, self.server.stats_pipeline_batch_size)
+        stats = channel_stats.get_stats(suffixes, channel_name, now)
+        
+        for name in sorted(stats):
+            fields = stats[name]
+            sketch = ChannelStats.get_sketch(fields)
+            status_codes = ChannelStats.get_status_codes(fields)
+            
+            item = Bunch()
+            item.channel_name = name
+            item.usage = fields.get('usage', 0)
+            item.rate = float('{:.2f}'.format(item.usage / delta_seconds)) if delta_seconds else 0
+            item.bytes_in = fields.get('bytes_in', 0)
+            item.bytes_out = fields.get('bytes_out', 0)
+            item.mean = float('{:.2f}'.format(sketch.get_mean()))
+            item.min_resp_time = int(round(sketch.get_min()))
+            item.max_resp_time = int(round(sketch.get_max()))
+            
+            for percentile in PERCENTILES:
+                item['p{}'.format(percentile)] = int(round(sketch.get_percentile(percentile)))
+                
+            # E.g. 200:10,500:2
+            item.status_codes = ','.join('{}:{}'.format(code, status_codes[code]) for code in sorted(status_codes))
+            
+            yield item
+            
+    def handle(self):
+        input = self.request.input
+        self.response.payload[:] = self.get_stats(input.start, input.stop, input.get('channel_name') or None)
+        
+class GetBrokerPool(AdminService):
+    """ Returns statistics of pools of greenlets broker clients of all the servers' workers
+    handle messages in - how many handlers each pool may run at a time, how many it's running now
+    and, since the previous report, how many were running at most, how many messages were
+    handled and how long, in milliseconds, they waited for a handler. Clients which haven't reported
+    their statistics in a while are assumed to have stopped and their statistics are deleted.
+    """
+    class SimpleIO(AdminSIO):
+        request_elem = 'zato_stats_get_broker_pool_request'
+        response_elem = 'zato_stats_get_broker_pool_response'
+        output_optional = ('client_name', 'size', 'busy', 'max_busy', 'handled', 'wait_time_mean', 'wait_time_max',
+            'reported')
+        
+    def get_stats(self, now=None):
+        now = now or datetime.utcnow()
+        conn = self.server.kvdb.conn
+        
+        for name, stats in sorted(conn.hgetall(KVDB.BROKER_POOL_STATS).items()):
+            stats = loads(stats)
+            reported = datetime.utcfromtimestamp(stats['reported'])
+            
+            if now - reported > timedelta(seconds=BROKER.POOL_STATS_INTERVAL * 3):
+                conn.hdel(KVDB.BROKER_POOL_STATS, name)
+                continue
+            
+            item = Bunch()
+            item.client_name = name
+            item.size = stats['size']
+            item.busy = stats['busy']
+            item.max_busy = stats['max_busy']
+            item.handled = stats['handled']
+            item.wait_time_mean = float('{:.2f}'.format(stats['wait_time_mean'] * 1000))
+            item.wait_time_max = float('{:.2f}'.format(stats['wait_time_max'] * 1000))
+            item.reported = reported.isoformat()
+            
+            yield item
+        
+    def handle(self):
+        self.response.payload[:] = self.get_stats()
+
 # ##############################################################################
@@ -10,10 +10,11 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 # stdlib
 from calendar import monthrange
-from copy import deepcopy
 from datetime import date, datetime, timedelta
 from itertools import chain
-from sys import maxint
+
+# anyjson
+from anyjson import dumps
 
 # Bunch
 from bunch import Bunch
@@ -26,21 +27,15 @@ from dateutil.rrule import DAILY, HOURLY, MINUTELY, MONTHLY, YEARLY
 # paodate
 from paodate import Date
 
-# SciPy
-from scipy import stats as sp_stats
-
 # Zato
 from zato.common import KVDB, StatsElem, ZatoException
 from zato.server.service import Integer, UTC
 from zato.server.service.internal.stats import BaseAggregatingService, STATS_KEYS, StatsReturningService, \
     stop_excluding_rrset
+from zato.server.stats import get_bucket_start, get_closed_summary_key, get_score, StatsIndex
 
 # ##############################################################################
 
-DEFAULT_STATS = {k:0 for k in STATS_KEYS}
-DEFAULT_STATS['mean'] = []
-DEFAULT_STATS['min'] = maxint
-
 class DT_PATTERNS(object):
     CURRENT_YEAR_START = '%Y-01-01'
     CURRENT_MONTH_START = '%Y-%m-01'
@@ -61,6 +56,33 @@ class DT_PATTERNS(object):
         'by-year': '%Y',
     }
     
+# What summaries of periods that have ended are closed out of, ordered so that summaries
+# other ones depend upon are closed first, e.g. each week is closed out of its days.
+CLOSED_SUMMARIES = (
+    ('by-day', relativedelta(days=1), KVDB.SERVICE_TIME_AGGREGATED_BY_HOUR),
+    ('by-week', relativedelta(weeks=1), KVDB.SERVICE_SUMMARY_BY_DAY),
+    ('by-month', relativedelta(months=1), KVDB.SERVICE_SUMMARY_BY_DAY),
+    ('by-year', relativedelta(years=1), KVDB.SERVICE_SUMMARY_BY_MONTH),
+)
+
+# How long after a period ends its summary is closed, gives jobs aggregating
+# statistics the period consists of time to catch up.
+CLOSE_SUMMARY_AFTER = timedelta(hours=2)
+
+def get_period_start(target, value):
+    """ Returns a datetime a summary period the value belongs to starts at.
+    """
+    start = datetime(value.year, value.month, value.day)
+    
+    if target == 'by-week':
+        return start - timedelta(days=start.weekday())
+    elif target == 'by-month':
+        return start.replace(day=1)
+    elif target == 'by-year':
+        return start.replace(month=1, day=1)
+    
+    return start
+    
 # ##############################################################################
 
 class SummarySlice(object):
@@ -140,22 +162,22 @@ class BaseSummarizingService(BaseAggregatingService):
         
         return (elem.strftime('%Y') for elem in stop_excluding_rrset(YEARLY, start, stop))
     
-    def _get_patterns(self, now, start, stop, kvdb_key, method):
-        return ('{}*:{}'.format(kvdb_key, elem) for elem in method(now, start, stop))
+    def _get_buckets(self, now, start, stop, kvdb_key, method):
+        return ((kvdb_key, elem) for elem in method(now, start, stop))
     
-    def get_by_minute_patterns(self, now, start=None, stop=None):
-        return self._get_patterns(now, start, stop, KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE, self.get_minutely_suffixes)
+    def get_by_minute_buckets(self, now, start=None, stop=None):
+        return self._get_buckets(now, start, stop, KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE, self.get_minutely_suffixes)
     
-    def get_by_hour_patterns(self, now, start=None, stop=None):
-        return self._get_patterns(now, start, stop, KVDB.SERVICE_TIME_AGGREGATED_BY_HOUR, self.get_hourly_suffixes)
+    def get_by_hour_buckets(self, now, start=None, stop=None):
+        return self._get_buckets(now, start, stop, KVDB.SERVICE_TIME_AGGREGATED_BY_HOUR, self.get_hourly_suffixes)
     
-    def get_by_day_patterns(self, now, start=None, stop=None):
-        return self._get_patterns(now, start, stop, KVDB.SERVICE_TIME_AGGREGATED_BY_DAY, self.get_daily_suffixes)
+    def get_by_day_buckets(self, now, start=None, stop=None):
+        return self._get_buckets(now, start, stop, KVDB.SERVICE_TIME_AGGREGATED_BY_DAY, self.get_daily_suffixes)
     
-    def get_by_month_patterns(self, now, start=None, stop=None):
-        return self._get_patterns(now, start, stop, KVDB.SERVICE_TIME_AGGREGATED_BY_MONTH, self.get_monthly_suffixes)
+    def get_by_month_buckets(self, now, start=None, stop=None):
+        return self._get_buckets(now, start, stop, KVDB.SERVICE_TIME_AGGREGATED_BY_MONTH, self.get_monthly_suffixes)
     
-    def create_summary(self, target, *pattern_names):
+    def create_summary(self, target, *bucket_names):
         now = datetime.utcnow()
         key_prefix = KVDB.SERVICE_SUMMARY_PREFIX_PATTERN.format(target)
         
@@ -167,37 +189,25 @@ class BaseSummarizingService(BaseAggregatingService):
             key_suffix = now.strftime(DT_PATTERNS.SUMMARY_SUFFIX_PATTERNS[target])
         total_seconds = (now - start).total_seconds()
         
-        patterns = []
-        for name in pattern_names:
-            patterns.append(getattr(self, 'get_by_{}_patterns'.format(name))(now))
+        buckets = []
+        for name in bucket_names:
+            buckets.append(getattr(self, 'get_by_{}_buckets'.format(name))(now))
+            
+        self.store_summary(key_prefix, key_suffix, chain(*buckets), total_seconds)
         
-        services = {}
+    def store_summary(self, key_prefix, key_suffix, buckets, total_seconds):
+        """ Stores a summary of statistics from all the buckets given on input and returns it.
+        """
+        services = self.collect_service_stats(buckets, total_seconds)
         
-        for elem in chain(*patterns):
-            prefix, suffix = elem.split('*')
-            suffix = suffix[1:]
-            stats = self.collect_service_stats(elem, prefix, suffix, None, False, False, False)
-            
-            for service_name, values in stats.items():
-                stats = services.setdefault(service_name, deepcopy(DEFAULT_STATS))
-                
-                for name in STATS_KEYS:
-                    value = values[name]
-                    if name == 'usage':
-                        stats[name] += value
-                    elif name == 'max':
-                        stats[name] = max(stats[name], value)
-                    elif name == 'mean':
-                        stats[name].append(value)
-                    elif name == 'min':
-                        stats[name] = min(stats[name], value)
-                        
-        for service_name, values in services.items():
-            values['mean'] = round(sp_stats.tmean(values['mean']), 2)
-            values['rate'] = round(values['usage'] / total_seconds, 2)
+        for values in services.values():
+            values['mean'] = round(values['mean'], 2)
+            values['rate'] = round(values['rate'], 2)
             
         self.hset_aggr_keys(services, key_prefix, key_suffix)
         
+        return services
+        
 # ##############################################################################
 
 class CreateSummaryByDay(BaseSummarizingService):
@@ -220,6 +230,56 @@ class CreateSummaryByYear(BaseSummarizingService):
         
 # ##############################################################################
 
+class CloseSummaries(BaseSummarizingService):
+    """ Stores final summaries of periods that have ended. Apart from being stored
+    just like ones of periods still going on, each is kept in a single record with
+    statistics of all the services which, once written, is never changed. This is what
+    services returning summaries read instead of statistics of each service separately.
+    """
+    def handle(self):
+        conn = self.server.kvdb.conn
+        stats_index = StatsIndex(conn)
+        now = datetime.utcnow() - CLOSE_SUMMARY_AFTER
+        
+        for target, period, source in CLOSED_SUMMARIES:
+            key_prefix = KVDB.SERVICE_SUMMARY_PREFIX_PATTERN.format(target)
+            
+            # Summaries of all the periods starting before the current one can be closed
+            closed_until = int(conn.hget(KVDB.SERVICE_SUMMARY_CLOSED_UNTIL, key_prefix) or 0)
+            stop = get_score(get_period_start(target, now))
+            
+            for key_suffix in stats_index.get_buckets(key_prefix, closed_until, stop):
+                if not conn.exists(get_closed_summary_key(key_prefix, key_suffix)):
+                    start = get_bucket_start(key_suffix)
+                    self.close_summary(stats_index, key_prefix, key_suffix, start, start + period, source)
+                    
+            conn.hset(KVDB.SERVICE_SUMMARY_CLOSED_UNTIL, key_prefix, stop)
+            
+    def close_summary(self, stats_index, key_prefix, key_suffix, start, stop, source):
+        
+        # Statistics the summary would be made of have already been moved to the archive,
+        # in whole or in part, so rather than storing a record without them, which would never
+        # be changed, the period is left without one and its summary is read as before.
+        archived_until = int(self.server.kvdb.conn.hget(KVDB.SERVICE_STATS_ARCHIVED_UNTIL, source) or 0)
+        if get_score(start) < archived_until:
+            self.logger.warn('Not closing summary [%s%s], its statistics have been archived', key_prefix, key_suffix)
+            return
+        
+        suffixes = stats_index.get_buckets(source, get_score(start), get_score(stop))
+        if not suffixes:
+            self.logger.info('Not closing summary [%s%s], there are no statistics of that period', key_prefix, key_suffix)
+            return
+        
+        services = self.store_summary(
+            key_prefix, key_suffix, ((source, suffix) for suffix in suffixes), (stop - start).total_seconds())
+        
+        record = dict((name, dict((key, values[key]) for key in STATS_KEYS)) for name, values in services.items())
+        self.server.kvdb.conn.setnx(get_closed_summary_key(key_prefix, key_suffix), dumps(record))
+        
+        self.logger.info('Closed summary [%s%s] of [%s] service(s)', key_prefix, key_suffix, len(record))
+        
+# ##############################################################################
+
 class GetSummaryBase(StatsReturningService):
     """ A base class for returning the summary of statistics for a given period.
     """
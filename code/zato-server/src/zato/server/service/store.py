@@ -58,6 +58,12 @@ class ServiceStore(InitializingObject):
         self.odb = odb
         self.id_to_impl_name = {}
         self.name_to_impl_name = {}
+        
+        # How many idle instances of each service to keep for reuse, 0 means a new one
+        # is always created. Pooled services mustn't keep any state of their own across
+        # requests in attributes other than the ones Service._reset sets.
+        self.instance_pool_size = 0
+        self.instance_pool = {}
 
     def _invoke_hook(self, object_, hook_name):
         """ A utility method for invoking various service's hooks.
@@ -71,9 +77,32 @@ class ServiceStore(InitializingObject):
             logger.error(msg)
 
     def new_instance(self, class_name):
-        """ Returns a new instance of a service of the given impl name.
+        """ Returns a new instance of a service of the given impl name, possibly
+        one taken from the pool of instances that were released earlier.
         """
+        if self.instance_pool_size:
+            pool = self.instance_pool.get(class_name)
+            if pool:
+                try:
+                    return pool.pop()
+                except IndexError:
+                    pass # Another greenlet took the last one in the meantime
+                
         return self.services[class_name]['service_class']()
+    
+    def release_instance(self, service):
+        """ Returns a service instance which has completed processing a request
+        to the pool so it can be reused by the next one.
+        """
+        if self.instance_pool_size:
+            pool = self.instance_pool.setdefault(service.impl_name, [])
+
+            service_data = self.services.get(service.impl_name, {})
+            
+            # The class might've been redeployed or deleted in the meantime and stale instances mustn't be reused
+            if len(pool) < self.instance_pool_size and service_data.get('service_class') is service.__class__:
+                service._reset()
+                pool.append(service)
         
     def new_instance_by_id(self, service_id):
         impl_name = self.id_to_impl_name[service_id]
@@ -240,6 +269,12 @@ class ServiceStore(InitializingObject):
                         self.services[impl_name]['deployment_info'] = depl_info
                         self.services[impl_name]['service_class'] = item
                         
+                        # Hooks and SimpleIO are resolved now rather than on each request
+                        item.get_invocation_plan()
+                        
+                        # Instances of a previous version of the class, if any, are no longer of use
+                        self.instance_pool.pop(impl_name, None)
+                        
                         si = self._get_source_code_info(mod)
                         
                         service_id, is_active, slow_threshold = self.odb.add_service(
@@ -207,9 +207,18 @@ class ZatoContext(PythonConfig):
             {'name': 'zato.stats.summary.create-summary-by-year', 'minutes':60,
              'service':'zato.stats.summary.create-summary-by-year'},
             
+            {'name': 'zato.stats.summary.close-summaries', 'minutes':60,
+             'service':'zato.stats.summary.close-summaries'},
+            
+            {'name': 'zato.stats.archive', 'minutes':60,
+             'service':'zato.stats.archive'},
+            
             {'name': 'zato.pattern.delivery.update-counters', 'seconds':30,
              'service':'zato.pattern.delivery.update-counters'},
             
             {'name': 'zato.pattern.delivery.dispatch-auto-resubmit', 'seconds':300,
              'service':'zato.pattern.delivery.dispatch-auto-resubmit'},
+            
+            {'name': 'zato.pattern.delivery.purge', 'minutes':10,
+             'service':'zato.pattern.delivery.purge'},
         ]
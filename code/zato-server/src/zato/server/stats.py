@@ -10,29 +10,1268 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 # stdlib
 import logging
+import os
+from calendar import timegm
 from contextlib import closing
-from datetime import datetime
+from datetime import datetime, timedelta
+from itertools import groupby
+from math import ceil, log
+from threading import RLock, Thread
+from time import sleep
+from traceback import format_exc
+
+# anyjson
+from anyjson import dumps, loads
+
+# Bunch
+from bunch import Bunch
 
 # dateutil
-from dateutil.rrule import MINUTELY, rrule
+from dateutil.parser import parse
+from dateutil.relativedelta import relativedelta
+
+# NumPy
+import numpy as np
+
+# Redis
+from redis import ResponseError
 
 # Zato
 from zato.common import KVDB, scheduler_date_time_format
 from zato.common.odb.model import Job, IntervalBasedJob, Service
+from zato.common.util import new_cid, TRACE1
 
 logger = logging.getLogger(__name__)
+
+# How long raw per-minute times are kept for AggregateByMinute to process them, in seconds
+RAW_BY_MINUTE_EXPIRE = 300
+
+# How many slow responses are kept for each service
+SLOW_RESPONSE_MAX = 100
+
+# Relative error of response times read off latency sketches, e.g. 0.01 = 1%
+SKETCH_ACCURACY = 0.01
+
+# Percentiles of response times stored along with aggregated statistics
+PERCENTILES = (50, 95, 99)
+
+# How many keys to ask SCAN for in one go
+SCAN_COUNT = 1000
+
+# How many commands statistics services send in one pipeline when reading the data
+PIPELINE_BATCH_SIZE = 500
+
+# What top N services can be found by without reading statistics of all of them
+TOP_N_TYPES = ('usage', 'time')
+
+# Key prefixes of statistics top N services are kept for, per-hour and per-day ones are rolled up
+# out of per-minute and per-hour ones, respectively. Rollups are listed along with the format
+# of their suffixes and how long their buckets are, from the longest one.
+TOP_N_PREFIXES = (KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE, KVDB.SERVICE_TIME_AGGREGATED_BY_HOUR,
+    KVDB.SERVICE_TIME_AGGREGATED_BY_DAY)
+TOP_N_ROLLUPS = (
+    (KVDB.SERVICE_TIME_AGGREGATED_BY_DAY, '%Y:%m:%d', timedelta(days=1)),
+    (KVDB.SERVICE_TIME_AGGREGATED_BY_HOUR, '%Y:%m:%d:%H', timedelta(hours=1)),
+)
+
+# Statistics of channels are rolled up in the same way
+CHANNEL_ROLLUPS = (
+    (KVDB.CHANNEL_STATS_BY_DAY, '%Y:%m:%d', timedelta(days=1)),
+    (KVDB.CHANNEL_STATS_BY_HOUR, '%Y:%m:%d:%H', timedelta(hours=1)),
+)
+
+# A rollup is used only that long after its period has ended,
+# by then all the statistics it's made of are sure to have been aggregated.
+ROLLUP_AFTER = timedelta(hours=2)
+
+# Per-minute statistics deleted on request
+DELETE_PREFIXES = (KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE, KVDB.CHANNEL_STATS_BY_MINUTE)
+
+# How many keys are deleted in one pipeline when deleting statistics
+DELETE_BATCH_SIZE = 1000
+
+# How long statuses of deletions of statistics are kept once they finish, in seconds
+DELETE_STATUS_EXPIRE = 86400
+
+# A deletion whose status hasn't been updated for that many seconds is considered
+# to have been interrupted, e.g. by its server's crash, and can be resumed.
+DELETE_RESUME_AFTER = 60
+
+DELETE_STATUS_RUNNING = 'running'
+DELETE_STATUS_FINISHED = 'finished'
+
+# Statistics are moved from the KVDB to an archive on disk after that many days. Jobs aggregating
+# statistics and closing summaries need them in the KVDB for at least ARCHIVE_AFTER_MIN days.
+ARCHIVE_AFTER = 7
+ARCHIVE_AFTER_MIN = 2
+
+# Key prefixes of statistics archived -> directories they're archived in
+ARCHIVE_PREFIXES = {
+    KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE: 'by-minute',
+    KVDB.SERVICE_TIME_AGGREGATED_BY_HOUR: 'by-hour',
+}
+
+# Fields of statistics archived, each of them is kept in a file of its own
+ARCHIVE_FIELDS = ('usage', 'mean', 'min', 'max')
+
+# Key prefixes of statistics kept in time buckets -> how many colon-separated
+# parts a bucket's suffix has, e.g. 2013:11:12:13:14 for per-minute ones.
+BUCKET_PREFIXES = {
+    KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE: 5,
+    KVDB.SERVICE_TIME_AGGREGATED_BY_HOUR: 4,
+    KVDB.SERVICE_TIME_AGGREGATED_BY_DAY: 3,
+    KVDB.SERVICE_TIME_AGGREGATED_BY_MONTH: 2,
+    KVDB.SERVICE_SUMMARY_BY_DAY: 3,
+    KVDB.SERVICE_SUMMARY_BY_WEEK: 3,
+    KVDB.SERVICE_SUMMARY_BY_MONTH: 2,
+    KVDB.SERVICE_SUMMARY_BY_YEAR: 1,
+}
+
+# Summaries of periods that have ended are also kept in records of their own,
+# each with statistics of all the services from a given period.
+SUMMARY_PREFIXES = (KVDB.SERVICE_SUMMARY_BY_DAY, KVDB.SERVICE_SUMMARY_BY_WEEK,
+    KVDB.SERVICE_SUMMARY_BY_MONTH, KVDB.SERVICE_SUMMARY_BY_YEAR)
+
+# How long a bucket is depending on the number of parts in its suffix
+BUCKET_DELTAS = {
+    5: relativedelta(minutes=1),
+    4: relativedelta(hours=1),
+    3: relativedelta(days=1),
+    2: relativedelta(months=1),
+    1: relativedelta(years=1),
+}
+
+def get_bucket_start(suffix):
+    """ Returns a datetime a bucket starts at, e.g. 2013:11 -> 2013-11-01 00:00:00.
+    """
+    parts = [int(elem) for elem in suffix.split(':')]
+    parts.extend([1] * (3 - len(parts))) # Month and day can't be 0
+    
+    return datetime(*parts)
+
+def get_score(value):
+    """ Returns a score in sorted sets of buckets for a given datetime.
+    """
+    return timegm(value.utctimetuple())
+
+def get_bucket_range(suffix):
+    """ Returns scores of the first second of a bucket and of the first second past it.
+    """
+    start = get_bucket_start(suffix)
+    return get_score(start), get_score(start + BUCKET_DELTAS[len(suffix.split(':'))])
+
+def get_closed_summary_key(prefix, suffix):
+    """ Returns a key of the record with a summary of a period that has ended.
+    """
+    return '{}{}{}'.format(KVDB.SERVICE_SUMMARY_CLOSED, prefix, suffix)
+
+def scan_keys(conn, pattern):
+    """ Yields all the keys matching a pattern, uses SCAN if the KVDB supports
+    it so the database isn't blocked for the whole duration.
+    """
+    try:
+        cursor, keys = conn.execute_command('SCAN', 0, 'MATCH', pattern, 'COUNT', SCAN_COUNT)
+    except ResponseError, e:
+        logger.warn('SCAN not supported, falling back to KEYS, e:[{}]'.format(e))
+        for key in conn.keys(pattern):
+            yield key
+        return
+    
+    while True:
+        for key in keys:
+            yield key
+            
+        if int(cursor) == 0:
+            break
+        
+        cursor, keys = conn.execute_command('SCAN', cursor, 'MATCH', pattern, 'COUNT', SCAN_COUNT)
+
+def read_pipelined(conn, command, args, batch_size=PIPELINE_BATCH_SIZE):
+    """ Yields results of a read-only command invoked with each of the arguments given
+    on input, e.g. [('key1',), ('key2',)] for HGETALL, in pipelines of batch_size
+    commands each instead of in a round-trip to the KVDB for each one.
+    """
+    for idx in range(0, len(args), batch_size):
+        with conn.pipeline(transaction=False) as p:
+            for elem in args[idx:idx+batch_size]:
+                getattr(p, command)(*elem)
+            
+            for result in p.execute():
+                yield result
+
+def split_into_buckets(suffixes, now, rollups, get_rolled_up):
+    """ Splits per-minute suffixes into buckets of rollups, as (prefix, suffix) tuples, given
+    from the longest one. Only periods fully covered which have ended long enough ago and which
+    get_rolled_up, given a prefix and suffixes of such periods, says have been rolled up are used.
+    Returns these buckets along with per-minute suffixes left.
+    """
+    buckets = []
+    pending = [get_bucket_start(suffix) for suffix in suffixes]
+    
+    for prefix, format, delta in rollups:
+        groups = [(suffix, list(group)) for suffix, group in groupby(pending, lambda elem: elem.strftime(format))]
+        
+        full = [suffix for suffix, group in groups
+            if len(group) * 60 == delta.total_seconds() and group[0] + delta + ROLLUP_AFTER <= now]
+        rolled_up = get_rolled_up(prefix, full) if full else set()
+        
+        buckets.extend((prefix, suffix) for suffix in full if suffix in rolled_up)
+        pending = [elem for suffix, group in groups if suffix not in rolled_up for elem in group]
+        
+    return buckets, [elem.strftime('%Y:%m:%d:%H:%M') for elem in pending]
+
+class LatencySketch(object):
+    """ A mergeable histogram of response times. Each time is counted in a bucket
+    whose bounds grow logarithmically so that any value read off the sketch is within
+    SKETCH_ACCURACY of the real one while the number of buckets depends only on the range
+    of times, e.g. there are fewer than 1000 of them for anything between 1 ms and a day,
+    rather than on how many times have been added.
+    
+    Merging sketches is only a matter of adding up counters of their buckets, which
+    is why per-minute sketches are kept in hashes each worker can HINCRBY independently
+    and why hourly, daily and monthly ones are simply sums of the more fine-grained ones.
+    """
+    gamma = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+    log_gamma = log(gamma)
+    
+    def __init__(self, buckets=None):
+        self.buckets = buckets or {} # Bucket index -> how many times there are in it
+        
+    def __repr__(self):
+        return '<{} at {} count:[{}]>'.format(self.__class__.__name__, hex(id(self)), self.count)
+    
+    @classmethod
+    def get_index(class_, value):
+        """ Returns an index of the bucket a value belongs to, there's a separate one for anything below 1 ms.
+        """
+        if value < 1:
+            return 0
+        return int(ceil(log(value) / class_.log_gamma)) + 1
+    
+    @classmethod
+    def get_value(class_, index):
+        """ Returns a value representing all of a bucket's times.
+        """
+        if not index:
+            return 0
+        return 2 * class_.gamma ** (index - 1) / (class_.gamma + 1)
+    
+    @property
+    def count(self):
+        return sum(self.buckets.values())
+    
+    def add(self, value, count=1):
+        index = self.get_index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + count
+        
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+            
+    def _get_rank_index(self, percentile):
+        """ Returns an index of the bucket a given percentile of all the times falls into.
+        """
+        rank = percentile / 100.0 * (self.count - 1)
+        total = 0
+        
+        for index in sorted(self.buckets):
+            total += self.buckets[index]
+            if total > rank:
+                return index
+            
+    def get_percentile(self, percentile):
+        """ Returns a value below which a given percentile, from 0 to 100, of all the times lies.
+        """
+        if not self.buckets:
+            return 0
+        return self.get_value(self._get_rank_index(percentile))
+    
+    def get_min(self):
+        return self.get_percentile(0)
+    
+    def get_max(self):
+        return self.get_percentile(100)
+    
+    def get_mean(self, max_percentile=100):
+        """ Returns a mean of all the times up to and including a given percentile.
+        """
+        if not self.buckets:
+            return 0
+        
+        max_index = self._get_rank_index(max_percentile)
+        total = count = 0
+        
+        for index, index_count in self.buckets.items():
+            if index <= max_index:
+                total += self.get_value(index) * index_count
+                count += index_count
                 
-class MaintenanceTool(object):
-    """ A tool for performing maintenance-related tasks, such as deleting the statistics.
+        return total / count
+    
+    def dumps(self):
+        """ Serializes the sketch to a string, e.g. '0:2,36:15,56:1'.
+        """
+        return ','.join('{}:{}'.format(index, self.buckets[index]) for index in sorted(self.buckets))
+    
+    @classmethod
+    def loads(class_, value):
+        return class_(dict((int(index), int(count)) for index, count in
+            (elem.split(':') for elem in value.split(',') if elem)))
+    
+    @classmethod
+    def from_hash(class_, value):
+        """ Creates a sketch out of a hash bucket indexes of which are its keys.
+        """
+        return class_(dict((int(index), int(count)) for index, count in value.items()))
+    
+class StatsIndex(object):
+    """ Keeps track of which services have statistics in which time buckets so that
+    no one needs to look them up with KEYS. For each key prefix, such as the one of
+    per-minute aggregated statistics, there is a sorted set of buckets, e.g.
+    2013:11:12:13:14, any service has data in, scored by the bucket's start time,
+    and for each bucket there is a set of names of services with data in it.
+    
+    Sketches of response times not processed yet don't belong to buckets so there is
+    only a set of services which have any, and per-minute sketches expire so their
+    buckets needn't be sorted.
+    
+    Writers pass in pipelines they use for storing the data, all the methods
+    use the connection the index was created with otherwise.
     """
     def __init__(self, conn):
         self.conn = conn
         
-    def delete(self, start, stop, interval):
+    def get_services_key(self, prefix, suffix):
+        return '{}{}{}'.format(KVDB.SERVICE_STATS_INDEX_SERVICES, prefix, suffix)
+    
+    def get_buckets_key(self, prefix):
+        return '{}{}'.format(KVDB.SERVICE_STATS_INDEX_BUCKETS, prefix)
+    
+    def add_raw(self, name, p=None):
+        (p or self.conn).sadd(KVDB.SERVICE_STATS_INDEX_RAW, name)
+        
+    def add_raw_by_minute(self, name, suffix, p=None):
+        p = p or self.conn
+        key = self.get_services_key(KVDB.SERVICE_TIME_SKETCH_BY_MINUTE, suffix)
+        
+        p.sadd(key, name)
+        p.expire(key, RAW_BY_MINUTE_EXPIRE)
+        
+    def add(self, prefix, name, suffix, p=None):
+        p = p or self.conn
+        p.sadd(self.get_services_key(prefix, suffix), name)
+        p.zadd(self.get_buckets_key(prefix), get_score(get_bucket_start(suffix)), suffix)
+        
+    def get_raw_services(self):
+        """ Returns names of all the services with any response times not processed yet.
+        """
+        return self.conn.smembers(KVDB.SERVICE_STATS_INDEX_RAW)
+        
+    def get_services(self, prefix, suffix):
+        """ Returns names of all the services with data in a given bucket.
+        """
+        return self.conn.smembers(self.get_services_key(prefix, suffix))
+    
+    def has_service(self, prefix, suffix, name):
+        return self.conn.sismember(self.get_services_key(prefix, suffix), name)
+    
+    def get_buckets(self, prefix, start, stop):
+        """ Returns suffixes of buckets with any data from between start and stop,
+        both of which are scores, the former is inclusive and the latter isn't.
+        """
+        return self.conn.zrangebyscore(self.get_buckets_key(prefix), start, '({}'.format(stop))
+    
+    def get_bucket_keys(self, prefix, suffix, names):
+        """ Returns all the keys of a bucket given names of services with data in it,
+        the bucket's own set of services is the last one.
+        """
+        keys = ['{}{}:{}'.format(prefix, name, suffix) for name in names]
+        keys.append(self.get_services_key(prefix, suffix))
+        
+        return keys
+        
+    def migrate(self):
+        """ Indexes statistics stored before the index existed. It needs to be done
+        only once so it's skipped if the KVDB says it's been already done.
+        """
+        if self.conn.get(KVDB.SERVICE_STATS_INDEX_MIGRATED):
+            return
+        
+        logger.info('Indexing existing service statistics')
+        
+        with self.conn.pipeline(transaction=False) as p:
+            
+            for prefix, suffix_parts in BUCKET_PREFIXES.items():
+                for key in scan_keys(self.conn, '{}*'.format(prefix)):
+                    parts = key[len(prefix):].split(':')
+                    name, suffix = ':'.join(parts[:-suffix_parts]), ':'.join(parts[-suffix_parts:])
+                    
+                    if name:
+                        self.add(prefix, name, suffix, p)
+                        
+            p.set(KVDB.SERVICE_STATS_INDEX_MIGRATED, datetime.utcnow().isoformat())
+            p.execute()
+            
+        logger.info('Indexed existing service statistics')
+
+class HeavyHitters(object):
+    """ Keeps track of services invoked most often and of ones that took the most time
+    so that top N of them can be found without reading statistics of all the services.
+    For each bucket of per-minute, per-hour and per-day statistics there is a sorted set
+    of services scored by usage, another one scored by the total time they took and a hash
+    of totals of all the services. Per-minute ones are stored along with the statistics
+    and per-hour and per-day ones are rolled up out of them with ZUNIONSTORE.
+    
+    A range is answered with a union of days and hours it fully covers, as long as they have
+    been rolled up already, and of minutes otherwise. If the range has per-minute statistics
+    stored before top N services were kept track of, it can't be answered at all.
+    """
+    def __init__(self, conn, batch_size=PIPELINE_BATCH_SIZE):
+        self.conn = conn
+        self.batch_size = batch_size
+        
+    def get_key(self, n_type, prefix, suffix):
+        return '{}{}:{}{}'.format(KVDB.SERVICE_STATS_TOP, n_type, prefix, suffix)
+    
+    def get_totals_key(self, prefix, suffix):
+        return '{}{}{}'.format(KVDB.SERVICE_STATS_TOP_TOTALS, prefix, suffix)
+    
+    def get_keys(self, prefix, suffix):
+        """ Returns all the keys of a bucket.
+        """
+        return [self.get_key(n_type, prefix, suffix) for n_type in TOP_N_TYPES] + [self.get_totals_key(prefix, suffix)]
+    
+    def add_bucket(self, prefix, suffix, stats, p=None):
+        """ Stores statistics of all the services from a bucket, each one's
+        a (service name, usage, mean response time) tuple.
+        """
+        if not stats:
+            return
+        
+        p = p or self.conn
+        totals = {'usage':0, 'time':0, 'mean':0, 'count':0}
+        
+        for name, usage, mean in stats:
+            p.zadd(self.get_key('usage', prefix, suffix), usage, name)
+            p.zadd(self.get_key('time', prefix, suffix), usage * mean, name)
+            
+            totals['usage'] += usage
+            totals['time'] += usage * mean
+            totals['mean'] += mean
+            totals['count'] += 1
+            
+        p.hmset(self.get_totals_key(prefix, suffix), totals)
+        
+    def rollup(self, target, target_suffix, source, source_suffixes):
+        """ Rolls up buckets of source statistics into a bucket of target ones.
+        Nothing is rolled up if any of the source buckets isn't kept track of.
+        """
+        args = [(self.get_totals_key(source, suffix),) for suffix in source_suffixes]
+        source_totals = list(read_pipelined(self.conn, 'hgetall', args, self.batch_size))
+        
+        if not source_totals or not all(source_totals):
+            logger.debug('Not rolling up top N services into [{}{}]'.format(target, target_suffix))
+            return
+        
+        totals = dict((name, sum(float(elem[name]) for elem in source_totals)) for name in source_totals[0])
+        
+        with self.conn.pipeline(transaction=False) as p:
+            for n_type in TOP_N_TYPES:
+                p.zunionstore(self.get_key(n_type, target, target_suffix),
+                    [self.get_key(n_type, source, suffix) for suffix in source_suffixes])
+            p.hmset(self.get_totals_key(target, target_suffix), totals)
+            p.execute()
+            
+    def get_buckets(self, suffixes, now):
+        """ Returns buckets, as (prefix, suffix) tuples, with statistics of all the services
+        from per-minute suffixes given on input or None if they can't be found out.
+        """
+        buckets, pending = split_into_buckets(suffixes, now, TOP_N_ROLLUPS, self._get_rolled_up)
+        prefix = KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE
+        
+        stats_index = StatsIndex(self.conn)
+        args = [(stats_index.get_services_key(prefix, suffix),) for suffix in pending]
+        has_stats = read_pipelined(self.conn, 'exists', args, self.batch_size)
+        
+        args = [(self.get_totals_key(prefix, suffix),) for suffix in pending]
+        has_totals = read_pipelined(self.conn, 'exists', args, self.batch_size)
+        
+        for suffix, stats_exist, totals_exist in zip(pending, has_stats, has_totals):
+            if totals_exist:
+                buckets.append((prefix, suffix))
+            elif stats_exist:
+                return None
+            
+        return buckets
+    
+    def _get_rolled_up(self, prefix, suffixes):
+        args = [(self.get_totals_key(prefix, suffix),) for suffix in suffixes]
+        return set(suffix for suffix, exists in zip(suffixes, read_pipelined(self.conn, 'exists', args, self.batch_size))
+            if exists)
+    
+    def get_top_n(self, prefix, suffixes, n, n_type, now=None):
+        """ Returns names of top n services by n_type from per-minute suffixes given on input
+        along with totals of all the services or None if they can't be found out this way.
+        """
+        if prefix != KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE or n_type not in TOP_N_TYPES:
+            return None
+        
+        buckets = self.get_buckets(suffixes, now or datetime.utcnow())
+        
+        if buckets is None:
+            return None
+        
+        top_n = Bunch({'names':[], 'usage':0, 'time':0, 'mean':0, 'count':0})
+        
+        if not buckets:
+            return top_n
+        
+        key = '{}{}'.format(KVDB.SERVICE_STATS_TOP, new_cid())
+        
+        with self.conn.pipeline(transaction=False) as p:
+            p.zunionstore(key, [self.get_key(n_type, bucket_prefix, suffix) for bucket_prefix, suffix in buckets])
+            p.zrevrange(key, 0, n - 1)
+            p.delete(key)
+            top_n.names = p.execute()[1]
+            
+        args = [(self.get_totals_key(bucket_prefix, suffix),) for bucket_prefix, suffix in buckets]
+        for totals in read_pipelined(self.conn, 'hgetall', args, self.batch_size):
+            for name, value in totals.items():
+                top_n[name] += float(value)
+                
+        return top_n
+
+class ChannelStats(object):
+    """ Statistics of HTTP channels - for each channel and minute there is a hash of counters
+    of requests, of responses with each HTTP status code, of bytes received and sent, and of
+    response times in buckets of a latency sketch. As all of them are counters, each request
+    simply increments them and per-hour and per-day statistics are their sums.
+    """
+    def __init__(self, conn, batch_size=PIPELINE_BATCH_SIZE):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.index = StatsIndex(conn)
+        
+    def get_key(self, prefix, name, suffix):
+        return '{}{}:{}'.format(prefix, name, suffix)
+    
+    @staticmethod
+    def get_fields(status_code, bytes_in, bytes_out, processing_time):
+        """ Returns counters a single request adds to its channel's statistics.
+        """
+        return {'usage':1, 'bytes_in':bytes_in, 'bytes_out':bytes_out, 'status:{}'.format(status_code):1,
+            'sketch:{}'.format(LatencySketch.get_index(processing_time)):1}
+    
+    @staticmethod
+    def get_sketch(fields):
+        """ Returns a latency sketch out of a channel's counters.
+        """
+        return LatencySketch(dict((int(name[7:]), int(value)) for name, value in fields.items() if name.startswith('sketch:')))
+    
+    @staticmethod
+    def get_status_codes(fields):
+        """ Returns a dictionary of HTTP status codes -> how many responses of each there were.
+        """
+        return dict((int(name[7:]), int(value)) for name, value in fields.items() if name.startswith('status:'))
+    
+    def add(self, name, suffix, fields, p=None):
+        """ Adds counters to a channel's per-minute statistics.
+        """
+        p = p or self.conn
+        key = self.get_key(KVDB.CHANNEL_STATS_BY_MINUTE, name, suffix)
+        
+        for field, value in fields.items():
+            p.hincrby(key, field, value)
+            
+        self.index.add(KVDB.CHANNEL_STATS_BY_MINUTE, name, suffix, p)
+        
+    def _read(self, buckets, name=None):
+        """ Returns sums of counters of each channel, or of one channel only, from buckets
+        given on input, as (prefix, suffix) tuples.
+        """
+        if name:
+            names = [[name]] * len(buckets)
+        else:
+            args = [(self.index.get_services_key(prefix, suffix),) for prefix, suffix in buckets]
+            names = read_pipelined(self.conn, 'smembers', args, self.batch_size)
+            
+        keys = [(elem, self.get_key(prefix, elem, suffix)) for (prefix, suffix), bucket_names in zip(buckets, names)
+            for elem in bucket_names]
+        args = [(key,) for elem, key in keys]
+        
+        stats = {}
+        
+        for (elem, key), fields in zip(keys, read_pipelined(self.conn, 'hgetall', args, self.batch_size)):
+            channel_stats = stats.setdefault(elem, {})
+            for field, value in fields.items():
+                channel_stats[field] = channel_stats.get(field, 0) + int(value)
+                
+        return dict((elem, fields) for elem, fields in stats.items() if fields)
+    
+    def rollup(self, target, target_suffix, source, source_suffixes):
+        """ Rolls up buckets of source statistics of all the channels into a bucket of target ones.
+        """
+        stats = self._read([(source, suffix) for suffix in source_suffixes])
+        
         with self.conn.pipeline() as p:
-            suffixes = (elem.strftime(':%Y:%m:%d:%H:%M') for elem in rrule(MINUTELY, dtstart=start, until=stop))
-            for suffix in suffixes:
-                for key in self.conn.keys('{}*{}'.format(KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE, suffix)):
-                    p.delete(key)
+            for name, fields in stats.items():
+                key = self.get_key(target, name, target_suffix)
+                p.delete(key)
+                p.hmset(key, fields)
+                self.index.add(target, name, target_suffix, p)
+            p.execute()
+            
+    def _get_rolled_up(self, prefix, suffixes):
+        start, stop = get_bucket_range(suffixes[0])[0], get_bucket_range(suffixes[-1])[1]
+        return set(self.index.get_buckets(prefix, start, stop)) & set(suffixes)
+    
+    def get_stats(self, suffixes, name=None, now=None):
+        """ Returns sums of counters of each channel, or of one channel only, from per-minute suffixes given on input.
+        """
+        buckets, minutes = split_into_buckets(suffixes, now or datetime.utcnow(), CHANNEL_ROLLUPS, self._get_rolled_up)
+        
+        if minutes:
+            buckets.extend((KVDB.CHANNEL_STATS_BY_MINUTE, suffix)
+                for suffix in sorted(self._get_rolled_up(KVDB.CHANNEL_STATS_BY_MINUTE, minutes)))
+            
+        return self._read(buckets, name)
+
+class QueueStats(object):
+    """ Statistics of how long messages invoking services asynchronously wait before
+    the services start. Broker clients stamp each message with the time it was enqueued
+    and dequeued at and workers with the time the service started, and for each service
+    there is a hash of latency sketches of the deltas, each counter in the hash named after
+    the part of the wait and the bucket it belongs to, e.g. 'broker:36'.
+    
+    - broker - from enqueueing to reading the message off the KVDB
+    - pool - from then on until there's been room in the pool of handlers to start the service
+    - queue - both of the above, i.e. the total queueing delay
+    
+    Times are stamped by different servers so any negative delay, a matter of clock skew, counts as 0.
+    """
+    parts = ('queue', 'broker', 'pool')
+    
+    def __init__(self, conn):
+        self.conn = conn
+        
+    @staticmethod
+    def get_fields(enqueued, dequeued, started):
+        """ Returns counters a single message adds to its service's statistics, times given on input
+        are in seconds since the epoch and the delays are stored in milliseconds.
+        """
+        delays = {
+            'queue': started - enqueued,
+            'broker': dequeued - enqueued,
+            'pool': started - dequeued,
+        }
+        return dict(('{}:{}'.format(part, LatencySketch.get_index(max(delay, 0) * 1000.0)), 1)
+            for part, delay in delays.items())
+    
+    @classmethod
+    def get_sketches(class_, fields):
+        """ Returns a latency sketch of each part of the wait out of a service's counters.
+        """
+        sketches = dict((part, LatencySketch()) for part in class_.parts)
+        
+        for name, value in fields.items():
+            part, index = name.split(':')
+            sketches[part].buckets[int(index)] = int(value)
+            
+        return sketches
+    
+    def add(self, name, fields, p=None):
+        """ Adds counters to a service's statistics.
+        """
+        p = p or self.conn
+        key = '{}{}'.format(KVDB.SERVICE_TIME_QUEUE, name)
+        
+        for field, value in fields.items():
+            p.hincrby(key, field, value)
+            
+    def get(self, name):
+        """ Returns latency sketches of each part of the wait for a given service.
+        """
+        return self.get_sketches(self.conn.hgetall('{}{}'.format(KVDB.SERVICE_TIME_QUEUE, name)))
+    
+class ServiceStatsBuffer(object):
+    """ Keeps service usage counters, response times, sample requests/responses,
+    slow responses, statistics of channels and queueing delays of asynchronous invocations
+    in memory and periodically flushes all of them to the KVDB in a single non-transactional
+    pipeline, using the very same keys services would otherwise have been writing to
+    on each invocation.
+    There is one buffer for each worker process.
+    
+    Data is flushed each 'flush_interval' milliseconds or as soon as there
+    are 'flush_max_samples' response times waiting to be stored, whichever comes first.
+    
+    Usage counters returned to services are the last cluster-wide values read
+    off the KVDB plus whatever has been accumulated locally since. Likewise,
+    the frequency of storing sample requests/responses is read when the buffer
+    is created and then refreshed during flushes rather than on each invocation.
+    
+    If a flush can't reach the KVDB, everything it was to write is merged back
+    with what has been buffered since and the next flush tries again.
+    """
+    def __init__(self, kvdb, flush_interval=500, flush_max_samples=1000):
+        self.kvdb = kvdb
+        self.index = StatsIndex(kvdb.conn)
+        self.channel_stats = ChannelStats(kvdb.conn)
+        self.queue_stats = QueueStats(kvdb.conn)
+        self.flush_interval = flush_interval / 1000.0 # Milliseconds -> seconds
+        self.flush_max_samples = flush_max_samples
+        self.lock = RLock()
+        self.keep_running = False
+        
+        self.usage = {} # Service name -> last known cluster-wide usage
+        self.req_resp_freq = {} # Service name -> how often to store sample requests/responses
+        
+        self._reset()
+        self._load_req_resp_freq()
+        
+    def _load_req_resp_freq(self):
+        """ Reads how often to store sample requests/responses of each service that has it set.
+        """
+        try:
+            keys = list(scan_keys(self.kvdb.conn, '{}*'.format(KVDB.REQ_RESP_SAMPLE)))
+            values = read_pipelined(self.kvdb.conn, 'hget', [(key, 'freq') for key in keys])
+            
+            for key, value in zip(keys, values):
+                self.req_resp_freq[key.replace(KVDB.REQ_RESP_SAMPLE, '', 1)] = int(value or 0)
+                
+        except Exception, e:
+            logger.warn('Could not read sample requests/responses frequency, e:[{}]'.format(format_exc(e)))
+            
+    def _reset(self):
+        self.pending_usage = {}
+        self.pending_last = {}
+        self.pending_raw = {}
+        self.pending_raw_by_minute = {}
+        self.pending_req_resp = {}
+        self.pending_slow = {}
+        self.pending_channels = {}
+        self.pending_queue = {}
+        self.pending_samples = 0
+        
+    def start(self):
+        """ Starts a background thread flushing the data periodically.
+        """
+        self.keep_running = True
+        
+        thread = Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+        
+    def stop(self):
+        """ Stops the background thread and flushes anything that's still in memory.
+        """
+        self.keep_running = False
+        self.flush()
+        
+    def _run(self):
+        while self.keep_running:
+            sleep(self.flush_interval)
+            self.flush()
+            
+    def incr_usage(self, name):
+        """ Increments the usage counter of a given service and returns the current value.
+        """
+        with self.lock:
+            pending = self.pending_usage[name] = self.pending_usage.get(name, 0) + 1
+            return self.usage.get(name, 0) + pending
+        
+    def add_time(self, name, processing_time, handle_return_time):
+        """ Stores a service's response time, flushes the data if there are
+        enough samples already.
+        """
+        suffix = handle_return_time.strftime('%Y:%m:%d:%H:%M')
+        
+        with self.lock:
+            self.pending_last[name] = processing_time
+            
+            sketch = self.pending_raw.get(name)
+            if not sketch:
+                sketch = self.pending_raw[name] = LatencySketch()
+            sketch.add(processing_time)
+            
+            sketch = self.pending_raw_by_minute.get((name, suffix))
+            if not sketch:
+                sketch = self.pending_raw_by_minute[(name, suffix)] = LatencySketch()
+            sketch.add(processing_time)
+            
+            self.pending_samples += 1
+            needs_flush = self.pending_samples >= self.flush_max_samples
+            
+        if needs_flush:
+            self.flush()
+            
+    def add_channel(self, name, fields, now):
+        """ Adds counters of a single request to a channel's statistics, as returned by ChannelStats.get_fields.
+        """
+        suffix = now.strftime('%Y:%m:%d:%H:%M')
+        
+        with self.lock:
+            pending = self.pending_channels.setdefault((name, suffix), {})
+            for field, value in fields.items():
+                pending[field] = pending.get(field, 0) + value
+                
+            self.pending_samples += 1
+            needs_flush = self.pending_samples >= self.flush_max_samples
+            
+        if needs_flush:
+            self.flush()
+            
+    def add_queue(self, name, fields):
+        """ Adds counters of how long a single message waited before a service started, as returned by QueueStats.get_fields.
+        """
+        with self.lock:
+            pending = self.pending_queue.setdefault(name, {})
+            for field, value in fields.items():
+                pending[field] = pending.get(field, 0) + value
+                
+    def should_store_req_resp(self, name, usage):
+        """ Same as zato.server.connection.request_response.should_store but uses
+        the frequency read off the KVDB during the last flush.
+        """
+        freq = self.req_resp_freq.get(name, 0)
+        
+        if freq and usage % freq == 0:
+            return '{}{}'.format(KVDB.REQ_RESP_SAMPLE, name), freq
+        
+        return None, None
+    
+    def store_req_resp(self, key, **data):
+        """ Stores a service's request/response pair, only the latest one
+        is kept for each service.
+        """
+        with self.lock:
+            self.pending_req_resp[key] = data
+            
+    def store_slow(self, name, **data):
+        """ Stores information regarding an invocation that came later than it was allowed.
+        """
+        key = '{}{}'.format(KVDB.RESP_SLOW, name)
+        data = dumps(data)
+        
+        with self.lock:
+            self.pending_slow.setdefault(key, []).append(data)
+            
+    def flush(self):
+        """ Writes everything accumulated so far to the KVDB in one pipeline.
+        """
+        with self.lock:
+            usage, last = self.pending_usage, self.pending_last
+            raw, raw_by_minute = self.pending_raw, self.pending_raw_by_minute
+            req_resp, slow = self.pending_req_resp, self.pending_slow
+            channels, queue = self.pending_channels, self.pending_queue
+            self._reset()
+            
+            # Sample requests/responses frequency is read for each service we've ever seen
+            names = sorted(set(self.usage) | set(usage))
+            
+        # Nothing has been invoked since the last flush, note that requests
+        # may have been rejected by channels before any service was invoked.
+        if not usage and not channels and not queue:
+            return
+        
+        usage_names = sorted(usage)
+        
+        try:
+            with self.kvdb.conn.pipeline(transaction=False) as p:
+                
+                for name in usage_names:
+                    p.incrby('{}{}'.format(KVDB.SERVICE_USAGE, name), usage[name])
+                    
+                for name, value in last.items():
+                    p.hset('{}{}'.format(KVDB.SERVICE_TIME_BASIC, name), 'last', value)
+                    
+                # Sketches are merged with what other workers have stored by adding up their buckets
+                for name, sketch in raw.items():
+                    key = '{}{}'.format(KVDB.SERVICE_TIME_SKETCH, name)
+                    for index, count in sketch.buckets.items():
+                        p.hincrby(key, index, count)
+                    self.index.add_raw(name, p)
+                    
+                for (name, suffix), sketch in raw_by_minute.items():
+                    key = '{}{}:{}'.format(KVDB.SERVICE_TIME_SKETCH_BY_MINUTE, name, suffix)
+                    for index, count in sketch.buckets.items():
+                        p.hincrby(key, index, count)
+                    p.expire(key, RAW_BY_MINUTE_EXPIRE)
+                    self.index.add_raw_by_minute(name, suffix, p)
+                    
+                for key, data in req_resp.items():
+                    p.hmset(key, data)
+                    
+                for key, values in slow.items():
+                    p.lpush(key, *values)
+                    p.ltrim(key, 0, SLOW_RESPONSE_MAX - 1)
+                    
+                for (name, suffix), fields in channels.items():
+                    self.channel_stats.add(name, suffix, fields, p)
+                    
+                for name, fields in queue.items():
+                    self.queue_stats.add(name, fields, p)
                     
+                for name in names:
+                    p.hget('{}{}'.format(KVDB.REQ_RESP_SAMPLE, name), 'freq')
+                    
+                result = p.execute()
+                
+        # Commands have reached the KVDB so merging the data back would count it twice
+        except ResponseError, e:
+            logger.warn('Could not flush service statistics, e:[{}]'.format(format_exc(e)))
+            
+        except Exception, e:
+            logger.warn('Could not flush service statistics, will try again, e:[{}]'.format(format_exc(e)))
+            self._merge_back(usage, last, raw, raw_by_minute, req_resp, slow, channels, queue)
+            
+        else:
+            with self.lock:
+                for name, value in zip(usage_names, result[:len(usage_names)]):
+                    self.usage[name] = max(self.usage.get(name, 0), int(value))
+                    
+                for name, value in zip(names, result[-len(names):]):
+                    self.req_resp_freq[name] = int(value or 0)
+                    
+            if logger.isEnabledFor(TRACE1):
+                logger.log(TRACE1, 'Flushed stats, services:[{}], raw times:[{}]'.format(
+                    len(usage_names), sum(sketch.count for sketch in raw.values())))
+                
+    def _merge_back(self, usage, last, raw, raw_by_minute, req_resp, slow, channels, queue):
+        """ Merges data of a flush that failed with whatever has been buffered since it started.
+        Data buffered in the meantime is newer so it takes precedence over the last response times
+        and sample requests/responses while everything else is added up. Samples merged back don't count
+        towards flush_max_samples so that each invocation doesn't try to flush while the KVDB is down.
+        """
+        with self.lock:
+            for name, value in usage.items():
+                self.pending_usage[name] = self.pending_usage.get(name, 0) + value
+                
+            for name, value in last.items():
+                self.pending_last.setdefault(name, value)
+                
+            for pending, sketches in ((self.pending_raw, raw), (self.pending_raw_by_minute, raw_by_minute)):
+                for key, sketch in sketches.items():
+                    if key in pending:
+                        sketch.merge(pending[key])
+                    pending[key] = sketch
+                    
+            for key, data in req_resp.items():
+                self.pending_req_resp.setdefault(key, data)
+                
+            for key, values in slow.items():
+                self.pending_slow[key] = (values + self.pending_slow.get(key, []))[-SLOW_RESPONSE_MAX:]
+                
+            for pending, data in ((self.pending_channels, channels), (self.pending_queue, queue)):
+                for key, fields in data.items():
+                    pending_fields = pending.setdefault(key, {})
+                    for field, value in fields.items():
+                        pending_fields[field] = pending_fields.get(field, 0) + value
+                        
+class StatsArchive(object):
+    """ An append-only columnar archive of statistics of periods that have ended, kept on disk
+    instead of in the KVDB. Statistics of each month are in a directory of their own in which
+    each column - bucket scores, indexes of service names and each of ARCHIVE_FIELDS - is a flat file
+    of fixed-size values read through numpy.memmap so that only pages actually needed are read in.
+    Rows are appended in the order of buckets so the column of bucket scores is always sorted.
+    
+    Each month's metadata keeps names of services, how many rows there are and until when
+    its buckets have been archived. Rows are appended and synced to disk first and only then
+    is the metadata atomically replaced which means that anything past the number of rows
+    it has is a leftover of an interrupted write and is cut off before appending again.
+    
+    The archive is read by all the servers in a cluster so if there are more
+    of them than one, its directory needs to be shared by all of them.
+    """
+    columns = (('bucket', 'i8'), ('name', 'i4')) + tuple((field, 'f8') for field in ARCHIVE_FIELDS)
+    
+    def __init__(self, dir):
+        self.dir = dir
+        
+    def get_month(self, suffix):
+        return get_bucket_start(suffix).strftime('%Y-%m')
+        
+    def get_month_dir(self, prefix, month):
+        return os.path.join(self.dir, ARCHIVE_PREFIXES[prefix], month)
+    
+    def get_meta(self, prefix, month):
+        path = os.path.join(self.get_month_dir(prefix, month), 'meta.json')
+        if not os.path.exists(path):
+            return {'rows':0, 'names':[], 'until':0}
+        
+        with open(path) as f:
+            return loads(f.read())
+        
+    def append(self, prefix, month, rows, until):
+        """ Appends rows, each a (bucket score, service name, values of ARCHIVE_FIELDS) tuple,
+        to a month's statistics and marks its buckets starting before until, a score, as archived.
+        """
+        month_dir = self.get_month_dir(prefix, month)
+        if not os.path.exists(month_dir):
+            os.makedirs(month_dir)
+            
+        meta = self.get_meta(prefix, month)
+        name_idx = dict((name, idx) for idx, name in enumerate(meta['names']))
+        
+        for score, name, values in rows:
+            if name not in name_idx:
+                name_idx[name] = len(meta['names'])
+                meta['names'].append(name)
+                
+        data = {
+            'bucket': [score for score, name, values in rows],
+            'name': [name_idx[name] for score, name, values in rows],
+        }
+        for idx, field in enumerate(ARCHIVE_FIELDS):
+            data[field] = [float(values[idx]) for score, name, values in rows]
+            
+        for column, dtype in self.columns:
+            with open(os.path.join(month_dir, column), 'ab') as f:
+                f.truncate(meta['rows'] * np.dtype(dtype).itemsize)
+                f.write(np.array(data[column], dtype=dtype).tostring())
+                f.flush()
+                os.fsync(f.fileno())
+                
+        meta['rows'] += len(rows)
+        meta['until'] = max(meta['until'], until)
+        
+        path = os.path.join(month_dir, 'meta.json')
+        with open(path + '.tmp', 'w') as f:
+            f.write(dumps(meta))
+            f.flush()
+            os.fsync(f.fileno())
+            
+        os.rename(path + '.tmp', path)
+        
+    def read(self, prefix, suffixes, fields, name=None):
+        """ Returns statistics of archived buckets given on input, of all the services
+        or of one service only, as a Bunch of service names, indexes into these names,
+        indexes into suffixes and stats, values of fields each in a row of an array.
+        """
+        positions = dict((get_score(get_bucket_start(suffix)), idx) for idx, suffix in enumerate(suffixes))
+        scores = np.array(sorted(positions), dtype='i8')
+        scores_idx = np.array([positions[score] for score in scores])
+        
+        result = Bunch(names=[], name_idx=[], suffix_idx=[], stats=[])
+        
+        for month in sorted(set(self.get_month(suffix) for suffix in suffixes)):
+            meta = self.get_meta(prefix, month)
+            if not meta['rows'] or (name and name not in meta['names']):
+                continue
+            
+            month_dir = self.get_month_dir(prefix, month)
+            columns = dict((column, np.memmap(os.path.join(month_dir, column), dtype=dtype, mode='r', shape=(meta['rows'],)))
+                for column, dtype in self.columns)
+            
+            # Buckets are sorted so only rows between the first and last one needed are looked at
+            start = np.searchsorted(columns['bucket'], scores[0], side='left')
+            stop = np.searchsorted(columns['bucket'], scores[-1], side='right')
+            
+            buckets = columns['bucket'][start:stop]
+            found = np.in1d(buckets, scores)
+            
+            if name:
+                found &= columns['name'][start:stop] == meta['names'].index(name)
+                
+            result.name_idx.append(columns['name'][start:stop][found] + len(result.names))
+            result.suffix_idx.append(scores_idx[np.searchsorted(scores, buckets[found])])
+            result.stats.append(np.column_stack([columns[field][start:stop][found] for field in fields]))
+            result.names.extend(meta['names'])
+            
+        result.name_idx = np.concatenate(result.name_idx) if result.name_idx else np.zeros(0, dtype=int)
+        result.suffix_idx = np.concatenate(result.suffix_idx) if result.suffix_idx else np.zeros(0, dtype=int)
+        result.stats = np.concatenate(result.stats) if result.stats else np.zeros((0, len(fields)))
+        
+        return result
+
+class MaintenanceTool(object):
+    """ A tool for performing maintenance-related tasks, such as deleting or archiving the statistics.
+    
+    Keys of statistics to delete are resolved from the index instead of being looked up
+    with KEYS and they are deleted in pipelines of delete_batch_size keys each, using
+    UNLINK if the KVDB supports it so that the memory is reclaimed in the background.
+    A bucket is removed from the index only along with or after the last of its keys
+    which means that an interrupted deletion can be simply run again, it will only
+    find the buckets not deleted yet.
+    
+    Progress of each deletion is kept in a hash under KVDB.SERVICE_STATS_DELETE_STATUS
+    and the deletion's ID until DELETE_STATUS_EXPIRE seconds after it finishes.
+    """
+    def __init__(self, conn, delete_batch_size=DELETE_BATCH_SIZE, pipeline_batch_size=PIPELINE_BATCH_SIZE):
+        self.conn = conn
+        self.index = StatsIndex(conn)
+        self.heavy_hitters = HeavyHitters(conn, pipeline_batch_size)
+        self.delete_batch_size = delete_batch_size
+        self.pipeline_batch_size = pipeline_batch_size
+        self.delete_command = None
+        
+    def get_status_key(self, id):
+        return '{}{}'.format(KVDB.SERVICE_STATS_DELETE_STATUS, id)
+    
+    def get_status(self, id):
+        """ Returns progress of a deletion, an empty dict if there's no such deletion.
+        """
+        return self.conn.hgetall(self.get_status_key(id))
+        
+    def get_delete_command(self):
+        """ Returns UNLINK if the KVDB supports it and DEL otherwise.
+        """
+        if not self.delete_command:
+            try:
+                self.conn.execute_command('UNLINK', self.get_status_key('unlink-check'))
+            except ResponseError, e:
+                logger.warn('UNLINK not supported, falling back to DEL, e:[{}]'.format(e))
+                self.delete_command = 'DEL'
+            else:
+                self.delete_command = 'UNLINK'
+                
+        return self.delete_command
+        
+    def delete(self, start, stop, id=None):
+        """ Deletes per-minute statistics of services and channels from between start and stop, both inclusive,
+        and returns the deletion's ID.
+        """
+        id = id or new_cid()
+        now = datetime.utcnow().isoformat()
+        
+        with self.conn.pipeline(transaction=False) as p:
+            p.hmset(self.get_status_key(id), {'id':id, 'start':start.isoformat(), 'stop':stop.isoformat(),
+                'status':DELETE_STATUS_RUNNING, 'buckets_deleted':0, 'keys_deleted':0, 'created':now, 'updated':now})
+            p.sadd(KVDB.SERVICE_STATS_DELETE_RUNNING, id)
+            p.execute()
+            
+        self._delete(id, start, stop)
+        
+        return id
+    
+    def resume(self):
+        """ Resumes deletions which were interrupted and returns their IDs. Deletions
+        still being run by other servers are left alone.
+        """
+        resumed = []
+        
+        for id in self.conn.smembers(KVDB.SERVICE_STATS_DELETE_RUNNING):
+            status = self.get_status(id)
+            
+            if not status:
+                self.conn.srem(KVDB.SERVICE_STATS_DELETE_RUNNING, id)
+                continue
+            
+            if (datetime.utcnow() - parse(status['updated'])).total_seconds() < DELETE_RESUME_AFTER:
+                continue
+            
+            logger.info('Resuming deletion of statistics id:[{}], start:[{}], stop:[{}], buckets deleted:[{}]'.format(
+                id, status['start'], status['stop'], status.get('buckets_deleted')))
+            
+            # So no one else resumes it at the same time
+            self.conn.hset(self.get_status_key(id), 'updated', datetime.utcnow().isoformat())
+            
+            self._delete(id, parse(status['start']), parse(status['stop']))
+            resumed.append(id)
+            
+        return resumed
+    
+    def _delete(self, id, start, stop):
+        status_key = self.get_status_key(id)
+        start_score, stop_score = get_score(start.replace(second=0, microsecond=0)), get_score(stop) + 1
+        
+        buckets = [(prefix, suffix) for prefix in DELETE_PREFIXES
+            for suffix in self.index.get_buckets(prefix, start_score, stop_score)]
+        
+        # A resumed deletion keeps the total it started with
+        self.conn.hsetnx(status_key, 'buckets_total', len(buckets))
+        
+        keys = []
+        deleted = [] # Buckets all the keys of which are in keys or have been already deleted
+        
+        for idx in range(0, len(buckets), self.pipeline_batch_size):
+            batch = buckets[idx:idx+self.pipeline_batch_size]
+            args = [(self.index.get_services_key(prefix, suffix),) for prefix, suffix in batch]
+            
+            for (prefix, suffix), names in zip(batch, read_pipelined(self.conn, 'smembers', args, self.pipeline_batch_size)):
+                if prefix in TOP_N_PREFIXES:
+                    keys.extend(self.heavy_hitters.get_keys(prefix, suffix))
+                keys.extend(self.index.get_bucket_keys(prefix, suffix, names))
+                
+                while len(keys) >= self.delete_batch_size:
+                    self._delete_keys(status_key, keys[:self.delete_batch_size], deleted)
+                    keys = keys[self.delete_batch_size:]
+                    deleted = []
+                    
+                deleted.append((prefix, suffix))
+                
+        if keys or deleted:
+            self._delete_keys(status_key, keys, deleted)
+            
+        with self.conn.pipeline(transaction=False) as p:
+            p.hmset(status_key, {'status':DELETE_STATUS_FINISHED, 'updated':datetime.utcnow().isoformat()})
+            p.expire(status_key, DELETE_STATUS_EXPIRE)
+            p.srem(KVDB.SERVICE_STATS_DELETE_RUNNING, id)
+            p.execute()
+            
+        logger.info('Deleted statistics id:[{}], start:[{}], stop:[{}], buckets:[{}]'.format(
+            id, start.isoformat(), stop.isoformat(), len(buckets)))
+            
+    def _delete_keys(self, status_key, keys, buckets):
+        """ Deletes keys and removes buckets from the index, in this order, along with updating the progress.
+        """
+        with self.conn.pipeline(transaction=False) as p:
+            if keys:
+                p.execute_command(self.get_delete_command(), *keys)
+                
+            for prefix in DELETE_PREFIXES:
+                suffixes = [suffix for bucket_prefix, suffix in buckets if bucket_prefix == prefix]
+                if suffixes:
+                    p.zrem(self.index.get_buckets_key(prefix), *suffixes)
+                
+            p.hincrby(status_key, 'keys_deleted', len(keys))
+            p.hincrby(status_key, 'buckets_deleted', len(buckets))
+            p.hset(status_key, 'updated', datetime.utcnow().isoformat())
             p.execute()
+            
+    def archive(self, archive, prefix, until):
+        """ Moves statistics of buckets starting before until, a datetime, to the archive
+        and deletes them from the KVDB. Buckets are deleted only after they've been archived
+        and buckets already archived are only deleted so archiving can be simply run again
+        if it's been interrupted. Returns how many buckets there were.
+        """
+        suffixes = self.index.get_buckets(prefix, 0, get_score(until))
+        delete_command = self.get_delete_command()
+        
+        for month, month_suffixes in groupby(suffixes, archive.get_month):
+            month_suffixes = list(month_suffixes)
+            archived_until = archive.get_meta(prefix, month)['until']
+            
+            for idx in range(0, len(month_suffixes), self.pipeline_batch_size):
+                batch = month_suffixes[idx:idx+self.pipeline_batch_size]
+                args = [(self.index.get_services_key(prefix, suffix),) for suffix in batch]
+                batch_names = list(read_pipelined(self.conn, 'smembers', args, self.pipeline_batch_size))
+                
+                cells = [(suffix, name) for suffix, names in zip(batch, batch_names)
+                    if get_score(get_bucket_start(suffix)) >= archived_until for name in sorted(names)]
+                
+                args = [('{}{}:{}'.format(prefix, name, suffix),) + ARCHIVE_FIELDS for suffix, name in cells]
+                rows = [(get_score(get_bucket_start(suffix)), name, values) for (suffix, name), values
+                    in zip(cells, read_pipelined(self.conn, 'hmget', args, self.pipeline_batch_size)) if values[0] is not None]
+                
+                batch_until = get_bucket_range(batch[-1])[1]
+                
+                if cells:
+                    archive.append(prefix, month, rows, batch_until)
+                    
+                # From now on, statistics of the batch are read from the archive
+                self.conn.hset(KVDB.SERVICE_STATS_ARCHIVED_UNTIL, prefix, batch_until)
+                
+                keys = []
+                for suffix, names in zip(batch, batch_names):
+                    if prefix in TOP_N_PREFIXES:
+                        keys.extend(self.heavy_hitters.get_keys(prefix, suffix))
+                    keys.extend(self.index.get_bucket_keys(prefix, suffix, names))
+                    
+                for keys_idx in range(0, len(keys), self.delete_batch_size):
+                    self.conn.execute_command(delete_command, *keys[keys_idx:keys_idx+self.delete_batch_size])
+                    
+                self.conn.zrem(self.index.get_buckets_key(prefix), *batch)
+                
+        logger.info('Archived statistics prefix:[{}], until:[{}], buckets:[{}]'.format(prefix, until.isoformat(), len(suffixes)))
+        
+        return len(suffixes)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2013 Dariusz Suchojad <dsuch at zato.io>
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# stdlib
+from unittest import TestCase
+
+# Bunch
+from bunch import Bunch
+
+# nose
+from nose.tools import eq_
+
+# Zato
+from zato.common import SIMPLE_IO
+from zato.server.base.worker import WorkerStore
+from zato.server.service import Response
+
+class WorkerStoreTestCase(TestCase):
+    def test_set_service_response_data(self):
+        
+        def gen():
+            yield 'a'
+            yield '東京'
+            
+        class SimpleIO:
+            output_required = ('a',)
+            
+        worker_store = WorkerStore(server=Bunch(kvdb=None))
+        
+        # Asynchronous, scheduler and AMQP/WMQ/ZMQ invocations get streamed responses joined ..
+        for payload in(gen(), ['a', '東京']):
+            service = Bunch(response=Response(None))
+            service.response.payload = payload
+            
+            worker_store._set_service_response_data(service)
+            eq_(service.response.payload, 'a東京'.encode('utf-8'))
+            
+        # .. while strings are left as they are ..
+        service = Bunch(response=Response(None))
+        service.response.payload = 'abc'
+        
+        worker_store._set_service_response_data(service)
+        eq_(service.response.payload, 'abc')
+        
+        # .. and SimpleIO responses are serialized.
+        service = Bunch(response=Response(None))
+        service.response.init('abc', SimpleIO, SIMPLE_IO.FORMAT.JSON)
+        service.response.payload = {'a':'b'}
+        
+        worker_store._set_service_response_data(service)
+        eq_(service.response.payload, '{"response": {"a": "b"}}')
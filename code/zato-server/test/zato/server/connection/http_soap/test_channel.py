@@ -10,6 +10,7 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 # stdlib
 from cStringIO import StringIO
+from datetime import datetime
 from unittest import TestCase
 from uuid import uuid4
 
@@ -213,6 +214,15 @@ class TestSetPayloadNonAdminServiceTestCase(MessageHandlingBase):
         payload = DummyPayload(uuid4().hex)
         ignored, service = self.get_data(None, None, '', payload=payload, service_class=DummyService)
         eq_(payload.value, service.response.payload)
+        
+    def test_payload_provided_stream(self):
+        chunks = [uuid4().hex for x in range(3)]
+        
+        ignored, service = self.get_data(None, URL_TYPE.PLAIN_HTTP, '', payload=iter(chunks), service_class=DummyService)
+        eq_(list(service.response.payload), chunks)
+        
+        ignored, service = self.get_data(None, URL_TYPE.SOAP, '', payload=iter(chunks), service_class=DummyService)
+        eq_(''.join(service.response.payload), channel.soap_doc.format(body=''.join(chunks)))
 
 # ##############################################################################
 
@@ -327,6 +337,119 @@ class TestRequestDispatcher(MessageHandlingBase):
         eq_(rd.request_handler.worker_store, worker_store)
         eq_(rd.request_handler.simple_io_config, simple_io_config)
         
+    def _dispatch_sized(self, payload, content_length, max_request_size, stream_request=False, stream_response=False):
+        """ Dispatches a request to a channel which may limit the size of requests
+        and returns the dispatcher's response, wsgi_environ and what the handler was invoked with.
+        """
+        handled = Bunch()
+        
+        class DummyRequestHandler(object):
+            def handle(self, cid, url_match, channel_item, wsgi_environ, payload, worker_store, simple_io_config):
+                handled.payload = payload
+                input_stream = wsgi_environ.get('zato.http.input_stream')
+                
+                if stream_response:
+                    
+                    # Reads the request only when the response is being streamed
+                    def gen():
+                        while True:
+                            chunk = input_stream.read(1000)
+                            if not chunk:
+                                break
+                            yield chunk
+                            
+                    handled.input_stream = input_stream
+                    payload = gen()
+                    
+                elif input_stream:
+                    handled.input_stream = input_stream
+                    handled.stream_data = input_stream.read()
+                
+                return Bunch(payload=payload, content_type='text/plain', headers={}, status_code=200)
+            
+        channel_item = Bunch()
+        channel_item.name = uuid4().hex
+        channel_item.is_active = True
+        channel_item.transport = URL_TYPE.PLAIN_HTTP
+        channel_item.data_format = DATA_FORMAT.JSON
+        channel_item.max_request_size = max_request_size
+        channel_item.stream_request = stream_request
+        
+        wsgi_environ = {
+            'PATH_INFO':uuid4().hex,
+            'wsgi.input':StringIO(payload),
+            'zato.http.response.headers': {},
+        }
+        
+        if content_length is not None:
+            wsgi_environ['CONTENT_LENGTH'] = str(content_length)
+        
+        rd = channel.RequestDispatcher(DummyURLData(Bunch(a=1), channel_item))
+        rd.request_handler = DummyRequestHandler()
+        rd.request_handler.server = Bunch(stats_buffer=Bunch(add_channel=lambda *ignored_args: None))
+        response = rd.dispatch(uuid4().hex, datetime.utcnow(), wsgi_environ, None)
+        
+        return response, wsgi_environ, handled
+    
+    def test_dispatch_max_request_size(self):
+        payload = 'a' * 100
+        
+        for content_length in(None, 100):
+            for max_request_size in(None, 0, 100, 1000):
+                response, wsgi_environ, handled = self._dispatch_sized(payload, content_length, max_request_size)
+                eq_(wsgi_environ['zato.http.response.status'], '200 OK')
+                eq_(response, payload)
+                eq_(handled.payload, payload)
+                
+            response, wsgi_environ, handled = self._dispatch_sized(payload, content_length, 99)
+            eq_(wsgi_environ['zato.http.response.status'], '413 Request Entity Too Large')
+            self.assertNotIn('payload', handled)
+            
+        # Content-Length alone is enough to reject a request, nothing is read in that case
+        response, wsgi_environ, handled = self._dispatch_sized(payload, 1000, 100)
+        eq_(wsgi_environ['zato.http.response.status'], '413 Request Entity Too Large')
+        eq_(wsgi_environ['wsgi.input'].tell(), 0)
+        
+    def test_stream_payload(self):
+        closed = []
+        
+        def gen():
+            try:
+                yield 'a'
+                yield ''
+                yield '東京'
+                raise Exception('Streaming error')
+            finally:
+                closed.append(True)
+            
+        rd = channel.RequestDispatcher()
+        eq_(list(rd.stream_payload(uuid4().hex, gen())), [b'a', '東京'.encode('utf-8')])
+        eq_(closed, [True])
+        
+    def test_dispatch_stream_request(self):
+        payload = 'a' * 100000
+        
+        response, wsgi_environ, handled = self._dispatch_sized(payload, None, None, True)
+        eq_(wsgi_environ['zato.http.response.status'], '200 OK')
+        eq_(handled.payload, '')
+        eq_(handled.stream_data, payload)
+        self.assertTrue(handled.input_stream.closed)
+        
+        response, wsgi_environ, handled = self._dispatch_sized(payload, None, 99999, True)
+        eq_(wsgi_environ['zato.http.response.status'], '413 Request Entity Too Large')
+        self.assertNotIn('payload', handled)
+        
+    def test_dispatch_stream_request_response(self):
+        payload = 'a' * 100000
+        
+        # The request is still open while the response that reads it is being streamed
+        response, wsgi_environ, handled = self._dispatch_sized(payload, None, None, True, True)
+        eq_(wsgi_environ['zato.http.response.status'], '200 OK')
+        self.assertFalse(handled.input_stream.closed)
+        
+        eq_(b''.join(response), payload)
+        self.assertTrue(handled.input_stream.closed)
+        
 # ##############################################################################
 
 class TestRequestHandler(TestCase):
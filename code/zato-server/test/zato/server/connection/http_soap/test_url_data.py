@@ -116,6 +116,67 @@ class URLDataTestCase(TestCase):
         match, _ = ud.match('/foo/bar', '')
         self.assertIsNone(match)
 
+    def test_match_route_index(self):
+
+        def get_item(soap_action, url_path):
+            item = Bunch()
+            item.match_target = '{}{}{}'.format(soap_action, MISC.SEPARATOR, url_path)
+            item.match_target_compiled = parse_compile(item.match_target)
+            return item
+
+        item1 = get_item('', '/customer/{cid}/order/{oid}')
+        item2 = get_item('', '/customer/{cid}')
+        item3 = get_item('', '/customer/ABC/order/{oid}')
+        item4 = get_item('', '/customer/details')
+        item5 = get_item('{action}', '/any/{path}')
+        item6 = get_item('action', '/customer/details')
+
+        ud = url_data.URLData([item1, item2, item3, item4, item5, item6])
+
+        # Placeholders may span several segments, earlier channels take precedence
+        match, item = ud.match('/customer/123/order/456', '')
+        eq_(item, item1)
+        eq_(sorted(match.named.items()), [(u'cid', u'123'), (u'oid', u'456')])
+
+        match, item = ud.match('/customer/123/456', '')
+        eq_(item, item2)
+        eq_(match.named, {'cid': '123/456'})
+
+        match, item = ud.match('/customer/details', '')
+        eq_(item, item2)
+        eq_(match.named, {'cid': 'details'})
+
+        # Matching is case-insensitive, as it is with parse patterns
+        _, item = ud.match('/CUSTOMER/DETAILS', 'ACTION')
+        eq_(item, item6)
+
+        match, item = ud.match('/any/thing', 'foo')
+        eq_(item, item5)
+        eq_(sorted(match.named.items()), [(u'action', u'foo'), (u'path', u'thing')])
+
+        match, item = ud.match('/customer', '')
+        self.assertIsNone(match)
+        self.assertIsNone(item)
+
+        # A separator in the SOAP action means all the channels are checked
+        match, item = ud.match('/any/thing', 'foo{}bar'.format(MISC.SEPARATOR))
+        eq_(item, item5)
+        eq_(match.named['action'], 'foo{}bar'.format(MISC.SEPARATOR))
+
+        # The index is rebuilt once channels are deleted
+        ud.url_sec = {item2.match_target: None}
+
+        msg = Bunch()
+        msg.old_soap_action = ''
+        msg.old_url_path = '/customer/{cid}'
+        ud.on_broker_msg_CHANNEL_HTTP_SOAP_DELETE(msg)
+
+        _, item = ud.match('/customer/details', '')
+        eq_(item, item4)
+
+        _, item = ud.match('/customer/abc/order/789', '')
+        eq_(item, item1)
+
 # ##############################################################################
 
     def test_check_security(self):
@@ -847,7 +908,7 @@ class URLDataTestCase(TestCase):
                 'is_internal', 'method', 'name', 'ping_method', 'pool_size', 
                 'service_id',  'impl_name', 'service_name',
                 'soap_action', 'soap_version', 'transport', 'url_path',
-                'merge_url_params_req', 'url_params_pri', 'params_pri'):
+                'merge_url_params_req', 'url_params_pri', 'params_pri', 'max_request_size', 'stream_request'):
                 msg[name] = uuid4().hex
                 
             if needs_security_id:
@@ -866,15 +927,15 @@ class URLDataTestCase(TestCase):
                 'is_internal', 'method', 'name', 'ping_method', 'pool_size', 
                 'service_id',  'impl_name', 'service_name',
                 'soap_action', 'soap_version', 'transport', 'url_path',
-                'merge_url_params_req', 'url_params_pri', 'params_pri'):
+                'merge_url_params_req', 'url_params_pri', 'params_pri', 'max_request_size', 'stream_request'):
                 eq_(msg[name], channel_item[name])
             
             if needs_security_id:
-                eq_(len(channel_item.keys()), 26)
+                eq_(len(channel_item.keys()), 28)
                 for name in('sec_type', 'security_id', 'security_name'):
                     eq_(msg[name], channel_item[name])
             else:
-                eq_(len(channel_item.keys()), 23)
+                eq_(len(channel_item.keys()), 25)
                     
         for needs_security_id in(True, False):
             msg = get_msg(needs_security_id)
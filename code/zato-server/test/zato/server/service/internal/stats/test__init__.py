@@ -8,14 +8,34 @@ Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+# stdlib
+from calendar import timegm
+from datetime import datetime
+from shutil import rmtree
+from sys import maxint
+from tempfile import mkdtemp
+from unittest import TestCase
+
+# anyjson
+from anyjson import dumps
+
 # Bunch
 from bunch import Bunch
 
+# mock
+from mock import MagicMock
+
+# nose
+from nose.tools import eq_
+
 # Zato
-from zato.common import zato_namespace
-from zato.common.test import rand_float, rand_int, rand_string, ServiceTestCase
+from zato.common import BROKER, CHANNEL, KVDB, SIMPLE_IO, zato_namespace
+from zato.common.broker_message import STATS
+from zato.server.stats import get_bucket_start, get_closed_summary_key, get_score, HeavyHitters, StatsArchive
+from zato.common.test import FakeServer, rand_float, rand_int, rand_string, ServiceTestCase
+from zato.common.util import new_cid
 from zato.server.service import Integer, UTC
-from zato.server.service.internal.stats import Delete, StatsReturningService, GetByService
+from zato.server.service.internal.stats import Delete, GetBrokerPool, StatsReturningService, GetByService
 
 ################################################################################
 
@@ -37,13 +57,29 @@ class DeleteTestCase(ServiceTestCase):
         self.assertEquals(self.sio.response_elem, 'zato_stats_delete_response')
         self.assertEquals(self.sio.input_required, (self.wrap_force_type(UTC('start')), self.wrap_force_type(UTC('stop'))))
         self.assertEquals(self.sio.namespace, zato_namespace)
+        self.assertEquals(self.sio.output_optional, ('id',))
         self.assertRaises(AttributeError, getattr, self.sio, 'input_optional')
         self.assertRaises(AttributeError, getattr, self.sio, 'output_required')
-        self.assertRaises(AttributeError, getattr, self.sio, 'output_optional')
         self.assertRaises(AttributeError, getattr, self.sio, 'output_repeated')
         
     def test_impl(self):
         self.assertEquals(self.service_class.get_name(), 'zato.stats.delete')
+        
+    def test_handle(self):
+        broker_client = Bunch(messages=[])
+        broker_client.invoke_async = broker_client.messages.append
+        
+        request = {'start':'2013-11-12T13:00:00', 'stop':'2013-11-12T14:00:00'}
+        
+        instance = self.service_class()
+        self.service_class.update(instance, CHANNEL.HTTP_SOAP, FakeServer(), broker_client, MagicMock(), new_cid(), request, request,
+            simple_io_config={}, data_format=SIMPLE_IO.FORMAT.JSON)
+        instance.handle()
+        
+        # The deletion runs in the background under the ID returned
+        eq_(instance.response.payload.getvalue(False)['zato_stats_delete_response'], {'id':instance.cid})
+        eq_(broker_client.messages, [{'action':STATS.DELETE, 'start':'2013-11-12T13:00:00', 'stop':'2013-11-12T14:00:00',
+            'id':instance.cid}])
    
 ###############################################################################
 
@@ -107,3 +143,331 @@ class GetByServiceTestCase(ServiceTestCase):
         
     def test_impl(self):
         self.assertEquals(self.service_class.get_name(), 'zato.stats.get-by-service')
+
+###############################################################################
+
+class FakePipeline(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *ignored_args):
+        pass
+
+    def __getattr__(self, name):
+        def _command(*args):
+            self.commands.append((name, args))
+        return _command
+
+    def execute(self):
+        self.conn.pipelines.append(len(self.commands))
+        return [getattr(self.conn, name)(*args) for name, args in self.commands]
+
+class FakeConn(object):
+    def __init__(self, sets, hashes, values=None, zsets=None):
+        self.sets = sets
+        self.hashes = hashes
+        self.values = values or {}
+        self.zsets = zsets or {}
+        self.pipelines = []
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def smembers(self, key):
+        return self.sets.get(key, set())
+
+    def sismember(self, key, value):
+        return value in self.sets.get(key, set())
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def hmget(self, key, *fields):
+        values = self.hashes.get(key, {})
+        return [values.get(field) for field in fields]
+
+    def hgetall(self, key):
+        return self.hashes.get(key, {})
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(field)
+
+    def hdel(self, key, field):
+        self.hashes.get(key, {}).pop(field, None)
+
+    def exists(self, key):
+        return any(key in elem for elem in(self.sets, self.hashes, self.values, self.zsets))
+
+    def zunionstore(self, dest, keys):
+        self.zsets[dest] = {}
+        for key in keys:
+            for name, score in self.zsets.get(key, {}).items():
+                self.zsets[dest][name] = self.zsets[dest].get(name, 0) + score
+
+    def zrevrange(self, key, start, stop):
+        values = sorted(self.zsets.get(key, {}).items(), key=lambda elem: (elem[1], elem[0]), reverse=True)
+        return [name for name, score in values][start:stop + 1]
+
+    def delete(self, key):
+        self.zsets.pop(key, None)
+
+class GetStatsTestCase(TestCase):
+
+    def setUp(self):
+        prefix = KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE
+        index_prefix = '{}{}'.format(KVDB.SERVICE_STATS_INDEX_SERVICES, prefix)
+
+        self.suffixes = ['2013:11:12:13:14', '2013:11:12:13:15']
+        s1, s2 = self.suffixes
+
+        sets = {
+            index_prefix + s1: set(['a', 'c']), # There are no statistics of c, e.g. they've just been deleted
+            index_prefix + s2: set(['a', 'b']),
+        }
+
+        hashes = {
+            '{}a:{}'.format(prefix, s1): {'usage':'10', 'mean':'20', 'min':'5', 'max':'50', 'rate':'0.16'},
+            '{}a:{}'.format(prefix, s2): {'usage':'30', 'mean':'10', 'min':'2', 'max':'40', 'rate':'0.5'},
+            '{}b:{}'.format(prefix, s2): {'usage':'5', 'mean':'100', 'min':'90', 'max':'110', 'rate':'0.08'},
+        }
+
+        self.service = StatsReturningService()
+        self.service.server = Bunch(kvdb=Bunch(conn=FakeConn(sets, hashes)), stats_pipeline_batch_size=2, stats_archive=None)
+
+    def get_stats(self, service='*', n=None, n_type=None):
+        return dict((elem.service_name, elem) for elem in self.service.get_stats(
+            '2013-11-12T13:14:00', '2013-11-12T13:16:00', service, n, n_type, suffixes=self.suffixes))
+
+    def test_get_stats(self):
+        stats = self.get_stats()
+        eq_(sorted(stats), ['a', 'b', 'c'])
+
+        a, b, c = stats['a'], stats['b'], stats['c']
+
+        eq_(a.usage, 40)
+        eq_(a.time, 500)
+        eq_(a.mean, 15)
+        eq_(a.rate, 0.33)
+        eq_(a.min_resp_time, 2)
+        eq_(a.max_resp_time, 50)
+        eq_(a.mean_trend, '20,10')
+        eq_(a.usage_trend, '10,30')
+        eq_(a.usage_perc_all_services, 88.89)
+        eq_(a.time_perc_all_services, 50)
+
+        eq_(b.usage, 5)
+        eq_(b.mean, 50)
+        eq_(b.min_resp_time, 90)
+        eq_(b.max_resp_time, 110)
+        eq_(b.mean_trend, '0,100')
+
+        eq_(c.usage, 0)
+        eq_(c.min_resp_time, maxint)
+        eq_(c.max_resp_time, 0)
+
+        for elem in(a, b, c):
+            eq_(elem.all_services_usage, 45)
+            eq_(elem.all_services_time, 1000)
+            eq_(elem.mean_all_services, '43')
+
+        # 2 SMEMBERS + 4 HMGET, in pipelines of no more than 2 commands each
+        eq_(self.service.server.kvdb.conn.pipelines, [2, 2, 2])
+
+    def test_get_stats_service(self):
+        stats = self.get_stats('b')
+        eq_(sorted(stats), ['b'])
+        eq_(stats['b'].usage, 5)
+        eq_(stats['b'].all_services_usage, 5)
+
+        eq_(self.get_stats('zzz'), {})
+
+    def test_top_n(self):
+        eq_(sorted(self.get_stats(n=1, n_type='usage')), ['a'])
+
+        # a and b have spent the same time so the lexicographically greater name goes first
+        top = self.service.get_stats(
+            '2013-11-12T13:14:00', '2013-11-12T13:16:00', n=3, n_type='time', suffixes=self.suffixes)
+        eq_([elem.service_name for elem in top], ['b', 'a', 'c'])
+
+class GetStatsTopNTestCase(TestCase):
+
+    def setUp(self):
+        prefix = KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE
+        heavy_hitters = HeavyHitters(None)
+
+        self.suffixes = ['2013:11:12:13:14', '2013:11:12:13:15']
+        s1, s2 = self.suffixes
+
+        # Only the top services' statistics are needed, others' aren't even in the index
+        hashes = {
+            '{}a:{}'.format(prefix, s1): {'usage':'10', 'mean':'20', 'min':'5', 'max':'50', 'rate':'0.16'},
+            '{}a:{}'.format(prefix, s2): {'usage':'30', 'mean':'10', 'min':'2', 'max':'40', 'rate':'0.5'},
+            '{}b:{}'.format(prefix, s2): {'usage':'5', 'mean':'100', 'min':'90', 'max':'110', 'rate':'0.08'},
+            heavy_hitters.get_totals_key(prefix, s1): {'usage':'12', 'time':'220', 'mean':'30', 'count':'2'},
+            heavy_hitters.get_totals_key(prefix, s2): {'usage':'35', 'time':'800', 'mean':'110', 'count':'2'},
+        }
+
+        zsets = {
+            heavy_hitters.get_key('usage', prefix, s1): {'a':10, 'c':2},
+            heavy_hitters.get_key('usage', prefix, s2): {'a':30, 'b':5},
+            heavy_hitters.get_key('time', prefix, s1): {'a':200, 'c':20},
+            heavy_hitters.get_key('time', prefix, s2): {'a':300, 'b':500},
+        }
+
+        self.service = StatsReturningService()
+        self.service.server = Bunch(kvdb=Bunch(conn=FakeConn({}, hashes, zsets=zsets)), stats_pipeline_batch_size=10, stats_archive=None)
+
+    def get_stats(self, n, n_type):
+        return list(self.service.get_stats(
+            '2013-11-12T13:14:00', '2013-11-12T13:16:00', n=n, n_type=n_type, suffixes=self.suffixes))
+
+    def test_top_n(self):
+        stats = self.get_stats(1, 'usage')
+        eq_([elem.service_name for elem in stats], ['a'])
+
+        a = stats[0]
+        eq_(a.usage, 40)
+        eq_(a.time, 500)
+        eq_(a.all_services_usage, 47)
+        eq_(a.all_services_time, 1020)
+        eq_(a.mean_all_services, '35')
+        eq_(a.usage_perc_all_services, 85.11)
+
+        # a and b have spent the same time so the lexicographically greater name goes first
+        stats = self.get_stats(2, 'time')
+        eq_([elem.service_name for elem in stats], ['b', 'a'])
+
+        # Temporary unions are deleted
+        eq_(sorted(self.service.server.kvdb.conn.zsets), [
+            HeavyHitters(None).get_key(n_type, KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE, suffix)
+                for n_type in ('time', 'usage') for suffix in self.suffixes])
+
+class GetStatsArchivedTestCase(TestCase):
+
+    def setUp(self):
+        prefix = KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE
+        self.suffixes = ['2013:11:12:13:14', '2013:11:12:13:15']
+        s1, s2 = self.suffixes
+
+        # The first minute has been archived, the other one is still in the KVDB
+        self.dir = mkdtemp()
+        archive = StatsArchive(self.dir)
+        archive.append(prefix, '2013-11', [(get_score(get_bucket_start(s1)), 'a', (10, 20, 5, 50))],
+            get_score(get_bucket_start(s2)))
+
+        sets = {'{}{}{}'.format(KVDB.SERVICE_STATS_INDEX_SERVICES, prefix, s2): set(['a', 'b'])}
+        hashes = {
+            '{}a:{}'.format(prefix, s2): {'usage':'30', 'mean':'10', 'min':'2', 'max':'40', 'rate':'0.5'},
+            '{}b:{}'.format(prefix, s2): {'usage':'5', 'mean':'100', 'min':'90', 'max':'110', 'rate':'0.08'},
+            KVDB.SERVICE_STATS_ARCHIVED_UNTIL: {prefix: str(get_score(get_bucket_start(s2)))},
+        }
+
+        self.service = StatsReturningService()
+        self.service.server = Bunch(kvdb=Bunch(conn=FakeConn(sets, hashes)), stats_pipeline_batch_size=10,
+            stats_archive=archive)
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def get_stats(self, service='*', n=None, n_type=None):
+        return dict((elem.service_name, elem) for elem in self.service.get_stats(
+            '2013-11-12T13:14:00', '2013-11-12T13:16:00', service, n, n_type, suffixes=self.suffixes))
+
+    def test_get_stats(self):
+        stats = self.get_stats()
+        eq_(sorted(stats), ['a', 'b'])
+
+        a, b = stats['a'], stats['b']
+
+        eq_(a.usage, 40)
+        eq_(a.time, 500)
+        eq_(a.min_resp_time, 2)
+        eq_(a.max_resp_time, 50)
+        eq_(a.mean_trend, '20,10')
+        eq_(a.usage_trend, '10,30')
+
+        eq_(b.usage, 5)
+        eq_(b.usage_trend, '0,5')
+
+        # SMEMBERS and 2 HMGET of the minute that's still in the KVDB only
+        eq_(self.service.server.kvdb.conn.pipelines, [1, 2])
+
+        stats = self.get_stats('a')
+        eq_(sorted(stats), ['a'])
+        eq_(stats['a'].usage, 40)
+
+        # Top N services can't be found out of heavy hitters if any of the minutes has been archived
+        eq_(sorted(self.get_stats(n=1, n_type='usage')), ['a'])
+
+class GetStatsClosedSummaryTestCase(TestCase):
+
+    def test_get_stats(self):
+        prefix = KVDB.SERVICE_SUMMARY_BY_DAY
+        suffixes = ['2013:11:12', '2013:11:13']
+        s1, s2 = suffixes
+
+        # The first day has ended so its summary is read from a single record,
+        # the other one is still going on so it's read from the index and hashes.
+        sets = {'{}{}{}'.format(KVDB.SERVICE_STATS_INDEX_SERVICES, prefix, s2): set(['b'])}
+        hashes = {'{}b:{}'.format(prefix, s2): {'usage':'5', 'mean':'100', 'min':'90', 'max':'110', 'rate':'0.01'}}
+        values = {get_closed_summary_key(prefix, s1): dumps({
+            'a': {'usage':10, 'mean':20, 'min':5, 'max':50, 'rate':0.01},
+            'b': {'usage':1, 'mean':50, 'min':50, 'max':50, 'rate':0.01},
+        })}
+
+        service = StatsReturningService()
+        service.server = Bunch(kvdb=Bunch(conn=FakeConn(sets, hashes, values)), stats_pipeline_batch_size=10, stats_archive=None)
+
+        stats = dict((elem.service_name, elem) for elem in service.get_stats(
+            '2013-11-12T00:00:00', '2013-11-14T00:00:00', stats_key_prefix=prefix, suffixes=suffixes))
+
+        eq_(sorted(stats), ['a', 'b'])
+
+        eq_(stats['a'].usage, 10)
+        eq_(stats['a'].usage_trend, '10,0')
+
+        eq_(stats['b'].usage, 6)
+        eq_(stats['b'].usage_trend, '1,5')
+        eq_(stats['b'].min_resp_time, 50)
+        eq_(stats['b'].max_resp_time, 110)
+
+        # GET of both records, SMEMBERS of the open day and HMGET of its only service
+        eq_(service.server.kvdb.conn.pipelines, [2, 1, 1])
+
+        stats = list(service.get_stats(
+            '2013-11-12T00:00:00', '2013-11-14T00:00:00', 'a', stats_key_prefix=prefix, suffixes=suffixes))
+        eq_([elem.service_name for elem in stats], ['a'])
+
+class GetBrokerPoolTestCase(TestCase):
+    def test_get_stats(self):
+        now = datetime(2013, 11, 12, 13, 14, 15)
+        reported = timegm(now.timetuple()) - BROKER.POOL_STATS_INTERVAL
+        stale = timegm(now.timetuple()) - BROKER.POOL_STATS_INTERVAL * 4
+
+        def get_stats(reported):
+            return dumps({'size':1000, 'busy':3, 'max_busy':1000, 'handled':500, 'wait_time_mean':0.0012345,
+                'wait_time_max':0.25, 'reported':reported})
+
+        hashes = {KVDB.BROKER_POOL_STATS: {'parallel-2':get_stats(reported), 'parallel-1':get_stats(stale)}}
+
+        service = GetBrokerPool()
+        service.server = Bunch(kvdb=Bunch(conn=FakeConn({}, hashes)))
+
+        stats = list(service.get_stats(now))
+        eq_(len(stats), 1)
+
+        eq_(stats[0].client_name, 'parallel-2')
+        eq_(stats[0].size, 1000)
+        eq_(stats[0].busy, 3)
+        eq_(stats[0].max_busy, 1000)
+        eq_(stats[0].handled, 500)
+        eq_(stats[0].wait_time_mean, 1.23)
+        eq_(stats[0].wait_time_max, 250)
+        eq_(stats[0].reported, '2013-11-12T13:14:05')
+
+        # A client that hasn't reported in a while is no longer running
+        eq_(sorted(hashes[KVDB.BROKER_POOL_STATS]), ['parallel-2'])
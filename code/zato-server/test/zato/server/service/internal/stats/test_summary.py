@@ -8,15 +8,41 @@ Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+# stdlib
+from datetime import datetime
+
+# anyjson
+from anyjson import loads
+
+# Bunch
+from bunch import Bunch
+
 # dateutil
 from dateutil.parser import parse
 
+# mock
+from mock import patch
+
 # nose
 from nose.tools import eq_
 
 # Zato
+from zato.common import KVDB
 from zato.common.test import ServiceTestCase
-from zato.server.service.internal.stats.summary import GetSummaryByRange
+from zato.server.service.internal.stats import STATS_KEYS
+from zato.server.service.internal.stats.summary import CloseSummaries, get_period_start, GetSummaryByRange
+from zato.server.stats import get_closed_summary_key, get_score
+
+class FakeConn(object):
+    def __init__(self, hashes=None):
+        self.hashes = hashes or {}
+        self.values = {}
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(field)
+
+    def setnx(self, key, value):
+        self.values.setdefault(key, value)
 
 class GetSummaryByRangeTestCase(ServiceTestCase):
     
@@ -80,3 +106,46 @@ class GetSummaryByRangeTestCase(ServiceTestCase):
         start = '208-08-11T18:01:34'
         stop = '2012-11-23T03:42:15'
         _check_expected(start, stop, False, False, False, True)
+
+class GetPeriodStartTestCase(ServiceTestCase):
+
+    def test_get_period_start(self):
+        value = datetime(2013, 11, 14, 13, 14, 15) # A Thursday
+
+        eq_(get_period_start('by-day', value), datetime(2013, 11, 14))
+        eq_(get_period_start('by-week', value), datetime(2013, 11, 11))
+        eq_(get_period_start('by-month', value), datetime(2013, 11, 1))
+        eq_(get_period_start('by-year', value), datetime(2013, 1, 1))
+
+        # A Monday is the start of its own week
+        eq_(get_period_start('by-week', datetime(2013, 11, 11, 0, 0, 1)), datetime(2013, 11, 11))
+
+class CloseSummariesTestCase(ServiceTestCase):
+
+    def close_summary(self, conn, suffixes):
+        prefix, suffix = KVDB.SERVICE_SUMMARY_BY_DAY, '2013:11:12'
+        stats_index = Bunch(get_buckets=lambda *ignored_args: suffixes)
+
+        service = CloseSummaries()
+        service.server = Bunch(kvdb=Bunch(conn=conn))
+
+        services = {'a': dict((key, 1) for key in STATS_KEYS)}
+        with patch.object(service, 'store_summary', return_value=services):
+            service.close_summary(stats_index, prefix, suffix, datetime(2013, 11, 12), datetime(2013, 11, 13),
+                KVDB.SERVICE_TIME_AGGREGATED_BY_HOUR)
+
+        return conn.values.get(get_closed_summary_key(prefix, suffix))
+
+    def test_close_summary(self):
+        eq_(loads(self.close_summary(FakeConn(), ['2013:11:12:13'])), {'a': dict((key, 1) for key in STATS_KEYS)})
+
+    def test_close_summary_no_buckets(self):
+        eq_(self.close_summary(FakeConn(), []), None)
+
+    def test_close_summary_archived(self):
+
+        # Hours of the day until 6 am have been moved to the archive and deleted from the KVDB
+        conn = FakeConn({KVDB.SERVICE_STATS_ARCHIVED_UNTIL: {
+            KVDB.SERVICE_TIME_AGGREGATED_BY_HOUR: str(get_score(datetime(2013, 11, 12, 6)))}})
+
+        eq_(self.close_summary(conn, ['2013:11:12:13']), None)
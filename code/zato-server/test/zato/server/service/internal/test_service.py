@@ -11,6 +11,9 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 # anyjson
 from anyjson import loads
 
+# mock
+from mock import patch
+
 # nose
 from nose.tools import eq_
 
@@ -19,8 +22,9 @@ from bunch import Bunch
 
 # Zato
 from zato.common.odb.model import Service
-from zato.common.test import Expected, rand_bool, rand_int, rand_string, ServiceTestCase
+from zato.common.test import Expected, FakeKVDB, rand_bool, rand_int, rand_string, ServiceTestCase
 from zato.server.service.internal.service import GetList, GetByName
+from zato.server.stats import LatencySketch, QueueStats
 
 def get_data():
     return Bunch({'id':rand_int(), 'name':rand_string(), 'is_active':rand_bool(), 
@@ -54,21 +58,14 @@ class GetListTestCase(ServiceTestCase):
                 eq_(given_value, expected_value)
 
 class GetByNameTestCase(ServiceTestCase):
-    def test_response(self):
-        request = {'cluster_id':rand_int(), 'name':rand_string()}
-        
-        expected_id = rand_int()
-        expected_name = rand_string()
-        expected_is_active = rand_bool()
-        expected_impl_name = rand_string()
-        expected_is_internal = rand_bool()
-        
+    
+    def get_response(self, request):
         service = Service()
-        service.id = expected_id
-        service.name = expected_name
-        service.is_active = expected_is_active
-        service.impl_name = expected_impl_name
-        service.is_internal = expected_is_internal
+        service.id = rand_int()
+        service.name = rand_string()
+        service.is_active = rand_bool()
+        service.impl_name = rand_string()
+        service.is_internal = rand_bool()
         
         expected = Expected()
         expected.add(service)
@@ -76,9 +73,42 @@ class GetByNameTestCase(ServiceTestCase):
         instance = self.invoke(GetByName, request, expected)
         response = Bunch(loads(instance.response.payload.getvalue())['zato_service_get_by_name_response'])
         
-        eq_(response.id, expected_id)
-        eq_(response.name, expected_name)
-        eq_(response.is_active, expected_is_active)
-        eq_(response.impl_name, expected_impl_name)
-        eq_(response.is_internal, expected_is_internal)
+        return service, response
+    
+    def test_response(self):
+        request = {'cluster_id':rand_int(), 'name':rand_string()}
+        service, response = self.get_response(request)
+        
+        eq_(response.id, service.id)
+        eq_(response.name, service.name)
+        eq_(response.is_active, service.is_active)
+        eq_(response.impl_name, service.impl_name)
+        eq_(response.is_internal, service.is_internal)
         eq_(response.usage, 0)
+        
+        # No asynchronous invocations yet
+        eq_(response.time_queue_p50, 0)
+        eq_(response.time_queue_p99, 0)
+        eq_(response.time_queue_broker_p99, 0)
+        eq_(response.time_queue_pool_p99, 0)
+        
+    def test_response_queue(self):
+        request = {'cluster_id':rand_int(), 'name':rand_string()}
+        fields = {}
+        
+        # 98 messages waited 5 ms for the broker and 5 ms for the pool, 2 of them 100 and 400 ms respectively
+        for count, dequeued, started in((98, 100.005, 100.01), (2, 100.1, 100.5)):
+            for x in range(count):
+                for name, value in QueueStats.get_fields(100.0, dequeued, started).items():
+                    fields[name] = fields.get(name, 0) + value
+                    
+        with patch.object(FakeKVDB.FakeConn, 'hgetall', return_value=fields):
+            service, response = self.get_response(request)
+            
+        def get_value(value):
+            return round(LatencySketch.get_value(LatencySketch.get_index(value)), 1)
+        
+        eq_(response.time_queue_p50, get_value(10))
+        eq_(response.time_queue_p99, get_value(500))
+        eq_(response.time_queue_broker_p99, get_value(100))
+        eq_(response.time_queue_pool_p99, get_value(400))
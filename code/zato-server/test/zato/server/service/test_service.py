@@ -10,14 +10,20 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 # stdlib
 import ast
-from logging import INFO
+from logging import getLogger, INFO
 from time import time
 from unittest import TestCase
 from uuid import uuid4
 
+# anyjson
+from anyjson import loads
+
 # Bunch
 from bunch import Bunch
 
+# lxml
+from lxml import objectify
+
 # nose
 from nose.tools import eq_
 
@@ -25,9 +31,14 @@ from nose.tools import eq_
 from retools.lock import LockTimeout
 
 # Zato
-from zato.common import CHANNEL, KVDB, PARAMS_PRIORITY, SCHEDULER_JOB_TYPE, URL_TYPE
+from zato.common import CHANNEL, KVDB, PARAMS_PRIORITY, ParsingException, SCHEDULER_JOB_TYPE, SIMPLE_IO, URL_TYPE, \
+     ZatoException
 from zato.common.test import FakeKVDB, rand_string, rand_int, ServiceTestCase
-from zato.server.service import HTTPRequestData, Request, Service
+from zato.server.service import AsIs, Boolean, CSV, get_input_plan, get_output_plan, HTTPRequestData, Integer, is_stream, join_stream, OutputPlan, Request, \
+     Response, Service, SimpleIOPayload
+from zato.server.service.store import ServiceStore
+
+logger = getLogger(__name__)
 
 # ##############################################################################
 
@@ -63,6 +74,118 @@ class HooksTestCase(ServiceTestCase):
 
 # ##############################################################################
 
+class TestInvocationPlan(TestCase):
+    def test_plan(self):
+        
+        class MyService(Service):
+            class SimpleIO:
+                input_required = ('a',)
+                
+            def before_handle(self):
+                pass
+            
+            def after_interval_based_job(self):
+                pass
+            
+        class MySubclass(MyService):
+            def after_handle(self):
+                pass
+            
+        class NoSIO(Service):
+            pass
+            
+        plan = MyService.get_invocation_plan()
+        eq_(plan.is_sio, True)
+        eq_(plan.sio, MyService.SimpleIO)
+        
+        for name, hook in plan.hooks.items():
+            if name in('before_handle', 'after_interval_based_job'):
+                eq_(hook.__func__, getattr(MyService, name).__func__)
+            else:
+                eq_(hook, None)
+                
+        # Computed once per class ..
+        self.assertIs(MyService.get_invocation_plan(), plan)
+        
+        # .. and subclasses get plans of their own.
+        sub_plan = MySubclass.get_invocation_plan()
+        self.assertIsNot(sub_plan, plan)
+        eq_(sub_plan.sio, MyService.SimpleIO)
+        eq_(sorted(name for name, hook in sub_plan.hooks.items() if hook),
+            ['after_handle', 'after_interval_based_job', 'before_handle'])
+        
+        no_sio_plan = NoSIO.get_invocation_plan()
+        eq_(no_sio_plan.is_sio, False)
+        eq_(no_sio_plan.sio, None)
+        eq_([hook for hook in no_sio_plan.hooks.values() if hook], [])
+        
+    def test_unknown_job_type(self):
+        
+        class MyService(Service):
+            pass
+        
+        instance = MyService()
+        instance.channel = CHANNEL.SCHEDULER
+        instance.job_type = rand_string()
+        instance.logger = Bunch(errors=[])
+        instance.logger.error = instance.logger.errors.append
+        
+        instance.call_job_hooks('before')
+        
+        eq_(len(instance.logger.errors), 1)
+        self.assertTrue(instance.logger.errors[0].startswith("Can't run before_{}_job".format(instance.job_type)))
+
+# ##############################################################################
+
+class TestInstancePool(TestCase):
+    def test_pool(self):
+        
+        class MyService(Service):
+            pass
+        
+        impl_name = MyService.get_impl_name()
+        
+        store = ServiceStore()
+        store.services = {impl_name: {'service_class': MyService}}
+        
+        # No pool by default
+        instance = store.new_instance(impl_name)
+        store.release_instance(instance)
+        self.assertIsNot(store.new_instance(impl_name), instance)
+        eq_(store.instance_pool, {})
+        
+        store.instance_pool_size = 1
+        
+        instance1 = store.new_instance(impl_name)
+        instance2 = store.new_instance(impl_name)
+        
+        instance1.cid = rand_string()
+        instance1.environ['foo'] = 'bar'
+        request, response = instance1.request, instance1.response
+        
+        store.release_instance(instance1)
+        store.release_instance(instance2) # The pool is full already
+        
+        eq_(store.instance_pool[impl_name], [instance1])
+        
+        instance = store.new_instance(impl_name)
+        self.assertIs(instance, instance1)
+        eq_(instance.cid, None)
+        eq_(instance.environ, {})
+        self.assertIsNot(instance.request, request)
+        self.assertIsNot(instance.response, response)
+        eq_(store.instance_pool[impl_name], [])
+        
+        # Instances of classes no longer deployed are not pooled
+        class MyService(Service):
+            pass
+        
+        store.services[impl_name]['service_class'] = MyService
+        store.release_instance(instance)
+        eq_(store.instance_pool[impl_name], [])
+
+# ##############################################################################
+
 class TestLogInputOutput(ServiceTestCase):
     def test_log_input_output(self):
         
@@ -284,4 +407,177 @@ class TestRequest(TestCase):
                             sorted({'a': 'a-req', 'b': 'b-req', 'c': 'c-req',
                              'd': 'd-opt', 'e': 'e-opt', 'f': 'f-opt',
                              'g': 'g-msg',
-                             'h':'channel_param_h'}.items()))
\ No newline at end of file
+                             'h':'channel_param_h'}.items()))
+    def test_get_params_plan(self):
+        
+        simple_io_config = {
+            'bool_parameter_prefixes': ['is_'],
+            'int_parameters': ['id'],
+            'int_parameter_suffixes': ['_id'],
+        }
+        
+        class SimpleIO:
+            request_elem = 'my_request'
+            input_required = ('id', 'user_id', 'is_active', CSV('tags'))
+            input_optional = ('name', AsIs('group_id'))
+            
+        plan = get_input_plan(SimpleIO, simple_io_config)
+        self.assertIs(get_input_plan(SimpleIO, simple_io_config), plan)
+        eq_([elem.name for elem in plan.required], ['id', 'user_id', 'is_active', 'tags'])
+        eq_([elem.name for elem in plan.optional], ['name', 'group_id'])
+        
+        expected = {'id':1, 'user_id':2, 'is_active':True, 'tags':['a', 'b'], 'name':None, 'group_id':'3'}
+            
+        for ns in('', 'urn:zato'):
+            xmlns = ' xmlns="{}"'.format(ns) if ns else ''
+            payload = objectify.fromstring(
+                '<my_request{}><id>1</id><user_id>2</user_id><is_active>true</is_active>' \
+                '<tags>a,b</tags><group_id>3</group_id></my_request>'.format(xmlns))
+            
+            r = Request(None, simple_io_config)
+            r.payload = payload
+            r.init(True, uuid4().hex, SimpleIO, SIMPLE_IO.FORMAT.XML, None, {})
+            eq_(sorted(r.input.items()), sorted(expected.items()))
+            
+        r = Request(None, simple_io_config)
+        r.payload = {'id':'1', 'user_id':'2', 'is_active':'true', 'tags':'a,b', 'group_id':'3'}
+        r.init(True, uuid4().hex, SimpleIO, SIMPLE_IO.FORMAT.JSON, None, {})
+        eq_(sorted(r.input.items()), sorted(expected.items()))
+        
+        # Elements in a namespace other than the root's are not looked up
+        r = Request(None, simple_io_config)
+        r.payload = objectify.fromstring('<my_request><id xmlns="urn:zato">1</id></my_request>')
+        r.is_xml = True
+        
+        self.assertRaises(ParsingException, r.get_params, SimpleIO.input_required, 'my_request')
+        eq_(r.get_params(['id'], 'my_request', None, is_required=False), {'id':None})
+
+# ##############################################################################
+
+class TestResponse(TestCase):
+    def test_payload_stream(self):
+        
+        def gen():
+            yield 'a'
+            yield 'b'
+            
+        response = Response(None)
+        for payload in(gen(), iter(['a', 'b']), ['a', 'b'], ('a', 'b')):
+            response.payload = payload
+            self.assertTrue(is_stream(response.payload))
+            eq_(list(response.payload), ['a', 'b'])
+            
+        response.payload = 'ab'
+        self.assertFalse(is_stream(response.payload))
+        
+    def test_payload_list_outgoing_declared(self):
+        
+        class SimpleIO:
+            output_required = ('a',)
+            
+        response = Response(None)
+        response.init(uuid4().hex, SimpleIO, SIMPLE_IO.FORMAT.JSON)
+        
+        # Lists are still treated as SimpleIO data if the output is declared ..
+        self.assertRaises(Exception, setattr, response, 'payload', ['a', 'b'])
+        
+        # .. but iterators never are.
+        response.payload = iter(['a', 'b'])
+        eq_(list(response.payload), ['a', 'b'])
+        
+    def test_join_stream(self):
+        joined = join_stream(iter(['a', '', '東京', b'c']))
+        eq_(joined, '東京'.join(['a', 'c']).encode('utf-8'))
+        self.assertIsInstance(joined, bytes)
+        
+    def test_set_response_data_stream(self):
+        
+        def gen():
+            yield 'a'
+            yield '東京'
+            
+        # Services invoking other ones get whole responses rather than one-shot iterators
+        for payload in(gen(), ['a', '東京']):
+            service = Service()
+            service.response.payload = payload
+            
+            response = Service().set_response_data(service, serialize=False, as_bunch=False)
+            eq_(response, 'a東京'.encode('utf-8'))
+            eq_(service.response.payload, response)
+            self.assertFalse(is_stream(service.response.payload))
+            
+# ##############################################################################
+
+class TestSimpleIOPayload(TestCase):
+    
+    def setUp(self):
+        self.simple_io_config = {
+            'bool_parameter_prefixes': ['is_', 'should_'],
+            'int_parameters': ['id'],
+            'int_parameter_suffixes': ['_id', '_count'],
+        }
+        
+        class SimpleIO:
+            response_elem = 'my_response'
+            output_required = ('id', 'name', Boolean('flag'), 'user_id')
+            output_optional = ('is_active', AsIs('group_id'), CSV('tags'), Integer('size'))
+            
+        self.io = SimpleIO
+        
+    def get_payload(self, data_format, plan=None):
+        plan = plan or get_output_plan(self.io, self.simple_io_config)
+        return SimpleIOPayload('cid', logger, data_format, plan.required_list, plan.optional_list,
+            self.simple_io_config, plan.response_elem, plan.namespace, plan)
+        
+    def get_items(self, count):
+        return [{'id':str(idx), 'name':'name-{}'.format(idx), 'flag':'true', 'user_id':str(idx * 10),
+                 'is_active':'', 'group_id':'123', 'tags':'a,b', 'size':'0'} for idx in range(count)]
+    
+    def test_plan_cached(self):
+        plan = get_output_plan(self.io, self.simple_io_config)
+        eq_(plan.outgoing_declared, True)
+        eq_([elem.name for elem in plan.elems], ['id', 'name', 'flag', 'user_id', 'is_active', 'group_id', 'tags', 'size'])
+        eq_([elem.is_required for elem in plan.elems], [True] * 4 + [False] * 4)
+        
+        self.assertIs(get_output_plan(self.io, self.simple_io_config), plan)
+        self.assertIsNot(get_output_plan(self.io, dict(self.simple_io_config)), plan)
+        
+    def test_json(self):
+        payload = self.get_payload(SIMPLE_IO.FORMAT.JSON)
+        payload[:] = self.get_items(2)
+        
+        response = loads(payload.getvalue())['my_response']
+        eq_(len(response), 2)
+        eq_(response[1], {'id':1, 'name':'name-1', 'flag':True, 'user_id':10,
+            'is_active':False, 'group_id':'123', 'tags':['a', 'b'], 'size':0})
+        
+        payload = self.get_payload(SIMPLE_IO.FORMAT.JSON)
+        payload.set_payload_attrs(self.get_items(1)[0])
+        eq_(loads(payload.getvalue())['my_response']['user_id'], 0)
+        
+    def test_xml_same_as_objectify(self):
+        
+        # A plan which builds XML using objectify only, as it's done when serialize is False
+        slow_plan = OutputPlan(self.io, self.simple_io_config)
+        slow_plan.xml_fast = False
+        
+        for items in(self.get_items(1), self.get_items(3)):
+            for idx, item in enumerate(items):
+                item['name'] = None if idx % 2 else 'zażółć'.encode('utf-8')
+            
+            fast = self.get_payload(SIMPLE_IO.FORMAT.XML)
+            fast[:] = items
+            
+            slow = self.get_payload(SIMPLE_IO.FORMAT.XML, slow_plan)
+            slow[:] = items
+            
+            eq_(fast.getvalue(), slow.getvalue())
+            
+    def test_missing_required(self):
+        item = self.get_items(1)[0]
+        item['name'] = ''
+        
+        payload = self.get_payload(SIMPLE_IO.FORMAT.JSON)
+        payload.append(item)
+        
+        self.assertRaises(ZatoException, payload.getvalue)
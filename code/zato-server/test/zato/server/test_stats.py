@@ -0,0 +1,832 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2013 Dariusz Suchojad <dsuch at zato.io>
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# stdlib
+import os
+from datetime import datetime, timedelta
+from random import Random
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+# anyjson
+from anyjson import loads
+
+# Bunch
+from bunch import Bunch
+
+# dateutil
+from dateutil.parser import parse
+
+# nose
+from nose.tools import eq_
+
+# Redis
+from redis import ConnectionError, ResponseError
+
+# Zato
+from zato.common import KVDB
+from zato.common.test import rand_int, rand_string
+from zato.server.stats import ARCHIVE_FIELDS, ChannelStats, DELETE_STATUS_FINISHED, DELETE_STATUS_RUNNING, \
+     get_bucket_range, get_bucket_start, get_score, HeavyHitters, LatencySketch, MaintenanceTool, QueueStats, \
+     RAW_BY_MINUTE_EXPIRE, ServiceStatsBuffer, SKETCH_ACCURACY, SLOW_RESPONSE_MAX, StatsArchive, StatsIndex
+
+class FakePipeline(object):
+    """ Records all the commands executed and returns canned results for INCRBY and HGET.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *ignored_args):
+        pass
+
+    def __getattr__(self, name):
+        def _command(*args):
+            self.commands.append((name,) + args)
+        return _command
+
+    def execute(self):
+        if self.conn.error:
+            raise self.conn.error
+
+        self.conn.executed.append(self.commands)
+
+        result = []
+        for command in self.commands:
+            if command[0] == 'incrby':
+                self.conn.usage[command[1]] = self.conn.usage.get(command[1], 0) + command[2]
+                result.append(self.conn.usage[command[1]])
+            elif command[0] == 'hget':
+                result.append(self.conn.freq.get(command[1]))
+            else:
+                result.append(True)
+
+        return result
+
+class FakeConn(object):
+    def __init__(self, keys=None):
+        self.executed = []
+        self.usage = {}
+        self.freq = {}
+        self.stored_keys = keys or []
+        self.error = None
+        self.values = {}
+
+    def pipeline(self, transaction=True):
+        self.transaction = transaction
+        return FakePipeline(self)
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def execute_command(self, *args):
+        # SCAN cursor MATCH pattern COUNT count, everything is returned in one go
+        prefix = args[3][:-1]
+        return 0, [key for key in self.stored_keys if key.startswith(prefix)]
+
+class ServiceStatsBufferTestCase(TestCase):
+
+    def get_buffer(self, flush_max_samples=1000, conn=None):
+        kvdb = Bunch()
+        kvdb.conn = conn or FakeConn()
+        return ServiceStatsBuffer(kvdb, 500, flush_max_samples)
+
+    def test_flush(self):
+        name1, name2 = rand_string(), rand_string()
+        now = datetime(2013, 11, 12, 13, 14, 15)
+        suffix = '2013:11:12:13:14'
+
+        stats_buffer = self.get_buffer()
+        stats_buffer.kvdb.conn.usage['{}{}'.format(KVDB.SERVICE_USAGE, name1)] = 100
+
+        eq_(stats_buffer.incr_usage(name1), 1)
+        eq_(stats_buffer.incr_usage(name1), 2)
+        eq_(stats_buffer.incr_usage(name2), 1)
+
+        stats_buffer.add_time(name1, 10, now)
+        stats_buffer.add_time(name1, 20, now)
+        stats_buffer.add_time(name2, 30, now)
+        stats_buffer.store_slow(name2, cid='abc', proc_time=30)
+
+        # Nothing has been sent yet
+        eq_(stats_buffer.kvdb.conn.executed, [])
+
+        stats_buffer.flush()
+        eq_(stats_buffer.kvdb.conn.transaction, False)
+        eq_(len(stats_buffer.kvdb.conn.executed), 1)
+
+        commands = stats_buffer.kvdb.conn.executed[0]
+        sketch_key1 = '{}{}'.format(KVDB.SERVICE_TIME_SKETCH, name1)
+        sketch_by_minute_key1 = '{}{}:{}'.format(KVDB.SERVICE_TIME_SKETCH_BY_MINUTE, name1, suffix)
+        index10, index20 = LatencySketch.get_index(10), LatencySketch.get_index(20)
+        slow_key2 = '{}{}'.format(KVDB.RESP_SLOW, name2)
+
+        self.assertIn(('incrby', '{}{}'.format(KVDB.SERVICE_USAGE, name1), 2), commands)
+        self.assertIn(('incrby', '{}{}'.format(KVDB.SERVICE_USAGE, name2), 1), commands)
+        self.assertIn(('hset', '{}{}'.format(KVDB.SERVICE_TIME_BASIC, name1), 'last', 20), commands)
+        self.assertIn(('hincrby', sketch_key1, index10, 1), commands)
+        self.assertIn(('hincrby', sketch_key1, index20, 1), commands)
+        self.assertIn(('hincrby', sketch_by_minute_key1, index10, 1), commands)
+        self.assertIn(('hincrby', sketch_by_minute_key1, index20, 1), commands)
+        self.assertIn(('expire', sketch_by_minute_key1, RAW_BY_MINUTE_EXPIRE), commands)
+        self.assertIn(('ltrim', slow_key2, 0, SLOW_RESPONSE_MAX - 1), commands)
+
+        # Services with statistics are indexed
+        index_key = '{}{}{}'.format(KVDB.SERVICE_STATS_INDEX_SERVICES, KVDB.SERVICE_TIME_SKETCH_BY_MINUTE, suffix)
+        self.assertIn(('sadd', KVDB.SERVICE_STATS_INDEX_RAW, name1), commands)
+        self.assertIn(('sadd', KVDB.SERVICE_STATS_INDEX_RAW, name2), commands)
+        self.assertIn(('sadd', index_key, name1), commands)
+        self.assertIn(('sadd', index_key, name2), commands)
+        self.assertIn(('expire', index_key, RAW_BY_MINUTE_EXPIRE), commands)
+
+        lpush = [command for command in commands if command[0] == 'lpush'][0]
+        eq_(lpush[1], slow_key2)
+        eq_(loads(lpush[2]), {'cid':'abc', 'proc_time':30})
+
+        # Usage counters now include what has been read off the KVDB
+        eq_(stats_buffer.incr_usage(name1), 103)
+        eq_(stats_buffer.incr_usage(name2), 2)
+
+    def test_flush_max_samples(self):
+        name = rand_string()
+        flush_max_samples = rand_int(2, 10)
+
+        stats_buffer = self.get_buffer(flush_max_samples)
+
+        for x in range(flush_max_samples - 1):
+            stats_buffer.incr_usage(name)
+            stats_buffer.add_time(name, x, datetime.utcnow())
+
+        eq_(stats_buffer.kvdb.conn.executed, [])
+
+        stats_buffer.incr_usage(name)
+        stats_buffer.add_time(name, 0, datetime.utcnow())
+
+        eq_(len(stats_buffer.kvdb.conn.executed), 1)
+        eq_(stats_buffer.pending_samples, 0)
+
+        # Nothing new to flush
+        stats_buffer.flush()
+        eq_(len(stats_buffer.kvdb.conn.executed), 1)
+
+    def test_req_resp(self):
+        name = rand_string()
+        freq_key = '{}{}'.format(KVDB.REQ_RESP_SAMPLE, name)
+
+        conn = FakeConn([freq_key])
+        conn.freq[freq_key] = 2
+
+        # Frequency is known as soon as the buffer is created
+        stats_buffer = self.get_buffer(conn=conn)
+        eq_(stats_buffer.should_store_req_resp(name, 3), (None, None))
+        eq_(stats_buffer.should_store_req_resp(name, 4), (freq_key, 2))
+
+        # .. and is refreshed on each flush
+        conn.freq[freq_key] = 3
+        stats_buffer.incr_usage(name)
+        stats_buffer.flush()
+
+        eq_(stats_buffer.should_store_req_resp(name, 4), (None, None))
+        eq_(stats_buffer.should_store_req_resp(name, 6), (freq_key, 3))
+
+        stats_buffer.incr_usage(name)
+        stats_buffer.store_req_resp(freq_key, cid='abc', req='req1')
+        stats_buffer.store_req_resp(freq_key, cid='def', req='req2')
+        stats_buffer.flush()
+
+        commands = stats_buffer.kvdb.conn.executed[-1]
+        hmset = [command for command in commands if command[0] == 'hmset']
+
+        # Only the latest pair is kept
+        eq_(hmset, [('hmset', freq_key, {'cid':'def', 'req':'req2'})])
+
+    def test_flush_failed(self):
+        name = rand_string()
+        now = datetime(2013, 11, 12, 13, 14, 15)
+        sketch_key = '{}{}'.format(KVDB.SERVICE_TIME_SKETCH, name)
+        channel_key = '{}my.channel:2013:11:12:13:14'.format(KVDB.CHANNEL_STATS_BY_MINUTE)
+
+        stats_buffer = self.get_buffer()
+        stats_buffer.incr_usage(name)
+        stats_buffer.add_time(name, 10, now)
+        stats_buffer.add_channel('my.channel', ChannelStats.get_fields(200, 10, 100, 5), now)
+
+        stats_buffer.kvdb.conn.error = ConnectionError()
+        stats_buffer.flush()
+        eq_(stats_buffer.kvdb.conn.executed, [])
+
+        # Nothing is lost, what couldn't be flushed is merged with data buffered since
+        stats_buffer.incr_usage(name)
+        stats_buffer.add_time(name, 10, now)
+        stats_buffer.add_time(name, 20, now)
+
+        stats_buffer.kvdb.conn.error = None
+        stats_buffer.flush()
+        commands = stats_buffer.kvdb.conn.executed[0]
+
+        self.assertIn(('incrby', '{}{}'.format(KVDB.SERVICE_USAGE, name), 2), commands)
+        self.assertIn(('hset', '{}{}'.format(KVDB.SERVICE_TIME_BASIC, name), 'last', 20), commands)
+        self.assertIn(('hincrby', sketch_key, LatencySketch.get_index(10), 2), commands)
+        self.assertIn(('hincrby', sketch_key, LatencySketch.get_index(20), 1), commands)
+        self.assertIn(('hincrby', channel_key, 'usage', 1), commands)
+
+    def test_flush_failed_response_error(self):
+        name = rand_string()
+
+        stats_buffer = self.get_buffer()
+        stats_buffer.incr_usage(name)
+
+        # Commands have been executed by the KVDB so they're not merged back
+        stats_buffer.kvdb.conn.error = ResponseError()
+        stats_buffer.flush()
+        eq_(stats_buffer.pending_usage, {})
+
+    def test_flush_channels(self):
+        now = datetime(2013, 11, 12, 13, 14, 15)
+        key = '{}my.channel:2013:11:12:13:14'.format(KVDB.CHANNEL_STATS_BY_MINUTE)
+
+        stats_buffer = self.get_buffer()
+        stats_buffer.add_channel('my.channel', ChannelStats.get_fields(200, 10, 100, 5), now)
+        stats_buffer.add_channel('my.channel', ChannelStats.get_fields(500, 20, 0, 5), now)
+
+        # Channels are flushed even if no service has been invoked
+        stats_buffer.flush()
+        commands = stats_buffer.kvdb.conn.executed[0]
+        sketch_field = 'sketch:{}'.format(LatencySketch.get_index(5))
+
+        self.assertIn(('hincrby', key, 'usage', 2), commands)
+        self.assertIn(('hincrby', key, 'bytes_in', 30), commands)
+        self.assertIn(('hincrby', key, 'bytes_out', 100), commands)
+        self.assertIn(('hincrby', key, 'status:200', 1), commands)
+        self.assertIn(('hincrby', key, 'status:500', 1), commands)
+        self.assertIn(('hincrby', key, sketch_field, 2), commands)
+        self.assertIn(('sadd', StatsIndex(None).get_services_key(KVDB.CHANNEL_STATS_BY_MINUTE, '2013:11:12:13:14'),
+            'my.channel'), commands)
+
+    def test_flush_queue(self):
+        key = '{}my.service'.format(KVDB.SERVICE_TIME_QUEUE)
+
+        stats_buffer = self.get_buffer()
+        stats_buffer.add_queue('my.service', QueueStats.get_fields(100.0, 100.005, 100.005))
+        stats_buffer.add_queue('my.service', QueueStats.get_fields(100.0, 100.005, 100.5))
+
+        # Queueing delays are flushed even if no service has been invoked since
+        stats_buffer.flush()
+        commands = stats_buffer.kvdb.conn.executed[0]
+
+        self.assertIn(('hincrby', key, 'broker:{}'.format(LatencySketch.get_index(5)), 2), commands)
+        self.assertIn(('hincrby', key, 'pool:0', 1), commands)
+        self.assertIn(('hincrby', key, 'pool:{}'.format(LatencySketch.get_index(495)), 1), commands)
+        self.assertIn(('hincrby', key, 'queue:{}'.format(LatencySketch.get_index(500)), 1), commands)
+
+class StatsIndexTestCase(TestCase):
+
+    def test_get_bucket_start(self):
+        eq_(get_bucket_start('2013:11:12:13:14'), datetime(2013, 11, 12, 13, 14))
+        eq_(get_bucket_start('2013:11:12:13'), datetime(2013, 11, 12, 13))
+        eq_(get_bucket_start('2013:11:12'), datetime(2013, 11, 12))
+        eq_(get_bucket_start('2013:11'), datetime(2013, 11, 1))
+        eq_(get_bucket_start('2013'), datetime(2013, 1, 1))
+
+    def test_get_bucket_range(self):
+        eq_(get_bucket_range('2013:11:12:13:59'),
+            (get_score(datetime(2013, 11, 12, 13, 59)), get_score(datetime(2013, 11, 12, 14, 0))))
+        eq_(get_bucket_range('2013:11:12:23'),
+            (get_score(datetime(2013, 11, 12, 23)), get_score(datetime(2013, 11, 13, 0))))
+        eq_(get_bucket_range('2013:12'),
+            (get_score(datetime(2013, 12, 1)), get_score(datetime(2014, 1, 1))))
+
+    def test_migrate(self):
+        name1, name2 = 'my.service', 'zato.ping'
+        conn = FakeConn([
+            '{}{}:2013:11:12:13:14'.format(KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE, name1),
+            '{}{}:2013:11'.format(KVDB.SERVICE_TIME_AGGREGATED_BY_MONTH, name2),
+        ])
+
+        StatsIndex(conn).migrate()
+        eq_(len(conn.executed), 1)
+
+        commands = conn.executed[0]
+        minute_key = '{}{}2013:11:12:13:14'.format(
+            KVDB.SERVICE_STATS_INDEX_SERVICES, KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE)
+        month_key = '{}{}2013:11'.format(
+            KVDB.SERVICE_STATS_INDEX_SERVICES, KVDB.SERVICE_TIME_AGGREGATED_BY_MONTH)
+
+        self.assertIn(('sadd', minute_key, name1), commands)
+        self.assertIn(('sadd', month_key, name2), commands)
+        self.assertIn(('zadd', '{}{}'.format(KVDB.SERVICE_STATS_INDEX_BUCKETS, KVDB.SERVICE_TIME_AGGREGATED_BY_MONTH),
+            get_score(datetime(2013, 11, 1)), '2013:11'), commands)
+        eq_(commands[-1][:2], ('set', KVDB.SERVICE_STATS_INDEX_MIGRATED))
+
+        # Already migrated
+        conn.values[KVDB.SERVICE_STATS_INDEX_MIGRATED] = True
+        StatsIndex(conn).migrate()
+        eq_(len(conn.executed), 1)
+
+class LatencySketchTestCase(TestCase):
+
+    def get_times(self, count=10000):
+        random = Random(1)
+        return [int(random.lognormvariate(3, 1)) for x in range(count)]
+
+    def test_percentiles(self):
+        times = self.get_times()
+        sketch = LatencySketch()
+
+        for value in times:
+            sketch.add(value)
+
+        times.sort()
+        eq_(sketch.count, len(times))
+
+        for percentile in(0, 50, 95, 99, 100):
+            expected = times[int(percentile / 100.0 * (len(times) - 1))]
+            self.assertLessEqual(abs(sketch.get_percentile(percentile) - expected), expected * SKETCH_ACCURACY)
+
+    def test_mean(self):
+        times = self.get_times()
+        sketch = LatencySketch()
+
+        for value in times:
+            sketch.add(value)
+
+        expected = sum(times) / len(times)
+        self.assertLessEqual(abs(sketch.get_mean() - expected), expected * SKETCH_ACCURACY)
+
+        # Only times up to the 0th percentile, i.e. the minimum, are included
+        eq_(sketch.get_mean(0), sketch.get_min())
+
+    def test_zero(self):
+        sketch = LatencySketch()
+        eq_(sketch.get_percentile(50), 0)
+        eq_(sketch.get_mean(), 0)
+
+        sketch.add(0)
+        sketch.add(0.5)
+        eq_(sketch.buckets, {0:2})
+        eq_(sketch.get_max(), 0)
+
+    def test_merge(self):
+        times = self.get_times()
+        sketch, sketch1, sketch2 = LatencySketch(), LatencySketch(), LatencySketch()
+
+        for idx, value in enumerate(times):
+            sketch.add(value)
+            (sketch1 if idx % 2 else sketch2).add(value)
+
+        sketch1.merge(sketch2)
+        eq_(sketch1.buckets, sketch.buckets)
+
+    def test_serialization(self):
+        sketch = LatencySketch()
+        for value in self.get_times(100):
+            sketch.add(value)
+
+        eq_(LatencySketch.loads(sketch.dumps()).buckets, sketch.buckets)
+        eq_(LatencySketch.loads('').buckets, {})
+
+        # What HGETALL returns
+        value = dict((str(index), str(count)) for index, count in sketch.buckets.items())
+        eq_(LatencySketch.from_hash(value).buckets, sketch.buckets)
+
+class FakeMaintenancePipeline(object):
+    """ Queues commands and runs them against the connection in order when executed.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *ignored_args):
+        pass
+
+    def __getattr__(self, name):
+        def _command(*args):
+            self.commands.append((name, args))
+        return _command
+
+    def execute(self):
+        return [getattr(self.conn, name)(*args) for name, args in self.commands]
+
+class FakeMaintenanceConn(object):
+    """ Keeps sets, hashes and sorted sets, e.g. of buckets, in memory. Can be told to fail
+    after deleting a given number of batches of keys.
+    """
+    def __init__(self, sets, buckets, has_unlink=True, fail_after=None):
+        self.sets = sets
+        self.buckets = buckets
+        self.hashes = {}
+        self.has_unlink = has_unlink
+        self.fail_after = fail_after
+        self.deleted = []
+
+    def pipeline(self, transaction=True):
+        return FakeMaintenancePipeline(self)
+
+    def execute_command(self, command, *keys):
+        if command == 'UNLINK' and not self.has_unlink:
+            raise ResponseError('unknown command')
+
+        if keys[0].endswith('unlink-check'):
+            return 0
+
+        if self.fail_after is not None:
+            if not self.fail_after:
+                raise ResponseError('Connection lost')
+            self.fail_after -= 1
+
+        self.deleted.append((command,) + keys)
+        for key in keys:
+            self.sets.pop(key, None)
+            self.hashes.pop(key, None)
+
+    def zrangebyscore(self, key, start, stop):
+        stop = int(stop[1:]) # Exclusive
+        return [suffix for suffix, score in sorted(self.buckets.get(key, {}).items(), key=lambda elem: elem[1])
+            if start <= score < stop]
+
+    def zrem(self, key, *suffixes):
+        for suffix in suffixes:
+            self.buckets[key].pop(suffix, None)
+
+    def zadd(self, key, score, name):
+        self.buckets.setdefault(key, {})[name] = score
+
+    def zunionstore(self, dest, keys):
+        self.buckets[dest] = {}
+        for key in keys:
+            for name, score in self.buckets.get(key, {}).items():
+                self.buckets[dest][name] = self.buckets[dest].get(name, 0) + score
+
+    def exists(self, key):
+        return any(key in elem for elem in(self.sets, self.hashes, self.buckets))
+
+    def smembers(self, key):
+        return set(self.sets.get(key, set()))
+
+    def sadd(self, key, value):
+        self.sets.setdefault(key, set()).add(value)
+
+    def srem(self, key, value):
+        self.sets.get(key, set()).discard(value)
+
+    def hgetall(self, key):
+        return self.hashes.get(key, {})
+
+    def hmget(self, key, *names):
+        return [self.hashes.get(key, {}).get(name) for name in names]
+
+    def hget(self, key, name):
+        return self.hashes.get(key, {}).get(name)
+
+    def delete(self, key):
+        self.hashes.pop(key, None)
+
+    def hmset(self, key, data):
+        self.hashes.setdefault(key, {}).update(data)
+
+    def hset(self, key, name, value):
+        self.hashes.setdefault(key, {})[name] = value
+
+    def hsetnx(self, key, name, value):
+        self.hashes.setdefault(key, {}).setdefault(name, value)
+
+    def hincrby(self, key, name, value):
+        hash = self.hashes.setdefault(key, {})
+        hash[name] = int(hash.get(name, 0)) + value
+
+    def expire(self, key, value):
+        pass
+
+class MaintenanceToolTestCase(TestCase):
+
+    def get_conn(self, **kwargs):
+        prefix = KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE
+        sets, buckets = {}, {}
+        index = StatsIndex(None)
+
+        for minute in range(4):
+            suffix = '2013:11:12:13:{:02}'.format(minute)
+            buckets[suffix] = get_score(get_bucket_start(suffix))
+            sets[index.get_services_key(prefix, suffix)] = set(['my.service', 'zato.ping'])
+
+        return FakeMaintenanceConn(sets, {index.get_buckets_key(prefix): buckets}, **kwargs)
+
+    def get_data_keys(self, conn):
+        return sorted(key for command in conn.deleted for key in command[1:]
+            if key.startswith(KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE))
+
+    def test_delete(self):
+        conn = self.get_conn()
+        tool = MaintenanceTool(conn, delete_batch_size=4, pipeline_batch_size=3)
+
+        id = tool.delete(datetime(2013, 11, 12, 13, 1, 30), datetime(2013, 11, 12, 13, 2, 10))
+
+        # Minutes 01 and 02 only, 2 services each, the bucket's set of services
+        # and 3 keys of top N services, in batches of 4 keys
+        eq_([len(command) - 1 for command in conn.deleted], [4, 4, 4])
+        eq_(set(command[0] for command in conn.deleted), set(['UNLINK']))
+        eq_(self.get_data_keys(conn), [
+            '{}my.service:2013:11:12:13:01'.format(KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE),
+            '{}my.service:2013:11:12:13:02'.format(KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE),
+            '{}zato.ping:2013:11:12:13:01'.format(KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE),
+            '{}zato.ping:2013:11:12:13:02'.format(KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE),
+        ])
+        eq_(sorted(conn.buckets.values()[0]), ['2013:11:12:13:00', '2013:11:12:13:03'])
+
+        status = tool.get_status(id)
+        eq_(status['status'], DELETE_STATUS_FINISHED)
+        eq_(status['buckets_total'], 2)
+        eq_(status['buckets_deleted'], 2)
+        eq_(status['keys_deleted'], 12)
+        eq_(conn.smembers(KVDB.SERVICE_STATS_DELETE_RUNNING), set())
+
+    def test_delete_no_unlink(self):
+        conn = self.get_conn(has_unlink=False)
+        MaintenanceTool(conn).delete(datetime(2013, 11, 12, 13, 0), datetime(2013, 11, 12, 13, 3))
+
+        eq_(len(conn.deleted), 1)
+        eq_(conn.deleted[0][0], 'DEL')
+        eq_(len(self.get_data_keys(conn)), 8)
+        eq_(conn.buckets.values()[0], {})
+
+    def test_resume(self):
+        conn = self.get_conn(fail_after=2)
+        tool = MaintenanceTool(conn, delete_batch_size=6)
+        start, stop = datetime(2013, 11, 12, 13, 0), datetime(2013, 11, 12, 13, 3)
+
+        self.assertRaises(ResponseError, tool.delete, start, stop, 'my-id')
+
+        status = tool.get_status('my-id')
+        eq_(status['status'], DELETE_STATUS_RUNNING)
+        eq_(status['buckets_deleted'], 1)
+        eq_(sorted(conn.buckets.values()[0]), ['2013:11:12:13:01', '2013:11:12:13:02', '2013:11:12:13:03'])
+
+        # Still being updated so it's not resumed yet
+        conn.fail_after = None
+        eq_(tool.resume(), [])
+
+        conn.hashes[tool.get_status_key('my-id')]['updated'] = datetime(2013, 11, 12).isoformat()
+        eq_(tool.resume(), ['my-id'])
+
+        status = tool.get_status('my-id')
+        eq_(status['status'], DELETE_STATUS_FINISHED)
+        eq_(status['buckets_total'], 4)
+        eq_(status['buckets_deleted'], 4)
+        eq_(len(set(self.get_data_keys(conn))), 8)
+        eq_(conn.buckets.values()[0], {})
+        eq_(conn.smembers(KVDB.SERVICE_STATS_DELETE_RUNNING), set())
+
+    def test_delete_id(self):
+        conn = self.get_conn(fail_after=1)
+        tool = MaintenanceTool(conn, delete_batch_size=6)
+
+        # As given to the worker in a message from zato.stats.delete, its ID is the service's CID
+        msg = Bunch(start='2013-11-12T13:00:00', stop='2013-11-12T13:03:00', id=rand_string())
+
+        self.assertRaises(ResponseError, tool.delete, parse(msg.start), parse(msg.stop), msg.id)
+        eq_(tool.get_status(msg.id)['status'], DELETE_STATUS_RUNNING)
+        eq_(conn.smembers(KVDB.SERVICE_STATS_DELETE_RUNNING), set([msg.id]))
+
+        # Resumed under the same ID so its progress can still be checked
+        conn.fail_after = None
+        conn.hashes[tool.get_status_key(msg.id)]['updated'] = datetime(2013, 11, 12).isoformat()
+        eq_(tool.resume(), [msg.id])
+
+        status = tool.get_status(msg.id)
+        eq_(status['id'], msg.id)
+        eq_(status['start'], msg.start)
+        eq_(status['stop'], msg.stop)
+        eq_(status['status'], DELETE_STATUS_FINISHED)
+
+        eq_(tool.delete(parse(msg.start), parse(msg.stop), msg.id), msg.id)
+
+    def test_delete_channels(self):
+        conn = self.get_conn()
+        channel_stats = ChannelStats(conn)
+
+        channel_stats.add('my.channel', '2013:11:12:13:01', ChannelStats.get_fields(200, 1, 1, 1))
+        channel_stats.add('my.channel', '2013:11:12:13:05', ChannelStats.get_fields(200, 1, 1, 1))
+
+        MaintenanceTool(conn).delete(datetime(2013, 11, 12, 13, 0), datetime(2013, 11, 12, 13, 3))
+
+        # Statistics of the channel from outside of the range are kept
+        deleted = [key for command in conn.deleted for key in command[1:]]
+        self.assertIn('{}my.channel:2013:11:12:13:01'.format(KVDB.CHANNEL_STATS_BY_MINUTE), deleted)
+        eq_(conn.buckets[channel_stats.index.get_buckets_key(KVDB.CHANNEL_STATS_BY_MINUTE)].keys(), ['2013:11:12:13:05'])
+
+class HeavyHittersTestCase(TestCase):
+
+    def get_suffixes(self, start, stop):
+        suffixes = []
+        while start < stop:
+            suffixes.append(start.strftime('%Y:%m:%d:%H:%M'))
+            start += timedelta(minutes=1)
+        return suffixes
+
+    def test_rollup(self):
+        minute, hour = KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE, KVDB.SERVICE_TIME_AGGREGATED_BY_HOUR
+        conn = FakeMaintenanceConn({}, {})
+        heavy_hitters = HeavyHitters(conn)
+
+        heavy_hitters.add_bucket(minute, '2013:11:12:13:14', [('a', 10, 2.0), ('b', 1, 100.0)])
+        heavy_hitters.add_bucket(minute, '2013:11:12:13:15', [('a', 20, 3.0)])
+        heavy_hitters.rollup(hour, '2013:11:12:13', minute, ['2013:11:12:13:14', '2013:11:12:13:15'])
+
+        eq_(conn.buckets[heavy_hitters.get_key('usage', hour, '2013:11:12:13')], {'a':30, 'b':1})
+        eq_(conn.buckets[heavy_hitters.get_key('time', hour, '2013:11:12:13')], {'a':80, 'b':100})
+        eq_(conn.hashes[heavy_hitters.get_totals_key(hour, '2013:11:12:13')],
+            {'usage':31, 'time':180, 'mean':105, 'count':3})
+
+        # One of the minutes isn't kept track of, e.g. it's from before top N services were
+        heavy_hitters.rollup(hour, '2013:11:12:14', minute, ['2013:11:12:13:15', '2013:11:12:13:16'])
+        eq_(conn.exists(heavy_hitters.get_totals_key(hour, '2013:11:12:14')), False)
+
+    def test_get_buckets(self):
+        minute, day = KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE, KVDB.SERVICE_TIME_AGGREGATED_BY_DAY
+        conn = FakeMaintenanceConn({}, {})
+        heavy_hitters = HeavyHitters(conn)
+
+        heavy_hitters.add_bucket(day, '2013:11:12', [('a', 1, 1.0)])
+        heavy_hitters.add_bucket(minute, '2013:11:11:23:59', [('a', 1, 1.0)])
+        heavy_hitters.add_bucket(minute, '2013:11:13:00:30', [('a', 1, 1.0)])
+
+        # The whole of 2013-11-12 and of its next day's first hour, which hasn't been rolled up
+        suffixes = self.get_suffixes(datetime(2013, 11, 11, 23, 58), datetime(2013, 11, 13, 1, 2))
+
+        eq_(heavy_hitters.get_buckets(suffixes, datetime(2013, 11, 20)),
+            [(day, '2013:11:12'), (minute, '2013:11:11:23:59'), (minute, '2013:11:13:00:30')])
+
+        # The day's rollup isn't used until it's sure to be complete
+        eq_(heavy_hitters.get_buckets(suffixes, datetime(2013, 11, 13, 1, 30)),
+            [(minute, '2013:11:11:23:59'), (minute, '2013:11:13:00:30')])
+
+        # There are statistics of a minute without top N services
+        conn.sets[StatsIndex(conn).get_services_key(minute, '2013:11:13:01:01')] = set(['a'])
+        eq_(heavy_hitters.get_buckets(suffixes, datetime(2013, 11, 20)), None)
+
+class ChannelStatsTestCase(TestCase):
+
+    def test_get_stats(self):
+        minute, hour = KVDB.CHANNEL_STATS_BY_MINUTE, KVDB.CHANNEL_STATS_BY_HOUR
+        conn = FakeMaintenanceConn({}, {})
+        channel_stats = ChannelStats(conn)
+
+        channel_stats.add('a', '2013:11:12:13:10', ChannelStats.get_fields(200, 10, 100, 5))
+        channel_stats.add('a', '2013:11:12:13:20', ChannelStats.get_fields(404, 20, 200, 50))
+        channel_stats.add('b', '2013:11:12:13:20', ChannelStats.get_fields(200, 1, 2, 3))
+        channel_stats.add('a', '2013:11:12:14:05', ChannelStats.get_fields(200, 30, 300, 5))
+        channel_stats.rollup(hour, '2013:11:12:13', minute, ['2013:11:12:13:10', '2013:11:12:13:20'])
+
+        eq_(conn.hashes['{}a:2013:11:12:13'.format(hour)]['usage'], 2)
+
+        # Per-minute statistics rolled up are no longer needed once the hour's rollup can be used
+        conn.hashes.pop('{}a:2013:11:12:13:10'.format(minute))
+        start = datetime(2013, 11, 12, 12, 58)
+        suffixes = [(start + timedelta(minutes=idx)).strftime('%Y:%m:%d:%H:%M') for idx in range(72)]
+
+        stats = channel_stats.get_stats(suffixes, now=datetime(2013, 11, 20))
+        eq_(sorted(stats), ['a', 'b'])
+        eq_(stats['a']['usage'], 3)
+        eq_(stats['a']['bytes_in'], 60)
+        eq_(stats['a']['bytes_out'], 600)
+        eq_(ChannelStats.get_status_codes(stats['a']), {200:2, 404:1})
+        eq_(ChannelStats.get_sketch(stats['a']).count, 3)
+
+        # One channel only
+        eq_(channel_stats.get_stats(suffixes, 'b', datetime(2013, 11, 20)).keys(), ['b'])
+
+        # The hour's rollup isn't used until it's sure to be complete
+        stats = channel_stats.get_stats(suffixes, now=datetime(2013, 11, 12, 14, 30))
+        eq_(stats['a']['usage'], 2)
+
+class QueueStatsTestCase(TestCase):
+
+    def test_get(self):
+        conn = FakeMaintenanceConn({}, {})
+        queue_stats = QueueStats(conn)
+
+        for idx in range(100):
+            queue_stats.add('a', QueueStats.get_fields(100.0, 100.0 + idx / 1000.0, 100.1 + idx / 1000.0))
+
+        # Clock skew between servers - dequeued before it was enqueued
+        queue_stats.add('a', QueueStats.get_fields(100.0, 99.0, 100.0))
+
+        sketches = queue_stats.get('a')
+        eq_(sorted(sketches), ['broker', 'pool', 'queue'])
+        eq_(sketches['queue'].count, 101)
+        self.assertAlmostEqual(sketches['queue'].get_percentile(50), 149, delta=149 * SKETCH_ACCURACY)
+        self.assertAlmostEqual(sketches['broker'].get_percentile(99), 98, delta=98 * SKETCH_ACCURACY)
+        eq_(sketches['broker'].buckets[0], 2) # 0 ms and the negative delay
+
+        # No statistics at all
+        sketches = queue_stats.get('b')
+        eq_(sketches['queue'].count, 0)
+        eq_(sketches['queue'].get_percentile(99), 0)
+
+class StatsArchiveTestCase(TestCase):
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.archive = StatsArchive(self.dir)
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def get_score(self, suffix):
+        return get_score(get_bucket_start(suffix))
+
+    def test_append_read(self):
+        prefix = KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE
+
+        self.archive.append(prefix, '2013-11', [
+            (self.get_score('2013:11:12:13:14'), 'a', (1, 10, 5, 15)),
+            (self.get_score('2013:11:12:13:14'), 'b', (2, 20, 10, 30)),
+        ], self.get_score('2013:11:12:13:15'))
+        self.archive.append(prefix, '2013-11', [
+            (self.get_score('2013:11:12:13:15'), 'a', (3, 30, 15, 45)),
+        ], self.get_score('2013:11:12:13:16'))
+
+        meta = self.archive.get_meta(prefix, '2013-11')
+        eq_(meta['rows'], 3)
+        eq_(meta['names'], ['a', 'b'])
+        eq_(meta['until'], self.get_score('2013:11:12:13:16'))
+
+        suffixes = ['2013:11:12:13:13', '2013:11:12:13:14', '2013:11:12:13:15']
+        result = self.archive.read(prefix, suffixes, ARCHIVE_FIELDS)
+        eq_([result.names[idx] for idx in result.name_idx], ['a', 'b', 'a'])
+        eq_(result.suffix_idx.tolist(), [1, 1, 2])
+        eq_(result.stats.tolist(), [[1, 10, 5, 15], [2, 20, 10, 30], [3, 30, 15, 45]])
+
+        # One service and one field only
+        result = self.archive.read(prefix, suffixes[2:], ('usage',), 'a')
+        eq_(result.suffix_idx.tolist(), [0])
+        eq_(result.stats.tolist(), [[3]])
+
+        eq_(len(self.archive.read(prefix, suffixes, ARCHIVE_FIELDS, 'c').stats), 0)
+        eq_(len(self.archive.read(prefix, ['2013:10:12:13:14'], ARCHIVE_FIELDS).stats), 0)
+
+    def test_interrupted_append(self):
+        prefix = KVDB.SERVICE_TIME_AGGREGATED_BY_HOUR
+        score = self.get_score('2013:11:12:13')
+
+        self.archive.append(prefix, '2013-11', [(score, 'a', (1, 1, 1, 1))], score + 3600)
+
+        # A write whose metadata wasn't stored
+        with open(os.path.join(self.archive.get_month_dir(prefix, '2013-11'), 'usage'), 'ab') as f:
+            f.write(b'leftover')
+
+        self.archive.append(prefix, '2013-11', [(score + 3600, 'a', (2, 2, 2, 2))], score + 7200)
+
+        result = self.archive.read(prefix, ['2013:11:12:13', '2013:11:12:14'], ARCHIVE_FIELDS)
+        eq_(result.stats[:,0].tolist(), [1, 2])
+
+    def test_archive(self):
+        prefix = KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE
+        sets, buckets = {}, {}
+        index = StatsIndex(None)
+
+        for minute in range(4):
+            suffix = '2013:11:12:13:{:02}'.format(minute)
+            buckets[suffix] = self.get_score(suffix)
+            sets[index.get_services_key(prefix, suffix)] = set(['my.service', 'zato.ping'])
+
+        conn = FakeMaintenanceConn(sets, {index.get_buckets_key(prefix): buckets})
+        tool = MaintenanceTool(conn, pipeline_batch_size=3)
+
+        for suffix in buckets:
+            for name in ('my.service', 'zato.ping'):
+                conn.hashes['{}{}:{}'.format(prefix, name, suffix)] = dict(zip(ARCHIVE_FIELDS, (int(suffix[-2:]), 1, 1, 1)))
+
+        eq_(tool.archive(self.archive, prefix, datetime(2013, 11, 12, 13, 2)), 2)
+
+        eq_(int(conn.hget(KVDB.SERVICE_STATS_ARCHIVED_UNTIL, prefix)), self.get_score('2013:11:12:13:02'))
+        eq_(sorted(conn.buckets.values()[0]), ['2013:11:12:13:02', '2013:11:12:13:03'])
+        eq_(sorted(key for key in conn.hashes if key.startswith(prefix)), [
+            '{}my.service:2013:11:12:13:02'.format(prefix),
+            '{}my.service:2013:11:12:13:03'.format(prefix),
+            '{}zato.ping:2013:11:12:13:02'.format(prefix),
+            '{}zato.ping:2013:11:12:13:03'.format(prefix),
+        ])
+
+        result = self.archive.read(prefix, ['2013:11:12:13:00', '2013:11:12:13:01'], ARCHIVE_FIELDS)
+        eq_(result.stats[:,0].tolist(), [0, 0, 1, 1])
+
+        # Buckets already archived are only deleted when archiving is run again
+        conn.buckets.values()[0]['2013:11:12:13:01'] = self.get_score('2013:11:12:13:01')
+        tool.archive(self.archive, prefix, datetime(2013, 11, 12, 13, 2))
+        eq_(self.archive.get_meta(prefix, '2013-11')['rows'], 4)
+        eq_(sorted(conn.buckets.values()[0]), ['2013:11:12:13:02', '2013:11:12:13:03'])
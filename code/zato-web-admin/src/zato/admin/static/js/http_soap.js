@@ -38,6 +38,7 @@ $.fn.zato.http_soap.data_table.new_row = function(item, data, include_tr) {
 
     var is_active = item.is_active == true;
 	var merge_url_params_req = item.merge_url_params_req == true;
+	var stream_request = item.stream_request == true;
 	
 	var is_channel = $(document).getUrlParam('connection') == 'channel';
 	var is_outgoing = $(document).getUrlParam('connection') == 'outgoing'
@@ -50,6 +51,8 @@ $.fn.zato.http_soap.data_table.new_row = function(item, data, include_tr) {
 	var merge_url_params_req_tr = '';
 	var url_params_pri_tr = '';
 	var params_pri_tr = '';
+	var max_request_size_tr = '';
+	var stream_request_tr = '';
 
     if(data.transport == 'soap') {
         soap_action_tr += String.format('<td>{0}</td>', item.soap_action);
@@ -64,6 +67,8 @@ $.fn.zato.http_soap.data_table.new_row = function(item, data, include_tr) {
 		merge_url_params_req_tr += String.format('<td class="ignore">{0}</td>', merge_url_params_req);
 		url_params_pri_tr += String.format('<td class="ignore">{0}</td>', item.url_params_pri);
 		params_pri_tr += String.format('<td class="ignore">{0}</td>', item.params_pri);
+		max_request_size_tr += String.format('<td class="ignore">{0}</td>', item.max_request_size ? item.max_request_size : '');
+		stream_request_tr += String.format('<td class="ignore">{0}</td>', stream_request);
 		
     }
     
@@ -107,6 +112,8 @@ $.fn.zato.http_soap.data_table.new_row = function(item, data, include_tr) {
 		row += merge_url_params_req_tr;
 		row += url_params_pri_tr;
 		row += params_pri_tr;
+		row += max_request_size_tr;
+		row += stream_request_tr;
 	}
 
     if(include_tr) {
@@ -23,7 +23,8 @@ $(document).ready(function() {
     $.fn.zato.data_table.parse();
     $.fn.zato.data_table.setup_forms(['name', 'target', 'target_type', 'short_def', 'total_count', 
             'in_progress_count', 'in_doubt_count', 'confirmed_count', 'failed_count',
-            'last_updated', 'last_used', 'check_after', 'retry_repeats', 'retry_seconds', 'expire_after',
+            'last_updated', 'last_used', 'check_after', 'retry_repeats', 'retry_seconds', 'retry_backoff',
+            'retry_max_seconds', 'expire_after',
             'expire_arch_succ_after', 'expire_arch_fail_after']);
 
     $("#look-up-task").click($.fn.zato.pattern.look_up_task);
@@ -35,6 +35,8 @@ class CreateForm(DataFormatForm):
     merge_url_params_req = forms.BooleanField(required=False, widget=forms.CheckboxInput(attrs={'checked':'checked'}))
     url_params_pri = forms.ChoiceField(widget=forms.Select())
     params_pri = forms.ChoiceField(widget=forms.Select())
+    max_request_size = forms.CharField(required=False, widget=forms.TextInput(attrs={'style':'width:20%'}))
+    stream_request = forms.BooleanField(required=False, widget=forms.CheckboxInput())
     method = forms.CharField(widget=forms.TextInput(attrs={'style':'width:20%'}))
     soap_action = forms.CharField(widget=forms.TextInput(attrs={'style':'width:100%'}))
     soap_version = forms.ChoiceField(widget=forms.Select())
@@ -14,7 +14,7 @@ from django import forms
 
 # Zato
 from zato.admin.web.forms import INITIAL_CHOICES_DICT
-from zato.common import DEFAULT_DELIVERY_INSTANCE_LIST_BATCH_NO, DEFAULT_DELIVERY_INSTANCE_LIST_BATCH_SIZE, INVOCATION_TARGET
+from zato.common import DEFAULT_DELIVERY_INSTANCE_LIST_BATCH_SIZE, INVOCATION_TARGET
 
 # It's a pity these have to be repeated here in addition to what is in zato.admin.web
 # but here the names are shorter.
@@ -45,6 +45,8 @@ class CreateForm(forms.Form):
     check_after = forms.CharField(widget=forms.TextInput(attrs={'class':'validate-digits', 'style':'width:18%'}))
     retry_repeats = forms.CharField(initial=5, widget=forms.TextInput(attrs={'class':'validate-digits', 'style':'width:12%'}))
     retry_seconds = forms.CharField(initial=600, widget=forms.TextInput(attrs={'class':'validate-digits', 'style':'width:18%'}))
+    retry_backoff = forms.CharField(initial=1, required=False, widget=forms.TextInput(attrs={'style':'width:12%'}))
+    retry_max_seconds = forms.CharField(required=False, widget=forms.TextInput(attrs={'style':'width:18%'}))
     
     expire_after = forms.CharField(widget=forms.TextInput(attrs={'class':'validate-digits', 'style':'width:18%'}))
     expire_arch_succ_after = forms.CharField(initial=72, widget=forms.TextInput(attrs={'class':'validate-digits', 'style':'width:12%'}))
@@ -60,5 +62,4 @@ class InstanceListForm(forms.Form):
     """
     start = forms.CharField(widget=forms.TextInput(attrs={'style':'width:150px; height:19px'}))
     stop = forms.CharField(widget=forms.TextInput(attrs={'style':'width:150px; height:19px'}))
-    current_batch = forms.CharField(initial=DEFAULT_DELIVERY_INSTANCE_LIST_BATCH_NO, widget=forms.TextInput(attrs={'style':'width:50px; height:19px'}))
     batch_size = forms.CharField(initial=DEFAULT_DELIVERY_INSTANCE_LIST_BATCH_SIZE, widget=forms.TextInput(attrs={'style':'width:50px; height:19px'}))
@@ -38,8 +38,12 @@ def bunchget(obj, args):
 # Taken from http://stackoverflow.com/a/16609498
 
 @register.simple_tag
-def url_replace(request, field, value):
+def url_replace(request, field, value, drop=None):
     dict_ = request.GET.copy()
     dict_[field] = value
+    
+    # So that a parameter conflicting with the new one isn't sent along
+    if drop:
+        dict_.pop(drop, None)
 
     return dict_.urlencode()
\ No newline at end of file
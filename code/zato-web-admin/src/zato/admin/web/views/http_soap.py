@@ -68,6 +68,8 @@ def _get_edit_create_message(params, prefix=''):
         '': bool(params.get(prefix + 'merge_url_params_req')),
         'url_params_pri': params.get(prefix + 'url_params_pri', URL_PARAMS_PRIORITY.DEFAULT),
         'params_pri': params.get(prefix + 'params_pri', PARAMS_PRIORITY.DEFAULT),
+        'max_request_size': params.get(prefix + 'max_request_size'),
+        'stream_request': bool(params.get(prefix + 'stream_request')),
         'method': params.get(prefix + 'method'),
         'soap_action': params.get(prefix + 'soap_action', ''),
         'soap_version': params.get(prefix + 'soap_version', ''),
@@ -154,6 +156,7 @@ def index(req):
                     transport, item.host, item.url_path, item.method, item.soap_action,
                     item.soap_version, item.data_format, item.ping_method, 
                     item.pool_size, item.merge_url_params_req, item.url_params_pri, item.params_pri, 
+                    item.max_request_size, item.stream_request,
                     service_id=item.service_id, service_name=item.service_name,
                     security_id=security_id, security_name=security_name)
             items.append(item)
@@ -174,7 +174,7 @@ class Index(_Index):
     
     class SimpleIO(_Index.SimpleIO):
         input_required = ('def_name',)
-        input_optional = ('batch_size', 'current_batch', 'start', 'stop', 'state')
+        input_optional = ('batch_size', 'after', 'before', 'start', 'stop', 'state')
         output_required = ('def_name', 'target_type', 'task_id', 'creation_time_utc', 'last_used_utc', 
             'source_count', 'target_count', 'resubmit_count', 'retry_repeats', 'check_after', 'retry_seconds')
         output_repeated = True
@@ -192,7 +192,7 @@ class Index(_Index):
         out.update(get_js_dt_format(self.req.zato.user_profile))
         
         service = 'zato.pattern.delivery.get-batch-info'
-        req = {key:self.input[key] for key in ('def_name', 'batch_size', 'current_batch', 'start', 'stop', 'state') if self.input.get(key)}
+        req = {key:self.input[key] for key in ('def_name', 'batch_size', 'after', 'before', 'start', 'stop', 'state') if self.input.get(key)}
         response = self.req.zato.client.invoke(service, req)
         
         if response.ok:
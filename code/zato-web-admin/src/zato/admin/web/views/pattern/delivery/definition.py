@@ -39,6 +39,7 @@ class Index(_Index):
             'expire_after', 'expire_arch_succ_after', 'expire_arch_fail_after', 'check_after', 
             'retry_repeats', 'retry_seconds', 'short_def', 'total_count', 
             'in_progress_count', 'in_doubt_count', 'confirmed_count', 'failed_count')
+        output_optional = ('retry_backoff', 'retry_max_seconds')
         output_repeated = True
         
     def on_before_append_item(self, item):
@@ -70,6 +71,7 @@ class _CreateEdit(CreateEdit):
         input_required = ['name', 'target', 'target_type', 'expire_after',
             'expire_arch_succ_after', 'expire_arch_fail_after', 'check_after', 
             'retry_repeats', 'retry_seconds', 'callback_list']
+        input_optional = ['retry_backoff', 'retry_max_seconds']
         output_required = ['id', 'name', 'target', 'short_def']
         
     def __call__(self, req, initial_input_dict={}, initial_return_data={}, *args, **kwargs):
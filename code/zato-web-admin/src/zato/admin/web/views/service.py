@@ -204,7 +204,8 @@ def overview(req, service_name):
             
             for name in('id', 'name', 'is_active', 'impl_name', 'is_internal', 
                   'usage', 'time_last', 'time_min_all_time', 'time_max_all_time', 
-                  'time_mean_all_time'):
+                  'time_mean_all_time', 'time_queue_p50', 'time_queue_p99', 'time_queue_broker_p99',
+                  'time_queue_pool_p99'):
 
                 value = getattr(response.data, name)
                 if name in('is_active', 'is_internal'):